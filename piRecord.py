@@ -10,17 +10,29 @@
 
 # TODO: describe the hardware (i.e. user interface module used)
 
-import RPi.GPIO as GPIO
-import signal
 import time
+
+# time the program started, for the startup profile logged by main
+start_time = time.time()
+
+import signal
 import logging
 import piRecordConf
 import piRecordEngine
 import piRecordUtils
-import Adafruit_CharLCD as LCD    #library used to control the LCD module
+import piRecordSpectrum
+import piRecordProfile
+import piRecordTelemetry
+import piRecordLog
+import piRecordWatchdog
+import piRecordHardware    #provides the library used to control the LCD module
 import os
 import errno
 
+# the offloader's controls, imported by main only if offload is enabled, as
+# the module brings in the copy and checksum code the UI doesn't otherwise use
+piRecordOffload = None
+
 # Recorder states
 IDLE_STATE = 0
 BUSY_STATE = 1
@@ -48,12 +60,30 @@ REC_IN_PROG=REC_STANDBY+1
 REC_ERROR=REC_IN_PROG+1
 REC_AUDITION=REC_ERROR+1
 
+# playback submodes
+PLY_START=INIT_SUBMODE
+PLY_SEL=TOP_SUBMODE
+PLY_PLAYING=PLY_SEL+1
+PLY_ERROR=PLY_PLAYING+1
+PLY_OVERDUB=PLY_ERROR+1
+
 # config submodes
 CFG_START=INIT_SUBMODE
 CFG_SEL_ITEM=TOP_SUBMODE
 CFG_CHANGE=CFG_SEL_ITEM+1
 CFG_ERROR=CFG_CHANGE+1
 
+# utility submodes
+UTL_START=INIT_SUBMODE
+UTL_SEL=TOP_SUBMODE
+UTL_RUNNING=UTL_SEL+1
+UTL_ERROR=UTL_RUNNING+1
+
+# utilities
+UTL_SPECTRUM = 0
+UTL_TUNER = 1
+UTL_LATENCY = 2
+
 # global variables to indicate current state and mode/submode of device
 running = True
 state = IDLE_STATE
@@ -61,6 +91,9 @@ run_mode = STARTUP_MODE
 submode = 0
 sleeping = False
 
+# set at startup if autoArm is configured, to start a take once ready
+auto_arm = False
+
 # fifo used to allow commands to be sent from command line.  
 # TODO (currently not working)
 fifo = None
@@ -86,10 +119,15 @@ mode_disp_list_short = ["SUP", "REC", "PLY", "CFG", "UTL"]
 # 2 dimensional list for the submodes defined for each mode
 submode_disp_list = [["---         ", "            ", "             ", "            ", "            "], 
                      ["---         ", "Standby...  ", "Rec in prog  ", "Rec Error   ", "Auditioning "], 
-                     ["---         ", "Sel file:   ", "Playing...   ", "Play Error  ", "            "], 
+                     ["---         ", "Sel file:   ", "Playing...   ", "Play Error  ", "Overdubbing "], 
                      ["---         ", "Sel item:   ", "Changing...  ", "Error       ", "            "],
                      ["---         ", "sel utility ", "Running...   ", "Error       ", "            "]] 
 
+# strings used to display the utilities when selecting one
+utility_disp_list = ["Spectrum        ",
+                     "Tuner           ",
+                     "Latency         "]
+
 # switch indices
 SEL_SW = 0
 UP_SW = 1
@@ -98,11 +136,13 @@ LEFT_SW = 3
 RIGHT_SW = 4
 NUM_SW = 5
 
-# object for controlling the LCD module object
-lcd = LCD.Adafruit_CharLCDPlate()
+# object for controlling the LCD module object (created by init_display, so
+# importing this module doesn't touch the hardware)
+lcd = None
 
-# lists to manage each switch, refereced by the switch indices above
-switch_list = [LCD.SELECT, LCD.UP, LCD.DOWN, LCD.LEFT, LCD.RIGHT]
+# lists to manage each switch, refereced by the switch indices above (the
+# buttons are filled in by init_display)
+switch_list = []
 switch_down_cnt = [0,0,0,0,0]
 switch_down = [False, False, False, False, False]
 switch_last = [False, False, False, False, False]
@@ -121,18 +161,26 @@ switch_last = [False, False, False, False, False]
 #   0
 ###############################################################################
 def graceful_exit():
+    piRecordLog.event("watchdog_stats", interval=0, **piRecordWatchdog.getStats())
+    piRecordWatchdog.stop()
+    if piRecordOffload != None:
+        piRecordOffload.stop()
     piRecordEngine.stop_process()  #stop the engine 
     logging.info(">> piRecord has exited gracefully.")
+    piRecordLog.event("log_stats", interval=0, **piRecordLog.getStats())
+    piRecordLog.stop()
 
-    # display goodbye message on terminal and on device
+    # display goodbye message on terminal and on device (unless the signal
+    # came before main set the display up)
     print ("goodbye.") 
-    lcd.clear()
-    lcd.message("goodbye!")
+    if lcd != None:
+        lcd.clear()
+        lcd.message("goodbye!")
 
-    # blank display after 3 seconds
-    time.sleep(3.0)
-    lcd.clear()
-    lcd.set_color(0,0,0)
+        # blank display after 3 seconds
+        time.sleep(3.0)
+        lcd.clear()
+        lcd.set_color(0,0,0)
 
     # TODO: close fifo
     # if fifo != None:
@@ -156,11 +204,6 @@ def handle_stop_signals(signum,frame):
     running = False
     graceful_exit()
     return 0
-   
-# register the signals used to stop the program.
-signal.signal(signal.SIGTERM, handle_stop_signals)
-signal.signal(signal.SIGHUP, handle_stop_signals)
-signal.signal(signal.SIGQUIT, handle_stop_signals)
 
 ###############################################################################
 # Function Name:
@@ -185,7 +228,9 @@ def process_command():
 # Function Name:
 #   process_sigusr
 # Description:
-#   processes user defined signals
+#   processes user defined signals: SIGUSR1 starts or stops the sampling
+#   profiler and SIGUSR2 writes a profile dump (see piRecordProfile), in
+#   this process and in the engine
 # Parameters:
 #   signum - the signal number
 #   frame - current stack frame
@@ -193,18 +238,67 @@ def process_command():
 #   0
 ###############################################################################
 def process_sigusr(signum,frame):
-    #TODO: find use for signals.  For now just test.
-    if (signum == signal.SIGUSR1):
-        print ("SIGUSR1 received")
-    elif (signum == signal.SIGUSR2):
-        print ("SIGUSR2 received")
+    if (signum == signal.SIGUSR1) or (signum == signal.SIGUSR2):
+        logging.info(piRecordProfile.handleSignal(signum, "ui", piRecordTelemetry.read))
+        piRecordEngine.signal_engine(signum)
     else:
         print ("signal received: ", signum)
     return 0
 
-# register user signals
-signal.signal(signal.SIGUSR1, process_sigusr)
-signal.signal(signal.SIGUSR2, process_sigusr)
+###############################################################################
+# Function Name:
+#   process_sighup
+# Description:
+#   handles SIGHUP (see piRecord.sh reload): piRecord.cfg is reloaded by the
+#   main loop, not in the handler, as the handler may interrupt it
+# Parameters:
+#   signum - the signal number
+#   frame - current stack frame
+# Return value: 
+#   0
+###############################################################################
+def process_sighup(signum,frame):
+    global reload_requested
+    reload_requested = True
+    return 0
+
+###############################################################################
+# Function Name:
+#   register_signals
+# Description:
+#   registers the signals used to stop the program, SIGHUP to reload the
+#   configuration, and the user signals.  Must be called from the main thread.
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def register_signals():
+    signal.signal(signal.SIGTERM, handle_stop_signals)
+    signal.signal(signal.SIGHUP, process_sighup)
+    signal.signal(signal.SIGQUIT, handle_stop_signals)
+    signal.signal(signal.SIGUSR1, process_sigusr)
+    signal.signal(signal.SIGUSR2, process_sigusr)
+    return 0
+
+###############################################################################
+# Function Name:
+#   init_display
+# Description:
+#   creates the LCD module object (and the switch list) if it hasn't been
+#   created yet.  The LCD library is first imported here.
+# Parameters:
+#   none
+# Return value:
+#   the LCD module object
+###############################################################################
+def init_display():
+    global lcd, switch_list
+    if lcd == None:
+        LCD = piRecordHardware.LCD
+        lcd = LCD.Adafruit_CharLCDPlate()
+        switch_list = [LCD.SELECT, LCD.UP, LCD.DOWN, LCD.LEFT, LCD.RIGHT]
+    return lcd
 
 ###############################################################################
 # Function Name:
@@ -396,7 +490,7 @@ def any_switch_pressed():
 #   the old if not)
 ###############################################################################
 def do_record_mode(submode):
-    global state
+    global state, auto_arm
 
     # initialize the new submode return value to the current submode.  If no 
     # change takes place then we will remain in the current submode.
@@ -413,7 +507,8 @@ def do_record_mode(submode):
     # if submode is STANDBY, then we monitor the record switch.  If pressed we
     # start recording and change submode to REC_IN_PROG
     elif submode == REC_STANDBY:
-        if switch_pressed(RIGHT_SW):
+        if switch_pressed(RIGHT_SW) or auto_arm:
+            auto_arm = False
             logging.info("recording started")
             if piRecordEngine.start_record():
                 new_submode = REC_IN_PROG
@@ -447,7 +542,16 @@ def do_record_mode(submode):
     # if submode is REC_IN_PROG, check if any switch was pressed and if so, 
     # stop the recording and change state to STOPPED 
     elif submode == REC_IN_PROG:
-        if any_switch_pressed():
+        # the take ends without a press if the engine failed and the watchdog
+        # couldn't restart it
+        if not piRecordEngine.is_recording():
+            logging.error("recording failed")
+            new_submode = REC_ERROR
+            state = ERROR_STATE
+            display_submode(RECORD_MODE,REC_ERROR)
+            lcd.set_cursor(0,1)
+            lcd.message("Any Btn to clear")
+        elif any_switch_pressed():
             logging.info("recording stopped")
             piRecordEngine.stop_record()
             new_submode = REC_STOPPED
@@ -470,6 +574,12 @@ def do_record_mode(submode):
     # return the new submode (which could be current submode, i.e. no change)
     return new_submode
 
+# global takes listed, selected take, files playing and the position shown
+playTakes = []
+playTakeCnt = 0
+playList = []
+playShown = None
+
 ###############################################################################
 # Function Name:
 #   do_playback_mode
@@ -481,25 +591,292 @@ def do_record_mode(submode):
 #   new submode - the new submode
 ###############################################################################
 def do_playback_mode(submode):
+    global state, playTakes, playTakeCnt, playList, playShown
+
+    # initialize return value to current submode
     new_submode = submode
-    #TODO: add play logic
+
+    # handle the START submode: list the takes and show the newest
+    if submode == PLY_START:
+        playTakes = piRecordUtils.getTakes(piRecordConf.outputDir)
+        playTakeCnt = len(playTakes) - 1
+        new_submode = PLY_SEL
+        display_mode(PLAYBACK_MODE,PLY_SEL)
+        lcd.set_cursor(0,1)
+        lcd.message(get_take_name(playTakes[playTakeCnt][0]).ljust(16) if playTakes else "No recordings   ")
+
+    # handle the SELECT submode: up/down cycle through the takes, the right
+    # button plays the selected take and the takes after it, and the left
+    # button records a new take along with the selected one (overdub)
+    elif submode == PLY_SEL:
+        if playTakes and switch_pressed(UP_SW):
+            playTakeCnt = (playTakeCnt + 1) % len(playTakes)
+            lcd.set_cursor(0,1)
+            lcd.message(get_take_name(playTakes[playTakeCnt][0]).ljust(16))
+        elif playTakes and switch_pressed(DOWN_SW):
+            playTakeCnt = (playTakeCnt - 1) % len(playTakes)
+            lcd.set_cursor(0,1)
+            lcd.message(get_take_name(playTakes[playTakeCnt][0]).ljust(16))
+        elif playTakes and switch_pressed(RIGHT_SW):
+            playList = [fn for take in playTakes[playTakeCnt:] for fn in take]
+            logging.info("playback started: %s", playList[0])
+            piRecordEngine.start_playback(playList)
+            playShown = None
+            state = BUSY_STATE
+            new_submode = PLY_PLAYING
+            display_submode(PLAYBACK_MODE,PLY_PLAYING)
+        elif playTakes and switch_pressed(LEFT_SW):
+            playList = playTakes[playTakeCnt]
+            logging.info("overdub started: %s", playList[0])
+            playShown = None
+            if piRecordEngine.start_record(backing=playList):
+                state = BUSY_STATE
+                new_submode = PLY_OVERDUB
+                display_submode(PLAYBACK_MODE,PLY_OVERDUB)
+                lcd.set_cursor(0,1)
+                lcd.message("Any Btn to stop ")
+            else:
+                piRecordEngine.stop_record()
+                state = ERROR_STATE
+                new_submode = PLY_ERROR
+                display_submode(PLAYBACK_MODE,PLY_ERROR)
+                lcd.set_cursor(0,1)
+                lcd.message("Any Btn to clear")
+
+    # handle the PLAYING submode: left/right skip back/ahead, up/down go to
+    # the next/previous cue point and select stops.  The position is shown
+    # as it changes.
+    elif submode == PLY_PLAYING:
+        play_state, index, pos, length = piRecordEngine.get_playback()
+        if play_state == piRecordEngine.PLAY_ERROR:
+            logging.error("playback failed")
+            state = ERROR_STATE
+            new_submode = PLY_ERROR
+            display_submode(PLAYBACK_MODE,PLY_ERROR)
+            lcd.set_cursor(0,1)
+            lcd.message("Any Btn to clear")
+        elif play_state == piRecordEngine.PLAY_STOPPED or switch_pressed(SEL_SW):
+            logging.info("playback stopped")
+            piRecordEngine.stop_playback()
+            state = IDLE_STATE
+            new_submode = PLY_START
+        elif switch_pressed(LEFT_SW):
+            piRecordEngine.seek_playback(-piRecordConf.playbackSkipSecs)
+        elif switch_pressed(RIGHT_SW):
+            piRecordEngine.seek_playback(piRecordConf.playbackSkipSecs)
+        elif switch_pressed(UP_SW):
+            piRecordEngine.cue_playback(1)
+        elif switch_pressed(DOWN_SW):
+            piRecordEngine.cue_playback(-1)
+        elif play_state == piRecordEngine.PLAY_PLAYING and (index, int(pos)) != playShown:
+            playShown = (index, int(pos))
+            lcd.set_cursor(0,1)
+            lcd.message(("%d:%02d %s" % (pos // 60, pos % 60, get_take_name(playList[index])))[:16].ljust(16))
+
+    # handle the OVERDUB submode: any button stops the take.  The position in
+    # the backing take is shown as it changes; if it couldn't be played, the
+    # take goes on without it.
+    elif submode == PLY_OVERDUB:
+        play_state, index, pos, length = piRecordEngine.get_playback()
+        if not piRecordEngine.is_recording():
+            logging.error("overdub failed")
+            state = ERROR_STATE
+            new_submode = PLY_ERROR
+            display_submode(PLAYBACK_MODE,PLY_ERROR)
+            lcd.set_cursor(0,1)
+            lcd.message("Any Btn to clear")
+        elif any_switch_pressed():
+            logging.info("overdub stopped")
+            piRecordEngine.stop_record()
+            state = IDLE_STATE
+            new_submode = PLY_START
+        elif play_state == piRecordEngine.PLAY_ERROR and playShown != play_state:
+            playShown = play_state
+            lcd.set_cursor(0,1)
+            lcd.message("No backing take ")
+        elif play_state == piRecordEngine.PLAY_PLAYING and (index, int(pos)) != playShown:
+            playShown = (index, int(pos))
+            lcd.set_cursor(0,1)
+            lcd.message(("%d:%02d %s" % (pos // 60, pos % 60, get_take_name(playList[index])))[:16].ljust(16))
+
+    # handle the ERROR submode: any button clears the error
+    elif submode == PLY_ERROR:
+        if any_switch_pressed():
+            logging.info("play err cleared")
+            state = IDLE_STATE
+            new_submode = PLY_START
+
     return new_submode
 
-# global config item count
+###############################################################################
+# Function Name:
+#   get_take_name
+# Description:
+#   returns the name of a take's file as shown on the LCD screen: without
+#   its directory and extension, and cut to the right (the end of the name,
+#   e.g. the time and part number, differs most between takes)
+# Parameters:
+#   filename - the take's file
+# Return value:
+#   the name, at most 10 characters
+###############################################################################
+def get_take_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0][-10:]
+
+# global config item count, the items' values being edited, and the change
+# being applied by the engine: (number, settings to apply once it has, items
+# edited from the keypad or None)
 cfgItemCnt = 0
+cfgValues = {}
+cfgApply = None
+
+# set by SIGHUP, to reload piRecord.cfg from the main loop
+reload_requested = False
+
+###############################################################################
+# Function Name:
+#   show_config_item
+# Description:
+#   shows the selected CONFIG mode item and the value it is being set to on
+#   the second line, marked with a "*" if it differs from the current value
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def show_config_item():
+    item = piRecordConf.cfgItemDispList[cfgItemCnt]
+    value = cfgValues[item]
+    text = "%s: %s" % (item, piRecordConf.formatCfgItem(item, value))
+    if value != piRecordConf.getCfgItems()[item]:
+        text += "*"
+    lcd.set_cursor(0,1)
+    lcd.message(text[:16].ljust(16))
+    return 0
+
+###############################################################################
+# Function Name:
+#   change_config_value
+# Description:
+#   steps the selected CONFIG mode item to the next or previous value the
+#   device accepts.  A new format also gets a sample width that fits it.
+# Parameters:
+#   step - 1 for the next value, -1 for the previous one
+# Return value:
+#   0
+###############################################################################
+def change_config_value(step):
+    item = piRecordConf.cfgItemDispList[cfgItemCnt]
+    choices = piRecordConf.getCfgItemChoices(item, cfgValues)
+    cfgValues[item] = choices[(choices.index(cfgValues[item]) + step) % len(choices)]
+    if item == "Fmt":
+        widths = piRecordConf.getFormatWidths(cfgValues["Fmt"])
+        if widths and cfgValues["Wid"] not in widths:
+            cfgValues["Wid"] = widths[0]
+    return 0
+
+###############################################################################
+# Function Name:
+#   send_config
+# Description:
+#   passes changed settings to the engine, which applies them between
+#   takes.  check_config_change follows the change up; until the engine has
+#   applied it, the UI keeps the settings the take in progress was started
+#   with.
+# Parameters:
+#   settings - the settings to apply, as piRecordConf.getSettings returns them
+#   values - the CONFIG mode items to save to piRecord.cfg once applied,
+#     else None
+# Return value:
+#   0
+###############################################################################
+def send_config(settings, values):
+    global cfgApply
+    old = piRecordConf.getSettings()
+    seq = piRecordEngine.apply_config(settings)
+    cfgApply = (seq, settings, values)
+    changed = sorted(name for name, value in settings.items() if old.get(name) != value)
+    logging.info("config change %d sent: %s", seq, ", ".join(changed))
+    return 0
+
+###############################################################################
+# Function Name:
+#   check_config_change
+# Description:
+#   checks on the configuration change sent to the engine, if any.  Once it
+#   is applied, the UI applies it too and keypad changes are saved to
+#   piRecord.cfg; if the engine failed to apply it, the settings are left as
+#   they were.
+# Parameters:
+#   none
+# Return value:
+#   piRecordEngine.CONFIG_PENDING, CONFIG_APPLIED or CONFIG_FAILED, else
+#   None if no change was sent
+###############################################################################
+def check_config_change():
+    global cfgApply
+    if cfgApply == None:
+        return None
+    seq, settings, values = cfgApply
+    status = piRecordEngine.get_config_status(seq)
+    if status == piRecordEngine.CONFIG_PENDING:
+        return status
+    cfgApply = None
+    if status == piRecordEngine.CONFIG_APPLIED:
+        logging.info("config change %d applied", seq)
+        piRecordConf.setSettings(settings)
+        if values != None:
+            piRecordConf.saveCfgItems(values)
+    else:
+        logging.error("config change %d failed, settings not changed", seq)
+    return status
+
+###############################################################################
+# Function Name:
+#   reload_config
+# Description:
+#   reloads piRecord.cfg (see piRecordConf.reloadConfig) and sends the
+#   changed settings to the engine.  Settings only read at startup (see
+#   piRecordConf.RESTART_PREFIXES) are logged as needing a restart and keep
+#   their values until then.
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def reload_config():
+    global reload_requested
+    reload_requested = False
+    settings, error = piRecordConf.reloadConfig()
+    if error != None:
+        logging.error("config not reloaded: %s", error)
+        return 0
+    old = piRecordConf.getSettings()
+    changed = sorted(name for name, value in settings.items() if old.get(name) != value)
+    restart = [name for name in changed if name.startswith(piRecordConf.RESTART_PREFIXES)]
+    if restart:
+        logging.warning("config reloaded, restart piRecord to apply: %s", ", ".join(restart))
+        settings.update((name, old[name]) for name in restart)
+    if len(restart) == len(changed):
+        logging.info("config reloaded, no changes to apply")
+        return 0
+    send_config(settings, None)
+    return 0
 
 ###############################################################################
 # Function Name:
 #   do_config_mode 
 # Description:
-#   the handler for the CONFIG operation mode
+#   the handler for the CONFIG operation mode.  Up/down select an item,
+#   left/right step through the values the device accepts, and select
+#   applies the changes, which the engine does between takes.
 # Parameters:
 #   submode - the current submode
 # Return value: 
 #   new submode - the new submode
 ###############################################################################
 def do_config_mode(submode):
-    global cfgItemCnt
+    global state, cfgItemCnt, cfgValues
 
     # initialize return value to current submode
     new_submode = submode
@@ -510,69 +887,167 @@ def do_config_mode(submode):
         new_submode = CFG_SEL_ITEM
         display_submode(CONFIG_MODE,CFG_SEL_ITEM)
         cfgItemCnt = 0
-        lcd.set_cursor(0,1)
-        lcd.message("                    ")
-        lcd.set_cursor(0,1)
-        lcd.message(piRecordConf.cfgItemDispList[cfgItemCnt]);
-        #TOD show setting value
+        cfgValues = piRecordConf.getCfgItems()
+        show_config_item()
 
     # handle the SELECT ITEM submode:
     elif submode == CFG_SEL_ITEM:
         
         # if up/down button pressed, cycle through settings
         if switch_pressed(UP_SW):
-            if cfgItemCnt == len(piRecordConf.cfgItemDispList)-1:
-                cfgItemCnt = 0
-            else:
-                cfgItemCnt += 1
-            lcd.set_cursor(0,1)
-            lcd.message(piRecordConf.cfgItemDispList[cfgItemCnt]);
-            #TODO show setting
+            cfgItemCnt = (cfgItemCnt + 1) % len(piRecordConf.cfgItemDispList)
+            show_config_item()
         elif switch_pressed(DOWN_SW):
-            if cfgItemCnt == 0:
-                cfgItemCnt = len(piRecordConf.cfgItemDispList)-1
-            else:
-                cfgItemCnt -= 1
-            lcd.set_cursor(0,1)
-            lcd.message(piRecordConf.cfgItemDispList[cfgItemCnt]);
-            #TODO: show setting
+            cfgItemCnt = (cfgItemCnt - 1) % len(piRecordConf.cfgItemDispList)
+            show_config_item()
 
         #if left/right switch pressed, cycle through values for current setting
-        #elif switch_pressed(LEFT_SW):
-            #TODO decr setting value
-        #elif switch_pressed(RIGHT_SW):
-            #TODO incr setting value
-
-        #if select switch pressed, enter CHANGE submode
+        elif switch_pressed(LEFT_SW):
+            change_config_value(-1)
+            show_config_item()
+        elif switch_pressed(RIGHT_SW):
+            change_config_value(1)
+            show_config_item()
+
+        #if select switch pressed, check the changes and pass them to the engine
+        #(unless a reload is still being applied)
         elif switch_pressed(SEL_SW):
-            new_submode = CFG_CHANGE
-            display_submode(CONFIG_MODE,CFG_CHANGE)
-
-    #handle the CHANGE ITEM submode
+            if cfgApply == None and cfgValues != piRecordConf.getCfgItems():
+                old = piRecordConf.getSettings()
+                piRecordConf.setCfgItems(cfgValues)
+                error = piRecordConf.checkRecConfig()
+                settings = piRecordConf.getSettings()
+                piRecordConf.setSettings(old)
+                if error != None:
+                    logging.error("config change refused: %s", error)
+                    new_submode = CFG_ERROR
+                    display_submode(CONFIG_MODE,CFG_ERROR)
+                    lcd.set_cursor(0,1)
+                    lcd.message(error[:16].ljust(16))
+                else:
+                    send_config(settings, dict(cfgValues))
+                    state = BUSY_STATE
+                    new_submode = CFG_CHANGE
+                    display_submode(CONFIG_MODE,CFG_CHANGE)
+                    lcd.set_cursor(0,1)
+                    lcd.message("Applying...     ")
+
+    #handle the CHANGE ITEM submode: wait for the engine to apply the changes
     elif submode == CFG_CHANGE:
-        #TODO: make the setting change
-        new_submode = CFG_SEL_ITEM
-        display_submode(CONFIG_MODE,CFG_SEL_ITEM)
-        lcd.set_cursor(0,1)
-        lcd.message("                    ")
-        lcd.set_cursor(0,1)
-        lcd.message(piRecordConf.cfgItemDispList[cfgItemCnt]);
-        #TODO: show setting value
+        status = check_config_change()
+        if status == piRecordEngine.CONFIG_APPLIED:
+            state = IDLE_STATE
+            new_submode = CFG_SEL_ITEM
+            display_submode(CONFIG_MODE,CFG_SEL_ITEM)
+            lcd.set_cursor(0,1)
+            lcd.message("Applied         ")
+        elif status != piRecordEngine.CONFIG_PENDING:
+            state = IDLE_STATE
+            cfgValues = piRecordConf.getCfgItems()
+            new_submode = CFG_ERROR
+            display_submode(CONFIG_MODE,CFG_ERROR)
+            lcd.set_cursor(0,1)
+            lcd.message("Device refused  ")
+
+    #handle the ERROR submode: any switch goes back to selecting items
+    elif submode == CFG_ERROR:
+        if any_switch_pressed():
+            new_submode = CFG_SEL_ITEM
+            display_submode(CONFIG_MODE,CFG_SEL_ITEM)
+            show_config_item()
     return new_submode
 
+# global selected utility and the last analysis result displayed
+utilityCnt = UTL_SPECTRUM
+utilitySeq = -1
+
 ###############################################################################
 # Function Name:
 #   do_utility_mode
 # Description:
-#   handleer for the UTILITY mode
+#   handleer for the UTILITY mode.  The utilities are the spectrum bar graph
+#   and the tuner, which show the engine's analysis of the live input, and
+#   the latency test (see piRecordOverdub), which needs a cable from the
+#   output to the input.
 # Parameters:
 #   submode - the current submode
 # Return value: 
 #   new_submode - the new submode
 ###############################################################################
 def do_utility_mode(submode):
+    global state, utilityCnt, utilitySeq
+
+    # initialize return value to current submode
     new_submode = submode
-    #TODO
+
+    # handle the START submode: show the selected utility
+    if submode == UTL_START:
+        new_submode = UTL_SEL
+        display_mode(UTIL_MODE,UTL_SEL)
+        lcd.set_cursor(0,1)
+        lcd.message(utility_disp_list[utilityCnt])
+
+    # handle the SELECT submode: up/down cycle through the utilities and the
+    # right button runs the selected one
+    elif submode == UTL_SEL:
+        if switch_pressed(UP_SW):
+            utilityCnt = (utilityCnt + 1) % len(utility_disp_list)
+            lcd.set_cursor(0,1)
+            lcd.message(utility_disp_list[utilityCnt])
+        elif switch_pressed(DOWN_SW):
+            utilityCnt = (utilityCnt - 1) % len(utility_disp_list)
+            lcd.set_cursor(0,1)
+            lcd.message(utility_disp_list[utilityCnt])
+        elif switch_pressed(RIGHT_SW):
+            logging.info("utility %d started", utilityCnt)
+            utilitySeq = -1
+            state = BUSY_STATE
+            new_submode = UTL_RUNNING
+            if utilityCnt == UTL_LATENCY:
+                piRecordEngine.measure_latency()
+                display_submode(UTIL_MODE,UTL_RUNNING)
+                lcd.set_cursor(0,1)
+                lcd.message("Measuring...    ")
+            else:
+                if utilityCnt == UTL_SPECTRUM:
+                    for i, pattern in enumerate(piRecordSpectrum.getBarChars()):
+                        lcd.create_char(i, pattern)
+                piRecordEngine.start_analysis()
+                lcd.clear()
+
+    # handle the RUNNING submode: the analysis results use the whole screen,
+    # redrawn when the engine has new ones; the latency is shown once
+    # measured.  Any button stops.
+    elif submode == UTL_RUNNING:
+        if any_switch_pressed():
+            logging.info("utility stopped")
+            if utilityCnt != UTL_LATENCY:
+                piRecordEngine.stop_analysis()
+            state = IDLE_STATE
+            new_submode = UTL_START
+            lcd.clear()
+        elif utilityCnt == UTL_LATENCY:
+            latency = piRecordEngine.get_latency()
+            if latency != utilitySeq and latency != piRecordEngine.LATENCY_TESTING:
+                utilitySeq = latency
+                lcd.set_cursor(0,1)
+                if latency >= 0:
+                    lcd.message(("%.2f ms" % (1000.0 * latency / piRecordConf.recRate)).ljust(16))
+                else:
+                    lcd.message("No click heard  ")
+        else:
+            result = piRecordEngine.get_analysis()
+            if result[piRecordSpectrum.RESULT_SEQ] != utilitySeq:
+                utilitySeq = result[piRecordSpectrum.RESULT_SEQ]
+                if utilityCnt == UTL_SPECTRUM:
+                    top, bottom = piRecordSpectrum.renderBars(result[piRecordSpectrum.RESULT_BANDS:])
+                else:
+                    top, bottom = piRecordSpectrum.renderTuner(result[piRecordSpectrum.RESULT_FREQ])
+                lcd.set_cursor(0,0)
+                lcd.message(top)
+                lcd.set_cursor(0,1)
+                lcd.message(bottom)
+
     return new_submode
 
 ###############################################################################
@@ -613,15 +1088,44 @@ def wake_up():
 
 ###############################################################################
 # Function Name:
-#   __main__  
+#   log_startup
+# Description:
+#   logs the time to ready (since the process started, which includes the
+#   interpreter's own startup, and since boot) and the time each startup
+#   phase took
+# Parameters:
+#   phases - list of (phase name, time it finished)
+# Return value:
+#   0
+###############################################################################
+def log_startup(phases):
+    parts = []
+    last = start_time
+    for name, finished in phases:
+        parts.append("%s %.2f s" % (name, finished - last))
+        last = finished
+    age = piRecordUtils.getProcessAge()
+    uptime = piRecordUtils.getUptime()
+    msg = "ready %.2f s after start" % (age if age != None else time.time() - start_time)
+    if uptime != None:
+        msg += ", %.1f s after boot" % uptime
+    logging.info("%s (%s)", msg, ", ".join(parts))
+    print (msg, "(" + ", ".join(parts) + ")")
+    return 0
+
+###############################################################################
+# Function Name:
+#   main
 # Description:
-#   The main loop for the PiRecord program
+#   The main loop for the PiRecord program.  It runs until the program is
+#   stopped; piRecordScenario runs it in a thread with simulated hardware.
 # Parameters:
 #   none
 # Return value: 
 #   none
 ###############################################################################
-if __name__ == "__main__":
+def main():
+    global submode, auto_arm, piRecordOffload
     cnt = 0
     test_cnt = 0
     select_mode = STARTUP_MODE
@@ -629,22 +1133,41 @@ if __name__ == "__main__":
     # display copyright info on terminal and LCD display
     print ("piRecord 0.1")
     print ("Copyright 2019 by John Hnatt.  All rights reserved")
+    startup = [("imports", time.time())]
+
+    # load the configuration, and start the log writer it configures
+    piRecordConf.getRecDevConfig()
+    log_queue = piRecordLog.start(piRecordConf.logFile, piRecordConf.logLevel, piRecordConf.logFormat,
+                                  piRecordConf.logMaxBytes, piRecordConf.logBackups, piRecordConf.logQueueSize)
     logging.info(" ")
     logging.info("***** piRecord has started *****")    
+    startup.append(("config", time.time()))
 
+    # the splash screen stays up while the engine starts
+    init_display()
     lcd.set_color(1,0,0)
     lcd.message("piRecord 0.1\n")
     lcd.message("(c) 2019 J Hnatt")
-    time.sleep(2.0)
-    lcd.clear()
-
-    # display the configuration on the terminal
-    piRecordConf.getRecDevConfig()
     piRecordConf.printConfig()
+    startup.append(("display", time.time()))
 
-    # get configuration settings
-    debounce_time = piRecordConf.swDebounceTime;
-    idle_seconds = piRecordConf.idleSeconds;
+    # start the engine with the configuration just loaded
+    status = piRecordEngine.start_process(log_queue)
+    if status == None:
+        logging.error("engine did not start")
+    else:
+        logging.info("engine ready: pid %d, started in %.2f s, RSS ui %.1f MB engine %.1f MB",
+                     status["pid"], status["startSecs"], status["uiRssMB"] or 0.0, status["engineRssMB"] or 0.0)
+        if status["configMismatch"]:
+            logging.warning("engine settings differ from the UI: %s", ", ".join(status["configMismatch"]))
+        auto_arm = piRecordConf.autoArm
+        if piRecordConf.watchdogEnabled:
+            piRecordWatchdog.start(piRecordConf.watchdogTimeout, piRecordConf.watchdogMaxRestarts)
+    if piRecordConf.offloadEnabled:
+        import piRecordOffload
+        piRecordOffload.start()
+    startup.append(("engine", time.time()))
+    lcd.clear()
 
     # initialize local variables
     change_mode_in_prog = False
@@ -664,11 +1187,22 @@ if __name__ == "__main__":
  
     # initialize mode to RECORD MODE
     set_mode(RECORD_MODE)
+    startup.append(("mode", time.time()))
+    log_startup(startup)
 
     try:
         # MAIN LOOP:
         while running:
 
+            # apply a reload (once any change being applied is done), and get
+            # configuration settings, which it may have changed
+            if reload_requested and cfgApply == None:
+                reload_config()
+            if not (run_mode == CONFIG_MODE and submode == CFG_CHANGE):
+                check_config_change()
+            debounce_time = piRecordConf.swDebounceTime
+            idle_seconds = piRecordConf.idleSeconds
+
             cnt += debounce_time
             test_cnt += 1
             time.sleep(debounce_time) # sleep to debounce
@@ -755,3 +1289,13 @@ if __name__ == "__main__":
     except KeyboardInterrupt: 
     # If CTRL+C is pressed, exit cleanly
         graceful_exit()
+
+###############################################################################
+# Function Name:
+#   __main__  
+# Description:
+#   runs the PiRecord program
+###############################################################################
+if __name__ == "__main__":
+    register_signals()
+    main()
@@ -17,12 +17,22 @@ CFGFILE="$PROGDIR/piRecord.cfg"
 LOGFILE="$PROGDIR/piRecord.log"
 PROGFILE="$PROGDIR/piRecord.py"
 CFGPROGFILE="$PROGDIR/piRecordConf.py"
+BATCHPROGFILE="$PROGDIR/piRecordBatch.py"
+LOUDPROGFILE="$PROGDIR/piRecordLoudness.py"
+TELEPROGFILE="$PROGDIR/piRecordTelemetry.py"
+SCENPROGFILE="$PROGDIR/piRecordScenario.py"
+SOAKPROGFILE="$PROGDIR/piRecordSoak.py"
+OFFLOADPROGFILE="$PROGDIR/piRecordOffload.py"
+TRIMPROGFILE="$PROGDIR/piRecordTrim.py"
+CHECKPROGFILE="$PROGDIR/piRecordCheck.py"
+PLAYPROGFILE="$PROGDIR/piRecordPlayback.py"
+LATPROGFILE="$PROGDIR/piRecordOverdub.py"
 CURRFNFILE="$PROGDIR/.currfn"
 
 myPid=0
 usage()
 {
-    echo "USAGE: piRecord [start|stop|restart|status|config|listrecs|delrecs|showlog|clearlog|playback|help]"
+    echo "USAGE: piRecord [start|stop|restart|status|config|reload|listrecs|delrecs|showlog|clearlog|playback|batch|loudness|telemetry|scenario|soak|offload|trim|verify|latency|help]"
 }
 
 is_running()
@@ -47,8 +57,18 @@ start()
 stop()
 {
     if is_running; then
-        #TODO: ensure other python programs don't get killed
-        sudo pkill -SIGTERM python
+        # only the UI is signalled: it stops the engine (closing any take in
+        # progress) and the offloader itself
+        read -r myPid <.mypid
+        if [ $myPid != 0 ]; then
+            kill -SIGTERM $myPid
+            for i in $(seq 30); do
+                kill -0 $myPid 2>/dev/null || break
+                sleep 0.5
+            done
+        else
+            echo "invalid pid"
+        fi
         echo 0 >.mypid
     else
         echo "piRecord is already stopped."
@@ -77,6 +97,17 @@ config()
     python3 $CFGPROGFILE
 }
 
+reload()
+{
+    read -r myPid <.mypid
+    if [ $myPid != 0 ]; then
+        kill -SIGHUP $myPid
+        echo "piRecord is reloading $CFGFILE"
+    else
+        echo "invalid pid"
+    fi
+}
+
 listrecs()
 {
     ls -l $RECDIR
@@ -126,8 +157,61 @@ sendsig()
 
 playback()
 {
+    if [ $# -gt 0 ]; then
+        python3 $PLAYPROGFILE "$@"
+        return
+    fi
     read -r pbfile <$CURRFNFILE
-    aplay $pbfile
+    if [[ $pbfile == *.flac ]]; then
+        flac -d -c -s $pbfile | aplay
+    else
+        python3 $PLAYPROGFILE $pbfile
+    fi
+}
+
+batch()
+{
+    python3 $BATCHPROGFILE "$@"
+}
+
+loudness()
+{
+    python3 $LOUDPROGFILE "$@"
+}
+
+telemetry()
+{
+    python3 $TELEPROGFILE
+}
+
+scenario()
+{
+    python3 $SCENPROGFILE "$@"
+}
+
+soak()
+{
+    python3 $SOAKPROGFILE "$@"
+}
+
+offload()
+{
+    python3 $OFFLOADPROGFILE "$@"
+}
+
+trim()
+{
+    python3 $TRIMPROGFILE "$@"
+}
+
+verify()
+{
+    python3 $CHECKPROGFILE "$@"
+}
+
+latency()
+{
+    python3 $LATPROGFILE
 }
 
 help()
@@ -137,14 +221,25 @@ help()
     echo "start - starts the piRecord program"
     echo "stop - stops the piRecord program"
     echo "restart - stops the currently running piRecord program and restarts it"
-    echo "status - prints the run status of the piRecord program (running or stopped)""
+    echo "status - prints the run status of the piRecord program (running or stopped)"
     echo "config - lists the piRecord configuration"
+    echo "reload - applies the changes made to piRecord.cfg between takes, without a restart"
     echo "listrecs - lists the recording files in the recording directory"
     echo "delrecs - deletes all recordings in the recording directory"
     echo "showlog - shows the program logfile"
     echo "clearlog - clears the program logfile"
-    echo "playback - plays back the last file recorded"
-    echo "help - this menu
+    echo "sendsig 1|2 - SIGUSR1 starts/stops the profiler, SIGUSR2 writes a profile dump"
+    echo "playback [files] - plays back the last file recorded, or the wave files given without gaps between them"
+    echo "batch - processes the recordings (mixdown, normalize, resample, compress)"
+    echo "loudness - shows loudness, loudness range and true peak of the recordings"
+    echo "telemetry - shows the engine's latest status counters"
+    echo "scenario - runs a scenario on simulated hardware and reports its latencies"
+    echo "soak - records for hours of simulated time and checks for leaks and corrupt takes"
+    echo "offload - copies the finished takes to the offload drive, verifying each copy"
+    echo "trim - trims the silence before and after the music in the given recordings"
+    echo "verify - checks the recordings against their checksums and lists any damaged time ranges"
+    echo "latency - measures the round trip latency used to line up overdubs (connect the output to the input)"
+    echo "help - this menu"
 
 }
 
@@ -164,6 +259,9 @@ case $1 in
     config)
         config
         ;;
+    reload)
+        reload
+        ;;
     listrecs)
         listrecs
         ;;
@@ -181,7 +279,42 @@ case $1 in
         sendsig
         ;;
     playback)
-        playback
+        shift
+        playback "$@"
+        ;;
+    batch)
+        shift
+        batch "$@"
+        ;;
+    loudness)
+        shift
+        loudness "$@"
+        ;;
+    telemetry)
+        telemetry
+        ;;
+    scenario)
+        shift
+        scenario "$@"
+        ;;
+    soak)
+        shift
+        soak "$@"
+        ;;
+    offload)
+        shift
+        offload "$@"
+        ;;
+    trim)
+        shift
+        trim "$@"
+        ;;
+    verify)
+        shift
+        verify "$@"
+        ;;
+    latency)
+        latency
         ;;
     help)
         help
@@ -0,0 +1,456 @@
+###############################################################################
+# piRecordBatch.py - Raspberry Pi audio recorder batch processing module
+# Description:
+#   runs a chain of processing stages (mixdown, normalize, resample, compress)
+#   over every recording in the recordings directory.  Files are read in
+#   fixed size chunks so memory use doesn't depend on the length of a take,
+#   and are spread across a pool of worker processes, one per core.
+#   Finished files are recorded in a state file in the output directory so
+#   an interrupted run can be restarted, skipping files already processed.
+#   The batch runs at idle CPU and I/O priority and pauses while the engine
+#   is recording.
+###############################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+import numpy
+import piRecordConf
+import piRecordUtils
+import piRecordFormat
+import piRecordWave
+import piRecordDSP
+import piRecordCompress
+
+# names of the available stages, in the order they are normally run
+STAGE_NAMES = ["mixdown", "normalize", "resample", "compress"]
+
+# state file recording the files already processed
+STATE_FILE = ".batchstate"
+
+# seconds to wait between checks while a recording is in progress
+RECORDING_WAIT = 5.0
+
+###############################################################################
+# Class Name:
+#   GainStage
+# Description:
+#   applies a fixed gain.  Used by the normalize stage once the peak level of
+#   the file has been measured.
+###############################################################################
+class GainStage:
+
+    def __init__(self):
+        self.gain = numpy.float32(1.0)
+
+    def process(self, x):
+        return x * self.gain
+
+    def flush(self):
+        return None
+
+###############################################################################
+# Class Name:
+#   MixdownStage
+# Description:
+#   mixes any number of channels down to stereo.  Mono is copied to both
+#   sides; with more channels, even numbered channels go to the left and odd
+#   numbered channels to the right, each side scaled by its channel count.
+###############################################################################
+class MixdownStage:
+
+    def __init__(self, nchannels):
+        self.matrix = numpy.zeros((nchannels, 2), dtype=numpy.float32)
+        if nchannels == 1:
+            self.matrix[0, :] = 1.0
+        else:
+            self.matrix[0::2, 0] = 1.0 / len(range(0, nchannels, 2))
+            self.matrix[1::2, 1] = 1.0 / len(range(1, nchannels, 2))
+
+    def process(self, x):
+        return x @ self.matrix
+
+    def flush(self):
+        return None
+
+###############################################################################
+# Class Name:
+#   ResampleStage
+# Description:
+#   changes the sample rate with the streaming polyphase resampler
+###############################################################################
+class ResampleStage:
+
+    def __init__(self, inRate, outRate, nchannels):
+        self.resampler = piRecordDSP.Resampler(inRate, outRate, nchannels)
+
+    def process(self, x):
+        return self.resampler.process(x)
+
+    def flush(self):
+        return self.resampler.flush()
+
+###############################################################################
+# Function Name:
+#   buildStages
+# Description:
+#   creates the stage objects for a chain.  The compress stage isn't a signal
+#   stage; it selects the flac writer for the output.
+# Parameters:
+#   chain - list of stage names
+#   nchannels - number of channels in the input file
+#   rate - sample rate of the input file
+#   targetRate - sample rate produced by the resample stage
+# Return value:
+#   tuple of (list of (name, stage), output channels, output rate)
+###############################################################################
+def buildStages(chain, nchannels, rate, targetRate):
+    stages = []
+    for name in chain:
+        if name == "normalize":
+            stages.append((name, GainStage()))
+        elif name == "mixdown":
+            stages.append((name, MixdownStage(nchannels)))
+            nchannels = 2
+        elif name == "resample":
+            if rate != targetRate:
+                stages.append((name, ResampleStage(rate, targetRate, nchannels)))
+                rate = targetRate
+        elif name != "compress":
+            raise ValueError("unknown batch stage: %s" % name)
+    return (stages, nchannels, rate)
+
+###############################################################################
+# Function Name:
+#   runStages
+# Description:
+#   passes a block through a list of stages
+# Parameters:
+#   stages - list of (name, stage)
+#   x - block of samples, shape (frames, channels)
+# Return value:
+#   the processed block
+###############################################################################
+def runStages(stages, x):
+    for name, stage in stages:
+        x = stage.process(x)
+    return x
+
+###############################################################################
+# Function Name:
+#   flushStages
+# Description:
+#   ends the stream, passing the samples still held by each stage through
+#   the stages that follow it
+# Parameters:
+#   stages - list of (name, stage)
+# Return value:
+#   the remaining processed samples, else None if there are none
+###############################################################################
+def flushStages(stages):
+    tail = None
+    for name, stage in stages:
+        if tail is not None and len(tail):
+            tail = stage.process(tail)
+        rest = stage.flush()
+        if rest is not None and len(rest):
+            tail = rest if tail is None else numpy.concatenate((tail, rest))
+    return tail
+
+###############################################################################
+# Function Name:
+#   waitWhileRecording
+# Description:
+#   pauses a batch worker for as long as the engine is recording
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def waitWhileRecording():
+    while piRecordUtils.isRecording():
+        time.sleep(RECORDING_WAIT)
+    return 0
+
+###############################################################################
+# Function Name:
+#   readChunks
+# Description:
+#   generator returning a file's samples as float blocks of chunkFrames
+# Parameters:
+#   reader - the WaveReader for the file
+#   chunkFrames - frames per block
+# Return value:
+#   blocks of shape (frames, channels)
+###############################################################################
+def readChunks(reader, chunkFrames):
+    reader.setpos(0)
+    while True:
+        waitWhileRecording()
+        data = reader.readframes(chunkFrames)
+        if not data:
+            return
+        yield piRecordFormat.samplesToFloat(data, reader.getsampwidth(), reader.getformattag(), reader.getnchannels())
+
+###############################################################################
+# Function Name:
+#   measurePeak
+# Description:
+#   measures the peak level at the normalize stage, by running the stages
+#   before it over the whole file
+# Parameters:
+#   reader - the WaveReader for the file
+#   stages - the stages before the normalize stage
+#   chunkFrames - frames per block
+# Return value:
+#   the absolute peak sample value
+###############################################################################
+def measurePeak(reader, stages, chunkFrames):
+    peak = 0.0
+    for x in readChunks(reader, chunkFrames):
+        x = runStages(stages, x)
+        if len(x):
+            peak = max(peak, float(numpy.abs(x).max()))
+    tail = flushStages(stages)
+    if tail is not None and len(tail):
+        peak = max(peak, float(numpy.abs(tail).max()))
+    return peak
+
+###############################################################################
+# Function Name:
+#   processFile
+# Description:
+#   runs the chain over one file.  The output is written to a temporary file
+#   that replaces the final name only when complete, and is removed if
+#   anything fails.  Runs in a pool worker.
+# Parameters:
+#   job - tuple of (input file, output directory, chain, settings dict)
+# Return value:
+#   tuple of (input file, output file, elapsed seconds)
+###############################################################################
+def processFile(job):
+    inName, outDir, chain, settings = job
+    startTime = time.time()
+    reader = piRecordWave.WaveReader(inName)
+    writer = None
+    proc = None
+    tmpName = None
+    done = False
+    try:
+        sampWidth = reader.getsampwidth()
+        fmtTag = reader.getformattag()
+        stages, outChannels, outRate = buildStages(chain, reader.getnchannels(), reader.getframerate(), settings['targetRate'])
+
+        # measure the level the normalize stage sees and set its gain
+        names = [name for name, stage in stages]
+        if "normalize" in names:
+            pos = names.index("normalize")
+            peak = measurePeak(reader, buildStages(chain[:chain.index("normalize")], reader.getnchannels(),
+                                                   reader.getframerate(), settings['targetRate'])[0], settings['chunkFrames'])
+            if peak > 0.0:
+                stages[pos][1].gain = numpy.float32(10.0 ** (settings['normalizeLevel'] / 20.0) / peak)
+
+        # open the output, compressing if the format allows it
+        baseName = os.path.join(outDir, os.path.splitext(os.path.basename(inName))[0])
+        if "compress" in chain and shutil.which("flac") != None and fmtTag == piRecordFormat.WAVE_FORMAT_PCM and sampWidth <= 3:
+            outName = baseName + piRecordCompress.FLAC_EXT
+            tmpName = outName + ".part"
+            cmd = piRecordCompress.makeFlacCommand(tmpName, outChannels, sampWidth, outRate, settings['compressLevel'])
+            proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            write = proc.stdin.write
+        else:
+            outName = baseName + piRecordConf.fileTypeExt
+            tmpName = outName + ".part"
+            writer = piRecordWave.WaveWriter(tmpName, outChannels, sampWidth, outRate, fmtTag)
+            write = writer.writeframesraw
+
+        for x in readChunks(reader, settings['chunkFrames']):
+            x = runStages(stages, x)
+            if len(x):
+                write(piRecordFormat.floatToSamples(x, sampWidth, fmtTag))
+        tail = flushStages(stages)
+        if tail is not None and len(tail):
+            write(piRecordFormat.floatToSamples(tail, sampWidth, fmtTag))
+
+        if proc != None:
+            proc.stdin.close()
+            status = proc.wait()
+            proc = None
+            if status != 0:
+                raise RuntimeError("flac failed on %s" % inName)
+        else:
+            writer.close()
+            writer = None
+        os.replace(tmpName, outName)
+        done = True
+
+    # on an error, don't leave the output's process, file or temporary file behind
+    finally:
+        reader.close()
+        if proc != None:
+            proc.kill()
+            proc.wait()
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        if writer != None:
+            writer.close()
+        if not done and tmpName != None and os.path.exists(tmpName):
+            os.remove(tmpName)
+    return (inName, outName, time.time() - startTime)
+
+###############################################################################
+# Function Name:
+#   loadState
+# Description:
+#   reads the state file listing the files already processed.  Each entry
+#   holds the size and modification time of the input and the chain it was
+#   processed with.
+# Parameters:
+#   outDir - the output directory
+# Return value:
+#   dict of entries by file name (empty if there is no state file)
+###############################################################################
+def loadState(outDir):
+    try:
+        with open(os.path.join(outDir, STATE_FILE)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+###############################################################################
+# Function Name:
+#   saveState
+# Description:
+#   replaces the state file atomically, so an interrupted batch never leaves
+#   it half written
+# Parameters:
+#   outDir - the output directory
+#   state - dict of entries by file name
+# Return value:
+#   0
+###############################################################################
+def saveState(outDir, state):
+    fn = os.path.join(outDir, STATE_FILE)
+    with open(fn + ".tmp", "w") as fd:
+        json.dump(state, fd, indent=1)
+    os.replace(fn + ".tmp", fn)
+    return 0
+
+###############################################################################
+# Function Name:
+#   getFileKey
+# Description:
+#   returns the key used to tell whether a file changed since it was
+#   processed
+# Parameters:
+#   fn - the file name
+#   chain - list of stage names
+# Return value:
+#   the key
+###############################################################################
+def getFileKey(fn, chain):
+    st = os.stat(fn)
+    return {"size": st.st_size, "mtime": st.st_mtime, "chain": ",".join(chain)}
+
+###############################################################################
+# Function Name:
+#   setIdlePriority
+# Description:
+#   lowers the CPU and I/O priority of the batch (inherited by the workers)
+#   so that it never competes with a recording
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def setIdlePriority():
+    os.nice(19)
+    if shutil.which("ionice") != None:
+        subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())])
+    return 0
+
+###############################################################################
+# Function Name:
+#   runBatch
+# Description:
+#   processes every recording not already processed with the same chain
+# Parameters:
+#   files - list of input files
+#   outDir - the output directory
+#   chain - list of stage names
+#   jobs - number of worker processes
+#   force - True to reprocess files already processed
+# Return value:
+#   number of files that failed
+###############################################################################
+def runBatch(files, outDir, chain, jobs, force):
+    os.makedirs(outDir, exist_ok=True)
+    state = loadState(outDir)
+    settings = {'targetRate': piRecordConf.batchTargetRate,
+                'normalizeLevel': piRecordConf.batchNormalizeLevel,
+                'chunkFrames': piRecordConf.batchChunkFrames,
+                'compressLevel': piRecordConf.compressLevel}
+
+    todo = []
+    for fn in files:
+        name = os.path.basename(fn)
+        if piRecordUtils.isRecording() and os.path.abspath(fn) == os.path.abspath(piRecordUtils.getCurrentFilename()):
+            print ("skipping", name, "(recording in progress)")
+        elif piRecordUtils.isTrimPending(fn):
+            print ("skipping", name, "(being trimmed)")
+        elif not force and state.get(name) == getFileKey(fn, chain):
+            print ("skipping", name, "(already processed)")
+        else:
+            todo.append((fn, outDir, chain, settings))
+
+    failures = 0
+    with multiprocessing.Pool(processes=jobs) as pool:
+        results = pool.imap_unordered(processFile, todo)
+        for i in range(len(todo)):
+            try:
+                inName, outName, elapsed = results.next()
+            except Exception as err:
+                print ("batch error:", err)
+                failures += 1
+                continue
+            state[os.path.basename(inName)] = getFileKey(inName, chain)
+            saveState(outDir, state)
+            print ("processed", inName, "->", outName, "in %.1f s" % elapsed)
+    return failures
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   runs the batch from the command line (see piRecord.sh batch)
+###############################################################################
+if __name__ == "__main__":
+    piRecordConf.getRecDevConfig()
+
+    parser = argparse.ArgumentParser(description="process the recordings in " + piRecordConf.outputDir)
+    parser.add_argument("files", nargs="*", help="recordings to process (default: all)")
+    parser.add_argument("--chain", default=piRecordConf.batchChain,
+                        help="comma separated stages from: " + ",".join(STAGE_NAMES))
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="reprocess files already processed")
+    args = parser.parse_args()
+
+    chain = [name.strip() for name in args.chain.split(",") if name.strip()]
+    for name in chain:
+        if name not in STAGE_NAMES:
+            parser.error("unknown stage: " + name)
+
+    files = [fn if os.path.exists(fn) else os.path.join(piRecordConf.outputDir, fn) for fn in args.files]
+    if not files:
+        files = sorted(os.path.join(piRecordConf.outputDir, fn) for fn in os.listdir(piRecordConf.outputDir)
+                       if fn.endswith(piRecordConf.fileTypeExt))
+
+    setIdlePriority()
+    outDir = os.path.join(piRecordConf.outputDir, piRecordConf.batchOutputSubdir)
+    exit(1 if runBatch(files, outDir, chain, args.jobs, args.force) else 0)
@@ -0,0 +1,383 @@
+###############################################################################
+# piRecordCheck.py - Raspberry Pi audio recorder integrity check module
+# Description:
+#   lets old takes be checked for corruption (e.g. from a failing card).
+#   As a take is written, a CRC-32 of each block of blockBytes of its sample
+#   data is computed and appended to a sidecar file (the take's name plus
+#   .crc): a 24 byte header, then 4 bytes per block.  Blocks are counted
+#   from the absolute file offset where the data started (origin), so they
+#   stay put when the file is trimmed in place; each CRC covers the part of
+#   its block that is in the data chunk.
+#
+#   piRecord.sh verify reads the takes back in large sequential reads,
+#   split into segments across a pool of worker processes, and reports the
+#   time ranges whose blocks don't match.  Data past the last CRC (e.g.
+#   from a take the engine died in) is reported as unchecked.  Flac takes
+#   carry their own checksums and are tested with the flac decoder.
+###############################################################################
+
+import argparse
+import array
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import zlib
+
+# sidecar file suffix, header layout and version
+SIDECAR_SUFFIX = ".crc"
+SIDECAR_MAGIC = b'PRCK'
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = struct.Struct('<4sHHIQI')
+
+# blocks in a verify job, and read at a time
+SEGMENT_BLOCKS = 4096
+READ_BLOCKS = 64
+
+###############################################################################
+# Class Name:
+#   BlockChecksum
+# Description:
+#   computes the CRC of each block of sample data as it is written, and
+#   appends it to the sidecar as soon as the block is complete (so a take
+#   cut off by a crash keeps the CRCs of what was written)
+###############################################################################
+class BlockChecksum:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   creates the sidecar and writes its header
+    # Parameters:
+    #   filename - the take's file name
+    #   blockBytes - bytes per block
+    #   origin - file offset of the sample data
+    #   frameSize - bytes per frame
+    #   rate - sample rate
+    ###########################################################################
+    def __init__(self, filename, blockBytes, origin, frameSize, rate):
+        self.blockBytes = blockBytes
+        self.crc = 0
+        self.filled = 0
+        self.fd = os.open(getSidecarName(filename), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.write(self.fd, SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, frameSize, blockBytes, origin, rate))
+
+    ###########################################################################
+    # Method Name:
+    #   update
+    # Description:
+    #   adds sample data to the running CRC, writing the CRC of each block
+    #   completed
+    # Parameters:
+    #   data - the sample data written
+    # Return value:
+    #   none
+    ###########################################################################
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = min(len(view), self.blockBytes - self.filled)
+            self.crc = zlib.crc32(view[:n], self.crc)
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.blockBytes:
+                os.write(self.fd, struct.pack('<I', self.crc))
+                self.crc = 0
+                self.filled = 0
+
+    def close(self):
+        if self.fd == None:
+            return
+        if self.filled:
+            os.write(self.fd, struct.pack('<I', self.crc))
+        os.close(self.fd)
+        self.fd = None
+
+###############################################################################
+# Function Name:
+#   getSidecarName
+# Description:
+#   returns the name of a take's checksum sidecar
+# Parameters:
+#   filename - the take's file name
+# Return value:
+#   the sidecar's file name
+###############################################################################
+def getSidecarName(filename):
+    return filename + SIDECAR_SUFFIX
+
+###############################################################################
+# Function Name:
+#   readSidecar
+# Description:
+#   reads a take's checksum sidecar
+# Parameters:
+#   filename - the take's file name
+# Return value:
+#   dict of frameSize, blockBytes, origin, rate and crcs (an array), or None
+#   if the take has no sidecar
+###############################################################################
+def readSidecar(filename):
+    try:
+        with open(getSidecarName(filename), 'rb') as fd:
+            data = fd.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < SIDECAR_HEADER.size:
+        raise ValueError("checksum sidecar too short: %s" % filename)
+    magic, version, frameSize, blockBytes, origin, rate = SIDECAR_HEADER.unpack_from(data)
+    if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or blockBytes == 0:
+        raise ValueError("not a checksum sidecar: %s" % filename)
+    body = data[SIDECAR_HEADER.size:]
+    crcs = array.array('I', body[:len(body) - len(body) % 4])
+    if sys.byteorder != 'little':
+        crcs.byteswap()
+    return {"frameSize": frameSize, "blockBytes": blockBytes, "origin": origin, "rate": rate, "crcs": crcs}
+
+###############################################################################
+# Function Name:
+#   blockCrc
+# Description:
+#   computes the CRC of the part of a block in the data chunk
+# Parameters:
+#   fd - the take, open for reading
+#   start, end - the block's file offsets
+#   dataStart, dataEnd - the data chunk's file offsets
+# Return value:
+#   the CRC
+###############################################################################
+def blockCrc(fd, start, end, dataStart, dataEnd):
+    start, end = max(start, dataStart), min(end, dataEnd)
+    fd.seek(start)
+    return zlib.crc32(fd.read(max(0, end - start)))
+
+###############################################################################
+# Function Name:
+#   trimSidecar
+# Description:
+#   writes the sidecar for a take about to be trimmed to a new range of
+#   file offsets, as the sidecar's name plus .new (piRecordWave.completeTrim
+#   moves it into place once the trim is done).  Blocks wholly outside the
+#   range are dropped and the CRCs of the blocks at its ends recomputed for
+#   the part kept; if such a block didn't match before, its new CRC is made
+#   not to match either, so the damage is still reported.
+# Parameters:
+#   filename - the take's file name
+#   dataStart, dataEnd - the data chunk's current file offsets
+#   newStart, newEnd - the file offsets of the data kept
+# Return value:
+#   the new sidecar's name, or None if the take has no sidecar
+###############################################################################
+def trimSidecar(filename, dataStart, dataEnd, newStart, newEnd):
+    sidecar = readSidecar(filename)
+    if sidecar == None:
+        return None
+    blockBytes, origin, crcs = sidecar["blockBytes"], sidecar["origin"], sidecar["crcs"]
+    first = max(0, (newStart - origin) // blockBytes)
+    last = min(len(crcs), -(-(newEnd - origin) // blockBytes))
+    kept = array.array('I', crcs[first:last])
+    with open(filename, 'rb') as fd:
+        for i in sorted({first, last - 1}):
+            if i < first or i >= last:
+                continue
+            start = origin + i * blockBytes
+            end = start + blockBytes
+            crc = blockCrc(fd, start, end, newStart, newEnd)
+            if blockCrc(fd, start, end, dataStart, dataEnd) != crcs[i]:
+                crc ^= 0xFFFFFFFF
+            kept[i - first] = crc
+    if sys.byteorder != 'little':
+        kept.byteswap()
+    newName = getSidecarName(filename) + ".new"
+    with open(newName, 'wb') as fd:
+        fd.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, sidecar["frameSize"], blockBytes,
+                                     origin + first * blockBytes, sidecar["rate"]))
+        fd.write(kept.tobytes())
+        fd.flush()
+        os.fsync(fd.fileno())
+    return newName
+
+###############################################################################
+# Function Name:
+#   verifySegment
+# Description:
+#   checks a run of a take's blocks against their CRCs (a worker job)
+# Parameters:
+#   job - (filename, data start, data end, sidecar, first block, end block)
+# Return value:
+#   (filename, list of the indexes of the blocks that don't match)
+###############################################################################
+def verifySegment(job):
+    filename, dataStart, dataEnd, sidecar, first, last = job
+    blockBytes, origin, crcs = sidecar["blockBytes"], sidecar["origin"], sidecar["crcs"]
+    damaged = []
+    with open(filename, 'rb', buffering=0) as fd:
+        os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for chunk in range(first, last, READ_BLOCKS):
+            chunkEnd = min(chunk + READ_BLOCKS, last)
+            start = max(origin + chunk * blockBytes, dataStart)
+            end = min(origin + chunkEnd * blockBytes, dataEnd)
+            fd.seek(start)
+            data = memoryview(fd.read(end - start))
+            for i in range(chunk, chunkEnd):
+                a = max(origin + i * blockBytes, dataStart) - start
+                b = min(origin + (i + 1) * blockBytes, dataEnd) - start
+                if zlib.crc32(data[a:b]) != crcs[i]:
+                    damaged.append(i)
+            os.posix_fadvise(fd.fileno(), start, end - start, os.POSIX_FADV_DONTNEED)
+    return filename, damaged
+
+###############################################################################
+# Function Name:
+#   verifyFlac
+# Description:
+#   tests a flac take with the decoder (a worker job)
+# Parameters:
+#   filename - the flac file
+# Return value:
+#   (filename, None if it decodes, else the decoder's message)
+###############################################################################
+def verifyFlac(filename):
+    result = subprocess.run(["flac", "-t", "-s", filename], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode == 0:
+        return filename, None
+    return filename, result.stderr.decode(errors="replace").strip().splitlines()[-1:] or ["decode failed"]
+
+###############################################################################
+# Function Name:
+#   formatTime
+# Description:
+#   formats a position in a take as h:mm:ss.sss
+# Parameters:
+#   secs - seconds from the start of the take
+# Return value:
+#   the string
+###############################################################################
+def formatTime(secs):
+    minutes, secs = divmod(secs, 60.0)
+    return "%d:%02d:%06.3f" % (minutes // 60, minutes % 60, secs)
+
+###############################################################################
+# Function Name:
+#   getRanges
+# Description:
+#   merges damaged blocks into time ranges of the take
+# Parameters:
+#   blocks - sorted indexes of the damaged blocks
+#   sidecar - the take's sidecar
+#   dataStart, dataEnd - the data chunk's file offsets
+# Return value:
+#   list of (start secs, end secs)
+###############################################################################
+def getRanges(blocks, sidecar, dataStart, dataEnd):
+    blockBytes, origin = sidecar["blockBytes"], sidecar["origin"]
+    bytesPerSec = float(sidecar["frameSize"] * sidecar["rate"])
+    ranges = []
+    for i in blocks:
+        start = (max(origin + i * blockBytes, dataStart) - dataStart) / bytesPerSec
+        end = (min(origin + (i + 1) * blockBytes, dataEnd) - dataStart) / bytesPerSec
+        if ranges and i == ranges[-1][2] + 1:
+            ranges[-1] = (ranges[-1][0], end, i)
+        else:
+            ranges.append((start, end, i))
+    return [(start, end) for start, end, i in ranges]
+
+###############################################################################
+# Function Name:
+#   verifyTakes
+# Description:
+#   checks takes against their sidecars (or the flac decoder) in parallel
+#   and prints the result of each
+# Parameters:
+#   files - list of takes
+#   jobs - number of worker processes
+# Return value:
+#   number of takes damaged or unreadable
+###############################################################################
+def verifyTakes(files, jobs):
+    import piRecordWave
+    takes = {}
+    segments = []
+    flacs = []
+    failures = 0
+    for fn in files:
+        if fn.endswith(".flac"):
+            if shutil.which("flac") == None:
+                print ("%s: not checked (flac decoder not installed)" % fn)
+            else:
+                flacs.append(fn)
+            continue
+        try:
+            sidecar = readSidecar(fn)
+            reader = piRecordWave.WaveReader(fn)
+            reader.close()
+        except (OSError, ValueError) as err:
+            print ("%s: unreadable (%s)" % (fn, err))
+            failures += 1
+            continue
+        if sidecar == None:
+            print ("%s: not checked (no checksums)" % fn)
+            continue
+        dataStart = reader.getdataoffset()
+        dataEnd = dataStart + reader.getnframes() * reader.frameSize
+        blockBytes, origin = sidecar["blockBytes"], sidecar["origin"]
+        first = max(0, (dataStart - origin) // blockBytes)
+        last = min(len(sidecar["crcs"]), -(-(dataEnd - origin) // blockBytes))
+        takes[fn] = {"sidecar": sidecar, "dataStart": dataStart, "dataEnd": dataEnd, "damaged": [],
+                     "checkedEnd": min(dataEnd, origin + last * blockBytes), "blocks": max(0, last - first)}
+        for i in range(first, last, SEGMENT_BLOCKS):
+            segments.append((fn, dataStart, dataEnd, sidecar, i, min(i + SEGMENT_BLOCKS, last)))
+
+    with multiprocessing.Pool(processes=jobs) as pool:
+        for fn, damaged in pool.imap_unordered(verifySegment, segments):
+            takes[fn]["damaged"] += damaged
+        for fn, error in pool.imap(verifyFlac, flacs):
+            if error == None:
+                print ("%s: ok" % fn)
+            else:
+                print ("%s: DAMAGED (%s)" % (fn, error[0]))
+                failures += 1
+
+    for fn, take in takes.items():
+        sidecar, dataStart, dataEnd = take["sidecar"], take["dataStart"], take["dataEnd"]
+        bytesPerSec = float(sidecar["frameSize"] * sidecar["rate"])
+        result = "ok (%d blocks)" % take["blocks"]
+        if take["damaged"]:
+            ranges = getRanges(sorted(take["damaged"]), sidecar, dataStart, dataEnd)
+            result = "DAMAGED " + ", ".join("%s-%s" % (formatTime(start), formatTime(end)) for start, end in ranges)
+            failures += 1
+        if take["checkedEnd"] < dataEnd:
+            result += ", unchecked from %s" % formatTime((take["checkedEnd"] - dataStart) / bytesPerSec)
+        print ("%s: %s" % (fn, result))
+    return failures
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   verifies the recordings from the command line (see piRecord.sh verify)
+###############################################################################
+if __name__ == "__main__":
+    import piRecordConf
+    import piRecordUtils
+    piRecordConf.getRecDevConfig()
+
+    parser = argparse.ArgumentParser(description="check the recordings in " + piRecordConf.outputDir)
+    parser.add_argument("files", nargs="*", help="recordings to check (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    args = parser.parse_args()
+
+    files = [fn if os.path.exists(fn) else os.path.join(piRecordConf.outputDir, fn) for fn in args.files]
+    if not files:
+        files = sorted(os.path.join(piRecordConf.outputDir, fn) for fn in os.listdir(piRecordConf.outputDir)
+                       if fn.endswith((".wav", ".flac")))
+    if piRecordUtils.isRecording():
+        current = os.path.splitext(os.path.abspath(piRecordUtils.getCurrentFilename()))[0]
+        files = [fn for fn in files if os.path.splitext(os.path.abspath(fn))[0] != current]
+    for fn in [fn for fn in files if piRecordUtils.isTrimPending(fn)]:
+        print ("%s: not checked (being trimmed)" % fn)
+        files.remove(fn)
+    exit(1 if verifyTakes(files, args.jobs) else 0)
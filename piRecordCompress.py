@@ -0,0 +1,329 @@
+###############################################################################
+# piRecordCompress.py - Raspberry Pi audio recorder compression module
+# Description:
+#   streams captured blocks into the flac encoder, which runs as its own
+#   process so that compression uses another core.  The engine writes to the
+#   encoder through a non-blocking pipe; if the encoder falls more than
+#   compressMaxBacklog seconds behind, the pipe is closed (so the flac file
+#   holds everything sent so far) and the rest of the take is written to a
+#   wave file of the same name.  What is still to be sent when the pipe is
+#   closed is sent by a thread of its own, so the engine never waits for the
+#   encoder.  A seek table is added by metaflac once the
+#   encoder has finished, using the padding reserved at the start of the file.
+###############################################################################
+
+import fcntl
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import piRecordConf
+import piRecordFormat
+import piRecordLog
+import piRecordWave
+
+FLAC_EXT = ".flac"
+
+# bytes reserved in the flac header for the seek table (18 bytes per point)
+SEEKTABLE_PADDING = 65536
+SEEKPOINT_SPACING = "10s"
+
+# size requested for the encoder pipe, the buffer between capture and encoder
+PIPE_SIZE = 1048576
+
+# encoders still finishing their file after the take was stopped
+finishing = []
+
+# threads sending the last of a take to an encoder and closing its input
+sending = []
+
+###############################################################################
+# Function Name:
+#   canCompress
+# Description:
+#   checks whether a recording can be compressed: the flac encoder must be
+#   installed and the stored samples must be integer PCM of at most 24 bits
+# Parameters:
+#   sampWidth - stored sample width in bytes
+#   fmtTag - the wave format tag of the stored samples
+# Return value:
+#   True if the recording can be compressed
+###############################################################################
+def canCompress(sampWidth, fmtTag):
+    if shutil.which("flac") == None:
+        piRecordLog.event("compress_unavailable", logging.WARNING, interval=0, reason="flac encoder not installed")
+        return False
+    if fmtTag != piRecordFormat.WAVE_FORMAT_PCM or sampWidth > 3:
+        piRecordLog.event("compress_unavailable", logging.WARNING, interval=0, reason="format not supported by flac",
+                          sampleWidth=sampWidth, formatTag=fmtTag)
+        return False
+    return True
+
+###############################################################################
+# Function Name:
+#   makeFlacCommand
+# Description:
+#   builds the shell command that encodes raw little endian samples read from
+#   standard input into a flac file, then adds the seek table
+# Parameters:
+#   filename - name of the flac file
+#   nchannels - number of channels
+#   sampwidth - sample width in bytes
+#   framerate - sample rate
+#   level - flac compression level (0-8)
+# Return value:
+#   the command string
+###############################################################################
+def makeFlacCommand(filename, nchannels, sampwidth, framerate, level):
+    flacCmd = ["flac", "-s", "-f", "-%d" % level, "--padding=%d" % SEEKTABLE_PADDING,
+               "--force-raw-format", "--endian=little",
+               "--sign=" + ("unsigned" if sampwidth == 1 else "signed"),
+               "--channels=%d" % nchannels, "--bps=%d" % (sampwidth * 8),
+               "--sample-rate=%d" % framerate, "-o", filename, "-"]
+    cmd = " ".join(shlex.quote(arg) for arg in flacCmd)
+    if shutil.which("metaflac") != None:
+        cmd += " && metaflac --add-seekpoint=%s %s" % (SEEKPOINT_SPACING, shlex.quote(filename))
+    return cmd
+
+###############################################################################
+# Function Name:
+#   reapCompressors
+# Description:
+#   collects the exit status of encoders that have finished their files
+# Parameters:
+#   none
+# Return value:
+#   number of encoders still running
+###############################################################################
+def reapCompressors():
+    for proc in finishing[:]:
+        if proc.poll() != None:
+            finishing.remove(proc)
+    return len(finishing)
+
+###############################################################################
+# Class Name:
+#   FlacWriter
+# Description:
+#   writes a flac file through the flac encoder.  The write methods match
+#   WaveWriter so the engine can use either.
+###############################################################################
+class FlacWriter:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   starts the encoder process for the given file
+    # Parameters:
+    #   filename - name of the recording; the extension is replaced by .flac
+    #   nchannels - number of channels
+    #   sampwidth - stored sample width in bytes
+    #   framerate - sample rate
+    #   level - flac compression level (0-8)
+    #   maxBacklog - seconds of audio the encoder may fall behind
+    #   writerOptions - WaveWriter options (see piRecordConf.getWriterOptions)
+    #                   for the wave file the take falls back to
+    ###########################################################################
+    def __init__(self, filename, nchannels, sampwidth, framerate, level, maxBacklog, writerOptions=None):
+        reapCompressors()
+        self.basename = os.path.splitext(filename)[0]
+        self.filename = self.basename + FLAC_EXT
+        self.nchannels = nchannels
+        self.sampwidth = sampwidth
+        self.framerate = framerate
+        self.frameSize = nchannels * sampwidth
+        self.maxPending = int(maxBacklog * framerate) * self.frameSize
+        self.pending = bytearray()
+        self.bytesSent = 0
+        self.wav = None
+        self.writerOptions = writerOptions or {}
+
+        cmd = makeFlacCommand(self.filename, nchannels, sampwidth, framerate, level)
+
+        # run in a new session so a ctrl-c on the terminal doesn't kill the
+        # encoder before it has finished the file
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.DEVNULL, start_new_session=True)
+        self.fd = self.proc.stdin.fileno()
+        try:
+            fcntl.fcntl(self.fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), PIPE_SIZE)
+        except OSError:
+            pass
+        os.set_blocking(self.fd, False)
+
+    ###########################################################################
+    # Method Name:
+    #   flush
+    # Description:
+    #   sends as much pending data to the encoder as the pipe will take
+    #   without blocking
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def flush(self):
+        while self.pending:
+            try:
+                n = os.write(self.fd, self.pending)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.fallBack("compressor failed")
+                return
+            del self.pending[:n]
+            self.bytesSent += n
+
+    ###########################################################################
+    # Method Name:
+    #   sendAll
+    # Description:
+    #   the sender thread: sends the last of the take to the encoder, waiting
+    #   for the pipe as long as it takes, then closes the encoder's input
+    # Parameters:
+    #   data - the data to send
+    # Return value:
+    #   none
+    ###########################################################################
+    def sendAll(self, data):
+        try:
+            os.set_blocking(self.fd, True)
+            view = memoryview(data)
+            while len(view):
+                n = os.write(self.fd, view)
+                view = view[n:]
+        except OSError:
+            piRecordLog.event("compress_failed", logging.ERROR, interval=0, file=self.filename)
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        sending.remove(threading.current_thread())
+
+    ###########################################################################
+    # Method Name:
+    #   fallBack
+    # Description:
+    #   stops compressing and continues the take in a wave file.  The encoder
+    #   is sent the rest of any partly sent frame (see closePipe) so that both
+    #   files hold whole frames and no samples are lost.
+    # Parameters:
+    #   reason - the reason given in the log
+    # Return value:
+    #   none
+    ###########################################################################
+    def fallBack(self, reason):
+        rest = -self.bytesSent % self.frameSize
+        self.closePipe(self.pending[:rest])
+        del self.pending[:rest]
+
+        wavName = self.basename + piRecordConf.fileTypeExt
+        piRecordLog.event("compress_fallback", logging.WARNING, interval=0, reason=reason,
+                          frame=self.bytesSent // self.frameSize, file=wavName)
+        self.wav = piRecordWave.WaveWriter(wavName, self.nchannels, self.sampwidth, self.framerate,
+                                           **self.writerOptions)
+        self.wav.writeframesraw(bytes(self.pending))
+        self.pending = bytearray()
+
+    ###########################################################################
+    # Method Name:
+    #   closePipe
+    # Description:
+    #   closes the encoder's input so it finishes the file in the background.
+    #   Data still to be sent is handed to a sender thread (see sendAll),
+    #   which closes the input once it is sent.
+    # Parameters:
+    #   data - the data still to be sent
+    # Return value:
+    #   none
+    ###########################################################################
+    def closePipe(self, data=b''):
+        finishing.append(self.proc)
+        self.bytesSent += len(data)
+        if data:
+            sender = threading.Thread(target=self.sendAll, args=(bytes(data),), daemon=True)
+            sending.append(sender)
+            sender.start()
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+    ###########################################################################
+    # Method Name:
+    #   writeframesraw
+    # Description:
+    #   queues sample data for the encoder, falling back to a wave file if
+    #   the encoder is too far behind
+    # Parameters:
+    #   data - the sample data
+    # Return value:
+    #   none
+    ###########################################################################
+    def writeframesraw(self, data):
+        if self.wav != None:
+            self.wav.writeframesraw(data)
+            return
+        self.pending += data
+        self.flush()
+        if self.wav == None and len(self.pending) > self.maxPending:
+            self.fallBack("compressor is behind")
+
+    def writeframes(self, data):
+        self.writeframesraw(data)
+
+    ###########################################################################
+    # Method Name:
+    #   getnframes
+    # Description:
+    #   returns the number of frames written so far
+    # Parameters:
+    #   none
+    # Return value:
+    #   the number of frames
+    ###########################################################################
+    def getnframes(self):
+        nframes = (self.bytesSent + len(self.pending)) // self.frameSize
+        if self.wav != None:
+            nframes += self.wav.getnframes()
+        return nframes
+
+    ###########################################################################
+    # Method Name:
+    #   close
+    # Description:
+    #   sends the remaining data to the encoder and closes its input (see
+    #   closePipe).  The encoder finishes the file (and metaflac adds the
+    #   seek table) without holding up the engine.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def close(self):
+        if self.wav != None:
+            self.wav.close()
+            return
+        self.closePipe(self.pending)
+        self.pending = bytearray()
+
+###############################################################################
+# Function Name:
+#   waitSent
+# Description:
+#   waits for the sender threads to finish, before the engine exits
+# Parameters:
+#   timeout - most seconds to wait
+# Return value:
+#   True if they all finished
+###############################################################################
+def waitSent(timeout):
+    endTime = time.time() + timeout
+    for sender in list(sending):
+        sender.join(max(0.0, endTime - time.time()))
+    return not sending
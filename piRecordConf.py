@@ -7,9 +7,10 @@
 #   11/27/19    jhnatt    add performance tuning and user preferences
 ###############################################################################
 
-import alsaaudio
-import logging
+from piRecordHardware import alsaaudio
 import configparser
+import json
+import os
 
 # Constants
 UI_PROTO = 0
@@ -35,26 +36,150 @@ recRate = 44100
 recFormat = alsaaudio.PCM_FORMAT_S16_LE
 recPeriodSize = 160
 recSampleWidth = 2
+floatStorage = False
+
+#Capture resampling (storeRate 0 = store at recRate)
+storeRate = 0
+storeTaps = 32
+storeBlockFrames = 1024
+
+#Multi-device capture (comma separated lists, one entry per extra device)
+multiDevices = ""
+multiChannels = ""
+multiOffsets = ""
+multiTaps = 24
 
 #Performance tuning
 engineLoopPd = 0.001    
 swDebounceTime = 0.020
 
+#Compression
+compressEnabled = False
+compressLevel = 5
+compressMaxBacklog = 2.0
+
+#Batch processing
+batchChain = "mixdown,normalize,resample,compress"
+batchTargetRate = 48000
+batchNormalizeLevel = -1.0
+batchChunkFrames = 65536
+batchOutputSubdir = "processed"
+
+#Loudness analysis
+loudnessLive = False
+
+#Safety track
+safetyEnabled = False
+safetyDir = "/media/usb/Recordings"
+safetySampleWidth = 0
+safetyQueueSecs = 10.0
+
+#Storage (file writing)
+storagePreallocMB = 64
+storageWritebackMB = 4
+storageDirectIO = False
+storageChecksumKB = 64
+
+#Silence trim
+trimEnabled = False
+trimThresholdDb = -50.0
+trimHoldSecs = 2.0
+trimPadSecs = 2.0
+
+#Playback
+playbackPeriodFrames = 4096
+playbackPrefetchSecs = 10.0
+playbackSkipSecs = 10.0
+
+#Overdub
+overdubPrimePeriods = 8
+overdubLatencyFrames = -1
+
+#Background offload
+offloadEnabled = False
+offloadDir = "/media/usb/Offload"
+offloadBlockMB = 4
+offloadRateMB = 8.0
+offloadRecordingRateMB = 0.5
+offloadVerify = True
+offloadDeleteAfter = False
+offloadPollSecs = 30.0
+
+#Live monitor
+monitorEnabled = False
+monitorAddress = ""
+monitorPort = 8080
+monitorBufferSecs = 10.0
+monitorMaxClients = 4
+
+#Spectrum/tuner analysis
+analysisRate = 10.0
+analysisCpuCap = 0.05
+analysisFftSize = 8192
+
+#Stage pipeline (comma separated lists, one entry per stage)
+pipelineStages = ""
+pipelineModes = ""
+pipelinePolicies = ""
+pipelineCpus = ""
+pipelineRingSecs = 5.0
+pipelineChunkFrames = 4096
+
+#Real-time mode
+realtimeEnabled = False
+realtimePriority = 70
+realtimeCpu = 3
+realtimeLockMemory = True
+realtimePrefaultMB = 16
+
+#Engine watchdog
+watchdogEnabled = True
+watchdogTimeout = 5.0
+watchdogMaxRestarts = 5
+
+#Sampling profiler
+profileRate = 100.0
+profileDir = ""
+
 #User preferences 
 idleSeconds = 300.000  
 auditionTime = 3.00
+autoArm = False
 
+#resolved capture device names, cached so startup doesn't list the devices
+DEV_CACHE_FILE = "./.devcache"
+devCache = None
 
-#Config item display lists (exported to main which handles settings)
+#capture device capabilities (see getDeviceCaps), probed once by the engine
+#and cached, so settings can be checked without opening the device
+DEV_CAPS_FILE = "./.devcaps"
+CAP_RATES = (8000, 11025, 16000, 22050, 32000, 44100, 48000, 88200, 96000, 176400, 192000)
+CAP_MAX_CHANNELS = 8
+devCaps = None
+
+#period sizes offered in CONFIG mode, and the range accepted
+PERIOD_SIZES = (64, 128, 160, 256, 512, 1024, 2048, 4096)
+MIN_PERIOD_SIZE = 16
+MAX_PERIOD_SIZE = 65536
+
+#settings that only take effect when piRecord is restarted (by prefix)
+RESTART_PREFIXES = ("realtime", "watchdog", "offload", "profile", "log")
+
+
+#Config item display lists (exported to main which handles settings), and
+#the variable each item sets
 cfgItemDispList = ["Dev", "Chn", "Rat", "Fmt", "Per", "Wid"]
+CFG_ITEM_VARS = {"Dev": "recDevice", "Chn": "recChannels", "Rat": "recRate", "Fmt": "recFormat",
+                 "Per": "recPeriodSize", "Wid": "recSampleWidth"}
 
 #Logging configuration
 LOG_LVL_DBG = 15  #define higher than regular debug to keep from flooding with ALSA debug messages 
 logLevel = LOG_LVL_DBG
 logFile = './piRecord.log'
 logFormat = '%(asctime)s %(levelname)s:  %(message)s'
-
-logging.basicConfig(filename=logFile,format=logFormat,level=logLevel)
+logMaxBytes = 1048576
+logBackups = 3
+logQueueSize = 1000
 
 #Create configuration parser object
 recConfig = configparser.RawConfigParser()
@@ -71,8 +196,27 @@ recConfig = configparser.RawConfigParser()
 ###############################################################################
 def printConfig():
     global recConfig
-    global recDevice, recChannels, recRate, recFormat, recPeriodSize, recSampleWidth
-    global swDebounceTime, engineLoopPd, idleSeconds, auditionTime
+    global recDevice, recChannels, recRate, recFormat, recPeriodSize, recSampleWidth, floatStorage
+    global storeRate, storeTaps, storeBlockFrames
+    global multiDevices, multiChannels, multiOffsets, multiTaps
+    global swDebounceTime, engineLoopPd, idleSeconds, auditionTime, autoArm
+    global compressEnabled, compressLevel, compressMaxBacklog
+    global batchChain, batchTargetRate, batchNormalizeLevel, batchChunkFrames, batchOutputSubdir
+    global loudnessLive
+    global safetyEnabled, safetyDir, safetySampleWidth, safetyQueueSecs
+    global storagePreallocMB, storageWritebackMB, storageDirectIO, storageChecksumKB
+    global trimEnabled, trimThresholdDb, trimHoldSecs, trimPadSecs
+    global playbackPeriodFrames, playbackPrefetchSecs, playbackSkipSecs
+    global overdubPrimePeriods, overdubLatencyFrames
+    global offloadEnabled, offloadDir, offloadBlockMB, offloadRateMB, offloadRecordingRateMB, offloadVerify
+    global offloadDeleteAfter, offloadPollSecs
+    global monitorEnabled, monitorAddress, monitorPort, monitorBufferSecs, monitorMaxClients
+    global analysisRate, analysisCpuCap, analysisFftSize
+    global pipelineStages, pipelineModes, pipelinePolicies, pipelineCpus, pipelineRingSecs, pipelineChunkFrames
+    global realtimeEnabled, realtimePriority, realtimeCpu, realtimeLockMemory, realtimePrefaultMB
+    global watchdogEnabled, watchdogTimeout, watchdogMaxRestarts
+    global profileRate, profileDir
+    global logMaxBytes, logBackups, logQueueSize
     print ("Current Recording Config:")
     print ("  recDevice = ", recDevice)
     print ("  recChannels = ", recChannels)
@@ -80,14 +224,102 @@ def printConfig():
     print ("  recFormat = ", recFormat)
     print ("  recPeriodSize = ", recPeriodSize)
     print ("  recSampleWidth = ", recSampleWidth)
+    print ("  floatStorage = ", floatStorage)
+    print ("Capture Resampling:")
+    print ("  storeRate: ", storeRate)
+    print ("  storeTaps: ", storeTaps)
+    print ("  storeBlockFrames: ", storeBlockFrames)
+    print ("Multi-device Capture:")
+    print ("  multiDevices: ", multiDevices)
+    print ("  multiChannels: ", multiChannels)
+    print ("  multiOffsets: ", multiOffsets)
+    print ("  multiTaps: ", multiTaps)
     print ("Performance Tuning:")
     print ("  swDebounceTime: ", swDebounceTime)
     print ("  engineLoopPd: ", engineLoopPd)
+    print ("Compression:")
+    print ("  compressEnabled: ", compressEnabled)
+    print ("  compressLevel: ", compressLevel)
+    print ("  compressMaxBacklog: ", compressMaxBacklog)
+    print ("Batch Processing:")
+    print ("  batchChain: ", batchChain)
+    print ("  batchTargetRate: ", batchTargetRate)
+    print ("  batchNormalizeLevel: ", batchNormalizeLevel)
+    print ("  batchChunkFrames: ", batchChunkFrames)
+    print ("  batchOutputSubdir: ", batchOutputSubdir)
+    print ("Loudness Analysis:")
+    print ("  loudnessLive: ", loudnessLive)
+    print ("Safety Track:")
+    print ("  safetyEnabled: ", safetyEnabled)
+    print ("  safetyDir: ", safetyDir)
+    print ("  safetySampleWidth: ", safetySampleWidth)
+    print ("  safetyQueueSecs: ", safetyQueueSecs)
+    print ("Storage:")
+    print ("  storagePreallocMB: ", storagePreallocMB)
+    print ("  storageWritebackMB: ", storageWritebackMB)
+    print ("  storageDirectIO: ", storageDirectIO)
+    print ("  storageChecksumKB: ", storageChecksumKB)
+    print ("Silence Trim:")
+    print ("  trimEnabled: ", trimEnabled)
+    print ("  trimThresholdDb: ", trimThresholdDb)
+    print ("  trimHoldSecs: ", trimHoldSecs)
+    print ("  trimPadSecs: ", trimPadSecs)
+    print ("Playback:")
+    print ("  playbackPeriodFrames: ", playbackPeriodFrames)
+    print ("  playbackPrefetchSecs: ", playbackPrefetchSecs)
+    print ("  playbackSkipSecs: ", playbackSkipSecs)
+    print ("Overdub:")
+    print ("  overdubPrimePeriods: ", overdubPrimePeriods)
+    print ("  overdubLatencyFrames: ", overdubLatencyFrames)
+    print ("Background Offload:")
+    print ("  offloadEnabled: ", offloadEnabled)
+    print ("  offloadDir: ", offloadDir)
+    print ("  offloadBlockMB: ", offloadBlockMB)
+    print ("  offloadRateMB: ", offloadRateMB)
+    print ("  offloadRecordingRateMB: ", offloadRecordingRateMB)
+    print ("  offloadVerify: ", offloadVerify)
+    print ("  offloadDeleteAfter: ", offloadDeleteAfter)
+    print ("  offloadPollSecs: ", offloadPollSecs)
+    print ("Live Monitor:")
+    print ("  monitorEnabled: ", monitorEnabled)
+    print ("  monitorAddress: ", monitorAddress)
+    print ("  monitorPort: ", monitorPort)
+    print ("  monitorBufferSecs: ", monitorBufferSecs)
+    print ("  monitorMaxClients: ", monitorMaxClients)
+    print ("Spectrum/Tuner Analysis:")
+    print ("  analysisRate: ", analysisRate)
+    print ("  analysisCpuCap: ", analysisCpuCap)
+    print ("  analysisFftSize: ", analysisFftSize)
+    print ("Stage Pipeline:")
+    print ("  pipelineStages: ", pipelineStages)
+    print ("  pipelineModes: ", pipelineModes)
+    print ("  pipelinePolicies: ", pipelinePolicies)
+    print ("  pipelineCpus: ", pipelineCpus)
+    print ("  pipelineRingSecs: ", pipelineRingSecs)
+    print ("  pipelineChunkFrames: ", pipelineChunkFrames)
+    print ("Real-time Mode:")
+    print ("  realtimeEnabled: ", realtimeEnabled)
+    print ("  realtimePriority: ", realtimePriority)
+    print ("  realtimeCpu: ", realtimeCpu)
+    print ("  realtimeLockMemory: ", realtimeLockMemory)
+    print ("  realtimePrefaultMB: ", realtimePrefaultMB)
+    print ("Engine Watchdog:")
+    print ("  watchdogEnabled: ", watchdogEnabled)
+    print ("  watchdogTimeout: ", watchdogTimeout)
+    print ("  watchdogMaxRestarts: ", watchdogMaxRestarts)
+    print ("Sampling Profiler:")
+    print ("  profileRate: ", profileRate)
+    print ("  profileDir: ", profileDir)
+    print ("Logging:")
+    print ("  logMaxBytes: ", logMaxBytes)
+    print ("  logBackups: ", logBackups)
+    print ("  logQueueSize: ", logQueueSize)
     print ("User Preferences: ")
     print ("  idleSeconds", idleSeconds)
     print ("  auditionTime", auditionTime)
+    print ("  autoArm", autoArm)
     print (" ")
-    print ("to change a setting, edit piRecord.cfg and restart piRecord")
+    print ("to change a setting, use CONFIG mode, or edit piRecord.cfg and run piRecord.sh reload")
     return 0
 
 ###############################################################################
@@ -95,19 +327,103 @@ def printConfig():
 #   getRecDevice
 # Description:
 #   this function obtains the list of available devices from ALSA and finds the 
-#   one matching the configured device.
+#   one matching the configured device.  Listing the devices is slow, so the
+#   name found is cached in DEV_CACHE_FILE for the next start.
 # Parameters:
-#   none
+#   refresh - True to list the devices even if the name is cached (e.g. when
+#             the cached device no longer opens)
 # Return value: 
 #   device name, else null if device not found.
 ###############################################################################
-def getRecDevice():
+def getRecDevice(refresh=False):
+    global devCache
+    if devCache == None:
+        try:
+            with open(DEV_CACHE_FILE) as fd:
+                devCache = json.load(fd)
+        except (OSError, ValueError):
+            devCache = {}
+    if not refresh and recDevice in devCache:
+        return devCache[recDevice]
+
     devList = alsaaudio.pcms(alsaaudio.PCM_CAPTURE)
     for dev in devList:
         if recDevice in dev:
-           return dev
+            devCache[recDevice] = dev
+            try:
+                with open(DEV_CACHE_FILE, "w") as fd:
+                    json.dump(devCache, fd)
+            except OSError:
+                pass
+            return dev
     return 'null'
 
+###############################################################################
+# Function Name:
+#   getStoreRate
+# Description:
+#   returns the sample rate takes are stored at
+# Parameters:
+#   none
+# Return value:
+#   storeRate, or recRate if it isn't set
+###############################################################################
+def getStoreRate():
+    return storeRate if storeRate > 0 else recRate
+
+###############################################################################
+# Function Name:
+#   getWriterOptions
+# Description:
+#   returns the storage settings as the options WaveWriter takes
+# Parameters:
+#   none
+# Return value:
+#   dict of WaveWriter keyword arguments
+###############################################################################
+def getWriterOptions():
+    return {"preallocBytes": storagePreallocMB * 1024 * 1024, "writebackBytes": storageWritebackMB * 1024 * 1024,
+            "directIO": storageDirectIO, "checksumBytes": storageChecksumKB * 1024}
+
+###############################################################################
+# Function Name:
+#   getMultiDevices
+# Description:
+#   splits the multi-device capture settings into one entry per extra device.
+#   Channels default to recChannels and offsets to 0.
+# Parameters:
+#   none
+# Return value:
+#   list of (device name, channels, offset in frames)
+###############################################################################
+def getMultiDevices():
+    names = [name.strip() for name in multiDevices.split(",") if name.strip()]
+    channels = [int(c) for c in multiChannels.split(",") if c.strip()]
+    offsets = [int(o) for o in multiOffsets.split(",") if o.strip()]
+    return [(name, channels[i] if i < len(channels) else recChannels, offsets[i] if i < len(offsets) else 0)
+            for i, name in enumerate(names)]
+
+###############################################################################
+# Function Name:
+#   getPipelineStages
+# Description:
+#   splits the stage pipeline settings into one entry per stage.  Modes
+#   default to thread, policies to drop and cpus to -1 (any).
+# Parameters:
+#   none
+# Return value:
+#   list of (stage name, mode, policy, cpu)
+###############################################################################
+def getPipelineStages():
+    split = lambda value: [item.strip() for item in value.split(",")]
+    names = [name for name in split(pipelineStages) if name]
+    modes = split(pipelineModes)
+    policies = split(pipelinePolicies)
+    cpus = split(pipelineCpus)
+    return [(name, modes[i] if i < len(modes) and modes[i] else "thread",
+             policies[i] if i < len(policies) and policies[i] else "drop",
+             int(cpus[i]) if i < len(cpus) and cpus[i] else -1) for i, name in enumerate(names)]
+
 ###############################################################################
 # Function Name:
 #   getRecFormat
@@ -115,7 +431,8 @@ def getRecDevice():
 #   this function converts the individual format parameters into the single
 #   constant used by the ALSA library.
 # Parameters:
-#   numBits: number of bits (8, 16, or 32)
+#   numBits: number of bits (8, 16, 24 or 32).  Note 24 bits selects ALSA's
+#            4 byte container format, which is packed to 3 bytes when stored
 #   signed:  True = signed, False = unsigned
 #   byteOrder: LE = little endian, BE = big endian
 # Return value: 
@@ -163,6 +480,240 @@ def getRecFormat(numBits, signed, byteOrder):
     
     return fmt
 
+###############################################################################
+# Function Name:
+#   getRecFormats
+# Description:
+#   lists the capture formats that can be configured
+# Parameters:
+#   none
+# Return value:
+#   list of (ALSA format constant, numBits, signed, byteOrder)
+###############################################################################
+def getRecFormats():
+    formats = []
+    for numBits in (8, 16, 24, 32):
+        for signed in (True, False):
+            for byteOrder in (("LE",) if numBits == 8 else ("LE", "BE")):
+                formats.append((getRecFormat(numBits, signed, byteOrder), numBits, signed, byteOrder))
+    return formats
+
+###############################################################################
+# Function Name:
+#   getFormatName
+# Description:
+#   returns a capture format's short name, e.g. S16_LE
+# Parameters:
+#   fmt - the ALSA format constant
+# Return value:
+#   the name, else the constant as a string
+###############################################################################
+def getFormatName(fmt):
+    for f, numBits, signed, byteOrder in getRecFormats():
+        if f == fmt:
+            return "%s%d%s" % ("S" if signed else "U", numBits, "" if numBits == 8 else "_" + byteOrder)
+    return str(fmt)
+
+###############################################################################
+# Function Name:
+#   getFormatWidths
+# Description:
+#   returns the sample widths (bytes) that go with a capture format: its
+#   valid bytes, or for 24 bits also its 4 byte container
+# Parameters:
+#   fmt - the ALSA format constant
+# Return value:
+#   list of widths, empty if the format can't be configured
+###############################################################################
+def getFormatWidths(fmt):
+    for f, numBits, signed, byteOrder in getRecFormats():
+        if f == fmt:
+            return [3, 4] if numBits == 24 else [numBits // 8]
+    return []
+
+###############################################################################
+# Function Name:
+#   getDeviceCaps
+# Description:
+#   returns a capture device's capabilities from DEV_CAPS_FILE (read again
+#   for a device not yet in it, as the engine process probes devices)
+# Parameters:
+#   device - the device name (as getRecDevice returns)
+# Return value:
+#   dict of the "rates", "channels" and "formats" it accepts, else None if
+#   it hasn't been probed
+###############################################################################
+def getDeviceCaps(device):
+    global devCaps
+    if devCaps == None or device not in devCaps:
+        try:
+            with open(DEV_CAPS_FILE) as fd:
+                devCaps = json.load(fd)
+        except (OSError, ValueError):
+            devCaps = {}
+    return devCaps.get(device)
+
+###############################################################################
+# Function Name:
+#   storeDeviceCaps
+# Description:
+#   caches a capture device's capabilities in DEV_CAPS_FILE
+# Parameters:
+#   device - the device name (as getRecDevice returns)
+#   caps - dict of the "rates", "channels" and "formats" it accepts
+# Return value:
+#   0
+###############################################################################
+def storeDeviceCaps(device, caps):
+    getDeviceCaps(device)
+    devCaps[device] = caps
+    try:
+        with open(DEV_CAPS_FILE, "w") as fd:
+            json.dump(devCaps, fd)
+    except OSError:
+        pass
+    return 0
+
+###############################################################################
+# Function Name:
+#   getCfgItemChoices
+# Description:
+#   lists the values a CONFIG mode item can be set to: those the capture
+#   device accepts, if its capabilities are known
+# Parameters:
+#   item - the item (see cfgItemDispList)
+#   values - the items' values being edited, by item
+# Return value:
+#   list of values
+###############################################################################
+def getCfgItemChoices(item, values):
+    caps = getDeviceCaps(getRecDevice()) if values["Dev"] == recDevice else None
+    if item == "Dev":
+        choices = [recDevice] + [card for card in alsaaudio.cards() if card != recDevice]
+    elif item == "Chn":
+        choices = caps["channels"] if caps else list(range(1, CAP_MAX_CHANNELS + 1))
+    elif item == "Rat":
+        choices = caps["rates"] if caps else list(CAP_RATES)
+    elif item == "Fmt":
+        choices = caps["formats"] if caps else [fmt for fmt, numBits, signed, byteOrder in getRecFormats()]
+    elif item == "Per":
+        choices = sorted(set(PERIOD_SIZES) | {recPeriodSize})
+    else:
+        choices = getFormatWidths(values["Fmt"])
+    if values[item] not in choices:
+        choices = [values[item]] + choices
+    return choices
+
+###############################################################################
+# Function Name:
+#   formatCfgItem
+# Description:
+#   returns a CONFIG mode item's value as shown on the LCD screen
+# Parameters:
+#   item - the item (see cfgItemDispList)
+#   value - its value
+# Return value:
+#   the value as a string
+###############################################################################
+def formatCfgItem(item, value):
+    if item == "Fmt":
+        return getFormatName(value)
+    return str(value)
+
+###############################################################################
+# Function Name:
+#   getCfgItems
+# Description:
+#   returns the current values of the CONFIG mode items
+# Parameters:
+#   none
+# Return value:
+#   dict of values by item
+###############################################################################
+def getCfgItems():
+    return {item: globals()[name] for item, name in CFG_ITEM_VARS.items()}
+
+###############################################################################
+# Function Name:
+#   setCfgItems
+# Description:
+#   sets the recording configuration from CONFIG mode items
+# Parameters:
+#   values - the items' values, by item
+# Return value:
+#   0
+###############################################################################
+def setCfgItems(values):
+    for item, value in values.items():
+        globals()[CFG_ITEM_VARS[item]] = value
+    return 0
+
+###############################################################################
+# Function Name:
+#   checkRecConfig
+# Description:
+#   checks the recording configuration against the capture device's cached
+#   capabilities (if it has been probed) and against itself
+# Parameters:
+#   none
+# Return value:
+#   None if it is valid, else the first problem found (fits the LCD screen)
+###############################################################################
+def checkRecConfig():
+    caps = getDeviceCaps(getRecDevice())
+    if not getFormatWidths(recFormat) or (caps and recFormat not in caps["formats"]):
+        return "Fmt unsupported"
+    if recChannels < 1 or (caps and recChannels not in caps["channels"]):
+        return "Chn unsupported"
+    if caps and recRate not in caps["rates"]:
+        return "Rat unsupported"
+    if not MIN_PERIOD_SIZE <= recPeriodSize <= MAX_PERIOD_SIZE:
+        return "Per out of range"
+    if recSampleWidth not in getFormatWidths(recFormat):
+        return "Wid must match"
+    return None
+
+###############################################################################
+# Function Name:
+#   saveCfgItems
+# Description:
+#   writes CONFIG mode items to piRecord.cfg.  Only the values on their
+#   lines change, so the file's comments and layout are kept; the file is
+#   replaced whole, so it is never left half written.
+# Parameters:
+#   values - the items' values, by item
+# Return value:
+#   0
+###############################################################################
+def saveCfgItems(values):
+    options = {}
+    for item, value in values.items():
+        if item == "Fmt":
+            for fmt, numBits, signed, byteOrder in getRecFormats():
+                if fmt == value:
+                    options.update(numBits=numBits, signed=signed, byteOrder=byteOrder)
+        else:
+            options[{"Dev": "devName", "Chn": "numChan", "Rat": "rate", "Per": "periodSize",
+                     "Wid": "sampleWidth"}[item]] = value
+    with open('piRecord.cfg') as fd:
+        lines = fd.readlines()
+    section = None
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith("["):
+            section = stripped.strip("[]").strip()
+        elif section == 'recDevice' and not stripped.startswith("#"):
+            name = stripped.replace("=", ":").split(":")[0].strip()
+            if name in options:
+                lines[i] = "%s: %s\n" % (name, options.pop(name))
+    if options:
+        at = next(i for i, line in enumerate(lines) if line.strip() == "[recDevice]") + 1
+        lines[at:at] = ["%s: %s\n" % item for item in options.items()]
+    with open('piRecord.cfg.tmp', "w") as fd:
+        fd.writelines(lines)
+    os.replace('piRecord.cfg.tmp', 'piRecord.cfg')
+    return 0
+
 ###############################################################################
 # Function Name:
 #   getRecDevDevConfig
@@ -175,8 +726,27 @@ def getRecFormat(numBits, signed, byteOrder):
 ###############################################################################
 def getRecDevConfig():
     global recConfig
-    global recDevice, recChannels, recRate, recFormat, recPeriodSize, recSampleWidth
-    global swDebounceTime, engineLoopPd, idleSeconds, auditionTime
+    global recDevice, recChannels, recRate, recFormat, recPeriodSize, recSampleWidth, floatStorage
+    global storeRate, storeTaps, storeBlockFrames
+    global multiDevices, multiChannels, multiOffsets, multiTaps
+    global swDebounceTime, engineLoopPd, idleSeconds, auditionTime, autoArm
+    global compressEnabled, compressLevel, compressMaxBacklog
+    global batchChain, batchTargetRate, batchNormalizeLevel, batchChunkFrames, batchOutputSubdir
+    global loudnessLive
+    global safetyEnabled, safetyDir, safetySampleWidth, safetyQueueSecs
+    global storagePreallocMB, storageWritebackMB, storageDirectIO, storageChecksumKB
+    global trimEnabled, trimThresholdDb, trimHoldSecs, trimPadSecs
+    global playbackPeriodFrames, playbackPrefetchSecs, playbackSkipSecs
+    global overdubPrimePeriods, overdubLatencyFrames
+    global offloadEnabled, offloadDir, offloadBlockMB, offloadRateMB, offloadRecordingRateMB, offloadVerify
+    global offloadDeleteAfter, offloadPollSecs
+    global monitorEnabled, monitorAddress, monitorPort, monitorBufferSecs, monitorMaxClients
+    global analysisRate, analysisCpuCap, analysisFftSize
+    global pipelineStages, pipelineModes, pipelinePolicies, pipelineCpus, pipelineRingSecs, pipelineChunkFrames
+    global realtimeEnabled, realtimePriority, realtimeCpu, realtimeLockMemory, realtimePrefaultMB
+    global watchdogEnabled, watchdogTimeout, watchdogMaxRestarts
+    global profileRate, profileDir
+    global logMaxBytes, logBackups, logQueueSize
 
     recConfig.read('piRecord.cfg')
 
@@ -187,15 +757,175 @@ def getRecDevConfig():
     recFormat = getRecFormat(recConfig.getint('recDevice', 'numBits'), recConfig.getboolean('recDevice', 'signed'), recConfig.get('recDevice', 'byteOrder'))
     recPeriodSize = recConfig.getint('recDevice', 'periodSize')
     recSampleWidth = recConfig.getint('recDevice', 'sampleWidth')
+    floatStorage = recConfig.getboolean('recDevice', 'floatStorage', fallback=floatStorage)
+
+    #get capture resampling settings:
+    storeRate = recConfig.getint('recDevice', 'storeRate', fallback=storeRate)
+    storeTaps = recConfig.getint('recDevice', 'storeTaps', fallback=storeTaps)
+    storeBlockFrames = recConfig.getint('recDevice', 'storeBlockFrames', fallback=storeBlockFrames)
+
+    #get multi-device capture settings:
+    multiDevices = recConfig.get('multiDevice', 'devices', fallback=multiDevices)
+    multiChannels = recConfig.get('multiDevice', 'channels', fallback=multiChannels)
+    multiOffsets = recConfig.get('multiDevice', 'offsets', fallback=multiOffsets)
+    multiTaps = recConfig.getint('multiDevice', 'taps', fallback=multiTaps)
     
     #get performance tunings:
     swDebounceTime = recConfig.getfloat('performanceTuning', 'swDebounceTime')
     engineLoopPd = recConfig.getfloat('performanceTuning', 'engineLoopPd')
 
+    #get compression settings:
+    compressEnabled = recConfig.getboolean('compression', 'enabled', fallback=compressEnabled)
+    compressLevel = recConfig.getint('compression', 'level', fallback=compressLevel)
+    compressMaxBacklog = recConfig.getfloat('compression', 'maxBacklogSecs', fallback=compressMaxBacklog)
+
+    #get batch processing settings:
+    batchChain = recConfig.get('batch', 'chain', fallback=batchChain)
+    batchTargetRate = recConfig.getint('batch', 'targetRate', fallback=batchTargetRate)
+    batchNormalizeLevel = recConfig.getfloat('batch', 'normalizeLevel', fallback=batchNormalizeLevel)
+    batchChunkFrames = recConfig.getint('batch', 'chunkFrames', fallback=batchChunkFrames)
+    batchOutputSubdir = recConfig.get('batch', 'outputSubdir', fallback=batchOutputSubdir)
+
+    #get loudness analysis settings:
+    loudnessLive = recConfig.getboolean('loudness', 'live', fallback=loudnessLive)
+
+    #get safety track settings:
+    safetyEnabled = recConfig.getboolean('safety', 'enabled', fallback=safetyEnabled)
+    safetyDir = recConfig.get('safety', 'dir', fallback=safetyDir)
+    safetySampleWidth = recConfig.getint('safety', 'sampleWidth', fallback=safetySampleWidth)
+    safetyQueueSecs = recConfig.getfloat('safety', 'queueSecs', fallback=safetyQueueSecs)
+
+    #get storage settings:
+    storagePreallocMB = recConfig.getint('storage', 'preallocMB', fallback=storagePreallocMB)
+    storageWritebackMB = recConfig.getint('storage', 'writebackMB', fallback=storageWritebackMB)
+    storageDirectIO = recConfig.getboolean('storage', 'directIO', fallback=storageDirectIO)
+    storageChecksumKB = recConfig.getint('storage', 'checksumKB', fallback=storageChecksumKB)
+
+    #get silence trim settings:
+    trimEnabled = recConfig.getboolean('trim', 'enabled', fallback=trimEnabled)
+    trimThresholdDb = recConfig.getfloat('trim', 'thresholdDb', fallback=trimThresholdDb)
+    trimHoldSecs = recConfig.getfloat('trim', 'holdSecs', fallback=trimHoldSecs)
+    trimPadSecs = recConfig.getfloat('trim', 'padSecs', fallback=trimPadSecs)
+
+    #get playback settings:
+    playbackPeriodFrames = recConfig.getint('playback', 'periodFrames', fallback=playbackPeriodFrames)
+    playbackPrefetchSecs = recConfig.getfloat('playback', 'prefetchSecs', fallback=playbackPrefetchSecs)
+    playbackSkipSecs = recConfig.getfloat('playback', 'skipSecs', fallback=playbackSkipSecs)
+
+    #get overdub settings:
+    overdubPrimePeriods = recConfig.getint('overdub', 'primePeriods', fallback=overdubPrimePeriods)
+    overdubLatencyFrames = recConfig.getint('overdub', 'latencyFrames', fallback=overdubLatencyFrames)
+
+    #get background offload settings:
+    offloadEnabled = recConfig.getboolean('offload', 'enabled', fallback=offloadEnabled)
+    offloadDir = recConfig.get('offload', 'dir', fallback=offloadDir)
+    offloadBlockMB = recConfig.getint('offload', 'blockMB', fallback=offloadBlockMB)
+    offloadRateMB = recConfig.getfloat('offload', 'rateMB', fallback=offloadRateMB)
+    offloadRecordingRateMB = recConfig.getfloat('offload', 'recordingRateMB', fallback=offloadRecordingRateMB)
+    offloadVerify = recConfig.getboolean('offload', 'verify', fallback=offloadVerify)
+    offloadDeleteAfter = recConfig.getboolean('offload', 'deleteAfter', fallback=offloadDeleteAfter)
+    offloadPollSecs = recConfig.getfloat('offload', 'pollSecs', fallback=offloadPollSecs)
+
+    #get live monitor settings:
+    monitorEnabled = recConfig.getboolean('monitor', 'enabled', fallback=monitorEnabled)
+    monitorAddress = recConfig.get('monitor', 'address', fallback=monitorAddress)
+    monitorPort = recConfig.getint('monitor', 'port', fallback=monitorPort)
+    monitorBufferSecs = recConfig.getfloat('monitor', 'bufferSecs', fallback=monitorBufferSecs)
+    monitorMaxClients = recConfig.getint('monitor', 'maxClients', fallback=monitorMaxClients)
+
+    #get spectrum/tuner analysis settings:
+    analysisRate = recConfig.getfloat('analysis', 'rate', fallback=analysisRate)
+    analysisCpuCap = recConfig.getfloat('analysis', 'cpuCap', fallback=analysisCpuCap)
+    analysisFftSize = recConfig.getint('analysis', 'fftSize', fallback=analysisFftSize)
+
+    #get stage pipeline settings:
+    pipelineStages = recConfig.get('pipeline', 'stages', fallback=pipelineStages)
+    pipelineModes = recConfig.get('pipeline', 'modes', fallback=pipelineModes)
+    pipelinePolicies = recConfig.get('pipeline', 'policies', fallback=pipelinePolicies)
+    pipelineCpus = recConfig.get('pipeline', 'cpus', fallback=pipelineCpus)
+    pipelineRingSecs = recConfig.getfloat('pipeline', 'ringSecs', fallback=pipelineRingSecs)
+    pipelineChunkFrames = recConfig.getint('pipeline', 'chunkFrames', fallback=pipelineChunkFrames)
+
+    #get real-time mode settings:
+    realtimeEnabled = recConfig.getboolean('realtime', 'enabled', fallback=realtimeEnabled)
+    realtimePriority = recConfig.getint('realtime', 'priority', fallback=realtimePriority)
+    realtimeCpu = recConfig.getint('realtime', 'cpu', fallback=realtimeCpu)
+    realtimeLockMemory = recConfig.getboolean('realtime', 'lockMemory', fallback=realtimeLockMemory)
+    realtimePrefaultMB = recConfig.getint('realtime', 'prefaultMB', fallback=realtimePrefaultMB)
+
+    #get engine watchdog settings:
+    watchdogEnabled = recConfig.getboolean('watchdog', 'enabled', fallback=watchdogEnabled)
+    watchdogTimeout = recConfig.getfloat('watchdog', 'timeout', fallback=watchdogTimeout)
+    watchdogMaxRestarts = recConfig.getint('watchdog', 'maxRestarts', fallback=watchdogMaxRestarts)
+
+    #get sampling profiler settings:
+    profileRate = recConfig.getfloat('profiler', 'rate', fallback=profileRate)
+    profileDir = recConfig.get('profiler', 'dir', fallback=profileDir)
+
+    #get logging settings:
+    logMaxBytes = recConfig.getint('logging', 'maxBytes', fallback=logMaxBytes)
+    logBackups = recConfig.getint('logging', 'backups', fallback=logBackups)
+    logQueueSize = recConfig.getint('logging', 'queueSize', fallback=logQueueSize)
+
     #get user preferences:
     idleSeconds = recConfig.getfloat('userPreferences', 'idleSeconds')
     auditionTime = recConfig.getfloat('userPreferences', 'auditionTime')
+    autoArm = recConfig.getboolean('userPreferences', 'autoArm', fallback=autoArm)
+
+    return 0
 
+
+###############################################################################
+# Function Name:
+#   getSettings
+# Description:
+#   returns the current settings (the module's variables of simple types),
+#   so they can be passed to the engine process
+# Parameters:
+#   none
+# Return value:
+#   dict of values by variable name
+###############################################################################
+def getSettings():
+    return {name: value for name, value in globals().items()
+            if not name.startswith("_") and not name.isupper() and isinstance(value, (bool, int, float, str))}
+
+###############################################################################
+# Function Name:
+#   reloadConfig
+# Description:
+#   reads piRecord.cfg again and checks the recording configuration (see
+#   checkRecConfig).  The current settings are left as they are, for the
+#   caller to apply the new ones (with setSettings) once the engine has.
+# Parameters:
+#   none
+# Return value:
+#   tuple of (the settings read, as getSettings returns them, else None if
+#   piRecord.cfg can't be read or isn't valid; the problem found, else None)
+###############################################################################
+def reloadConfig():
+    old = getSettings()
+    try:
+        getRecDevConfig()
+        error = checkRecConfig()
+    except (configparser.Error, ValueError) as err:
+        error = str(err)
+    settings = getSettings() if error == None else None
+    setSettings(old)
+    return settings, error
+
+###############################################################################
+# Function Name:
+#   setSettings
+# Description:
+#   applies settings returned by getSettings (in the engine process)
+# Parameters:
+#   settings - dict of values by variable name
+# Return value:
+#   0
+###############################################################################
+def setSettings(settings):
+    globals().update(settings)
     return 0
 
 
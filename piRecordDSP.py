@@ -0,0 +1,400 @@
+###############################################################################
+# piRecordDSP.py - Raspberry Pi audio recorder signal processing module
+# Description:
+#   streaming signal processing used on recorded audio.  Every function works
+#   on NumPy blocks of shape (frames, channels) and keeps whatever state it
+#   needs between blocks, so files of any length are processed in constant
+#   memory.
+###############################################################################
+
+import math
+import numpy
+
+# most output samples computed in one step by the resampler's gather path
+MAX_GATHER = 8192
+
+# outputs per phase from which the resampler computes phase by phase
+MIN_PHASE_RUN = 64
+
+###############################################################################
+# Class Name:
+#   Resampler
+# Description:
+#   streaming polyphase resampler for a rational rate change L/M.  The
+#   prototype low pass filter is a Kaiser windowed sinc split into L phases of
+#   tapsPerPhase taps; each output sample is one phase applied to the most
+#   recent input samples.  Outputs are computed a whole block at a time, and
+#   the last input samples are kept so consecutive blocks join seamlessly.
+#   The filter delay is removed, so output sample k lines up with input time
+#   k * inRate / outRate.
+###############################################################################
+class Resampler:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   designs the filter for the given rate change
+    # Parameters:
+    #   inRate - input sample rate
+    #   outRate - output sample rate
+    #   nchannels - number of channels
+    #   tapsPerPhase - filter length per phase (quality vs. CPU)
+    #   rolloff - pass band edge as a fraction of the lower Nyquist frequency
+    #   beta - Kaiser window shape (stop band attenuation)
+    ###########################################################################
+    def __init__(self, inRate, outRate, nchannels, tapsPerPhase=32, rolloff=0.94, beta=9.0):
+        g = math.gcd(int(inRate), int(outRate))
+        self.L = int(outRate) // g
+        self.M = int(inRate) // g
+        self.T = tapsPerPhase
+        self.nchannels = nchannels
+
+        # prototype filter at the upsampled rate L * inRate, centred on a
+        # whole number of output samples so the delay can be removed exactly
+        n = self.T * self.L
+        self.delay = int(round((n - 1) / 2.0 / self.M))
+        fc = rolloff * min(1.0, self.L / self.M) / self.L
+        t = numpy.arange(n) - self.delay * self.M
+        h = fc * numpy.sinc(fc * t) * numpy.kaiser(n, beta) * self.L
+
+        # phase p uses taps p, p+L, p+2L... ; taps run backwards in time.  Each
+        # phase is scaled to unity gain at DC.
+        phases = h.reshape(self.T, self.L).T
+        phases = phases / phases.sum(axis=1, keepdims=True)
+        self.phases = numpy.ascontiguousarray(phases, dtype=numpy.float32)
+        self.taps = numpy.arange(self.T)
+        self.reset()
+
+    ###########################################################################
+    # Method Name:
+    #   reset
+    # Description:
+    #   clears the filter history to start a new stream
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def reset(self):
+        self.history = numpy.zeros((self.T - 1, self.nchannels), dtype=numpy.float32)
+        self.inCount = 0
+        self.nextOut = 0
+        self.outCount = 0
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   filters a block, producing every output sample whose newest input
+    #   sample is now available.  Large blocks are computed phase by phase:
+    #   every Lth output uses the same phase, on inputs M apart, so each
+    #   phase is a strided FIR over the block.  Small blocks gather the input
+    #   window of each output sample instead.
+    # Parameters:
+    #   x - block of input samples, shape (frames, channels)
+    # Return value:
+    #   block of output samples including the filter delay
+    ###########################################################################
+    def run(self, x):
+        buf = numpy.concatenate((self.history, x.astype(numpy.float32, copy=False)))
+        bufStart = self.inCount - (self.T - 1)
+        self.inCount += len(x)
+
+        startOut = self.nextOut
+        endOut = (self.inCount * self.L + self.M - 1) // self.M
+        self.nextOut = endOut
+        self.history = buf[len(buf) - (self.T - 1):]
+        nout = endOut - startOut
+        y = numpy.empty((nout, self.nchannels), dtype=numpy.float32)
+
+        if nout >= self.L * MIN_PHASE_RUN:
+            for r in range(self.L):
+                t0 = (startOut + r) * self.M
+                p = t0 % self.L
+                b = t0 // self.L - bufStart
+                n = (nout - r + self.L - 1) // self.L
+                acc = numpy.zeros((n, self.nchannels), dtype=numpy.float32)
+                for j in range(self.T):
+                    acc += self.phases[p, j] * buf[b-j:b-j+(n-1)*self.M+1:self.M]
+                y[r::self.L] = acc
+            return y
+
+        # gather the input window of every output sample, a slice at a time
+        # to bound the memory used
+        k = numpy.arange(startOut, endOut, dtype=numpy.int64) * self.M
+        for i in range(0, nout, MAX_GATHER):
+            ks = k[i:i+MAX_GATHER]
+            idx = (ks // self.L - bufStart)[:, None] - self.taps[None, :]
+            y[i:i+MAX_GATHER] = numpy.einsum('kt,ktc->kc', self.phases[ks % self.L], buf[idx])
+        return y
+
+    ###########################################################################
+    # Method Name:
+    #   process
+    # Description:
+    #   resamples a block of input
+    # Parameters:
+    #   x - block of input samples, shape (frames, channels)
+    # Return value:
+    #   block of resampled samples, shape (frames, channels)
+    ###########################################################################
+    def process(self, x):
+        y = self.run(x)
+        if self.outCount < self.delay:
+            drop = min(len(y), self.delay - self.outCount)
+            self.outCount += drop
+            y = y[drop:]
+        return y
+
+    ###########################################################################
+    # Method Name:
+    #   flush
+    # Description:
+    #   ends the stream, returning the output still held in the filter.  The
+    #   total output length is the input length scaled by the rate change.
+    # Parameters:
+    #   none
+    # Return value:
+    #   the remaining resampled samples
+    ###########################################################################
+    def flush(self):
+        total = (self.inCount * self.L + self.M - 1) // self.M
+        emitted = max(0, self.nextOut - self.delay)
+        inCount = self.inCount
+        y = self.process(numpy.zeros((self.T, self.nchannels), dtype=numpy.float32))
+        self.inCount = inCount
+        return y[:max(0, total - emitted)]
+
+###############################################################################
+# Class Name:
+#   FractionalResampler
+# Description:
+#   streaming resampler for a ratio that may change from block to block, used
+#   to follow the drift between two clocks.  Input is written as it arrives
+#   and output is read a block at a time at the current ratio (input frames
+#   per output frame).  Each output sample is a Kaiser windowed sinc centred
+#   on its fractional input position.  The kernel is a polynomial in the
+#   fraction (a Farrow structure), so a block costs one small matrix product
+#   per channel: the polynomial's FIR outputs are computed for every input
+#   sample the block uses and combined per output sample by its fraction.
+#   Positions count input frames since the stream started, so the reader can
+#   seek to an absolute position (e.g. to align the stream).
+###############################################################################
+class FractionalResampler:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   designs the kernel polynomials
+    # Parameters:
+    #   nchannels - number of channels
+    #   taps - kernel length (even; quality vs. CPU)
+    #   order - polynomial order in the fraction
+    #   rolloff - pass band edge as a fraction of the Nyquist frequency
+    #   beta - Kaiser window shape (stop band attenuation)
+    ###########################################################################
+    def __init__(self, nchannels, taps=24, order=5, rolloff=0.9, beta=8.0):
+        self.nchannels = nchannels
+        half = taps // 2
+        self.offsets = numpy.arange(1 - half, half + 1)
+        self.reach = half
+
+        # fit each tap's value over the fraction (the sample's distance past
+        # its input sample) with a polynomial; row m multiplies fraction**m
+        frac = numpy.linspace(0.0, 1.0, 8 * taps + 1)
+        t = self.offsets[None, :] - frac[:, None]
+        window = numpy.i0(beta * numpy.sqrt(numpy.clip(1.0 - (t / half) ** 2, 0.0, 1.0))) / numpy.i0(beta)
+        h = rolloff * numpy.sinc(rolloff * t) * window
+        h /= h.sum(axis=1, keepdims=True)
+        self.coef = numpy.ascontiguousarray(numpy.polynomial.polynomial.polyfit(frac, h, order), dtype=numpy.float32)
+        self.buf = numpy.zeros((nchannels, 0), dtype=numpy.float32)
+        self.bufStart = 0
+        self.written = 0
+        self.pos = 0.0
+
+    ###########################################################################
+    # Method Name:
+    #   write
+    # Description:
+    #   appends input samples
+    # Parameters:
+    #   x - block of input samples, shape (frames, channels)
+    # Return value:
+    #   none
+    ###########################################################################
+    def write(self, x):
+        self.buf = numpy.concatenate((self.buf, x.T.astype(numpy.float32)), axis=1)
+        self.written += len(x)
+
+    ###########################################################################
+    # Method Name:
+    #   seek
+    # Description:
+    #   moves the read position.  Input not yet written, or already dropped,
+    #   reads as silence.
+    # Parameters:
+    #   pos - the input position of the next output sample
+    # Return value:
+    #   none
+    ###########################################################################
+    def seek(self, pos):
+        self.pos = float(pos)
+        self.trim()
+
+    ###########################################################################
+    # Method Name:
+    #   available
+    # Description:
+    #   returns how many output samples can be read at a ratio before the
+    #   kernel reaches past the input written so far
+    # Parameters:
+    #   ratio - input frames per output frame
+    # Return value:
+    #   the number of output samples
+    ###########################################################################
+    def available(self, ratio):
+        room = self.written - self.reach - self.pos
+        return int(room / ratio) + 1 if room >= 0 else 0
+
+    ###########################################################################
+    # Method Name:
+    #   read
+    # Description:
+    #   computes output samples at a ratio
+    # Parameters:
+    #   n - number of output samples
+    #   ratio - input frames per output frame
+    # Return value:
+    #   block of output samples, shape (n, channels)
+    ###########################################################################
+    def read(self, n, ratio):
+        y = numpy.zeros((n, self.nchannels), dtype=numpy.float32)
+        if n == 0:
+            return y
+        t = self.pos + ratio * numpy.arange(n)
+        idx = numpy.floor(t).astype(numpy.int64)
+        frac = (t - idx).astype(numpy.float32)
+
+        # the input the block's kernels cover, padded with silence where it
+        # reaches outside what is held
+        lo = int(idx[0]) + int(self.offsets[0])
+        hi = int(idx[-1]) + int(self.offsets[-1]) + 1
+        seg = self.buf[:, max(0, lo - self.bufStart):max(0, hi - self.bufStart)]
+        before = min(hi, self.bufStart) - lo if lo < self.bufStart else 0
+        after = (hi - lo) - before - seg.shape[1]
+        if before or after:
+            seg = numpy.concatenate((numpy.zeros((self.nchannels, before), dtype=numpy.float32), seg,
+                                     numpy.zeros((self.nchannels, after), dtype=numpy.float32)), axis=1)
+
+        rel = idx - idx[0]
+        seg = numpy.ascontiguousarray(seg)
+        step = seg.strides[1]
+        windows = numpy.lib.stride_tricks.as_strided(seg, (self.nchannels, len(self.offsets), len(rel) and int(rel[-1]) + 1),
+                                                     (seg.strides[0], step, step), writeable=False)
+        for c in range(self.nchannels):
+            v = (self.coef @ windows[c])[:, rel]
+            acc = v[-1]
+            for m in range(len(v) - 2, -1, -1):
+                acc = acc * frac + v[m]
+            y[:, c] = acc
+        self.pos += ratio * n
+        self.trim()
+        return y
+
+    ###########################################################################
+    # Method Name:
+    #   trim
+    # Description:
+    #   drops input the kernel can no longer reach
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def trim(self):
+        drop = min(int(math.floor(self.pos)) + int(self.offsets[0]) - self.bufStart, self.buf.shape[1])
+        if drop > 0:
+            self.buf = self.buf[:, drop:]
+            self.bufStart += drop
+        if self.buf.shape[1] == 0:
+            self.bufStart = max(self.bufStart, self.written)
+
+###############################################################################
+# Function Name:
+#   biquadImpulse
+# Description:
+#   computes the impulse response of a cascade of biquad filters
+# Parameters:
+#   sections - list of (b0, b1, b2, a1, a2) coefficient tuples
+#   length - number of samples of the response to compute
+# Return value:
+#   the impulse response
+###############################################################################
+def biquadImpulse(sections, length):
+    h = numpy.zeros(length)
+    h[0] = 1.0
+    for b0, b1, b2, a1, a2 in sections:
+        x1 = x2 = y1 = y2 = 0.0
+        out = numpy.zeros(length)
+        for n in range(length):
+            x0 = h[n]
+            y0 = b0 * x0 + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            out[n] = y0
+            x2, x1, y2, y1 = x1, x0, y1, y0
+        h = out
+    return h
+
+###############################################################################
+# Class Name:
+#   FIRFilter
+# Description:
+#   streaming FIR filter using FFT overlap-save convolution.  All the FFT
+#   segments of a block are transformed together, and the last input samples
+#   are kept so consecutive blocks join seamlessly.  Output sample n is the
+#   filter applied to input samples up to n (the filter delay isn't removed).
+###############################################################################
+class FIRFilter:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   prepares the filter's frequency response
+    # Parameters:
+    #   h - the filter taps
+    #   nchannels - number of channels
+    ###########################################################################
+    def __init__(self, h, nchannels):
+        self.taps = len(h)
+        self.nfft = 1 << (4 * self.taps - 1).bit_length()
+        self.step = self.nfft - self.taps + 1
+        self.H = numpy.fft.rfft(h, self.nfft)[None, :, None]
+        self.nchannels = nchannels
+        self.history = numpy.zeros((self.taps - 1, nchannels))
+
+    ###########################################################################
+    # Method Name:
+    #   process
+    # Description:
+    #   filters a block
+    # Parameters:
+    #   x - block of input samples, shape (frames, channels)
+    # Return value:
+    #   block of filtered samples, shape (frames, channels)
+    ###########################################################################
+    def process(self, x):
+        n = len(x)
+        if n == 0:
+            return numpy.zeros((0, self.nchannels))
+        buf = numpy.concatenate((self.history, x))
+        self.history = buf[len(buf) - (self.taps - 1):]
+
+        # split into segments that each produce step new outputs
+        nseg = -(-n // self.step)
+        buf = numpy.concatenate((buf, numpy.zeros((nseg * self.step + self.taps - 1 - len(buf), self.nchannels))))
+        seg = numpy.lib.stride_tricks.sliding_window_view(buf, self.nfft, axis=0)[::self.step]
+        seg = seg.transpose(0, 2, 1)
+        y = numpy.fft.irfft(numpy.fft.rfft(seg, axis=1) * self.H, self.nfft, axis=1)
+        return y[:, self.taps-1:, :].reshape(-1, self.nchannels)[:n]
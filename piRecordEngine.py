@@ -9,30 +9,153 @@
 ###############################################################################
 
 import multiprocessing
-import alsaaudio
+import queue
+import logging
+from piRecordHardware import alsaaudio
 import piRecordConf
 import piRecordUtils
+import piRecordTelemetry
+import piRecordLog
+import piRecordSpectrum
+import piRecordRealtime
+import piRecordProfile
+import signal
+import os
+import threading
 import time
-import wave
+
+# modules only the engine process needs, imported by load_engine_modules so
+# the UI process starts without them (and numpy)
+piRecordFormat = None
+piRecordWave = None
+piRecordCompress = None
+piRecordLoudness = None
+piRecordFanout = None
+piRecordMonitor = None
+piRecordMulti = None
+piRecordResample = None
+piRecordIO = None
+piRecordTrim = None
+piRecordPipeline = None
+piRecordPlayback = None
+piRecordOverdub = None
 
 # Message ids used to send to command queue 
 REQ_REC_START = 1
 REQ_REC_STOP = 2
 REQ_REC_CONT = 3
-#TODO: support playback
 REQ_PLY_START = 4
 REQ_PLY_STOP = 5
 REQ_PLY_CONT = 6
+REQ_PLY_SEEK = 11
+REQ_PLY_CUE = 12
+REQ_LAT_TEST = 13
+REQ_CFG_SET = 14
+
+REQ_ANA_START = 7
+REQ_ANA_STOP = 8
+REQ_ANA_CONT = 9
+
+REQ_ENG_STOP = 10
+
+# heartbeat fields the engine keeps up to date in shared memory, so the UI
+# can tell it has died or stalled (see piRecordWatchdog).  Sample times are
+# the capture times of the take's first frame and of the last frame written.
+# The playback fields are the player's state (PLAY_xxx),
+# the index of the file playing in the playlist, and the position in and
+# length of the file in seconds (while overdubbing, those of the backing
+# take).  The latency field is the last latency test's result (LATENCY_xxx
+# or the latency in frames).  The config field is the number of the last
+# configuration change applied (negative if it failed, see apply_config).
+HB_TIME = 0
+HB_FRAMES = 1
+HB_FIRST_SAMPLE = 2
+HB_LAST_SAMPLE = 3
+HB_PLAY_STATE = 4
+HB_PLAY_INDEX = 5
+HB_PLAY_POS = 6
+HB_PLAY_LEN = 7
+HB_LATENCY = 8
+HB_CONFIG = 9
+HB_SIZE = 10
+
+# player states (HB_PLAY_STATE)
+PLAY_STOPPED = 0
+PLAY_PLAYING = 1
+PLAY_STARTING = 2
+PLAY_ERROR = 3
+
+# latency test results (HB_LATENCY) other than a latency
+LATENCY_NONE = -1
+LATENCY_TESTING = -2
+LATENCY_FAILED = -3
+
+# configuration change states (see get_config_status)
+CONFIG_PENDING = 0
+CONFIG_APPLIED = 1
+CONFIG_FAILED = 2
+
+# settings the capture device is set up with, and those the extra devices
+# and the stage pipeline are set up with as well
+DEVICE_SETTINGS = ("recDevice", "recChannels", "recRate", "recFormat", "recPeriodSize")
+MULTI_SETTINGS = DEVICE_SETTINGS + ("floatStorage", "multiDevices", "multiChannels", "multiOffsets", "multiTaps")
+PIPELINE_SETTINGS = MULTI_SETTINGS + ("storeRate", "pipelineStages", "pipelineModes", "pipelinePolicies",
+                                      "pipelineCpus", "pipelineRingSecs", "pipelineChunkFrames")
+
+# most seconds between heartbeats while the engine is idle
+HEARTBEAT_PERIOD = 0.5
+
+# seconds a dead engine is given to exit once terminated before it is killed
+ENGINE_KILL_TIMEOUT = 1.0
+
+# seconds to wait for the engine process to report it is ready, and to stop
+ENGINE_START_TIMEOUT = 10.0
+ENGINE_STOP_TIMEOUT = 5.0
+
+# seconds between progress events while recording
+PROGRESS_INTERVAL = 60.0
 
 # Initialize global variables
 curr_filename = "$"
 recording = False
 pEngine = None
+pQueue = None
+pReply = None
+anaResult = None
+heartbeat = None
+engineLogQueue = None
+take_base = None
+take_part = 1
+# the store rate and safety copy directory the take in progress was started
+# with (a reload only changes the settings between takes)
+take_store_rate = 1
+take_safety_dir = None
+take_frames = 0
+take_captured = 0
+take_frame_size = 1
+take_resume = None
 recPCM = None
+recConvert = None
+recMeter = None
+recMonitor = None
+recMulti = None
+recResample = None
+recAnalyzer = None
+recPipeline = None
+recPlayer = None
+recOverdub = None
+config_seq = 0
+loopStats = piRecordRealtime.LoopStats()
+
+# held by the UI process's calls that change the engine or the take, as the
+# watchdog may restart the engine from its own thread
+engine_lock = threading.RLock()
 
 # Debug vars
 data_cnt = 0
 nodata_cnt = 0
+write_secs = 0.0
+write_max = 0.0
 
 ###############################################################################
 # Function Name:
@@ -41,23 +164,35 @@ nodata_cnt = 0
 #   called externally to start the recording process by sending a start request
 #   to the engine 
 # Parameters:
-#   none
+#   filename - the file to record to; None starts a new take with the next
+#              filename, otherwise the take is continued in this file
+#   backing - a take's part files to play while recording (overdub), None
+#             to record without
 # Return value: 
 #   0 = success else error
 ###############################################################################
-def start_record():
-    global curr_filename
+def start_record(filename=None, backing=None):
+    global curr_filename, take_base, take_part, take_store_rate, take_safety_dir
     global recording
     status = 0
-    print ("\n**NEW RECORDING**")
-    print ("start_record() called, recording = ", recording)
-    if recording == False:
-        curr_filename = piRecordUtils.getNextFilename()
-        piRecordUtils.setCurrentFilename(curr_filename)
-        if status == 0:  #no error
-            pQueue.put(REQ_REC_START)
-            print ("REQ_REC_START sent.")
-            recording = True
+    with engine_lock:
+        if pEngine == None:
+            status = -1
+        elif recording == False:
+            if filename == None:
+                take_base = piRecordUtils.getNextFilename()
+                take_part = 1
+                take_store_rate = piRecordConf.getStoreRate()
+                take_safety_dir = piRecordConf.safetyDir if piRecordConf.safetyEnabled else None
+                filename = take_base
+            curr_filename = filename
+            piRecordUtils.setCurrentFilename(curr_filename)
+            if status == 0:  #no error
+                if backing != None:
+                    heartbeat[HB_PLAY_STATE] = PLAY_STARTING
+                pQueue.put((REQ_REC_START, backing))
+                piRecordLog.event("record_requested", interval=0, file=curr_filename)
+                recording = True
     return status == 0
 
 ###############################################################################
@@ -72,13 +207,14 @@ def start_record():
 #   0 = success else error
 ###############################################################################
 def stop_record():
-    global recording
+    global recording, take_resume
     status = 0
-    print ("stop_record() called, recording = "), recording
-    if recording == True:
-        pQueue.put(REQ_REC_STOP)
-        print ("REQ_REC_STOP sent" )
-        recording = False
+    with engine_lock:
+        take_resume = None
+        if recording == True:
+            pQueue.put(REQ_REC_STOP)
+            piRecordLog.event("stop_requested", interval=0)
+            recording = False
     return status == 0
 
 ###############################################################################
@@ -93,27 +229,28 @@ def stop_record():
 ###############################################################################
 def audition(duration):
 
+    import piRecordFormat
+    import piRecordWave
     if curr_filename == '$':
         return -1
-    f = wave.open(curr_filename, 'rb')
+    if not os.path.exists(curr_filename):
+        piRecordLog.event("audition_unavailable", logging.WARNING, file=curr_filename, reason="compressed")
+        return -1
+    f = piRecordWave.WaveReader(curr_filename)
+
+    # 8bit is unsigned in wav files, wider integer samples are signed and
+    # packed little endian, float samples are little endian
+    fmt = piRecordFormat.getPlaybackFormat(f.getsampwidth(), f.getformattag())
+    if fmt == None:
+        piRecordLog.event("audition_unavailable", logging.WARNING, file=curr_filename, reason="unsupported format")
+        f.close()
+        return (-1)
+
     device = alsaaudio.PCM(device=piRecordConf.getRecDevice())
     # Set attributes
     device.setchannels(f.getnchannels())
     device.setrate(f.getframerate())
-
-    # 8bit is unsigned in wav files
-    if f.getsampwidth() == 1:
-        device.setformat(alsaaudio.PCM_FORMAT_U8)
-    # Otherwise we assume signed data, little endian
-    elif f.getsampwidth() == 2:
-        device.setformat(alsaaudio.PCM_FORMAT_S16_LE)
-    elif f.getsampwidth() == 3:
-        device.setformat(alsaaudio.PCM_FORMAT_S24_LE)
-    elif f.getsampwidth() == 4:
-        device.setformat(alsaaudio.PCM_FORMAT_S32_LE)
-    else:
-        print ("Playback error: unsupported format")
-        return (-1)
+    device.setformat(fmt)
     
     periodsize = int(f.getframerate() / 8)
 
@@ -130,19 +267,469 @@ def audition(duration):
 
     return 0
 
+###############################################################################
+# Function Name:
+#   start_analysis
+# Description:
+#   called externally to start the spectrum/tuner analysis.  If no recording
+#   is in progress, the engine captures just for the analysis.
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def start_analysis():
+    pQueue.put(REQ_ANA_START)
+    return 0
+
+###############################################################################
+# Function Name:
+#   stop_analysis
+# Description:
+#   called externally to stop the spectrum/tuner analysis
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def stop_analysis():
+    pQueue.put(REQ_ANA_STOP)
+    return 0
+
+###############################################################################
+# Function Name:
+#   get_analysis
+# Description:
+#   called externally to read the latest analysis results
+# Parameters:
+#   none
+# Return value:
+#   list laid out as described in piRecordSpectrum (RESULT_xxx)
+###############################################################################
+def get_analysis():
+    with anaResult.get_lock():
+        return list(anaResult)
+
+###############################################################################
+# Function Name:
+#   start_playback
+# Description:
+#   called externally to start playing a list of wave files.  The state reads
+#   PLAY_STARTING until the engine has started (or failed to start) playing.
+# Parameters:
+#   files - the wave files, played in order without gaps
+# Return value:
+#   0 = success else error
+###############################################################################
+def start_playback(files):
+    if pEngine == None:
+        return -1
+    heartbeat[HB_PLAY_STATE] = PLAY_STARTING
+    pQueue.put((REQ_PLY_START, list(files)))
+    return 0
+
+###############################################################################
+# Function Name:
+#   stop_playback
+# Description:
+#   called externally to stop playing
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def stop_playback():
+    pQueue.put(REQ_PLY_STOP)
+    return 0
+
+###############################################################################
+# Function Name:
+#   seek_playback
+# Description:
+#   called externally to move the playback position
+# Parameters:
+#   secs - seconds to move (negative to go back)
+# Return value:
+#   0
+###############################################################################
+def seek_playback(secs):
+    pQueue.put((REQ_PLY_SEEK, secs))
+    return 0
+
+###############################################################################
+# Function Name:
+#   cue_playback
+# Description:
+#   called externally to move playback to the next cue point, or back to the
+#   start of this one (see piRecordPlayback.Player.cue)
+# Parameters:
+#   direction - 1 for the next, -1 to go back
+# Return value:
+#   0
+###############################################################################
+def cue_playback(direction):
+    pQueue.put((REQ_PLY_CUE, direction))
+    return 0
+
+###############################################################################
+# Function Name:
+#   get_playback
+# Description:
+#   called externally to read where playback is
+# Parameters:
+#   none
+# Return value:
+#   (state (PLAY_xxx), index of the file playing, seconds into it, its
+#   length in seconds)
+###############################################################################
+def get_playback():
+    if heartbeat == None:
+        return (PLAY_ERROR, 0, 0.0, 0.0)
+    return (int(heartbeat[HB_PLAY_STATE]), int(heartbeat[HB_PLAY_INDEX]), heartbeat[HB_PLAY_POS],
+            heartbeat[HB_PLAY_LEN])
+
+###############################################################################
+# Function Name:
+#   measure_latency
+# Description:
+#   called externally to run the click test (see piRecordOverdub).  The
+#   result reads LATENCY_TESTING until the test has finished.
+# Parameters:
+#   none
+# Return value:
+#   0 = success else error
+###############################################################################
+def measure_latency():
+    if pEngine == None:
+        return -1
+    heartbeat[HB_LATENCY] = LATENCY_TESTING
+    pQueue.put(REQ_LAT_TEST)
+    return 0
+
+###############################################################################
+# Function Name:
+#   get_latency
+# Description:
+#   called externally to read the last latency test's result
+# Parameters:
+#   none
+# Return value:
+#   the latency in frames, else LATENCY_xxx
+###############################################################################
+def get_latency():
+    if heartbeat == None:
+        return LATENCY_FAILED
+    return int(heartbeat[HB_LATENCY])
+
+###############################################################################
+# Function Name:
+#   apply_config
+# Description:
+#   called externally to pass changed settings to the engine, which applies
+#   them between takes (once the take in progress, if any, has stopped)
+# Parameters:
+#   settings - the settings, as piRecordConf.getSettings returns them
+# Return value:
+#   the change's number, for get_config_status, else -1 if there is no
+#   engine
+###############################################################################
+def apply_config(settings):
+    global config_seq
+    if pEngine == None:
+        return -1
+    config_seq += 1
+    pQueue.put((REQ_CFG_SET, settings, config_seq))
+    return config_seq
+
+###############################################################################
+# Function Name:
+#   get_config_status
+# Description:
+#   called externally to find out whether a configuration change has been
+#   applied
+# Parameters:
+#   seq - the change's number (see apply_config)
+# Return value:
+#   CONFIG_PENDING, CONFIG_APPLIED or CONFIG_FAILED
+###############################################################################
+def get_config_status(seq):
+    if heartbeat == None or seq < 0:
+        return CONFIG_FAILED
+    done = int(heartbeat[HB_CONFIG])
+    if done == seq:
+        return CONFIG_APPLIED
+    if done == -seq:
+        return CONFIG_FAILED
+    return CONFIG_PENDING
+
+###############################################################################
+# Function Name:
+#   signal_engine
+# Description:
+#   called externally to pass a signal on to the engine process
+# Parameters:
+#   signum - the signal number
+# Return value:
+#   0
+###############################################################################
+def signal_engine(signum):
+    if pEngine != None and pEngine.pid != None:
+        os.kill(pEngine.pid, signum)
+    return 0
+
+###############################################################################
+# Function Name:
+#   start_process
+# Description:
+#   starts the recording engine process (called once the configuration has
+#   been loaded).  The process is spawned rather than forked, so it starts
+#   from a fresh interpreter instead of a copy of the UI process and its
+#   LCD/GPIO state, and is given the UI's current settings.  Waits for the
+#   engine to report that it is ready.
+# Parameters:
+#   logQueue - the queue the engine's log records go to (see piRecordLog),
+#              None to leave the engine's logging alone
+# Return value:
+#   dict with the engine's pid, the settings it is running with, any that
+#   differ from the UI's (configMismatch), the seconds it took to start and
+#   the RSS of both processes in MB; None if it didn't report in time
+###############################################################################
+def start_process(logQueue=None):
+    global pEngine, pQueue, pReply, anaResult, heartbeat, engineLogQueue, recording
+    with engine_lock:
+        if pEngine != None:
+            stop_process()
+        ctx = multiprocessing.get_context("spawn")
+        pQueue = ctx.Queue()
+        pReply = ctx.Queue()
+        anaResult = ctx.Array('d', piRecordSpectrum.RESULT_SIZE)
+        heartbeat = ctx.RawArray('d', HB_SIZE)
+        heartbeat[HB_LATENCY] = LATENCY_NONE
+        engineLogQueue = logQueue
+        recording = False
+        settings = piRecordConf.getSettings()
+        start_time = time.time()
+        pEngine = ctx.Process(target=piRecordEngine, args=(pQueue, pReply, anaResult, heartbeat, settings, logQueue),
+                              name="piRecordEngine")
+        pEngine.start()
+        try:
+            status = pReply.get(timeout=ENGINE_START_TIMEOUT)
+        except queue.Empty:
+            piRecordLog.event("engine_not_ready", logging.ERROR, interval=0, timeout=ENGINE_START_TIMEOUT)
+            return None
+        if status.get("deviceError"):
+            piRecordLog.event("device_error", logging.ERROR, interval=0, error=status["deviceError"])
+        status["startSecs"] = time.time() - start_time
+        status["uiRssMB"] = piRecordUtils.getProcessRss()
+        status["configMismatch"] = sorted(name for name, value in settings.items() if status["settings"].get(name) != value)
+        return status
+
 ###############################################################################
 # Function Name:
 #   stop_process
 # Description:
-#   stops the recording engine process (called upon program termination)
+#   stops the recording engine process (called upon program termination).
+#   The engine closes any take in progress before it exits; it is only
+#   terminated if it doesn't exit in time.
 # Parameters:
 #   none
 # Return value: 
 #   0
 ###############################################################################
 def stop_process():
-    #TODO: stop/cleanup any recording in process
-    pEngine.terminate()
+    global pEngine, recording
+    with engine_lock:
+        if pEngine == None:
+            return 0
+        if pEngine.is_alive():
+            pQueue.put(REQ_ENG_STOP)
+            pEngine.join(ENGINE_STOP_TIMEOUT)
+            if pEngine.is_alive():
+                piRecordLog.event("engine_terminated", logging.WARNING, interval=0)
+                pEngine.terminate()
+                pEngine.join()
+        pEngine = None
+        recording = False
+    return 0
+
+###############################################################################
+# Function Name:
+#   check_engine
+# Description:
+#   called externally (by the watchdog) to check that the engine process is
+#   alive and its loop is still running
+# Parameters:
+#   timeout - most seconds allowed since the engine's last heartbeat
+# Return value:
+#   None if the engine is healthy (or not started), else why it isn't
+###############################################################################
+def check_engine(timeout):
+    with engine_lock:
+        if pEngine == None:
+            return None
+        if not pEngine.is_alive():
+            return "exited with code %s" % pEngine.exitcode
+        stalled = time.time() - heartbeat[HB_TIME]
+        if stalled > timeout:
+            return "stalled for %.1f s" % stalled
+    return None
+
+###############################################################################
+# Function Name:
+#   kill_process
+# Description:
+#   called externally (by the watchdog) to end an engine that has died or
+#   stalled, without waiting for it.  The part of the take it was recording
+#   is finalized, and the take is kept for restart_process to continue.
+# Parameters:
+#   reason - why the engine is killed, for the log
+# Return value:
+#   dict describing the take's last part (file, frames in it, frames written
+#   that didn't reach it (unsaved), the capture time of its last frame,
+#   lastSample, and the take's store rate), None if no take was in progress
+###############################################################################
+def kill_process(reason):
+    global pEngine, recording, take_resume
+    with engine_lock:
+        if pEngine == None:
+            return take_resume
+        piRecordLog.event("engine_failed", logging.ERROR, interval=0, pid=pEngine.pid, reason=reason,
+                          recording=recording)
+        if pEngine.is_alive():
+            pEngine.terminate()
+            pEngine.join(ENGINE_KILL_TIMEOUT)
+            if pEngine.is_alive():
+                pEngine.kill()
+                pEngine.join()
+        pEngine = None
+        if recording:
+            recording = False
+            # frames the engine wrote that never reached the file (still in
+            # its buffers) count as part of the gap
+            filename = piRecordUtils.getCurrentFilename()
+            frames = int(heartbeat[HB_FRAMES])
+            saved = finalize_take(filename, frames)
+            take_resume = {"file": filename, "frames": saved, "unsaved": frames - saved,
+                           "lastSample": heartbeat[HB_LAST_SAMPLE] - (frames - saved) / float(take_store_rate),
+                           "rate": take_store_rate}
+        return take_resume
+
+###############################################################################
+# Function Name:
+#   restart_process
+# Description:
+#   called externally (by the watchdog) to replace an engine that has died
+#   or stalled.  The old process is killed (see kill_process) and a new
+#   engine is started, which opens the capture device again.  If a take was
+#   in progress (or was when an earlier restart failed) it is continued in
+#   the take's next numbered file (see piRecordUtils.getPartFilename).
+# Parameters:
+#   reason - why the engine is restarted, for the log
+# Return value:
+#   dict with the file the take continues in (next, None if no take was in
+#   progress) and, if one was, the take's last part as from kill_process;
+#   None if the engine didn't start
+###############################################################################
+def restart_process(reason):
+    global take_part, take_resume
+    with engine_lock:
+        kill_process(reason)
+        status = start_process(engineLogQueue)
+        if status == None:
+            return None
+        piRecordLog.event("engine_restarted", logging.WARNING, interval=0, pid=status["pid"],
+                          startSecs=round(status["startSecs"], 3))
+        result = {"next": None}
+        if take_resume != None:
+            result.update(take_resume)
+            take_resume = None
+            take_part += 1
+            result["next"] = piRecordUtils.getPartFilename(take_base, take_part)
+            start_record(result["next"])
+        return result
+
+###############################################################################
+# Function Name:
+#   is_recording
+# Description:
+#   called externally to check whether a take is in progress, including one
+#   waiting for the engine to be restarted
+# Parameters:
+#   none
+# Return value:
+#   True if it is
+###############################################################################
+def is_recording():
+    return recording or take_resume != None
+
+###############################################################################
+# Function Name:
+#   finalize_take
+# Description:
+#   finishes the files of a take part that a dead engine left open.  Wave
+#   files get their header filled in from the data on disk, as does the
+#   safety copy; a flac file is finished by its encoder, which sees the end
+#   of its input when the engine dies.
+# Parameters:
+#   filename - the take part's file
+#   frames - the frames the engine reported writing to it
+# Return value:
+#   the frames in the file (frames if it couldn't be read)
+###############################################################################
+def finalize_take(filename, frames):
+    import piRecordWave
+    files = [filename]
+    if take_safety_dir != None:
+        files.append(os.path.join(take_safety_dir, os.path.basename(curr_filename)))
+    for i, fn in enumerate(files):
+        if not fn.endswith(".wav") or not os.path.exists(fn):
+            continue
+        try:
+            nframes = piRecordWave.finalizeWave(fn)
+        except (OSError, ValueError) as err:
+            piRecordLog.event("take_not_finalized", logging.ERROR, interval=0, file=fn, error=err)
+            continue
+        if i == 0:
+            frames = nframes
+    piRecordLog.event("take_finalized", logging.WARNING, interval=0, file=filename, frames=frames)
+    return frames
+
+###############################################################################
+# Function Name:
+#   wait_first_sample
+# Description:
+#   called externally to wait for the current take's first frame to be
+#   written
+# Parameters:
+#   timeout - most seconds to wait
+# Return value:
+#   the capture time of the first frame, or None if none was written in time
+###############################################################################
+def wait_first_sample(timeout):
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        with engine_lock:
+            if not recording:
+                return None
+            if heartbeat[HB_FRAMES] > 0:
+                return heartbeat[HB_FIRST_SAMPLE]
+        time.sleep(HEARTBEAT_PERIOD / 10)
+    return None
+
+###############################################################################
+# Function Name:
+#   engine_sigusr
+# Description:
+#   handles the user signals passed on by the UI process: SIGUSR1 starts or
+#   stops the sampling profiler and SIGUSR2 writes a profile dump
+# Parameters:
+#   signum - the signal number
+#   frame - current stack frame
+# Return value:
+#   0
+###############################################################################
+def engine_sigusr(signum, frame):
+    piRecordLog.event("profiler", interval=0, action=piRecordProfile.handleSignal(signum, "engine", piRecordTelemetry.snapshot))
     return 0
 
 ###############################################################################
@@ -153,59 +740,243 @@ def stop_process():
 #   It is spawned as a process and monitors the message queues for record/playback
 #   commands. 
 # Parameters:
-#   none
+#   requests - the request queue
+#   reply - queue the ready report is sent on
+#   result - the shared analysis results
+#   beat - the shared heartbeat (HB_xxx)
+#   settings - the configuration, from piRecordConf.getSettings()
+#   logQueue - the queue log records go to (None = log as the module does)
 # Return value: 
 #   0
 ###############################################################################   
-def piRecordEngine():
-    global data_cnt, nodata_cnt
-    global recPCM
+def piRecordEngine(requests, reply, result, beat, settings, logQueue):
+    global data_cnt, nodata_cnt, write_secs, write_max, take_frames, take_captured
+    global recPCM, pQueue, anaResult, heartbeat
+
+    # the UI stops the engine, so ctrl-C in a terminal doesn't cut a take short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pQueue = requests
+    anaResult = result
+    heartbeat = beat
+    piRecordConf.setSettings(settings)
+    if logQueue != None:
+        piRecordLog.attach(logQueue, piRecordConf.logLevel)
 
     # initialize local variables
     curr_fd = 0
-    sleep_time = piRecordConf.engineLoopPd
-    cnt = 0
+    last_progress = 0.0
     rec_in_progress = False
+    pending_config = None
+    piRecordTelemetry.register('engine', engine_stats)
+    piRecordTelemetry.register('log', piRecordLog.getStats)
+    piRecordTelemetry.register('realtime', loopStats.getStats)
+    signal.signal(signal.SIGUSR1, engine_sigusr)
+    signal.signal(signal.SIGUSR2, engine_sigusr)
+
+    # enter real-time mode if configured (each part that isn't permitted is
+    # skipped)
+    if piRecordConf.realtimeEnabled:
+        piRecordRealtime.enterRealtime(piRecordConf.realtimePriority, piRecordConf.realtimeCpu,
+                                       piRecordConf.realtimeLockMemory, piRecordConf.realtimePrefaultMB * 1024 * 1024)
+
+    # load the modules and open the capture device now, while the UI shows
+    # its splash screen, so the first take doesn't wait for them.  If the
+    # device can't be opened, it is tried again when recording starts.
+    load_engine_modules()
+    piRecordTelemetry.register('storage', piRecordIO.getStats)
+    device_error = None
+    try:
+        init_record_input()
+        if piRecordConf.getDeviceCaps(piRecordConf.getRecDevice()) == None:
+            probe_device_caps()
+    except alsaaudio.ALSAAudioError as err:
+        recPCM = None
+        device_error = str(err)
+    init_multi_input()
+    init_pipeline()
+
+    # finish the trims interrupted by a crash or power cut (those a previous
+    # engine started that are still running are left to finish)
+    try:
+        for fn in piRecordWave.recoverTrims(piRecordConf.outputDir, piRecordUtils.isTrimPending):
+            piRecordLog.event("trim_recovered", logging.WARNING, interval=0, file=fn)
+    except (OSError, ValueError) as err:
+        piRecordLog.event("trim_not_recovered", logging.ERROR, interval=0, error=err)
+
+    # report the settings in use and that the engine is ready
+    heartbeat[HB_TIME] = time.time()
+    reply.put({"pid": os.getpid(), "settings": piRecordConf.getSettings(),
+               "engineRssMB": piRecordUtils.getProcessRss(), "deviceError": device_error})
 
     # enter loop...    
     while True:
 
-        # wait for the next request from the message queue 
-        req = pQueue.get()
+        # wait for the next request from the message queue, beating the
+        # heartbeat at least every HEARTBEAT_PERIOD
+        try:
+            req = pQueue.get(timeout=HEARTBEAT_PERIOD)
+        except queue.Empty:
+            req = None
+        heartbeat[HB_TIME] = time.time()
+        args = ()
+        if isinstance(req, tuple):
+            req, args = req[0], req[1:]
+        if recPipeline != None:
+            log_stage_results()
+
+        # apply configuration changes between takes (and not while the
+        # analyzer is using the device)
+        if req == REQ_CFG_SET:
+            pending_config = args
+        if pending_config != None and rec_in_progress == False and recAnalyzer == None:
+            handle_config_req(*pending_config)
+            pending_config = None
 
         # handle start record requests:       
         if req == REQ_REC_START:
-            print ("REQ_REC_START received, calling do_record_start")
+            handle_play_stop_req()
             curr_fd = handle_record_start_req()
             init_record_input()
+            if args and args[0]:
+                handle_overdub_start_req(args[0])
             rec_in_progress = True
             data_cnt = 0
             nodata_cnt = 0
+            write_secs = 0.0
+            write_max = 0.0
+            take_frames = 0
+            take_captured = 0
+            heartbeat[HB_FRAMES] = 0
+            loopStats.reset()
+            last_progress = time.time()
             pQueue.put(REQ_REC_CONT)
 
         # hanlde stop record requests:
         elif req == REQ_REC_STOP:
-            print ("REQ_STOP received, calling do_record_stop")
             handle_record_stop_req(curr_fd)
             rec_in_progress = False
-            print ("data_cnt = ", data_cnt)
-            print ("nodata_cnt = ", nodata_cnt)
+            if recAnalyzer != None:
+                pQueue.put(REQ_ANA_CONT)
 
         # handle continue record requests:
         elif req == REQ_REC_CONT:
             if rec_in_progress == True:
                 handle_record_continue_req(curr_fd, recPCM)
-                time.sleep(sleep_time)
+                if recOverdub != None:
+                    update_play_status(PLAY_PLAYING, recOverdub)
+                piRecordTelemetry.publish()
+                loopStats.sleep(piRecordConf.engineLoopPd)
                 pQueue.put(REQ_REC_CONT)
-                cnt = cnt + 1
-                if cnt >= 500:
-                    cnt = 0
-                    print (".....")
+                if time.time() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.time()
+                    piRecordLog.event("recording", interval=0, blocks=data_cnt, noData=nodata_cnt,
+                                      xruns=loopStats.xruns, writeMaxMs=round(1000.0 * write_max, 3))
+
+        # handle playback requests.  Playback writes a period at a time to
+        # the device, which waits while the device's buffer is full.
+        elif req == REQ_PLY_START:
+            handle_play_stop_req()
+            if rec_in_progress == True:
+                heartbeat[HB_PLAY_STATE] = PLAY_ERROR
+            elif handle_play_start_req(args[0]):
+                pQueue.put(REQ_PLY_CONT)
+
+        elif req == REQ_PLY_STOP:
+            handle_play_stop_req()
+
+        elif req == REQ_PLY_CONT:
+            if recPlayer != None:
+                if handle_play_continue_req():
+                    piRecordTelemetry.publish()
+                    pQueue.put(REQ_PLY_CONT)
+                else:
+                    handle_play_stop_req()
+
+        elif req == REQ_PLY_SEEK or req == REQ_PLY_CUE:
+            if recPlayer != None:
+                if req == REQ_PLY_SEEK:
+                    recPlayer.seek(args[0])
+                else:
+                    recPlayer.cue(args[0])
+                update_play_status(PLAY_PLAYING)
+
+        # handle latency test requests, which take a few seconds (beating the
+        # heartbeat)
+        elif req == REQ_LAT_TEST:
+            if rec_in_progress == True:
+                heartbeat[HB_LATENCY] = LATENCY_FAILED
             else:
-                print ("Recording has stopped...")
+                handle_play_stop_req()
+                handle_latency_test_req()
+
+        # handle analysis requests.  While recording, the analyzer is fed
+        # from the recording loop; otherwise it has its own capture loop.
+        elif req == REQ_ANA_START:
+            if recAnalyzer == None:
+                handle_analysis_start_req()
+                if rec_in_progress == False:
+                    init_record_input()
+                    pQueue.put(REQ_ANA_CONT)
+
+        elif req == REQ_ANA_STOP:
+            handle_analysis_stop_req()
+
+        elif req == REQ_ANA_CONT:
+            if recAnalyzer != None and rec_in_progress == False:
+                handle_analysis_continue_req(recPCM)
+                time.sleep(piRecordConf.engineLoopPd)
+                pQueue.put(REQ_ANA_CONT)
+
+        # handle the engine stop request, closing any take in progress
+        elif req == REQ_ENG_STOP:
+            if rec_in_progress == True:
+                handle_record_stop_req(curr_fd)
+                rec_in_progress = False
+            handle_analysis_stop_req()
+            handle_play_stop_req()
+            if recMonitor != None:
+                recMonitor.close()
+            if recMulti != None:
+                recMulti.close()
+            if recPipeline != None:
+                recPipeline.close()
+            piRecordFanout.waitClosed(ENGINE_STOP_TIMEOUT / 2)
+            piRecordCompress.waitSent(ENGINE_STOP_TIMEOUT / 4)
+            piRecordTelemetry.flush()
+            piRecordLog.event("engine_stopped", interval=0)
+            break
     
     return 0
 
+###############################################################################
+# Function Name:
+#   load_engine_modules
+# Description:
+#   imports the modules only the engine process uses
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def load_engine_modules():
+    global piRecordFormat, piRecordWave, piRecordCompress, piRecordLoudness, piRecordFanout, piRecordMonitor
+    global piRecordMulti, piRecordResample, piRecordIO, piRecordTrim, piRecordPipeline, piRecordPlayback
+    global piRecordOverdub
+    import piRecordFormat
+    import piRecordWave
+    import piRecordCompress
+    import piRecordLoudness
+    import piRecordFanout
+    import piRecordMonitor
+    import piRecordMulti
+    import piRecordResample
+    import piRecordIO
+    import piRecordTrim
+    import piRecordPipeline
+    import piRecordPlayback
+    import piRecordOverdub
+    return 0
+
 ###############################################################################
 # Function Name:
 #   init_record_input
@@ -213,62 +984,363 @@ def piRecordEngine():
 #   creates a new recoridng input object if not already created, then sets its
 #   attributes according to the configuration
 # Parameters:
-#   none
+#   strict - raise ALSAAudioError if the device sets another channel count,
+#            rate or format than configured (as devices set the nearest
+#            they can do)
 # Return value: 
 #   0
 ###############################################################################
-def init_record_input():
+def init_record_input(strict=False):
     global recPCM
-    device = piRecordConf.recDevice
     
-    # create the recording input object
+    # create the recording input object.  If the cached device name no
+    # longer opens (e.g. the interface was plugged into another port), the
+    # device list is read again.
     if recPCM == None:
-        recPCM = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device=piRecordConf.getRecDevice())
+        try:
+            recPCM = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device=piRecordConf.getRecDevice())
+        except alsaaudio.ALSAAudioError:
+            recPCM = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device=piRecordConf.getRecDevice(True))
 
     # Set attributes based on the current recording configuration
-    recPCM.setchannels(piRecordConf.recChannels)
-    recPCM.setrate(piRecordConf.recRate)
-    recPCM.setformat(piRecordConf.recFormat)
+    configured = (piRecordConf.recChannels, piRecordConf.recRate, piRecordConf.recFormat)
+    actual = (recPCM.setchannels(piRecordConf.recChannels), recPCM.setrate(piRecordConf.recRate),
+              recPCM.setformat(piRecordConf.recFormat))
     recPCM.setperiodsize(piRecordConf.recPeriodSize)
+    if strict and any(a != None and a != c for a, c in zip(actual, configured)):
+        raise alsaaudio.ALSAAudioError("device set %s, not %s" % (actual, configured))
 
     #return the recording input object
     return 0
 
+###############################################################################
+# Function Name:
+#   init_multi_input
+# Description:
+#   opens the extra capture devices configured in [multiDevice], whose
+#   channels are added to each take after the main device's.  If one can't
+#   be opened, takes are recorded from the main device only.
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def init_multi_input():
+    global recMulti
+    devices = piRecordConf.getMultiDevices()
+    if recMulti != None or not devices:
+        return 0
+    try:
+        recMulti = piRecordMulti.MultiInput(devices, piRecordConf.recFormat, piRecordConf.recRate,
+                                            piRecordConf.recPeriodSize, piRecordConf.floatStorage,
+                                            piRecordConf.recChannels, piRecordConf.multiTaps)
+    except alsaaudio.ALSAAudioError as err:
+        piRecordLog.event("multi_device_error", logging.ERROR, interval=0, devices=piRecordConf.multiDevices, error=err)
+    return 0
+
+###############################################################################
+# Function Name:
+#   init_pipeline
+# Description:
+#   starts the processing stages configured in [pipeline], with a ring large
+#   enough for ringSecs of the widest take.  If they can't be started, takes
+#   are recorded without them.
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def init_pipeline():
+    global recPipeline
+    if recPipeline != None or not piRecordConf.pipelineStages.strip():
+        return 0
+    sampWidth = piRecordFormat.getConverter(piRecordConf.recFormat, piRecordConf.floatStorage)[1]
+    nchannels = piRecordConf.recChannels + (recMulti.channels if recMulti != None else 0)
+    capacity = max(1, int(piRecordConf.pipelineRingSecs * piRecordConf.getStoreRate())) * nchannels * sampWidth
+    try:
+        stages = piRecordConf.getPipelineStages()
+        recPipeline = piRecordPipeline.Pipeline(stages, capacity, piRecordConf.pipelineChunkFrames)
+        piRecordTelemetry.register('pipeline', recPipeline.getStats)
+    except (ValueError, OSError) as err:
+        piRecordLog.event("pipeline_not_started", logging.ERROR, interval=0, stages=piRecordConf.pipelineStages,
+                          error=err)
+    return 0
+
+###############################################################################
+# Function Name:
+#   log_stage_results
+# Description:
+#   logs the results of the processing stages that have finished a take
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def log_stage_results():
+    for name, fn, result in recPipeline.collect():
+        piRecordLog.event("stage_result", interval=0, stage=name, file=fn, result=result)
+    return 0
+
+###############################################################################
+# Function Name:
+#   probe_device_caps
+# Description:
+#   finds the rates, channel counts and formats the capture device accepts,
+#   by setting each in turn, and caches them (see piRecordConf.getDeviceCaps)
+#   so settings can be checked without the device.  The device is set up as
+#   configured again afterwards.
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def probe_device_caps():
+    start = time.perf_counter()
+    caps = {"rates": [], "channels": [], "formats": []}
+    for rate in piRecordConf.CAP_RATES:
+        if probe_device_setting(recPCM.setrate, rate):
+            caps["rates"].append(rate)
+    for nchannels in range(1, piRecordConf.CAP_MAX_CHANNELS + 1):
+        if probe_device_setting(recPCM.setchannels, nchannels):
+            caps["channels"].append(nchannels)
+    for fmt, numBits, signed, byteOrder in piRecordConf.getRecFormats():
+        if probe_device_setting(recPCM.setformat, fmt):
+            caps["formats"].append(fmt)
+    init_record_input()
+    piRecordConf.storeDeviceCaps(piRecordConf.getRecDevice(), caps)
+    piRecordLog.event("device_probed", interval=0, device=piRecordConf.getRecDevice(),
+                      ms=round(1000.0 * (time.perf_counter() - start), 1), **caps)
+    return 0
+
+###############################################################################
+# Function Name:
+#   probe_device_setting
+# Description:
+#   tells whether the capture device accepts a setting
+# Parameters:
+#   setter - the device's set method
+#   value - the value
+# Return value:
+#   True if the device was set to the value
+###############################################################################
+def probe_device_setting(setter, value):
+    try:
+        return setter(value) == value
+    except alsaaudio.ALSAAudioError:
+        return False
+
+###############################################################################
+# Function Name:
+#   handle_config_req
+# Description:
+#   handles configuration change requests (between takes): applies the
+#   settings and sets up again what they change - the capture device in
+#   place (opened again only if it is another device), the extra devices
+#   and the stage pipeline.  Takes pick up the other settings as they start.
+#   If the device doesn't accept the settings, the old ones are restored.
+# Parameters:
+#   settings - the settings, as piRecordConf.getSettings returns them
+#   seq - the change's number, reported in the heartbeat once applied
+# Return value:
+#   0
+###############################################################################
+def handle_config_req(settings, seq):
+    start = time.perf_counter()
+    old = piRecordConf.getSettings()
+    changed = sorted(name for name, value in settings.items() if old.get(name) != value)
+    piRecordConf.setSettings(settings)
+    try:
+        reconfigure_engine(changed)
+    except (alsaaudio.ALSAAudioError, ValueError, OSError) as err:
+        piRecordLog.event("config_failed", logging.ERROR, interval=0, changed=changed, error=err)
+        piRecordConf.setSettings(old)
+        try:
+            reconfigure_engine(changed)
+        except (alsaaudio.ALSAAudioError, ValueError, OSError) as err:
+            piRecordLog.event("device_error", logging.ERROR, interval=0, error=err)
+        heartbeat[HB_CONFIG] = -seq
+        return 0
+    piRecordLog.event("config_applied", interval=0, changed=changed, ms=round(1000.0 * (time.perf_counter() - start), 1))
+    heartbeat[HB_CONFIG] = seq
+    return 0
+
+###############################################################################
+# Function Name:
+#   reconfigure_engine
+# Description:
+#   sets up again what changed settings affect (see handle_config_req).  A
+#   new capture device is probed if its capabilities aren't cached, and the
+#   settings are checked against them.
+# Parameters:
+#   changed - names of the settings changed
+# Return value:
+#   0
+###############################################################################
+def reconfigure_engine(changed):
+    global recPCM, recMulti, recPipeline, recMonitor
+    if "recDevice" in changed and recPCM != None:
+        recPCM.close()
+        recPCM = None
+    if any(name in changed for name in DEVICE_SETTINGS):
+        if piRecordConf.getDeviceCaps(piRecordConf.getRecDevice()) == None:
+            init_record_input()
+            probe_device_caps()
+        error = piRecordConf.checkRecConfig()
+        if error != None:
+            raise ValueError(error)
+        init_record_input(True)
+    if any(name in changed for name in MULTI_SETTINGS) and recMulti != None:
+        recMulti.close()
+        recMulti = None
+    if recMulti == None:
+        init_multi_input()
+    if any(name in changed for name in PIPELINE_SETTINGS) and recPipeline != None:
+        recPipeline.close()
+        recPipeline = None
+        piRecordTelemetry.unregister('pipeline')
+    if recPipeline == None:
+        init_pipeline()
+    if any(name.startswith("monitor") for name in changed) and recMonitor != None:
+        recMonitor.close()
+        recMonitor = None
+        piRecordTelemetry.unregister('monitor')
+    return 0
+
 ###############################################################################
 # Function Name:
 #   handle_record_start_req
 # Description:
-#   handles record start requests by opening the wave file for writing.
+#   handles record start requests by opening the wave file for writing. The
+#   stored sample width and format are derived from the capture format, and
+#   the conversion used for each captured block is selected here.  If
+#   compression is enabled, a flac file is written instead.  If takes are
+#   stored at another rate than the device's, the resampling stage is set
+#   up, and everything after it works at the stored rate.
 # Parameters:
 #   none
 # Return value: 
 #   the file descriptor for the wave file
 ###############################################################################
 def handle_record_start_req():
+    global recConvert, recMeter, recMonitor, recResample, take_frame_size
     curr_fn = piRecordUtils.getCurrentFilename()
-    print ("handle_record_start_req: open file", curr_fn, "here...")
-    fd = wave.open(curr_fn, 'wb')
-    fd.setnchannels(piRecordConf.recChannels)
-    fd.setsampwidth(piRecordConf.recSampleWidth)
-    fd.setframerate(piRecordConf.recRate)
+    piRecordUtils.setRecording(True)
+    recConvert, sampWidth, fmtTag = piRecordFormat.getConverter(piRecordConf.recFormat, piRecordConf.floatStorage)
+    nchannels = piRecordConf.recChannels
+    if recMulti != None:
+        nchannels += recMulti.channels
+        recMulti.start()
+        piRecordTelemetry.register('multi', recMulti.getStats)
+    take_frame_size = nchannels * sampWidth
+    rate = piRecordConf.getStoreRate()
+    if rate != piRecordConf.recRate:
+        recResample = piRecordResample.CaptureResampler(piRecordConf.recRate, rate, nchannels, sampWidth, fmtTag,
+                                                        piRecordConf.storeTaps, piRecordConf.storeBlockFrames)
+        piRecordTelemetry.register('resample', recResample.getStats)
+    piRecordLog.event("take_started", interval=0, file=curr_fn, rate=rate, deviceRate=piRecordConf.recRate,
+                      channels=nchannels, sampleWidth=sampWidth, configuredWidth=piRecordConf.recSampleWidth)
+    if piRecordConf.compressEnabled and piRecordCompress.canCompress(sampWidth, fmtTag):
+        fd = piRecordCompress.FlacWriter(curr_fn, nchannels, sampWidth, rate,
+                                         piRecordConf.compressLevel, piRecordConf.compressMaxBacklog,
+                                         piRecordConf.getWriterOptions())
+        piRecordUtils.setCurrentFilename(fd.filename)
+    else:
+        fd = piRecordWave.WaveWriter(curr_fn, nchannels, sampWidth, rate, fmtTag, **piRecordConf.getWriterOptions())
+    if piRecordConf.safetyEnabled:
+        maxBlocks = max(1, int(piRecordConf.safetyQueueSecs * piRecordConf.recRate / piRecordConf.recPeriodSize))
+        target = piRecordFanout.SafetyTarget(os.path.join(piRecordConf.safetyDir, os.path.basename(curr_fn)),
+                                             nchannels, sampWidth, fmtTag, rate,
+                                             piRecordConf.safetySampleWidth, maxBlocks, piRecordConf.getWriterOptions())
+        fd = piRecordFanout.FanoutWriter(fd, [target])
+        piRecordTelemetry.register('safety', fd.getStats)
+    if piRecordConf.loudnessLive:
+        recMeter = piRecordLoudness.LiveMeter(rate, nchannels, sampWidth, fmtTag, piRecordConf.recPeriodSize)
+        piRecordTelemetry.register('loudness', recMeter.getStats)
+    if piRecordConf.monitorEnabled and recMonitor == None:
+        try:
+            recMonitor = piRecordMonitor.Monitor(piRecordConf.monitorAddress, piRecordConf.monitorPort,
+                                                 piRecordConf.monitorBufferSecs, piRecordConf.monitorMaxClients)
+            piRecordTelemetry.register('monitor', recMonitor.getStats)
+        except OSError as err:
+            piRecordLog.event("monitor_not_started", logging.WARNING, interval=0, error=err)
+    if recMonitor != None:
+        recMonitor.ring.configure(nchannels, sampWidth, fmtTag, rate)
+    if recPipeline != None:
+        recPipeline.begin(nchannels, sampWidth, fmtTag, rate, piRecordUtils.getCurrentFilename())
     return fd
 
 ###############################################################################
 # Function Name:
 #   handle_record_stop_req
 # Description:
-#   handles the record stop request by writing null and closing the file
+#   handles the record stop request by writing null and closing the file,
+#   then starts the silence trim of the take if it is enabled
 # Parameters:
 #   fd - file descriptor of the currenly open wave file
 # Return value: 
 #   0
 ###############################################################################
 def handle_record_stop_req(fd):
-    print ("handle_record_stop_req: close file here...")
+    global recMeter, recResample
+    data = b''
+    if recMulti != None:
+        data = recMulti.flush()
+        recMulti.stop()
+        piRecordTelemetry.unregister('multi')
+    if recResample != None:
+        data = recResample.process(data) + recResample.flush()
+    write_block(fd, data)
     fd.writeframes(''.encode())
     fd.close()
+    handle_overdub_stop_req()
+    if recPipeline != None:
+        recPipeline.end()
+    piRecordUtils.setRecording(False)
+    piRecordTelemetry.publish(True)
+    piRecordTelemetry.unregister('safety')
+    if recResample != None:
+        recResample = None
+        piRecordTelemetry.unregister('resample')
+    piRecordLog.event("take_stopped", interval=0, file=piRecordUtils.getCurrentFilename(), blocks=data_cnt,
+                      noData=nodata_cnt, xruns=loopStats.xruns, writeMaxMs=round(1000.0 * write_max, 3))
+
+    # report the live loudness measurement, and cache it for wave files
+    # (unless blocks were dropped, so the file is measured when it's asked for)
+    if recMeter != None:
+        result = recMeter.stop()
+        dropped = recMeter.droppedBlocks
+        recMeter = None
+        piRecordTelemetry.unregister('loudness')
+        curr_fn = piRecordUtils.getCurrentFilename()
+        piRecordLog.event("loudness", logging.WARNING if dropped else logging.INFO, interval=0, file=curr_fn,
+                          result=piRecordLoudness.formatResult(result), droppedBlocks=dropped)
+        if curr_fn.endswith(piRecordConf.fileTypeExt) and dropped == 0:
+            piRecordLoudness.storeResult(curr_fn, result)
+
+    # trim the silence before and after the music, keeping the head of a
+    # take continued after a restart
+    curr_fn = piRecordUtils.getCurrentFilename()
+    if piRecordConf.trimEnabled and curr_fn.endswith(".wav"):
+        part = piRecordUtils.getPartNumber(curr_fn)
+        piRecordTrim.start(curr_fn, head=part == 1)
+        piRecordLog.event("take_trim_started", interval=0, file=curr_fn, part=part)
     return 0
 
+###############################################################################
+# Function Name:
+#   engine_stats
+# Description:
+#   returns the engine's counters for telemetry.  writeSecs is the total time
+#   spent writing blocks to the file this take.
+# Parameters:
+#   none
+# Return value:
+#   dict of counters
+###############################################################################
+def engine_stats():
+    return {"dataBlocks": data_cnt, "noDataBlocks": nodata_cnt,
+            "writeSecs": round(write_secs, 6), "writeMaxMs": round(1000.0 * write_max, 3)}
+
 ###############################################################################
 # Function Name:
 #   handle_record_continue_req
@@ -282,23 +1354,343 @@ def handle_record_stop_req(fd):
 #   0
 ###############################################################################
 def handle_record_continue_req(fd, inp):
-    global data_cnt, nodata_cnt
+    global data_cnt, nodata_cnt, take_frames, take_captured
     lngth, data = inp.read()
-    if lngth:
-        fd.writeframesraw(data)
+    if lngth > 0 and recOverdub != None:
+        recOverdub.feed(lngth)
+    if lngth < 0:
+        # the device overran (-EPIPE) and has recovered; the data is lost.
+        # An overrun before the first block only drops audio from before the
+        # take started, so it isn't counted.
+        if data_cnt:
+            loopStats.addXrun()
+            piRecordLog.event("xrun", logging.WARNING, block=data_cnt, xruns=loopStats.xruns)
+        if recMulti != None:
+            recMulti.skip()
+        nodata_cnt += 1
+    elif lngth:
+        now = time.time()
+        data = recConvert(data)
+        if recAnalyzer != None:
+            recAnalyzer.feed(data)
+        if recMulti != None:
+            data = recMulti.combine(data, now)
+        if recOverdub != None:
+            size = len(data)
+            data = recOverdub.align(data, take_frame_size)
+            lngth -= (size - len(data)) // take_frame_size
+        if recResample != None:
+            data = recResample.process(data)
+        written = write_block(fd, data)
         data_cnt += 1
+
+        # the block was captured up to now, less what the stages before the
+        # file still hold, so the watchdog can tell how much audio a restart
+        # missed (an overdub's dropped frames aren't part of the take)
+        take_captured += lngth
+        if written:
+            rate = float(piRecordConf.getStoreRate())
+            last_sample = now - (take_captured / float(piRecordConf.recRate) - (take_frames + written) / rate)
+            if take_frames == 0:
+                heartbeat[HB_FIRST_SAMPLE] = last_sample - written / rate
+            take_frames += written
+            heartbeat[HB_LAST_SAMPLE] = last_sample
+            heartbeat[HB_FRAMES] = take_frames
     else:
         nodata_cnt += 1
     return 0
 
 ###############################################################################
-# Main code
+# Function Name:
+#   write_block
+# Description:
+#   writes a block of stored samples to the take and passes it to the meter,
+#   monitor and processing stages
+# Parameters:
+#   fd - file descriptor of the currenly open wave file
+#   data - the block (may be empty while a stage collects frames)
+# Return value:
+#   the number of frames written
+###############################################################################
+def write_block(fd, data):
+    global write_secs, write_max
+    if not data:
+        return 0
+    start = time.perf_counter()
+    fd.writeframesraw(data)
+    elapsed = time.perf_counter() - start
+    write_secs += elapsed
+    write_max = max(write_max, elapsed)
+    if recMeter != None:
+        recMeter.feed(data)
+    if recMonitor != None:
+        recMonitor.ring.write(data)
+    if recPipeline != None:
+        recPipeline.publish(data)
+    return len(data) // take_frame_size
+
+###############################################################################
+# Function Name:
+#   handle_play_start_req
+# Description:
+#   handles play start requests by mapping the first file that can be played
+# Parameters:
+#   files - the wave files, in order
+# Return value:
+#   True if playback started
+###############################################################################
+def handle_play_start_req(files):
+    global recPlayer
+    try:
+        recPlayer = piRecordPlayback.Player(files, piRecordConf.getRecDevice(), piRecordConf.playbackPeriodFrames,
+                                            piRecordConf.playbackPrefetchSecs)
+    except ValueError as err:
+        piRecordLog.event("play_error", logging.ERROR, interval=0, error=err)
+        heartbeat[HB_PLAY_STATE] = PLAY_ERROR
+        return False
+    for err in recPlayer.errors:
+        piRecordLog.event("play_skipped", logging.WARNING, interval=0, error=err)
+    piRecordTelemetry.register('playback', recPlayer.getStats)
+    piRecordLog.event("play_started", interval=0, file=files[recPlayer.index], files=len(files))
+    update_play_status(PLAY_PLAYING)
+    return True
+
+###############################################################################
+# Function Name:
+#   handle_play_continue_req
+# Description:
+#   handles play continue requests by writing the next period to the device
+# Parameters:
+#   none
+# Return value:
+#   False once playback has finished (or failed)
+###############################################################################
+def handle_play_continue_req():
+    errors = len(recPlayer.errors)
+    try:
+        playing = recPlayer.play()
+    except alsaaudio.ALSAAudioError as err:
+        piRecordLog.event("play_error", logging.ERROR, interval=0, file=recPlayer.files[recPlayer.index], error=err)
+        update_play_status(PLAY_ERROR)
+        return False
+    for err in recPlayer.errors[errors:]:
+        piRecordLog.event("play_skipped", logging.WARNING, interval=0, error=err)
+    update_play_status(PLAY_PLAYING if playing else PLAY_STOPPED)
+    return playing
+
+###############################################################################
+# Function Name:
+#   handle_play_stop_req
+# Description:
+#   handles play stop requests by closing the device and the files
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def handle_play_stop_req():
+    global recPlayer
+    if recPlayer != None:
+        piRecordLog.event("play_stopped", interval=0, **recPlayer.getStats())
+        recPlayer.close()
+        recPlayer = None
+        piRecordTelemetry.unregister('playback')
+        if heartbeat[HB_PLAY_STATE] != PLAY_ERROR:
+            heartbeat[HB_PLAY_STATE] = PLAY_STOPPED
+    return 0
+
+###############################################################################
+# Function Name:
+#   update_play_status
+# Description:
+#   updates the playback fields of the shared status
+# Parameters:
+#   state - the player's state (PLAY_xxx)
+#   player - what is playing (the player, or the overdub's backing take)
+# Return value:
+#   0
 ###############################################################################
-# create the mesage queue and start the engige
-pQueue = multiprocessing.Queue()
-pEngine = multiprocessing.Process(target=piRecordEngine)
-pEngine.start()
+def update_play_status(state, player=None):
+    player = recPlayer if player == None else player
+    heartbeat[HB_PLAY_INDEX], heartbeat[HB_PLAY_POS], heartbeat[HB_PLAY_LEN] = player.getPosition()
+    heartbeat[HB_PLAY_STATE] = state
+    return 0
 
+###############################################################################
+# Function Name:
+#   handle_overdub_start_req
+# Description:
+#   starts playing the backing take for the take just started.  The round
+#   trip latency the take is shifted by is the configured one, else the one
+#   measured before; if it has never been measured, the click test is run
+#   first.  If the backing take can't be played, the take is recorded
+#   without it.
+# Parameters:
+#   files - the backing take's part files
+# Return value:
+#   0
+###############################################################################
+def handle_overdub_start_req(files):
+    global recOverdub
+    device = piRecordConf.getRecDevice()
+    latency = piRecordConf.overdubLatencyFrames
+    if latency < 0:
+        latency = get_measured_latency(True)
+    if latency == None:
+        piRecordLog.event("overdub_uncompensated", logging.WARNING, interval=0, backing=files[0])
+        latency = 0
+    try:
+        recOverdub = piRecordOverdub.Overdub(files, device, piRecordConf.recRate, piRecordConf.recPeriodSize,
+                                             piRecordConf.overdubPrimePeriods, latency)
+        recOverdub.start(recPCM)
+    except (OSError, ValueError, alsaaudio.ALSAAudioError) as err:
+        piRecordLog.event("overdub_error", logging.ERROR, interval=0, backing=files[0], error=err)
+        heartbeat[HB_PLAY_STATE] = PLAY_ERROR
+        if recOverdub != None:
+            recOverdub.close()
+            recOverdub = None
+        return 0
+    piRecordTelemetry.register('overdub', recOverdub.getStats)
+    piRecordLog.event("overdub_started", interval=0, file=piRecordUtils.getCurrentFilename(), backing=files[0],
+                      latencyFrames=latency)
+    update_play_status(PLAY_PLAYING, recOverdub)
+    return 0
 
+###############################################################################
+# Function Name:
+#   handle_overdub_stop_req
+# Description:
+#   stops playing the backing take, if the take is an overdub
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def handle_overdub_stop_req():
+    global recOverdub
+    if recOverdub != None:
+        piRecordLog.event("overdub_stopped", interval=0, **recOverdub.getStats())
+        recOverdub.close()
+        recOverdub = None
+        piRecordTelemetry.unregister('overdub')
+        heartbeat[HB_PLAY_STATE] = PLAY_STOPPED
+    return 0
 
+###############################################################################
+# Function Name:
+#   get_measured_latency
+# Description:
+#   returns the round trip latency for the current settings, by running
+#   the click test (and caching its result) unless it is cached
+# Parameters:
+#   cached - use the cached latency if there is one
+# Return value:
+#   the latency in frames, or None if the clicks weren't heard
+###############################################################################
+def get_measured_latency(cached):
+    key = piRecordOverdub.getLatencyKey(piRecordConf.getRecDevice(), piRecordConf.recRate,
+                                        piRecordConf.recPeriodSize, piRecordConf.overdubPrimePeriods)
+    latency = piRecordOverdub.loadLatency(key) if cached else None
+    if latency != None:
+        return latency
+    try:
+        latency = piRecordOverdub.measureLatency(recPCM, piRecordConf.getRecDevice(), piRecordConf.recFormat,
+                                                 piRecordConf.recChannels, piRecordConf.recRate,
+                                                 piRecordConf.recPeriodSize, piRecordConf.overdubPrimePeriods,
+                                                 beat_heartbeat)
+    except alsaaudio.ALSAAudioError as err:
+        piRecordLog.event("latency_error", logging.ERROR, interval=0, error=err)
+        return None
+    piRecordLog.event("latency_measured", interval=0, latencyFrames=latency)
+    if latency != None:
+        piRecordOverdub.storeLatency(key, latency)
+    return latency
+
+###############################################################################
+# Function Name:
+#   handle_latency_test_req
+# Description:
+#   handles latency test requests by running the click test
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def handle_latency_test_req():
+    try:
+        init_record_input()
+    except alsaaudio.ALSAAudioError as err:
+        piRecordLog.event("latency_error", logging.ERROR, interval=0, error=err)
+        heartbeat[HB_LATENCY] = LATENCY_FAILED
+        return 0
+    latency = get_measured_latency(False)
+    heartbeat[HB_LATENCY] = LATENCY_FAILED if latency == None else latency
+    return 0
+
+###############################################################################
+# Function Name:
+#   beat_heartbeat
+# Description:
+#   beats the heartbeat, for requests that take a while
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def beat_heartbeat():
+    heartbeat[HB_TIME] = time.time()
+    return 0
 
+###############################################################################
+# Function Name:
+#   handle_analysis_start_req
+# Description:
+#   handles the analysis start request by starting the analyzer thread
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def handle_analysis_start_req():
+    global recConvert, recAnalyzer
+    recConvert, sampWidth, fmtTag = piRecordFormat.getConverter(piRecordConf.recFormat, piRecordConf.floatStorage)
+    recAnalyzer = piRecordSpectrum.Analyzer(piRecordConf.recRate, piRecordConf.recChannels, sampWidth, fmtTag,
+                                            anaResult, piRecordConf.analysisRate, piRecordConf.analysisCpuCap,
+                                            piRecordConf.analysisFftSize)
+    piRecordTelemetry.register('analysis', recAnalyzer.getStats)
+    return 0
+
+###############################################################################
+# Function Name:
+#   handle_analysis_stop_req
+# Description:
+#   handles the analysis stop request by stopping the analyzer thread
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def handle_analysis_stop_req():
+    global recAnalyzer
+    if recAnalyzer != None:
+        recAnalyzer.stop()
+        recAnalyzer = None
+        piRecordTelemetry.unregister('analysis')
+    return 0
+
+###############################################################################
+# Function Name:
+#   handle_analysis_continue_req
+# Description:
+#   handles the analysis continue request (sent only while not recording) by
+#   reading data from the recording input and passing it to the analyzer
+# Parameters:
+#   inp - the recording input object
+# Return value:
+#   0
+###############################################################################
+def handle_analysis_continue_req(inp):
+    lngth, data = inp.read()
+    if lngth > 0:
+        recAnalyzer.feed(recConvert(data))
+    return 0
@@ -0,0 +1,304 @@
+###############################################################################
+# piRecordFanout.py - Raspberry Pi audio recorder safety track module
+# Description:
+#   writes the captured blocks to extra storage targets (e.g. a USB stick) as
+#   well as the primary recording.  The primary file is written in the engine
+#   loop as before; every extra target has its own bounded queue and writer
+#   thread, so a slow or removed device can never hold up the primary file
+#   or the capture loop.  If a target's queue is full, blocks are dropped and
+#   replaced by silence once it catches up, so the safety track stays in
+#   time with the primary.  A target that fails to write stops, and the
+#   primary carries on.  Closing a target doesn't wait for it either: it
+#   finishes its file in the background (see waitClosed).
+###############################################################################
+
+import logging
+import os
+import queue
+import threading
+import time
+import piRecordFormat
+import piRecordLog
+import piRecordWave
+
+# target states reported in telemetry
+TARGET_OK = "ok"
+TARGET_LAGGING = "lagging"
+TARGET_FAILED = "failed"
+TARGET_UNAVAILABLE = "unavailable"
+
+# seconds a closing target waits for room in its queue, and then for its
+# writer thread to finish the file
+CLOSE_TIMEOUT = 5.0
+
+# targets still finishing their files
+closing = []
+
+###############################################################################
+# Class Name:
+#   SafetyTarget
+# Description:
+#   writes a copy of the recording to another directory, in its own thread,
+#   optionally at a smaller sample width
+###############################################################################
+class SafetyTarget:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   starts the target's writer thread, which opens the file (see run), so
+    #   a drive that hangs doesn't hold up the start of the take
+    # Parameters:
+    #   filename - name of the copy
+    #   nchannels - number of channels
+    #   sampWidth - stored sample width of the blocks written
+    #   fmtTag - wave format tag of the blocks written
+    #   rate - sample rate
+    #   targetWidth - sample width of the copy (0 = same as the primary)
+    #   maxBlocks - most blocks queued before blocks are dropped
+    #   writerOptions - how the copy is written (see piRecordWave.WaveWriter)
+    ###########################################################################
+    def __init__(self, filename, nchannels, sampWidth, fmtTag, rate, targetWidth, maxBlocks, writerOptions=None):
+        self.filename = filename
+        self.nchannels = nchannels
+        self.inFormat = (sampWidth, fmtTag)
+        self.rate = rate
+        self.frameSize = nchannels * sampWidth
+        self.outWidth = targetWidth if targetWidth else sampWidth
+        self.outTag = fmtTag if self.outWidth == sampWidth else piRecordFormat.WAVE_FORMAT_PCM
+        self.blocks = queue.Queue(maxsize=maxBlocks)
+        self.state = TARGET_OK
+        self.lastError = ""
+        self.queuedFrames = 0
+        self.dequeuedFrames = 0
+        self.writtenFrames = 0
+        self.droppedFrames = 0
+        self.pendingSilence = 0
+        self.maxWriteTime = 0.0
+        self.writerOptions = writerOptions or {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   put
+    # Description:
+    #   queues a block for the target without ever waiting.  If the queue is
+    #   full the block is dropped and counted, and the frames dropped are
+    #   queued as silence ahead of the next block that fits.
+    # Parameters:
+    #   data - block of stored samples
+    # Return value:
+    #   none
+    ###########################################################################
+    def put(self, data):
+        nframes = len(data) // self.frameSize
+        if self.state in (TARGET_FAILED, TARGET_UNAVAILABLE):
+            self.droppedFrames += nframes
+            return
+        try:
+            if self.pendingSilence:
+                self.blocks.put_nowait(self.pendingSilence)
+                self.queuedFrames += self.pendingSilence
+                self.pendingSilence = 0
+            self.blocks.put_nowait(data)
+            self.queuedFrames += nframes
+        except queue.Full:
+            self.state = TARGET_LAGGING
+            self.droppedFrames += nframes
+            self.pendingSilence += nframes
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   the writer thread: opens the copy, then writes queued blocks (and
+    #   silence for blocks that were dropped) until the take stops or a write
+    #   fails.  If the target directory can't be written, the target is
+    #   marked unavailable.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self.writer = piRecordWave.WaveWriter(self.filename, self.nchannels, self.outWidth, self.rate,
+                                                  self.outTag, **self.writerOptions)
+        except OSError as err:
+            self.state = TARGET_UNAVAILABLE
+            self.lastError = str(err)
+            piRecordLog.event("safety_unavailable", logging.WARNING, interval=0, file=self.filename, error=err)
+            return
+        while True:
+            data = self.blocks.get()
+            if data is None:
+                break
+            try:
+                startTime = time.time()
+                if isinstance(data, int):
+                    self.dequeuedFrames += data
+                    self.write(self.silence(data))
+                    self.state = TARGET_OK
+                else:
+                    self.dequeuedFrames += len(data) // self.frameSize
+                    self.write(data)
+                self.maxWriteTime = max(self.maxWriteTime, time.time() - startTime)
+            except OSError as err:
+                self.state = TARGET_FAILED
+                self.lastError = str(err)
+                piRecordLog.event("safety_failed", logging.ERROR, interval=0, file=self.filename, error=err)
+                break
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+
+    ###########################################################################
+    # Method Name:
+    #   write
+    # Description:
+    #   writes a block to the copy, converting the sample width if needed
+    # Parameters:
+    #   data - block of stored samples
+    # Return value:
+    #   none
+    ###########################################################################
+    def write(self, data):
+        nframes = len(data) // self.frameSize
+        if self.outWidth != self.inFormat[0] or self.outTag != self.inFormat[1]:
+            x = piRecordFormat.samplesToFloat(data, self.inFormat[0], self.inFormat[1], self.nchannels)
+            data = piRecordFormat.floatToSamples(x, self.outWidth, self.outTag)
+        self.writer.writeframesraw(data)
+        self.writtenFrames += nframes
+
+    ###########################################################################
+    # Method Name:
+    #   silence
+    # Description:
+    #   returns a block of silence in the stored format (8 bit wave samples
+    #   are unsigned, so their silence isn't zero)
+    # Parameters:
+    #   nframes - number of frames
+    # Return value:
+    #   the block
+    ###########################################################################
+    def silence(self, nframes):
+        if self.inFormat == (1, piRecordFormat.WAVE_FORMAT_PCM):
+            return b'\x80' * (nframes * self.frameSize)
+        return bytes(nframes * self.frameSize)
+
+    ###########################################################################
+    # Method Name:
+    #   close
+    # Description:
+    #   ends the copy without waiting: a closer thread hands the writer thread
+    #   the end of the take (see finish)
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def close(self):
+        if self.state == TARGET_UNAVAILABLE:
+            return
+        closer = threading.Thread(target=self.finish, daemon=True)
+        closing.append(closer)
+        closer.start()
+
+    ###########################################################################
+    # Method Name:
+    #   finish
+    # Description:
+    #   the closer thread: waits a bounded time for the writer thread to write
+    #   what is queued (including silence for any blocks dropped at the end)
+    #   and close the file.  A device that hangs is left to its (daemon)
+    #   thread.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def finish(self):
+        try:
+            if self.pendingSilence:
+                self.blocks.put(self.pendingSilence, timeout=CLOSE_TIMEOUT)
+                self.pendingSilence = 0
+            self.blocks.put(None, timeout=CLOSE_TIMEOUT)
+        except queue.Full:
+            pass
+        self.thread.join(CLOSE_TIMEOUT)
+        if self.thread.is_alive():
+            piRecordLog.event("safety_not_finished", logging.ERROR, interval=0, file=self.filename)
+        closing.remove(threading.current_thread())
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns the target's health and lag counters for telemetry
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters
+    ###########################################################################
+    def getStats(self):
+        return {"file": self.filename, "state": self.state, "error": self.lastError,
+                "queuedBlocks": self.blocks.qsize(),
+                "lagSecs": (self.queuedFrames - self.dequeuedFrames) / float(self.rate),
+                "writtenFrames": self.writtenFrames, "droppedFrames": self.droppedFrames,
+                "maxWriteSecs": self.maxWriteTime}
+
+###############################################################################
+# Class Name:
+#   FanoutWriter
+# Description:
+#   writes the primary recording directly and hands every block to the extra
+#   targets.  The write methods match WaveWriter so the engine can use it in
+#   place of the primary writer.
+###############################################################################
+class FanoutWriter:
+
+    def __init__(self, primary, targets):
+        self.primary = primary
+        self.targets = targets
+
+    def writeframesraw(self, data):
+        self.primary.writeframesraw(data)
+        for target in self.targets:
+            target.put(data)
+
+    def writeframes(self, data):
+        self.primary.writeframes(data)
+        for target in self.targets:
+            target.put(data)
+
+    def getnframes(self):
+        return self.primary.getnframes()
+
+    def close(self):
+        self.primary.close()
+        for target in self.targets:
+            target.close()
+
+    def getStats(self):
+        return [target.getStats() for target in self.targets]
+
+###############################################################################
+# Function Name:
+#   waitClosed
+# Description:
+#   waits for the targets being closed to finish their files, before the
+#   engine exits
+# Parameters:
+#   timeout - most seconds to wait
+# Return value:
+#   True if they all finished
+###############################################################################
+def waitClosed(timeout):
+    endTime = time.time() + timeout
+    for closer in list(closing):
+        closer.join(max(0.0, endTime - time.time()))
+    return not closing
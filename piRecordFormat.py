@@ -0,0 +1,334 @@
+###############################################################################
+# piRecordFormat.py - Raspberry Pi audio recorder sample format module
+# Description:
+#   converts blocks of captured ALSA samples into the sample layout stored in
+#   the wave file.  All conversions work on whole capture blocks with NumPy so
+#   that no per-sample Python code runs in the engine's record loop.
+###############################################################################
+
+from piRecordHardware import alsaaudio
+import numpy
+
+# Wave file format tags
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Capture format descriptions, indexed by the ALSA format constant.  Each entry
+# is (container bytes, valid bits, signed, big endian, float).  Note that ALSA's
+# S24_LE/S24_BE formats are 24 bit samples in a 4 byte container, while the
+# S24_3LE/S24_3BE formats are packed 3 byte samples.
+captureFormats = {}
+
+###############################################################################
+# Function Name:
+#   addCaptureFormat
+# Description:
+#   adds a capture format description to the table, if the installed version
+#   of the ALSA library defines the format
+# Parameters:
+#   name - name of the ALSA format constant
+#   width - container size in bytes
+#   bits - number of valid bits in the container
+#   signed - True if samples are signed
+#   bigEndian - True if the container is big endian
+#   isFloat - True if samples are IEEE float
+# Return value:
+#   0
+###############################################################################
+def addCaptureFormat(name, width, bits, signed, bigEndian, isFloat=False):
+    fmt = getattr(alsaaudio, name, None)
+    if fmt != None:
+        captureFormats[fmt] = (width, bits, signed, bigEndian, isFloat)
+    return 0
+
+addCaptureFormat('PCM_FORMAT_S8', 1, 8, True, False)
+addCaptureFormat('PCM_FORMAT_U8', 1, 8, False, False)
+addCaptureFormat('PCM_FORMAT_S16_LE', 2, 16, True, False)
+addCaptureFormat('PCM_FORMAT_S16_BE', 2, 16, True, True)
+addCaptureFormat('PCM_FORMAT_U16_LE', 2, 16, False, False)
+addCaptureFormat('PCM_FORMAT_U16_BE', 2, 16, False, True)
+addCaptureFormat('PCM_FORMAT_S24_LE', 4, 24, True, False)
+addCaptureFormat('PCM_FORMAT_S24_BE', 4, 24, True, True)
+addCaptureFormat('PCM_FORMAT_U24_LE', 4, 24, False, False)
+addCaptureFormat('PCM_FORMAT_U24_BE', 4, 24, False, True)
+addCaptureFormat('PCM_FORMAT_S24_3LE', 3, 24, True, False)
+addCaptureFormat('PCM_FORMAT_S24_3BE', 3, 24, True, True)
+addCaptureFormat('PCM_FORMAT_S32_LE', 4, 32, True, False)
+addCaptureFormat('PCM_FORMAT_S32_BE', 4, 32, True, True)
+addCaptureFormat('PCM_FORMAT_U32_LE', 4, 32, False, False)
+addCaptureFormat('PCM_FORMAT_U32_BE', 4, 32, False, True)
+addCaptureFormat('PCM_FORMAT_FLOAT_LE', 4, 32, True, False, True)
+addCaptureFormat('PCM_FORMAT_FLOAT_BE', 4, 32, True, True, True)
+addCaptureFormat('PCM_FORMAT_FLOAT64_LE', 8, 64, True, False, True)
+addCaptureFormat('PCM_FORMAT_FLOAT64_BE', 8, 64, True, True, True)
+
+# scale factor used to map a full scale 32 bit integer onto [-1.0, 1.0)
+INT32_SCALE = numpy.float32(1.0 / 2147483648.0)
+
+###############################################################################
+# Function Name:
+#   getCaptureFormat
+# Description:
+#   looks up the description of an ALSA capture format
+# Parameters:
+#   fmt - the ALSA format constant
+# Return value:
+#   tuple of (container bytes, valid bits, signed, big endian, float)
+###############################################################################
+def getCaptureFormat(fmt):
+    if fmt not in captureFormats:
+        raise ValueError("unsupported capture format: %s" % fmt)
+    return captureFormats[fmt]
+
+###############################################################################
+# Function Name:
+#   getByteOrder
+# Description:
+#   returns the container byte indices that, taken in order, give the valid
+#   bytes of a sample in little endian order (the order used by wave files)
+# Parameters:
+#   width - container size in bytes
+#   bits - number of valid bits in the container
+#   bigEndian - True if the container is big endian
+# Return value:
+#   list of byte indices
+###############################################################################
+def getByteOrder(width, bits, bigEndian):
+    validBytes = bits // 8
+    if bigEndian:
+        return list(range(width-1, width-1-validBytes, -1))
+    return list(range(0, validBytes))
+
+###############################################################################
+# Function Name:
+#   makeIntConverter
+# Description:
+#   builds the conversion function for integer samples stored as integer PCM.
+#   The valid bytes of every container are gathered in little endian order in
+#   a single vectorized pass, and the sign bit is flipped where the capture
+#   and wave signedness differ (wave files store 8 bit samples unsigned and
+#   all wider samples signed).
+# Parameters:
+#   width - container size in bytes
+#   bits - number of valid bits in the container
+#   signed - True if the captured samples are signed
+#   bigEndian - True if the container is big endian
+# Return value:
+#   the conversion function (bytes in, bytes out)
+###############################################################################
+def makeIntConverter(width, bits, signed, bigEndian):
+    order = getByteOrder(width, bits, bigEndian)
+    validBytes = len(order)
+    flipSign = signed if validBytes == 1 else not signed
+
+    # samples already in wave layout are written as they are
+    if order == list(range(width)) and not flipSign:
+        return convertNone
+
+    isPrefix = order == list(range(validBytes))
+
+    def convert(data):
+        block = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, width)
+        if isPrefix:
+            out = numpy.array(block[:, :validBytes])
+        else:
+            out = block[:, order]
+        if flipSign:
+            out[:, validBytes-1] ^= 0x80
+        return out.tobytes()
+
+    return convert
+
+###############################################################################
+# Function Name:
+#   makeFloatConverter
+# Description:
+#   builds the conversion function for integer samples stored as 32 bit float.
+#   Samples are aligned to the top of a 32 bit integer so that every integer
+#   width shares the same scale factor.
+# Parameters:
+#   width - container size in bytes
+#   bits - number of valid bits in the container
+#   signed - True if the captured samples are signed
+#   bigEndian - True if the container is big endian
+# Return value:
+#   the conversion function (bytes in, bytes out)
+###############################################################################
+def makeFloatConverter(width, bits, signed, bigEndian):
+    endian = '>' if bigEndian else '<'
+
+    # 4 byte containers are read directly as 32 bit integers
+    if width == 4:
+        intType = numpy.dtype(endian + ('i4' if signed else 'u4'))
+        shift = 32 - bits
+
+        def convert(data):
+            samples = numpy.frombuffer(data, dtype=intType)
+            if not signed:
+                samples = (samples ^ numpy.uint32(0x80000000 >> shift)).view(numpy.int32)
+            if shift:
+                samples = numpy.left_shift(samples, shift)
+            return numpy.multiply(samples, INT32_SCALE, dtype='<f4').tobytes()
+
+        return convert
+
+    # narrower containers are gathered into the top bytes of a 32 bit integer
+    order = getByteOrder(width, bits, bigEndian)
+    validBytes = len(order)
+
+    def convert(data):
+        block = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, width)
+        wide = numpy.zeros((block.shape[0], 4), dtype=numpy.uint8)
+        wide[:, 4-validBytes:] = block[:, order]
+        if not signed:
+            wide[:, 3] ^= 0x80
+        samples = wide.view('<i4').reshape(-1)
+        return numpy.multiply(samples, INT32_SCALE, dtype='<f4').tobytes()
+
+    return convert
+
+###############################################################################
+# Function Name:
+#   makeSwapConverter
+# Description:
+#   builds the conversion function for big endian float samples
+# Parameters:
+#   width - sample size in bytes
+# Return value:
+#   the conversion function (bytes in, bytes out)
+###############################################################################
+def makeSwapConverter(width):
+    srcType = numpy.dtype('>f%d' % width)
+
+    def convert(data):
+        return numpy.frombuffer(data, dtype=srcType).byteswap().tobytes()
+
+    return convert
+
+###############################################################################
+# Function Name:
+#   convertNone
+# Description:
+#   conversion function used when the captured data is already in the layout
+#   stored in the wave file
+# Parameters:
+#   data - block of captured samples
+# Return value:
+#   the unmodified block
+###############################################################################
+def convertNone(data):
+    return data
+
+###############################################################################
+# Function Name:
+#   getConverter
+# Description:
+#   determines how samples captured in the given ALSA format are stored, and
+#   the function used to convert each captured block.  Integer samples are
+#   stored as packed integer PCM (so 24 bit samples take 3 bytes on disk rather
+#   than ALSA's 4 byte container).  When floatStorage is set, integer samples
+#   wider than 16 bits are stored as 32 bit IEEE float instead.  Float samples
+#   are always stored as float.
+# Parameters:
+#   fmt - the ALSA capture format constant
+#   floatStorage - True to store wide integer formats as 32 bit float
+# Return value:
+#   tuple of (conversion function, stored sample width, wave format tag)
+###############################################################################
+def getConverter(fmt, floatStorage=False):
+    width, bits, signed, bigEndian, isFloat = getCaptureFormat(fmt)
+
+    if isFloat:
+        if bigEndian:
+            return (makeSwapConverter(width), width, WAVE_FORMAT_IEEE_FLOAT)
+        return (convertNone, width, WAVE_FORMAT_IEEE_FLOAT)
+
+    if floatStorage and bits > 16:
+        return (makeFloatConverter(width, bits, signed, bigEndian), 4, WAVE_FORMAT_IEEE_FLOAT)
+
+    return (makeIntConverter(width, bits, signed, bigEndian), bits // 8, WAVE_FORMAT_PCM)
+
+###############################################################################
+# Function Name:
+#   getPlaybackFormat
+# Description:
+#   returns the ALSA format used to play back samples stored in a wave file
+# Parameters:
+#   sampleWidth - stored sample width in bytes
+#   formatTag - the wave format tag (PCM or IEEE float)
+# Return value:
+#   the ALSA format constant, else None if the format is not supported
+###############################################################################
+def getPlaybackFormat(sampleWidth, formatTag):
+    if formatTag == WAVE_FORMAT_IEEE_FLOAT:
+        if sampleWidth == 4:
+            return alsaaudio.PCM_FORMAT_FLOAT_LE
+        if sampleWidth == 8:
+            return getattr(alsaaudio, 'PCM_FORMAT_FLOAT64_LE', None)
+        return None
+    if sampleWidth == 1:
+        return alsaaudio.PCM_FORMAT_U8
+    if sampleWidth == 2:
+        return alsaaudio.PCM_FORMAT_S16_LE
+    if sampleWidth == 3:
+        return getattr(alsaaudio, 'PCM_FORMAT_S24_3LE', None)
+    if sampleWidth == 4:
+        return alsaaudio.PCM_FORMAT_S32_LE
+    return None
+
+###############################################################################
+# Function Name:
+#   samplesToFloat
+# Description:
+#   converts stored wave samples to 32 bit float in the range [-1.0, 1.0)
+# Parameters:
+#   data - block of stored samples
+#   sampleWidth - stored sample width in bytes
+#   formatTag - the wave format tag (PCM or IEEE float)
+#   nchannels - number of channels
+# Return value:
+#   array of samples, shape (frames, channels)
+###############################################################################
+def samplesToFloat(data, sampleWidth, formatTag, nchannels):
+    if formatTag == WAVE_FORMAT_IEEE_FLOAT:
+        samples = numpy.frombuffer(data, dtype='<f%d' % sampleWidth).astype(numpy.float32, copy=False)
+    elif sampleWidth == 1:
+        samples = (numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float32) - 128.0) * numpy.float32(1.0 / 128.0)
+    elif sampleWidth == 2:
+        samples = numpy.multiply(numpy.frombuffer(data, dtype='<i2'), numpy.float32(1.0 / 32768.0), dtype=numpy.float32)
+    elif sampleWidth == 3:
+        block = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+        wide = numpy.zeros((block.shape[0], 4), dtype=numpy.uint8)
+        wide[:, 1:] = block
+        samples = numpy.multiply(wide.view('<i4').reshape(-1), INT32_SCALE, dtype=numpy.float32)
+    else:
+        samples = numpy.multiply(numpy.frombuffer(data, dtype='<i4'), INT32_SCALE, dtype=numpy.float32)
+    return samples.reshape(-1, nchannels)
+
+###############################################################################
+# Function Name:
+#   floatToSamples
+# Description:
+#   converts float samples to the stored wave layout, rounding and clipping
+#   integer samples to full scale
+# Parameters:
+#   samples - array of float samples, shape (frames, channels)
+#   sampleWidth - stored sample width in bytes
+#   formatTag - the wave format tag (PCM or IEEE float)
+# Return value:
+#   block of stored samples
+###############################################################################
+def floatToSamples(samples, sampleWidth, formatTag):
+    if formatTag == WAVE_FORMAT_IEEE_FLOAT:
+        return samples.astype('<f%d' % sampleWidth).tobytes()
+
+    fullScale = float(1 << (sampleWidth * 8 - 1))
+    ints = numpy.clip(numpy.rint(samples.astype(numpy.float64) * fullScale), -fullScale, fullScale - 1).astype(numpy.int32)
+    if sampleWidth == 1:
+        return (ints + 128).astype(numpy.uint8).tobytes()
+    if sampleWidth == 2:
+        return ints.astype('<i2').tobytes()
+    if sampleWidth == 3:
+        return ints.astype('<i4').reshape(-1, 1).view(numpy.uint8)[:, :3].tobytes()
+    return ints.astype('<i4').tobytes()
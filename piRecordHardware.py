@@ -0,0 +1,44 @@
+###############################################################################
+# piRecordHardware.py - Raspberry Pi audio recorder hardware module
+# Description:
+#   selects the hardware backends used by the other modules: the ALSA
+#   library, the LCD/keypad plate library and the GPIO library.  If the
+#   PIRECORD_SIM environment variable is set (to anything but 0), the
+#   simulated backends in piRecordSim are used instead, so the recorder runs
+#   on any Linux machine (see piRecordScenario).  The variable must be set
+#   before the first piRecord module is imported.
+#
+#   Modules use the backends by name, e.g.
+#     from piRecordHardware import alsaaudio
+#   Each backend is imported the first time it is used, so the offline tools
+#   (batch, loudness, trim, ...) don't need the LCD and GPIO libraries.
+###############################################################################
+
+import importlib
+import os
+
+SIMULATED = os.environ.get("PIRECORD_SIM", "0") not in ("", "0")
+
+# module providing each backend: (simulated, real); None for no backend
+BACKENDS = {"alsaaudio": ("piRecordSim", "alsaaudio"),
+            "LCD": ("piRecordSim", "Adafruit_CharLCD"),
+            "GPIO": (None, "RPi.GPIO")}
+
+###############################################################################
+# Function Name:
+#   __getattr__
+# Description:
+#   imports a backend the first time it is asked for, and keeps it as a
+#   module attribute so later uses don't come here
+# Parameters:
+#   name - the backend's name
+# Return value:
+#   the backend module (None for GPIO when simulated)
+###############################################################################
+def __getattr__(name):
+    if name not in BACKENDS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    module = BACKENDS[name][0 if SIMULATED else 1]
+    backend = None if module == None else importlib.import_module(module)
+    globals()[name] = backend
+    return backend
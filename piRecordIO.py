@@ -0,0 +1,448 @@
+###############################################################################
+# piRecordIO.py - Raspberry Pi audio recorder file I/O module
+# Description:
+#   writes recordings so that a long take doesn't fill the Pi's small RAM
+#   with page cache.  A StreamFile:
+#     - preallocates the file's extents preallocBytes at a time, without
+#       changing its size (so readers and finalizeWave only ever see the
+#       data written), and gives back what is left over on close
+#     - starts writeback of each writebackBytes window as soon as it is
+#       written (sync_file_range), so the kernel writes a little at a time
+#       instead of in storms when its dirty limits are reached, and once the
+#       window before it is on disk drops it from the cache
+#       (posix_fadvise DONTNEED), so finished audio doesn't evict the
+#       recorder's own pages.  The waiting for the disk and the dropping are
+#       done by a thread of their own (see syncLoop), so a card that stalls
+#       never holds up the writer.
+#     - optionally writes with O_DIRECT, from an aligned buffer, bypassing
+#       the cache altogether.  Each write then waits for the card, and up to
+#       a window of audio is held in memory, so it is off by default.
+#   sync_file_range and fallocate are called through ctypes; where they (or
+#   O_DIRECT) aren't available the file is written as before.
+###############################################################################
+
+import ctypes
+import ctypes.util
+import fcntl
+import mmap
+import os
+import queue
+import threading
+import time
+
+# fallocate modes: allocate without changing the file size, and free a range
+# (with KEEP_SIZE) so it reads as zeros
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+# sync_file_range flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# offset and size alignment for O_DIRECT writes
+DIRECT_ALIGN = 4096
+
+# bytes written at a time with O_DIRECT when no writeback window is set
+DIRECT_CHUNK = 256 * 1024
+
+# the C library functions used, loaded on first use (None if unavailable)
+libc = None
+libcLoaded = False
+
+# this process's counters
+stats = {"preallocCalls": 0, "preallocFailed": 0, "writebackWindows": 0, "droppedBytes": 0,
+         "directWrites": 0, "maxSyncMs": 0.0}
+
+# windows for the writeback thread to wait for and drop from the cache, as
+# (fd, offset, length), or (fd, None, None) to close the fd
+syncJobs = queue.Queue()
+syncThread = None
+syncLock = threading.Lock()
+
+###############################################################################
+# Function Name:
+#   getLibc
+# Description:
+#   loads the C library's fallocate and sync_file_range, with 64 bit
+#   offsets (as on a 32 bit Pi OS)
+# Parameters:
+#   none
+# Return value:
+#   dict of functions by name (empty if the library can't be loaded)
+###############################################################################
+def getLibc():
+    global libc, libcLoaded
+    if libcLoaded:
+        return libc
+    libcLoaded = True
+    libc = {}
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return libc
+    for name, symbols, argtypes in (("fallocate", ("fallocate64", "fallocate"), (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)),
+                                    ("sync_file_range", ("sync_file_range",), (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint))):
+        for symbol in symbols:
+            func = getattr(lib, symbol, None)
+            if func != None:
+                func.argtypes = argtypes
+                func.restype = ctypes.c_int
+                libc[name] = func
+                break
+    return libc
+
+###############################################################################
+# Class Name:
+#   StreamFile
+# Description:
+#   a file written from start to end (apart from rewriting its header),
+#   with the write, seek, tell and close methods WaveWriter uses
+###############################################################################
+class StreamFile:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   creates the file
+    # Parameters:
+    #   filename - name of the file to create
+    #   preallocBytes - bytes allocated at a time (0 = don't preallocate)
+    #   writebackBytes - writeback window (0 = leave writeback to the
+    #                    kernel)
+    #   direct - True to write with O_DIRECT where the file system allows
+    ###########################################################################
+    def __init__(self, filename, preallocBytes=0, writebackBytes=0, direct=False):
+        self.preallocBytes = preallocBytes
+        self.writebackBytes = writebackBytes
+        self.fd = None
+        self.direct = False
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if direct and hasattr(os, "O_DIRECT"):
+            try:
+                self.fd = os.open(filename, flags | os.O_DIRECT, 0o666)
+                self.direct = True
+            except OSError:
+                pass
+        if self.fd == None:
+            self.fd = os.open(filename, flags, 0o666)
+        if self.direct:
+            chunk = writebackBytes if writebackBytes else DIRECT_CHUNK
+            self.chunk = max(DIRECT_ALIGN, chunk - chunk % DIRECT_ALIGN)
+            self.buffer = mmap.mmap(-1, self.chunk)
+            self.pending = bytearray()
+        self.pos = 0
+        self.size = 0
+        self.allocated = 0
+        self.windowEnd = writebackBytes
+        self.syncFd = os.dup(self.fd) if writebackBytes and not self.direct else None
+
+    ###########################################################################
+    # Method Name:
+    #   write
+    # Description:
+    #   writes data at the current position
+    # Parameters:
+    #   data - the bytes
+    # Return value:
+    #   none
+    ###########################################################################
+    def write(self, data):
+        if self.direct:
+            self.pending += data
+            if len(self.pending) >= self.chunk:
+                self.writeDirect()
+            return
+        self.preallocate(self.pos + len(data))
+        view = memoryview(data)
+        while len(view):
+            n = os.write(self.fd, view)
+            view = view[n:]
+            self.pos += n
+        self.size = max(self.size, self.pos)
+        self.writeback()
+
+    ###########################################################################
+    # Method Name:
+    #   writeDirect
+    # Description:
+    #   writes the whole chunks collected, through the aligned buffer
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def writeDirect(self):
+        while len(self.pending) >= self.chunk:
+            self.preallocate(self.pos + self.chunk)
+            self.buffer[:] = self.pending[:self.chunk]
+            del self.pending[:self.chunk]
+            n = os.write(self.fd, self.buffer)
+            if n != self.chunk:
+                raise OSError("short direct write")
+            self.pos += n
+            self.size = max(self.size, self.pos)
+            stats["directWrites"] += 1
+
+    ###########################################################################
+    # Method Name:
+    #   endDirect
+    # Description:
+    #   switches back to buffered writes (to write the last partial chunk,
+    #   or the header) after writing the data collected
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def endDirect(self):
+        if not self.direct:
+            return
+        self.direct = False
+        self.writebackBytes = 0
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+        pending = bytes(self.pending)
+        self.pending = bytearray()
+        self.buffer.close()
+        self.write(pending)
+
+    ###########################################################################
+    # Method Name:
+    #   preallocate
+    # Description:
+    #   allocates the next preallocBytes of the file once a write would run
+    #   past what is allocated.  If the file system can't, preallocation is
+    #   turned off for the file.
+    # Parameters:
+    #   end - the offset the write ends at
+    # Return value:
+    #   none
+    ###########################################################################
+    def preallocate(self, end):
+        if not self.preallocBytes or end <= self.allocated:
+            return
+        fallocate = getLibc().get("fallocate")
+        start = max(self.allocated, self.size)
+        length = max(self.preallocBytes, end - start)
+        if fallocate == None or fallocate(self.fd, FALLOC_FL_KEEP_SIZE, start, length) != 0:
+            self.preallocBytes = 0
+            stats["preallocFailed"] += 1
+            return
+        self.allocated = start + length
+        stats["preallocCalls"] += 1
+
+    ###########################################################################
+    # Method Name:
+    #   writeback
+    # Description:
+    #   for each writeback window completed, starts writing it (without
+    #   waiting) and hands the window before it, which has had a window's
+    #   time to reach the card, to the writeback thread to drop from the
+    #   cache.  Without sync_file_range the kernel starts the writeback of
+    #   any dirty pages when they are dropped.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def writeback(self):
+        if not self.writebackBytes or self.syncFd == None:
+            return
+        syncRange = getLibc().get("sync_file_range")
+        while self.size >= self.windowEnd:
+            start = self.windowEnd - self.writebackBytes
+            previous = start - self.writebackBytes
+            if syncRange != None:
+                syncRange(self.fd, start, self.writebackBytes, SYNC_FILE_RANGE_WRITE)
+            if previous >= 0:
+                queueSync(self.syncFd, previous, self.writebackBytes)
+            stats["writebackWindows"] += 1
+            self.windowEnd += self.writebackBytes
+
+    ###########################################################################
+    # Method Name:
+    #   seek
+    # Description:
+    #   moves the position (only used to rewrite the header, so direct
+    #   writes end first)
+    # Parameters:
+    #   offset - the new position
+    #   whence - os.SEEK_SET, SEEK_CUR or SEEK_END
+    # Return value:
+    #   the new position
+    ###########################################################################
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.endDirect()
+        self.pos = os.lseek(self.fd, offset, whence)
+        return self.pos
+
+    def tell(self):
+        return self.pos + (len(self.pending) if self.direct else 0)
+
+    ###########################################################################
+    # Method Name:
+    #   close
+    # Description:
+    #   writes what is left, gives back the space preallocated past the end
+    #   and drops the file from the cache (starting the writeback of what
+    #   is still dirty) before closing it
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def close(self):
+        if self.fd == None:
+            return
+        try:
+            self.endDirect()
+            if self.allocated > self.size:
+                os.ftruncate(self.fd, self.size)
+            if self.writebackBytes:
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            if self.syncFd != None:
+                queueSync(self.syncFd, None, None)
+                self.syncFd = None
+
+###############################################################################
+# Function Name:
+#   queueSync
+# Description:
+#   hands a window to the writeback thread (see syncLoop), starting the
+#   thread the first time
+# Parameters:
+#   fd - the thread's own descriptor of the file
+#   offset - start of the window, or None to close fd once the windows
+#            queued before are done
+#   length - length of the window
+# Return value:
+#   0
+###############################################################################
+def queueSync(fd, offset, length):
+    global syncThread
+    with syncLock:
+        if syncThread == None:
+            syncThread = threading.Thread(target=syncLoop, daemon=True, name="writeback")
+            syncThread.start()
+    syncJobs.put((fd, offset, length))
+    return 0
+
+###############################################################################
+# Function Name:
+#   syncLoop
+# Description:
+#   the writeback thread: waits for each window handed to it to reach the
+#   disk, then drops it from the cache.  maxSyncMs is the longest wait.
+# Parameters:
+#   none
+# Return value:
+#   none
+###############################################################################
+def syncLoop():
+    syncRange = getLibc().get("sync_file_range")
+    while True:
+        fd, offset, length = syncJobs.get()
+        if offset == None:
+            os.close(fd)
+            continue
+        began = time.perf_counter()
+        try:
+            if syncRange != None:
+                syncRange(fd, offset, length,
+                          SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            continue
+        stats["droppedBytes"] += length
+        stats["maxSyncMs"] = max(stats["maxSyncMs"], round(1000.0 * (time.perf_counter() - began), 3))
+
+###############################################################################
+# Function Name:
+#   syncDir
+# Description:
+#   syncs a directory, so a file created or renamed in it survives a power
+#   loss (or the drive being pulled)
+# Parameters:
+#   path - the directory
+# Return value:
+#   0
+###############################################################################
+def syncDir(path):
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return 0
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+    return 0
+
+###############################################################################
+# Function Name:
+#   punchHole
+# Description:
+#   frees the whole file system blocks in a range of a file, which then
+#   reads as zeros, without changing the file's size
+# Parameters:
+#   fd - the open file's descriptor
+#   offset - start of the range
+#   length - length of the range
+# Return value:
+#   bytes freed (0 if the file system or C library can't)
+###############################################################################
+def punchHole(fd, offset, length):
+    start = -(-offset // DIRECT_ALIGN) * DIRECT_ALIGN
+    end = (offset + length) // DIRECT_ALIGN * DIRECT_ALIGN
+    fallocate = getLibc().get("fallocate")
+    if end <= start or fallocate == None:
+        return 0
+    if fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, start, end - start) != 0:
+        return 0
+    return end - start
+
+###############################################################################
+# Function Name:
+#   getCacheStats
+# Description:
+#   reads the system's dirty and writeback page totals from /proc/meminfo
+# Parameters:
+#   none
+# Return value:
+#   dict of dirtyKB and writebackKB (empty if they can't be read)
+###############################################################################
+def getCacheStats():
+    fields = {"Dirty:": "dirtyKB", "Writeback:": "writebackKB", "Cached:": "cachedKB"}
+    result = {}
+    try:
+        with open("/proc/meminfo") as fd:
+            for line in fd:
+                words = line.split()
+                if words and words[0] in fields:
+                    result[fields[words[0]]] = int(words[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return result
+
+###############################################################################
+# Function Name:
+#   getStats
+# Description:
+#   returns this process's counters, the windows waiting for the writeback
+#   thread (syncQueued) and the system's cache totals for telemetry
+# Parameters:
+#   none
+# Return value:
+#   dict of counters
+###############################################################################
+def getStats():
+    result = dict(stats)
+    result["syncQueued"] = syncJobs.qsize()
+    result.update(getCacheStats())
+    return result
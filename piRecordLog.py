@@ -0,0 +1,402 @@
+###############################################################################
+# piRecordLog.py - Raspberry Pi audio recorder logging module
+# Description:
+#   a non-blocking logging pipeline.  Log records go onto bounded queues:
+#   one in the UI process, and one the engine process puts its records on,
+#   which a thread in the UI moves to the first.  Putting a record on a
+#   queue never waits; if the queue is full the record is dropped and
+#   counted.  A single writer thread in the UI process takes the records off
+#   in batches, writes each batch with one write call and rotates the log
+#   file when it grows past the configured size.  A slow SD card therefore
+#   holds up only the writer.
+#
+#   The engine reports what it does as events: one line of name and
+#   key=value fields, rate limited per event name so a burst (e.g. of
+#   xruns) can't flood the log.  Events that were held back are counted in
+#   the next one that gets through.
+#
+#   Running this module measures the cost of a log call with this pipeline
+#   and with a plain file handler (see __main__).
+###############################################################################
+
+import argparse
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+
+# records taken off the queue and written at a time
+BATCH_SIZE = 64
+
+# seconds between events with the same name unless given otherwise
+EVENT_INTERVAL = 1.0
+
+# the queue other processes put their records on, and the UI process's
+# writer
+logQueue = None
+writer = None
+
+# this process's producer counters, and when each event was last logged
+stats = {"queued": 0, "dropped": 0, "eventsSuppressed": 0}
+lastEvents = {}
+
+###############################################################################
+# Class Name:
+#   QueueHandler
+# Description:
+#   a logging handler that puts records on the log queue without waiting
+###############################################################################
+class QueueHandler(logging.handlers.QueueHandler):
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            stats["queued"] += 1
+        except queue.Full:
+            stats["dropped"] += 1
+
+###############################################################################
+# Class Name:
+#   LogWriter
+# Description:
+#   the writer thread: writes the queued records in batches and rotates the
+#   log file by size
+###############################################################################
+class LogWriter:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   opens the log file and starts the writer thread, and the thread that
+    #   moves records from the other processes' queue to the writer's
+    # Parameters:
+    #   records - the queue of log records
+    #   remote - the queue other processes put their records on
+    #   filename - the log file
+    #   fmt - the log line format
+    #   maxBytes - size the file is rotated at (0 = never)
+    #   backups - rotated files kept (piRecord.log.1 is the newest)
+    ###########################################################################
+    def __init__(self, records, remote, filename, fmt, maxBytes, backups):
+        self.records = records
+        self.remote = remote
+        self.filename = filename
+        self.formatter = logging.Formatter(fmt)
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.fd = open(filename, "a")
+        self.written = 0
+        self.batches = 0
+        self.maxBatch = 0
+        self.rotations = 0
+        self.maxWriteTime = 0.0
+        self.remoteDropped = 0
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+        threading.Thread(target=self.receive, name="log-receiver", daemon=True).start()
+
+    ###########################################################################
+    # Method Name:
+    #   receive
+    # Description:
+    #   the receiver thread: moves records from the other processes' queue
+    #   to the writer's.  A None record is passed on and stops the thread.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def receive(self):
+        while True:
+            record = self.remote.get()
+            try:
+                self.records.put(record, block=record == None)
+            except queue.Full:
+                self.remoteDropped += 1
+            if record == None:
+                break
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   the writer thread.  Waits for a record, then takes whatever else is
+    #   queued (up to BATCH_SIZE) and writes them together.  A None record
+    #   stops the thread once everything before it is written.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self):
+        running = True
+        while running:
+            batch = [self.records.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+            if batch:
+                self.write(batch)
+        self.fd.close()
+
+    ###########################################################################
+    # Method Name:
+    #   write
+    # Description:
+    #   formats and writes a batch of records, then rotates the file if it
+    #   has grown too big.  Write errors (e.g. a full card) lose the batch
+    #   but don't stop the writer.
+    # Parameters:
+    #   batch - list of log records
+    # Return value:
+    #   none
+    ###########################################################################
+    def write(self, batch):
+        text = "".join(self.formatter.format(record) + "\n" for record in batch)
+        start = time.perf_counter()
+        try:
+            self.fd.write(text)
+            self.fd.flush()
+            if self.maxBytes and self.fd.tell() >= self.maxBytes:
+                self.rotate()
+        except (OSError, ValueError):
+            pass
+        self.maxWriteTime = max(self.maxWriteTime, time.perf_counter() - start)
+        self.written += len(batch)
+        self.batches += 1
+        self.maxBatch = max(self.maxBatch, len(batch))
+
+    ###########################################################################
+    # Method Name:
+    #   rotate
+    # Description:
+    #   renames the log file to .1 (and the older files up one), dropping the
+    #   oldest, and starts a new file
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def rotate(self):
+        self.fd.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.filename, i)):
+                os.replace("%s.%d" % (self.filename, i), "%s.%d" % (self.filename, i + 1))
+        if self.backups > 0:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self.fd = open(self.filename, "a")
+        self.rotations += 1
+
+    ###########################################################################
+    # Method Name:
+    #   stop
+    # Description:
+    #   writes what is queued and stops the threads.  The stop goes through
+    #   the receiver, so records the other processes queued first are kept.
+    # Parameters:
+    #   timeout - most seconds to wait
+    # Return value:
+    #   none
+    ###########################################################################
+    def stop(self, timeout):
+        self.remote.put(None)
+        self.thread.join(timeout)
+
+    def getStats(self):
+        return {"written": self.written, "batches": self.batches, "maxBatch": self.maxBatch,
+                "rotations": self.rotations, "remoteDropped": self.remoteDropped, "maxWriteMs": round(1000.0 * self.maxWriteTime, 3)}
+
+###############################################################################
+# Function Name:
+#   start
+# Description:
+#   starts the pipeline in the UI process: creates the queues and the
+#   writer and sends this process's log records to the writer
+# Parameters:
+#   filename - the log file
+#   level - the lowest level logged
+#   fmt - the log line format
+#   maxBytes - size the file is rotated at (0 = never)
+#   backups - rotated files kept
+#   queueSize - most records queued (on each queue) before records are
+#               dropped
+# Return value:
+#   the queue for other processes, to be passed to the engine (see attach)
+###############################################################################
+def start(filename, level, fmt, maxBytes, backups, queueSize):
+    global logQueue, writer
+    records = queue.Queue(queueSize)
+    logQueue = multiprocessing.get_context("spawn").Queue(queueSize)
+    writer = LogWriter(records, logQueue, filename, fmt, maxBytes, backups)
+    attach(records, level)
+    return logQueue
+
+###############################################################################
+# Function Name:
+#   attach
+# Description:
+#   sends this process's log records to the log queue, replacing any other
+#   handlers
+# Parameters:
+#   records - the log queue
+#   level - the lowest level logged
+# Return value:
+#   0
+###############################################################################
+def attach(records, level):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    return 0
+
+###############################################################################
+# Function Name:
+#   stop
+# Description:
+#   writes what is queued and stops the writer (in the UI process)
+# Parameters:
+#   timeout - most seconds to wait
+# Return value:
+#   0
+###############################################################################
+def stop(timeout=2.0):
+    global writer
+    if writer != None:
+        writer.stop(timeout)
+        writer = None
+    return 0
+
+###############################################################################
+# Function Name:
+#   event
+# Description:
+#   logs an event as its name followed by key=value fields, unless an event
+#   with the same name was logged less than interval seconds ago.  The
+#   first event after some were held back carries suppressed=N.
+# Parameters:
+#   name - the event name
+#   level - the log level
+#   interval - least seconds between events with this name (0 = no limit)
+#   fields - the event's fields
+# Return value:
+#   True if the event was logged
+###############################################################################
+def event(name, level=logging.INFO, interval=EVENT_INTERVAL, **fields):
+    now = time.time()
+    last, suppressed = lastEvents.get(name, (0.0, 0))
+    if interval and now - last < interval:
+        lastEvents[name] = (last, suppressed + 1)
+        stats["eventsSuppressed"] += 1
+        return False
+    lastEvents[name] = (now, 0)
+    if suppressed:
+        fields["suppressed"] = suppressed
+    text = " ".join("%s=%s" % (key, formatValue(value)) for key, value in fields.items())
+    logging.log(level, "%s %s" % (name, text) if text else name)
+    return True
+
+###############################################################################
+# Function Name:
+#   formatValue
+# Description:
+#   formats an event field value, quoting strings with spaces
+# Parameters:
+#   value - the value
+# Return value:
+#   the text
+###############################################################################
+def formatValue(value):
+    if isinstance(value, float):
+        return "%.6g" % value
+    text = str(value)
+    if not text or " " in text or '"' in text:
+        return '"%s"' % text.replace('"', '\\"')
+    return text
+
+###############################################################################
+# Function Name:
+#   getStats
+# Description:
+#   returns this process's logging counters (and the writer's, in the UI
+#   process) for telemetry
+# Parameters:
+#   none
+# Return value:
+#   dict of counters
+###############################################################################
+def getStats():
+    result = dict(stats)
+    if writer != None:
+        result.update(writer.getStats())
+    return result
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   measures the time a log call takes with this pipeline and with a plain
+#   file handler, both writing to the same directory, e.g.
+#     python3 piRecordLog.py --count 20000 --dir /home/pi
+#   --sync makes each write wait for the card (as a busy card would).
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the logging pipeline")
+    parser.add_argument("--count", type=int, default=20000, help="log calls per run")
+    parser.add_argument("--dir", help="directory for the test log (default: a temporary one)")
+    parser.add_argument("--sync", action="store_true", help="fsync after every write")
+    args = parser.parse_args()
+
+    logDir = args.dir or tempfile.mkdtemp(prefix="piRecordLog")
+    fmt = '%(asctime)s %(levelname)s:  %(message)s'
+
+    def measure(name):
+        times = []
+        for i in range(args.count):
+            start = time.perf_counter()
+            logging.info("switch pressed: %d", i)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        print ("%-10s mean %7.1f us  p99 %7.1f us  max %8.1f us" % (name, 1e6 * sum(times) / len(times),
+               1e6 * times[int(len(times) * 0.99)], 1e6 * times[-1]))
+
+    # plain file handler, as logging.basicConfig sets up
+    plain = logging.FileHandler(os.path.join(logDir, "plain.log"))
+    plain.setFormatter(logging.Formatter(fmt))
+    if args.sync:
+        plainEmit = plain.emit
+        def syncEmit(record):
+            plainEmit(record)
+            os.fsync(plain.stream.fileno())
+        plain.emit = syncEmit
+    logging.getLogger().addHandler(plain)
+    logging.getLogger().setLevel(logging.INFO)
+    measure("plain")
+    logging.getLogger().removeHandler(plain)
+    plain.close()
+
+    start(os.path.join(logDir, "queued.log"), logging.INFO, fmt, 1024 * 1024, 3, 10000)
+    if args.sync:
+        writerWrite = writer.write
+        def syncWrite(batch):
+            writerWrite(batch)
+            os.fsync(writer.fd.fileno())
+        writer.write = syncWrite
+    measure("queued")
+    logWriter = writer
+    stop(30.0)
+    print ("queued     dropped %d of %d, %d batches of up to %d, slowest write %.1f ms" % (stats["dropped"],
+           args.count, logWriter.batches, logWriter.maxBatch, 1000.0 * logWriter.maxWriteTime))
@@ -0,0 +1,445 @@
+###############################################################################
+# piRecordLoudness.py - Raspberry Pi audio recorder loudness module
+# Description:
+#   measures integrated loudness (LUFS), loudness range (LU) and true peak
+#   (dBTP) as defined by EBU R128 / ITU-R BS.1770 and EBU Tech 3342.  Audio
+#   is K-weighted in large blocks with an FFT convolution, and gated block
+#   loudness is kept in fixed size histograms, so memory use doesn't depend
+#   on the length of a take.  Results for recordings are cached per file,
+#   keyed on the file's size and modification time.  The meter can also run
+#   live on the engine's capture blocks, in a thread of the engine process.
+###############################################################################
+
+import collections
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import numpy
+import piRecordConf
+import piRecordFormat
+import piRecordWave
+import piRecordDSP
+
+# cache file, kept in the same directory as the recordings
+CACHE_FILE = ".loudness"
+
+# gating constants (BS.1770 and Tech 3342)
+ABS_GATE = -70.0
+REL_GATE = -10.0
+LRA_REL_GATE = -20.0
+LRA_LOW = 10.0
+LRA_HIGH = 95.0
+
+# block loudness histograms run from the absolute gate to +5 LUFS
+HIST_MIN = ABS_GATE
+HIST_MAX = 5.0
+HIST_STEP = 0.01
+HIST_BINS = int(round((HIST_MAX - HIST_MIN) / HIST_STEP))
+
+# frames of audio the meter collects before filtering
+METER_BLOCK = 65536
+
+# seconds of capture blocks the live meter queues before blocks are dropped
+MAX_QUEUED_SECS = 4.0
+
+###############################################################################
+# Function Name:
+#   kWeighting
+# Description:
+#   returns the K-weighting filter (high shelf plus high pass) for a sample
+#   rate, as an FIR filter long enough for the IIR response to decay below
+#   -120 dB.  The biquad coefficients follow the BS.1770 definitions.
+# Parameters:
+#   rate - the sample rate
+# Return value:
+#   the filter taps
+###############################################################################
+def kWeighting(rate):
+    # stage 1: high shelf modelling the head
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10.0 ** (gain / 20.0)
+    vb = vh ** 0.4996667741545416
+    a0 = 1.0 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0)
+
+    # stage 2: RLB high pass
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1.0 + k / q + k * k
+    highPass = (1.0, -2.0, 1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0)
+
+    length = 1 << int(math.ceil(math.log2(rate / 6.0)))
+    return piRecordDSP.biquadImpulse([shelf, highPass], length)
+
+###############################################################################
+# Function Name:
+#   channelWeights
+# Description:
+#   returns the BS.1770 channel weights.  For 5.1 (L R C LFE Ls Rs) the LFE is
+#   excluded and the surrounds are weighted +1.5 dB; all other layouts weight
+#   every channel equally.
+# Parameters:
+#   nchannels - number of channels
+# Return value:
+#   array of weights
+###############################################################################
+def channelWeights(nchannels):
+    weights = numpy.ones(nchannels)
+    if nchannels == 6:
+        weights[3] = 0.0
+        weights[4:6] = 1.41
+    return weights
+
+###############################################################################
+# Function Name:
+#   energyToLoudness
+# Description:
+#   converts mean square energy to loudness
+# Parameters:
+#   energy - the weighted mean square energy
+# Return value:
+#   loudness in LUFS (-inf for silence)
+###############################################################################
+def energyToLoudness(energy):
+    if energy <= 0.0:
+        return float('-inf')
+    return -0.691 + 10.0 * math.log10(energy)
+
+###############################################################################
+# Class Name:
+#   LoudnessMeter
+# Description:
+#   measures loudness and true peak over a stream of float blocks
+###############################################################################
+class LoudnessMeter:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   sets up the filters and histograms for a stream
+    # Parameters:
+    #   rate - the sample rate
+    #   nchannels - number of channels
+    ###########################################################################
+    def __init__(self, rate, nchannels):
+        self.rate = rate
+        self.nchannels = nchannels
+        self.kFilter = piRecordDSP.FIRFilter(kWeighting(rate), nchannels)
+        self.weights = channelWeights(nchannels)
+        self.hop = rate // 10
+        self.partial = numpy.zeros(0)
+        self.hops = collections.deque(maxlen=30)
+        self.hopCount = 0
+        self.blockHist = numpy.zeros(HIST_BINS)
+        self.blockEnergy = numpy.zeros(HIST_BINS)
+        self.shortHist = numpy.zeros(HIST_BINS)
+        self.shortEnergy = numpy.zeros(HIST_BINS)
+
+        # true peak is measured at 4x oversampling (2x from 96 kHz up)
+        factor = 4 if rate < 96000 else 2
+        self.upsampler = piRecordDSP.Resampler(rate, rate * factor, nchannels, tapsPerPhase=12)
+        self.peak = 0.0
+        self.frames = 0
+        self.pending = []
+        self.pendingFrames = 0
+
+    ###########################################################################
+    # Method Name:
+    #   process
+    # Description:
+    #   adds a block to the measurement.  Blocks are collected until there
+    #   are METER_BLOCK frames, so small capture blocks are filtered together.
+    # Parameters:
+    #   x - block of float samples, shape (frames, channels)
+    # Return value:
+    #   none
+    ###########################################################################
+    def process(self, x):
+        self.pending.append(x)
+        self.pendingFrames += len(x)
+        if self.pendingFrames >= METER_BLOCK:
+            self.measure()
+
+    ###########################################################################
+    # Method Name:
+    #   measure
+    # Description:
+    #   measures the collected blocks: true peak on the oversampled signal,
+    #   and the K-weighted energy of each 100 ms hop.  The hop energies are
+    #   combined into 400 ms gating blocks and 3 s short-term windows, whose
+    #   loudness is added to the histograms.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def measure(self):
+        if not self.pending:
+            return
+        x = numpy.concatenate(self.pending)
+        self.pending = []
+        self.pendingFrames = 0
+        self.frames += len(x)
+
+        up = self.upsampler.process(x)
+        if len(up):
+            self.peak = max(self.peak, float(numpy.abs(up).max()))
+
+        y = self.kFilter.process(x)
+        z = numpy.concatenate((self.partial, (y * y) @ self.weights))
+        nhops = len(z) // self.hop
+        self.partial = z[nhops * self.hop:]
+        hopEnergy = z[:nhops * self.hop].reshape(nhops, self.hop).mean(axis=1)
+
+        blocks = []
+        shorts = []
+        for e in hopEnergy:
+            self.hops.append(e)
+            self.hopCount += 1
+            if self.hopCount >= 4:
+                blocks.append(sum(list(self.hops)[-4:]) / 4.0)
+            if self.hopCount >= 30:
+                shorts.append(sum(self.hops) / 30.0)
+        self.addToHistogram(self.blockHist, self.blockEnergy, blocks)
+        self.addToHistogram(self.shortHist, self.shortEnergy, shorts)
+
+    ###########################################################################
+    # Method Name:
+    #   addToHistogram
+    # Description:
+    #   adds gating block energies to a loudness histogram, dropping blocks
+    #   below the absolute gate
+    # Parameters:
+    #   hist - block counts per loudness bin
+    #   energy - sum of block energies per loudness bin
+    #   blocks - list of block energies
+    # Return value:
+    #   none
+    ###########################################################################
+    def addToHistogram(self, hist, energy, blocks):
+        e = numpy.array(blocks)
+        if len(e) == 0:
+            return
+        with numpy.errstate(divide='ignore'):
+            loudness = -0.691 + 10.0 * numpy.log10(e)
+        keep = loudness > ABS_GATE
+        bins = numpy.clip(((loudness[keep] - HIST_MIN) / HIST_STEP).astype(int), 0, HIST_BINS - 1)
+        numpy.add.at(hist, bins, 1)
+        numpy.add.at(energy, bins, e[keep])
+
+    ###########################################################################
+    # Method Name:
+    #   result
+    # Description:
+    #   ends the stream and returns the measurements
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of integrated (LUFS), range (LU), truePeak (dBTP) and duration
+    #   (s); loudness values are None if the take is silent or too short
+    ###########################################################################
+    def result(self):
+        self.measure()
+        tail = self.upsampler.flush()
+        if len(tail):
+            self.peak = max(self.peak, float(numpy.abs(tail).max()))
+
+        binLoudness = HIST_MIN + numpy.arange(HIST_BINS) * HIST_STEP
+
+        # integrated loudness: blocks above the relative gate
+        integrated = None
+        if self.blockHist.sum() > 0:
+            gate = energyToLoudness(self.blockEnergy.sum() / self.blockHist.sum()) + REL_GATE
+            above = binLoudness >= gate - HIST_STEP
+            if self.blockHist[above].sum() > 0:
+                integrated = energyToLoudness(self.blockEnergy[above].sum() / self.blockHist[above].sum())
+
+        # loudness range: spread of the gated short-term loudness
+        lra = None
+        if self.shortHist.sum() > 0:
+            gate = energyToLoudness(self.shortEnergy.sum() / self.shortHist.sum()) + LRA_REL_GATE
+            counts = numpy.where(binLoudness >= gate - HIST_STEP, self.shortHist, 0)
+            if counts.sum() > 0:
+                cdf = numpy.cumsum(counts) / counts.sum()
+                low = binLoudness[numpy.searchsorted(cdf, LRA_LOW / 100.0)]
+                high = binLoudness[numpy.searchsorted(cdf, LRA_HIGH / 100.0)]
+                lra = float(high - low)
+
+        truePeak = 20.0 * math.log10(self.peak) if self.peak > 0.0 else None
+        return {"integrated": integrated, "range": lra, "truePeak": truePeak,
+                "duration": self.frames / float(self.rate)}
+
+###############################################################################
+# Function Name:
+#   analyzeFile
+# Description:
+#   measures a wave file
+# Parameters:
+#   fn - the file name
+#   chunkFrames - frames read at a time
+# Return value:
+#   the measurement dict (see LoudnessMeter.result)
+###############################################################################
+def analyzeFile(fn, chunkFrames=METER_BLOCK):
+    reader = piRecordWave.WaveReader(fn)
+    meter = LoudnessMeter(reader.getframerate(), reader.getnchannels())
+    while True:
+        data = reader.readframes(chunkFrames)
+        if not data:
+            break
+        meter.process(piRecordFormat.samplesToFloat(data, reader.getsampwidth(), reader.getformattag(), reader.getnchannels()))
+    reader.close()
+    return meter.result()
+
+###############################################################################
+# Function Name:
+#   loadCache
+# Description:
+#   reads the loudness cache for a directory
+# Parameters:
+#   dirName - the directory
+# Return value:
+#   dict of cache entries by file name
+###############################################################################
+def loadCache(dirName):
+    try:
+        with open(os.path.join(dirName, CACHE_FILE)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+###############################################################################
+# Function Name:
+#   storeResult
+# Description:
+#   adds a file's measurements to the cache for its directory.  The cache is
+#   replaced atomically.
+# Parameters:
+#   fn - the file name
+#   result - the measurement dict
+# Return value:
+#   0
+###############################################################################
+def storeResult(fn, result):
+    dirName = os.path.dirname(fn)
+    cache = loadCache(dirName)
+    st = os.stat(fn)
+    cache[os.path.basename(fn)] = {"size": st.st_size, "mtime": st.st_mtime, "result": result}
+    cacheName = os.path.join(dirName, CACHE_FILE)
+    with open(cacheName + ".tmp", "w") as fd:
+        json.dump(cache, fd, indent=1)
+    os.replace(cacheName + ".tmp", cacheName)
+    return 0
+
+###############################################################################
+# Function Name:
+#   getLoudness
+# Description:
+#   returns the measurements for a recording, from the cache if the file is
+#   unchanged since it was measured
+# Parameters:
+#   fn - the file name
+# Return value:
+#   the measurement dict (see LoudnessMeter.result)
+###############################################################################
+def getLoudness(fn):
+    entry = loadCache(os.path.dirname(fn)).get(os.path.basename(fn))
+    st = os.stat(fn)
+    if entry != None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+        return entry["result"]
+    result = analyzeFile(fn)
+    storeResult(fn, result)
+    return result
+
+###############################################################################
+# Function Name:
+#   formatResult
+# Description:
+#   formats measurements for display
+# Parameters:
+#   result - the measurement dict
+# Return value:
+#   the display string
+###############################################################################
+def formatResult(result):
+    def fmt(value, unit):
+        return "  --  " + unit if value == None else "%6.1f %s" % (value, unit)
+    return "%s  LRA %s  peak %s" % (fmt(result["integrated"], "LUFS"), fmt(result["range"], "LU"),
+                                    fmt(result["truePeak"], "dBTP"))
+
+###############################################################################
+# Class Name:
+#   LiveMeter
+# Description:
+#   runs a LoudnessMeter on the engine's capture blocks in a background
+#   thread, so the measurement is ready the moment a take stops without the
+#   filtering running in the capture loop.  Blocks are handed over as the
+#   stored bytes; the conversion to float happens in the thread.  If the
+#   thread falls behind, blocks are dropped rather than queued without limit,
+#   and the measurement is left incomplete (see droppedBlocks).
+###############################################################################
+class LiveMeter:
+
+    def __init__(self, rate, nchannels, sampWidth, fmtTag, blockFrames):
+        self.meter = LoudnessMeter(rate, nchannels)
+        self.format = (sampWidth, fmtTag, nchannels)
+        self.blocks = queue.Queue(maxsize=max(1, int(MAX_QUEUED_SECS * rate / blockFrames)))
+        self.droppedBlocks = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def feed(self, data):
+        try:
+            self.blocks.put_nowait(data)
+        except queue.Full:
+            self.droppedBlocks += 1
+
+    def run(self):
+        while True:
+            data = self.blocks.get()
+            if data == None:
+                return
+            self.meter.process(piRecordFormat.samplesToFloat(data, *self.format))
+
+    ###########################################################################
+    # Method Name:
+    #   stop
+    # Description:
+    #   waits for the thread to measure the remaining blocks
+    # Parameters:
+    #   none
+    # Return value:
+    #   the measurement dict (see LoudnessMeter.result)
+    ###########################################################################
+    def stop(self):
+        self.blocks.put(None)
+        self.thread.join()
+        return self.meter.result()
+
+    def getStats(self):
+        return {"queuedBlocks": self.blocks.qsize(), "droppedBlocks": self.droppedBlocks}
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   prints the measurements for the given recordings, or all recordings
+#   (see piRecord.sh loudness)
+###############################################################################
+if __name__ == "__main__":
+    piRecordConf.getRecDevConfig()
+    files = sys.argv[1:]
+    if not files:
+        files = sorted(os.path.join(piRecordConf.outputDir, fn) for fn in os.listdir(piRecordConf.outputDir)
+                       if fn.endswith(piRecordConf.fileTypeExt))
+    for fn in files:
+        print ("%-32s %s" % (os.path.basename(fn), formatResult(getLoudness(fn))))
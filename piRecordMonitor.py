@@ -0,0 +1,460 @@
+###############################################################################
+# piRecordMonitor.py - Raspberry Pi audio recorder live monitor module
+# Description:
+#   serves the recording in progress over HTTP so it can be heard from a
+#   phone or laptop on the local network.  The engine copies each stored
+#   block into a ring buffer; every client has its own thread that sends
+#   straight from the ring, so the engine never waits for a client.  A
+#   client that falls behind skips ahead to the live position (the audio it
+#   missed is dropped), and clients beyond maxClients are turned away.
+#
+#   /stream.wav   the live capture as a chunked wave stream
+#   /status.json  the current levels, monitor counters and engine telemetry
+###############################################################################
+
+import argparse
+import http.server
+import json
+import math
+import socketserver
+import threading
+import time
+import numpy
+import piRecordFormat
+import piRecordTelemetry
+import piRecordWave
+
+# seconds a client thread sleeps when there is no new data
+POLL_PERIOD = 0.02
+
+# seconds a send may block before the client is dropped
+SEND_TIMEOUT = 1.0
+
+# a client further behind than this fraction of the ring skips ahead
+MAX_LAG_FRACTION = 0.5
+
+# largest send, as a fraction of the ring, so a send can't be overwritten
+MAX_SEND_FRACTION = 0.125
+
+# seconds of audio the levels in /status.json are measured over
+LEVEL_SECS = 0.1
+
+# level reported for silence, in dBFS
+LEVEL_FLOOR = -120.0
+
+###############################################################################
+# Class Name:
+#   RingBuffer
+# Description:
+#   holds the last few seconds of stored samples.  There is one writer (the
+#   engine loop) and any number of readers; the writer never locks or waits.
+#   Positions are byte counts since the start of the take, so a reader can
+#   tell how far behind it is; the generation changes when a new take
+#   starts, which may change the format.
+###############################################################################
+class RingBuffer:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   creates an empty ring; configure() sizes it for a take
+    # Parameters:
+    #   seconds - seconds of audio held
+    ###########################################################################
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.view = None
+        self.size = 0
+        self.written = 0
+        self.generation = 0
+        self.format = None
+
+    ###########################################################################
+    # Method Name:
+    #   configure
+    # Description:
+    #   allocates the ring for a new take
+    # Parameters:
+    #   nchannels - number of channels
+    #   sampWidth - stored sample width in bytes
+    #   fmtTag - wave format tag of the stored samples
+    #   rate - sample rate
+    # Return value:
+    #   none
+    ###########################################################################
+    def configure(self, nchannels, sampWidth, fmtTag, rate):
+        frameSize = nchannels * sampWidth
+        self.view = memoryview(bytearray(frameSize * max(1, int(self.seconds * rate))))
+        self.size = len(self.view)
+        self.written = 0
+        self.format = (nchannels, sampWidth, fmtTag, rate)
+        self.generation += 1
+
+    ###########################################################################
+    # Method Name:
+    #   write
+    # Description:
+    #   copies a block into the ring, wrapping at the end
+    # Parameters:
+    #   data - block of stored samples
+    # Return value:
+    #   none
+    ###########################################################################
+    def write(self, data):
+        if self.view == None:
+            return
+        data = memoryview(data)[-self.size:]
+        n = len(data)
+        pos = self.written % self.size
+        first = min(n, self.size - pos)
+        self.view[pos:pos + first] = data[:first]
+        if n > first:
+            self.view[:n - first] = data[first:]
+        self.written += n
+
+    ###########################################################################
+    # Method Name:
+    #   slices
+    # Description:
+    #   returns views of the ring from pos up to at most maxBytes, without
+    #   copying.  A range that wraps is returned as two views.
+    # Parameters:
+    #   pos - start position (byte count since the start of the take)
+    #   maxBytes - most bytes returned
+    # Return value:
+    #   list of memoryviews, and the position after them
+    ###########################################################################
+    def slices(self, pos, maxBytes):
+        end = min(self.written, pos + maxBytes)
+        if end <= pos:
+            return [], pos
+        start = pos % self.size
+        n = end - pos
+        first = min(n, self.size - start)
+        views = [self.view[start:start + first]]
+        if n > first:
+            views.append(self.view[:n - first])
+        return views, end
+
+    ###########################################################################
+    # Method Name:
+    #   latest
+    # Description:
+    #   returns a copy of the most recent bytes in the ring
+    # Parameters:
+    #   nbytes - number of bytes wanted
+    # Return value:
+    #   the bytes (fewer if the take has just started)
+    ###########################################################################
+    def latest(self, nbytes):
+        end = self.written
+        views, end = self.slices(max(0, end - min(nbytes, self.size)), nbytes)
+        return b''.join(bytes(v) for v in views)
+
+###############################################################################
+# Class Name:
+#   MonitorHandler
+# Description:
+#   handles one HTTP request.  Each request runs in its own thread.
+###############################################################################
+class MonitorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ("/", "/stream.wav"):
+            self.server.monitor.stream(self)
+        elif path == "/status.json":
+            body = json.dumps(self.server.monitor.getStatus(), indent=1).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    # requests are counted in the telemetry rather than logged
+    def log_message(self, format, *args):
+        pass
+
+###############################################################################
+# Class Name:
+#   MonitorServer
+# Description:
+#   the threaded HTTP server
+###############################################################################
+class MonitorServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+###############################################################################
+# Class Name:
+#   Monitor
+# Description:
+#   the live monitor: the ring buffer the engine writes to and the HTTP
+#   server that reads from it, running in a background thread
+###############################################################################
+class Monitor:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   starts the HTTP server
+    # Parameters:
+    #   address - address to listen on ("" = all interfaces)
+    #   port - port to listen on (0 = any free port)
+    #   bufferSecs - seconds of audio held in the ring
+    #   maxClients - most streams served at once
+    ###########################################################################
+    def __init__(self, address, port, bufferSecs, maxClients):
+        self.ring = RingBuffer(bufferSecs)
+        self.maxClients = maxClients
+        self.clients = 0
+        self.clientLock = threading.Lock()
+        self.streamsServed = 0
+        self.streamsRefused = 0
+        self.droppedBytes = 0
+        self.server = MonitorServer((address, port), MonitorHandler)
+        self.server.monitor = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   stream
+    # Description:
+    #   sends the live capture to a client as a chunked wave stream, starting
+    #   at the live position.  The stream ends when a new take starts with
+    #   a different format, or when the client goes away.
+    # Parameters:
+    #   handler - the request handler
+    # Return value:
+    #   none
+    ###########################################################################
+    def stream(self, handler):
+        with self.clientLock:
+            if self.clients >= self.maxClients or self.ring.format == None:
+                self.streamsRefused += 1
+                refused = True
+            else:
+                self.clients += 1
+                self.streamsServed += 1
+                refused = False
+        if refused:
+            handler.send_error(503, "No stream available")
+            return
+
+        try:
+            handler.connection.settimeout(SEND_TIMEOUT)
+            self.sendStream(handler)
+        except OSError:
+            pass
+        finally:
+            with self.clientLock:
+                self.clients -= 1
+        handler.close_connection = True
+
+    ###########################################################################
+    # Method Name:
+    #   sendStream
+    # Description:
+    #   the body of stream()
+    # Parameters:
+    #   handler - the request handler
+    # Return value:
+    #   none
+    ###########################################################################
+    def sendStream(self, handler):
+        ring = self.ring
+        generation = ring.generation
+        nchannels, sampWidth, fmtTag, rate = ring.format
+        frameSize = nchannels * sampWidth
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "audio/wav")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.end_headers()
+        self.sendChunk(handler, [piRecordWave.makeWaveHeader(nchannels, sampWidth, rate, fmtTag, piRecordWave.MAX_SIZE)])
+
+        pos = ring.written - ring.written % frameSize
+        while True:
+            if ring.generation != generation:
+                if ring.format != (nchannels, sampWidth, fmtTag, rate):
+                    break
+                generation = ring.generation
+                pos = 0
+
+            # a client that has fallen behind skips ahead to the live position
+            lag = ring.written - pos
+            if lag > ring.size * MAX_LAG_FRACTION:
+                skip = lag - lag % frameSize
+                self.droppedBytes += skip
+                pos += skip
+                continue
+
+            views, end = ring.slices(pos, int(ring.size * MAX_SEND_FRACTION))
+            if not views:
+                time.sleep(POLL_PERIOD)
+                continue
+            self.sendChunk(handler, views)
+            pos = end
+
+        handler.wfile.write(b"0\r\n\r\n")
+
+    ###########################################################################
+    # Method Name:
+    #   sendChunk
+    # Description:
+    #   sends data as one HTTP chunk
+    # Parameters:
+    #   handler - the request handler
+    #   views - list of buffers making up the chunk
+    # Return value:
+    #   none
+    ###########################################################################
+    def sendChunk(self, handler, views):
+        n = sum(len(v) for v in views)
+        handler.wfile.write(b"%x\r\n" % n)
+        for v in views:
+            handler.wfile.write(v)
+        handler.wfile.write(b"\r\n")
+
+    ###########################################################################
+    # Method Name:
+    #   getLevels
+    # Description:
+    #   measures the peak and RMS level of each channel over the last
+    #   LEVEL_SECS of the ring
+    # Parameters:
+    #   none
+    # Return value:
+    #   list of {"peak", "rms"} in dBFS per channel
+    ###########################################################################
+    def getLevels(self):
+        if self.ring.format == None:
+            return []
+        nchannels, sampWidth, fmtTag, rate = self.ring.format
+        frameSize = nchannels * sampWidth
+        data = self.ring.latest(int(rate * LEVEL_SECS) * frameSize)
+        data = data[len(data) % frameSize:]
+        if not data:
+            return [{"peak": LEVEL_FLOOR, "rms": LEVEL_FLOOR} for ch in range(nchannels)]
+        x = piRecordFormat.samplesToFloat(data, sampWidth, fmtTag, nchannels)
+        peak = numpy.max(numpy.abs(x), axis=0)
+        rms = numpy.sqrt(numpy.mean(numpy.square(x, dtype=numpy.float64), axis=0))
+        return [{"peak": toDb(p), "rms": toDb(r)} for p, r in zip(peak, rms)]
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns the monitor's counters for telemetry
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters
+    ###########################################################################
+    def getStats(self):
+        return {"port": self.port, "clients": self.clients, "streamsServed": self.streamsServed,
+                "streamsRefused": self.streamsRefused, "droppedBytes": self.droppedBytes}
+
+    ###########################################################################
+    # Method Name:
+    #   getStatus
+    # Description:
+    #   returns the body of /status.json
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of the format, levels and telemetry
+    ###########################################################################
+    def getStatus(self):
+        status = {"levels": self.getLevels(), "telemetry": piRecordTelemetry.snapshot()}
+        if self.ring.format != None:
+            nchannels, sampWidth, fmtTag, rate = self.ring.format
+            status["format"] = {"channels": nchannels, "sampleWidth": sampWidth, "formatTag": fmtTag,
+                                "rate": rate, "seconds": self.ring.written / float(nchannels * sampWidth * rate)}
+        status["monitor"] = self.getStats()
+        return status
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+###############################################################################
+# Function Name:
+#   toDb
+# Description:
+#   converts a linear level to dBFS
+# Parameters:
+#   level - the level (1.0 = full scale)
+# Return value:
+#   the level in dBFS, no lower than LEVEL_FLOOR
+###############################################################################
+def toDb(level):
+    if level <= 0.0:
+        return LEVEL_FLOOR
+    return max(LEVEL_FLOOR, round(20.0 * math.log10(level), 2))
+
+###############################################################################
+# Function Name:
+#   simulate
+# Description:
+#   feeds a monitor with a test tone in real time, the way the engine feeds
+#   it from the capture device, so the monitor can be tried on a machine
+#   with no audio hardware
+# Parameters:
+#   monitor - the monitor
+#   rate - sample rate
+#   nchannels - number of channels
+#   periodSize - frames per block
+#   freq - tone frequency in Hz
+# Return value:
+#   none (runs until interrupted)
+###############################################################################
+def simulate(monitor, rate, nchannels, periodSize, freq):
+    monitor.ring.configure(nchannels, 2, piRecordFormat.WAVE_FORMAT_PCM, rate)
+    blockTime = periodSize / float(rate)
+    frame = 0
+    nextTime = time.time()
+    while True:
+        t = (frame + numpy.arange(periodSize)) / float(rate)
+        x = 0.25 * numpy.sin(2.0 * numpy.pi * freq * t)
+        x = numpy.repeat(x[:, numpy.newaxis], nchannels, axis=1)
+        monitor.ring.write(piRecordFormat.floatToSamples(x, 2, piRecordFormat.WAVE_FORMAT_PCM))
+        frame += periodSize
+        nextTime += blockTime
+        time.sleep(max(0.0, nextTime - time.time()))
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   runs the monitor with a simulated source, e.g.
+#     python3 piRecordMonitor.py --port 8080
+#     curl -s http://localhost:8080/status.json
+#     curl -s http://localhost:8080/stream.wav | aplay
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="live monitor with a simulated source")
+    parser.add_argument("--address", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--rate", type=int, default=44100, help="sample rate")
+    parser.add_argument("--channels", type=int, default=2, help="number of channels")
+    parser.add_argument("--period", type=int, default=160, help="frames per block")
+    parser.add_argument("--freq", type=float, default=440.0, help="tone frequency")
+    parser.add_argument("--clients", type=int, default=4, help="most streams at once")
+    args = parser.parse_args()
+
+    monitor = Monitor(args.address, args.port, 10.0, args.clients)
+    print ("monitoring on port", monitor.port)
+    try:
+        simulate(monitor, args.rate, args.channels, args.period, args.freq)
+    except KeyboardInterrupt:
+        monitor.close()
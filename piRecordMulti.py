@@ -0,0 +1,462 @@
+###############################################################################
+# piRecordMulti.py - Raspberry Pi audio recorder multi-device capture module
+# Description:
+#   captures from extra devices (e.g. a second USB interface for room mics)
+#   alongside the main capture device, and adds their channels to the take
+#   on the main device's timeline.
+#
+#   Each device's frames are placed in time by an ArrivalClock: a block
+#   can be read late (the main device is polled) but never early, so the
+#   earliest arrival time less the frames so far over the last
+#   CLOCK_WINDOW_SECS gives the time of the device's first frame, free of
+#   the scheduling delays.  The devices' clocks are independent, so each
+#   extra stream goes through a FractionalResampler whose ratio follows the
+#   drift: for every block of the take, the extra device's position at the
+#   time of the block's last frame is compared with the position the
+#   resampler has read to.  The error, averaged over ERROR_SMOOTH_SECS,
+#   steers the ratio through a PI loop with a time constant of
+#   DRIFT_LOOP_SECS, so the drift estimate settles and the error stays
+#   within a sample or so for as long as the take runs.
+#
+#   The extra devices' blocks arrive up to a period apart, so the main
+#   device's blocks are held back by a fixed delay (a few periods) before
+#   they are combined with the extra streams.  A device that overruns, or
+#   drifts further than RESYNC_FRAMES, is aligned again.  Alignment is to
+#   the time the blocks were read; a fixed latency difference between
+#   devices can be corrected with offsets in piRecord.cfg.
+###############################################################################
+
+import collections
+import logging
+import queue
+import threading
+import time
+import numpy
+from piRecordHardware import alsaaudio
+import piRecordDSP
+import piRecordFormat
+import piRecordLog
+
+# seconds of arrival times a device's clock is estimated from
+CLOCK_WINDOW_SECS = 2.0
+
+# seconds the alignment error is averaged over before it steers the ratio
+ERROR_SMOOTH_SECS = 1.0
+
+# time constant of the drift loop in seconds: how quickly an error is
+# corrected and the drift estimate follows a change
+DRIFT_LOOP_SECS = 10.0
+
+# seconds after a device is aligned before its error counts towards the
+# maximum reported
+SETTLE_SECS = 3 * DRIFT_LOOP_SECS
+
+# alignment error (frames) at which a device is aligned again
+RESYNC_FRAMES = 256
+
+# blocks a capture thread may queue before blocks are dropped
+QUEUE_BLOCKS = 64
+
+###############################################################################
+# Class Name:
+#   ArrivalClock
+# Description:
+#   estimates the time of a device's first frame from the times its blocks
+#   arrived, as the lower envelope of (arrival - frames / rate)
+###############################################################################
+class ArrivalClock:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.samples = collections.deque()
+
+    ###########################################################################
+    # Method Name:
+    #   add
+    # Description:
+    #   adds a block's arrival.  Samples that can no longer be the minimum
+    #   are dropped, so the oldest kept is the minimum of the window.
+    # Parameters:
+    #   arrival - time the block was read
+    #   frames - frames read up to the end of the block
+    # Return value:
+    #   none
+    ###########################################################################
+    def add(self, arrival, frames):
+        start = arrival - frames / float(self.rate)
+        while self.samples and self.samples[-1][1] >= start:
+            self.samples.pop()
+        self.samples.append((arrival, start))
+        while arrival - self.samples[0][0] > CLOCK_WINDOW_SECS:
+            self.samples.popleft()
+
+    def reset(self):
+        self.samples.clear()
+
+    def ready(self):
+        return len(self.samples) > 0
+
+    ###########################################################################
+    # Method Name:
+    #   position
+    # Description:
+    #   returns the device's position at a time
+    # Parameters:
+    #   t - the time
+    # Return value:
+    #   the position in frames
+    ###########################################################################
+    def position(self, t):
+        return (t - self.samples[0][1]) * self.rate
+
+    def time(self, position):
+        return self.samples[0][1] + position / float(self.rate)
+
+###############################################################################
+# Class Name:
+#   SecondaryInput
+# Description:
+#   an extra capture device: its capture thread, its resampler and the loop
+#   that keeps it aligned
+###############################################################################
+class SecondaryInput:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   opens the device with the main device's rate, format and period size
+    # Parameters:
+    #   device - the ALSA device name
+    #   nchannels - number of channels to capture
+    #   offset - frames the device's audio is moved earlier in the take
+    #   fmt - the ALSA capture format
+    #   rate - sample rate
+    #   periodSize - frames per period
+    #   floatStorage - whether 24/32 bit samples are stored as float
+    #   taps - resampler kernel length
+    ###########################################################################
+    def __init__(self, device, nchannels, offset, fmt, rate, periodSize, floatStorage, taps):
+        self.device = device
+        self.nchannels = nchannels
+        self.offset = offset
+        self.rate = rate
+        self.convert, self.sampWidth, self.fmtTag = piRecordFormat.getConverter(fmt, floatStorage)
+        self.pcm = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL, device=device)
+        self.pcm.setchannels(nchannels)
+        self.pcm.setrate(rate)
+        self.pcm.setformat(fmt)
+        self.pcm.setperiodsize(periodSize)
+        self.resampler = piRecordDSP.FractionalResampler(nchannels, taps)
+
+        # loop gains for a critically damped loop (the position error is the
+        # integral of the ratio error, in frames)
+        self.kp = 2.0 / (DRIFT_LOOP_SECS * rate)
+        self.ki = 1.0 / (DRIFT_LOOP_SECS * DRIFT_LOOP_SECS * rate)
+        self.integral = 0.0
+        self.thread = None
+        self.running = False
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+        self.clock = ArrivalClock(rate)
+
+    ###########################################################################
+    # Method Name:
+    #   start
+    # Description:
+    #   starts capturing for a take.  The drift estimate is kept from the
+    #   last take, as the clocks don't change.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def start(self):
+        self.resampler = piRecordDSP.FractionalResampler(self.nchannels, len(self.resampler.offsets))
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+        self.delivered = 0
+        self.clock.reset()
+        self.lost = False
+        self.aligned = False
+        self.error = 0.0
+        self.ratio = 1.0 + self.integral
+        self.settleTime = None
+        self.maxError = 0.0
+        self.resyncs = 0
+        self.xruns = 0
+        self.dropped = 0
+        self.underruns = 0
+        self.frames = 0
+        self.cpuSecs = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="capture-" + self.device, daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   the capture thread: reads blocks from the device and queues them with
+    #   the time they arrived.  An overrun is queued as a block of None, as
+    #   the frames lost can't be counted.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self):
+        while self.running:
+            lngth, data = self.pcm.read()
+            now = time.time()
+            if lngth < 0:
+                block = None
+            elif lngth > 0:
+                block = piRecordFormat.samplesToFloat(self.convert(data), self.sampWidth, self.fmtTag, self.nchannels)
+            else:
+                continue
+            try:
+                self.blocks.put_nowait((now, block))
+            except queue.Full:
+                self.dropped += 1
+                self.lost = True
+
+    ###########################################################################
+    # Method Name:
+    #   read
+    # Description:
+    #   returns the device's audio for a block of the take.  Frames lost to
+    #   an overrun or a full queue break the device's clock, which is then
+    #   estimated afresh.
+    # Parameters:
+    #   n - number of frames
+    #   endTime - time of the block's last frame on the main device
+    # Return value:
+    #   block of samples, shape (n, channels)
+    ###########################################################################
+    def read(self, n, endTime):
+        if self.lost:
+            self.lost = False
+            self.clock.reset()
+            self.aligned = False
+        while True:
+            try:
+                arrival, block = self.blocks.get_nowait()
+            except queue.Empty:
+                break
+            if block is None:
+                self.xruns += 1
+                self.clock.reset()
+                self.aligned = False
+                continue
+            self.resampler.write(block)
+            self.delivered += len(block)
+            self.clock.add(arrival, self.delivered)
+        if not self.clock.ready():
+            return numpy.zeros((n, self.nchannels), dtype=numpy.float32)
+
+        # where the resampler must have read to at the end of the block
+        target = self.clock.position(endTime) + self.offset
+        now = time.time()
+        if not self.aligned:
+            self.resampler.seek(target - n * self.ratio)
+            self.error = 0.0
+            self.aligned = True
+            self.settleTime = now + SETTLE_SECS
+            self.resyncs += 1
+            piRecordLog.event("multi_aligned", interval=0, device=self.device, resyncs=self.resyncs,
+                              driftPpm=round(self.integral * 1e6, 2))
+
+        # steer the ratio by the averaged error
+        dt = n / float(self.rate)
+        error = target - (self.resampler.pos + n * self.ratio)
+        self.error += (error - self.error) * min(1.0, dt / ERROR_SMOOTH_SECS)
+        if abs(self.error) > RESYNC_FRAMES:
+            piRecordLog.event("multi_drifted", logging.WARNING, device=self.device, errorFrames=round(self.error, 1))
+            self.aligned = False
+        self.integral += self.ki * self.error * dt
+        self.ratio = 1.0 + self.integral + self.kp * self.error
+        if now >= self.settleTime:
+            self.maxError = max(self.maxError, abs(self.error))
+
+        if self.resampler.available(self.ratio) < n:
+            self.underruns += 1
+        start = time.perf_counter()
+        y = self.resampler.read(n, self.ratio)
+        self.cpuSecs += time.perf_counter() - start
+        self.frames += n
+        return y
+
+    ###########################################################################
+    # Method Name:
+    #   stop
+    # Description:
+    #   stops capturing at the end of a take
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join(1.0)
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.pcm.close()
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns the device's counters.  alignErrorFrames is the averaged
+    #   error now and maxAlignErrorFrames the largest once settled;
+    #   resampleCpuPct is the resampler's time as a share of the audio's.
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters
+    ###########################################################################
+    def getStats(self):
+        audioSecs = self.frames / float(self.rate)
+        return {"device": self.device, "driftPpm": round(self.integral * 1e6, 3),
+                "alignErrorFrames": round(self.error, 3), "maxAlignErrorFrames": round(self.maxError, 3),
+                "resyncs": self.resyncs, "xruns": self.xruns, "droppedBlocks": self.dropped,
+                "underruns": self.underruns, "queueDepth": self.blocks.qsize(),
+                "resampleCpuPct": round(100.0 * self.cpuSecs / audioSecs, 3) if audioSecs else 0.0}
+
+###############################################################################
+# Class Name:
+#   MultiInput
+# Description:
+#   combines the main device's blocks with the extra devices' channels.  The
+#   write methods take and return stored samples, so the engine writes the
+#   result as it would the main device's blocks.
+###############################################################################
+class MultiInput:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   opens the extra devices
+    # Parameters:
+    #   devices - list of (device name, channels, offset) from
+    #             piRecordConf.getMultiDevices
+    #   fmt - the ALSA capture format
+    #   rate - sample rate
+    #   periodSize - frames per period
+    #   floatStorage - whether 24/32 bit samples are stored as float
+    #   primaryChannels - the main device's channels
+    #   taps - resampler kernel length
+    ###########################################################################
+    def __init__(self, devices, fmt, rate, periodSize, floatStorage, primaryChannels, taps):
+        self.inputs = []
+        try:
+            for device, nchannels, offset in devices:
+                self.inputs.append(SecondaryInput(device, nchannels, offset, fmt, rate, periodSize, floatStorage, taps))
+        except alsaaudio.ALSAAudioError:
+            self.close()
+            raise
+        self.rate = rate
+        self.channels = sum(inp.nchannels for inp in self.inputs)
+        self.sampWidth, self.fmtTag = piRecordFormat.getConverter(fmt, floatStorage)[1:]
+        self.primaryFrameSize = primaryChannels * self.sampWidth
+
+        # the main device's blocks are held back long enough for the extra
+        # devices' blocks of the same time to have arrived
+        self.delay = 3 * periodSize + taps + max([0] + [offset for device, nchannels, offset in devices])
+        self.pending = bytearray()
+        self.clock = ArrivalClock(rate)
+
+    def start(self):
+        self.pending = bytearray()
+        self.frames = 0
+        self.clock.reset()
+        for inp in self.inputs:
+            inp.start()
+
+    ###########################################################################
+    # Method Name:
+    #   combine
+    # Description:
+    #   adds a block from the main device and returns the frames now ready
+    #   for the take, with the extra devices' channels after the main
+    #   device's
+    # Parameters:
+    #   data - block of stored samples from the main device
+    #   now - time it was read
+    # Return value:
+    #   block of stored samples for the take (empty while the delay fills)
+    ###########################################################################
+    def combine(self, data, now):
+        self.pending += data
+        self.frames += len(data) // self.primaryFrameSize
+        self.clock.add(now, self.frames)
+        n = len(self.pending) // self.primaryFrameSize - self.delay
+        if n <= 0:
+            return b''
+        return self.merge(n)
+
+    ###########################################################################
+    # Method Name:
+    #   skip
+    # Description:
+    #   called when the main device overruns.  The frames lost can't be
+    #   counted, so its clock is estimated afresh.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def skip(self):
+        self.clock.reset()
+
+    ###########################################################################
+    # Method Name:
+    #   merge
+    # Description:
+    #   takes frames off the delay and adds the extra devices' channels
+    # Parameters:
+    #   n - number of frames
+    # Return value:
+    #   block of stored samples
+    ###########################################################################
+    def merge(self, n):
+        size = n * self.primaryFrameSize
+        parts = [numpy.frombuffer(bytes(self.pending[:size]), dtype=numpy.uint8).reshape(n, -1)]
+        del self.pending[:size]
+        endTime = self.clock.time(self.frames - len(self.pending) // self.primaryFrameSize)
+        for inp in self.inputs:
+            samples = piRecordFormat.floatToSamples(inp.read(n, endTime), self.sampWidth, self.fmtTag)
+            parts.append(numpy.frombuffer(samples, dtype=numpy.uint8).reshape(n, -1))
+        return numpy.hstack(parts).tobytes()
+
+    ###########################################################################
+    # Method Name:
+    #   flush
+    # Description:
+    #   returns the frames still held back at the end of a take, once the
+    #   extra devices have captured the audio that goes with them
+    # Parameters:
+    #   none
+    # Return value:
+    #   block of stored samples
+    ###########################################################################
+    def flush(self):
+        n = len(self.pending) // self.primaryFrameSize
+        if n == 0:
+            return b''
+        time.sleep(self.delay / float(self.rate))
+        return self.merge(n)
+
+    def stop(self):
+        for inp in self.inputs:
+            inp.stop()
+
+    def close(self):
+        for inp in self.inputs:
+            inp.close()
+
+    def getStats(self):
+        return {"delayFrames": self.delay, "devices": [inp.getStats() for inp in self.inputs]}
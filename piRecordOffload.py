@@ -0,0 +1,448 @@
+###############################################################################
+# piRecordOffload.py - Raspberry Pi audio recorder offload module
+# Description:
+#   copies finished takes from the recordings directory to another drive
+#   (e.g. a USB drive, or any mounted file system), so the card can be
+#   emptied between sets.  Each file is:
+#     - read and written in large blocks, hashed (SHA-256) as it is read,
+#       and written to a .part file, which is synced to the drive
+#     - read back from the drive (after dropping it from the cache, so the
+#       drive's copy is what is checked) and compared with the hash
+#     - renamed to its final name once it is verified, and optionally
+#       deleted from the recordings directory
+#   A take's checksum sidecar (see piRecordCheck) is copied with it.
+#   The take being recorded is never copied, nor is any file changed in the
+#   last few seconds (a take being finished).  Copied files are recorded in
+#   a state file on the drive, so only new takes are copied on the next run.
+#
+#   The offloader runs at idle CPU and I/O priority, with its bandwidth
+#   capped at rateMB per second.  While the engine is recording the cap is
+#   lowered to recordingRateMB (0 pauses the offload) and smaller blocks are
+#   used, so the copy never competes with the take for the card.  Source
+#   blocks are dropped from the cache once copied.
+#
+#   piRecord.sh offload copies the takes once; with --watch (started by
+#   piRecord when offload is enabled) it keeps checking for new ones.
+###############################################################################
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import piRecordCheck
+import piRecordConf
+import piRecordIO
+import piRecordUtils
+
+# state file (on the destination drive) recording the files copied
+STATE_FILE = ".offloadstate"
+
+# suffix of a file being copied
+PART_SUFFIX = ".part"
+
+# extensions of the takes copied
+TAKE_EXTS = (".wav", ".flac")
+
+# seconds a file must be unchanged before it is copied
+SETTLE_SECS = 10.0
+
+# seconds to wait between checks while paused for a recording
+RECORDING_WAIT = 2.0
+
+# largest block copied at a time while a recording is in progress
+RECORDING_BLOCK = 256 * 1024
+
+# space left free on the destination drive
+FREE_MARGIN = 16 * 1024 * 1024
+
+# the offloader process started by piRecord
+offloadProc = None
+
+###############################################################################
+# Class Name:
+#   Throttle
+# Description:
+#   caps the offload's bandwidth, lowering the cap (or pausing) while the
+#   engine is recording
+###############################################################################
+class Throttle:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   sets the caps
+    # Parameters:
+    #   rate - bytes per second when not recording (0 = no cap)
+    #   recordingRate - bytes per second while recording (0 = pause)
+    #   blockBytes - bytes copied at a time when not recording
+    ###########################################################################
+    def __init__(self, rate, recordingRate, blockBytes):
+        self.rate = rate
+        self.recordingRate = recordingRate
+        self.blockBytes = blockBytes
+        self.next = time.monotonic()
+        self.currentRate = rate
+        self.pausedSecs = 0.0
+        self.throttledSecs = 0.0
+
+    ###########################################################################
+    # Method Name:
+    #   wait
+    # Description:
+    #   waits until the next block may be transferred: while paused for a
+    #   recording, then for as long as the cap requires after the blocks
+    #   before it (see spent).  The size of the block depends on whether a
+    #   recording is in progress, so the block is asked for rather than
+    #   given.
+    # Parameters:
+    #   none
+    # Return value:
+    #   bytes that may be transferred
+    ###########################################################################
+    def wait(self):
+        recording = piRecordUtils.isRecording()
+        if recording and self.recordingRate == 0:
+            start = time.monotonic()
+            while piRecordUtils.isRecording():
+                time.sleep(RECORDING_WAIT)
+            self.pausedSecs += time.monotonic() - start
+            self.next = time.monotonic()
+            recording = False
+        self.currentRate = self.recordingRate if recording else self.rate
+        delay = self.next - time.monotonic()
+        if self.currentRate and delay > 0:
+            time.sleep(delay)
+            self.throttledSecs += delay
+        return min(self.blockBytes, RECORDING_BLOCK) if recording else self.blockBytes
+
+    ###########################################################################
+    # Method Name:
+    #   spent
+    # Description:
+    #   counts the bytes transferred against the cap, setting when the next
+    #   block may be
+    # Parameters:
+    #   nbytes - bytes transferred
+    # Return value:
+    #   none
+    ###########################################################################
+    def spent(self, nbytes):
+        if self.currentRate:
+            self.next = max(self.next, time.monotonic()) + nbytes / float(self.currentRate)
+
+###############################################################################
+# Function Name:
+#   setIdlePriority
+# Description:
+#   lowers the CPU and I/O priority of the offloader so that it never
+#   competes with a recording
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def setIdlePriority():
+    os.nice(19)
+    if shutil.which("ionice") != None:
+        subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())])
+    return 0
+
+###############################################################################
+# Function Name:
+#   transfer
+# Description:
+#   reads a file block by block, hashing each block and passing it to a
+#   writer, with source blocks dropped from the cache once read
+# Parameters:
+#   fin - the unbuffered file to read
+#   throttle - the Throttle
+#   write - function taking each block (None to only hash the file)
+# Return value:
+#   (bytes read, SHA-256 hex digest)
+###############################################################################
+def transfer(fin, throttle, write):
+    digest = hashlib.sha256()
+    buffer = bytearray(throttle.blockBytes)
+    view = memoryview(buffer)
+    fd = fin.fileno()
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    pos = 0
+    while True:
+        n = fin.readinto(view[:throttle.wait()])
+        if not n:
+            break
+        throttle.spent(n)
+        digest.update(view[:n])
+        if write != None:
+            write(view[:n])
+        os.posix_fadvise(fd, pos, n, os.POSIX_FADV_DONTNEED)
+        pos += n
+    return pos, digest.hexdigest()
+
+###############################################################################
+# Function Name:
+#   copyFile
+# Description:
+#   copies a file to a .part file on the destination, syncs it, verifies
+#   it and renames it into place
+# Parameters:
+#   src - the file to copy
+#   dest - the destination file name
+#   throttle - the Throttle
+#   verify - True to read the copy back and compare it with the source
+# Return value:
+#   SHA-256 hex digest of the file, or None if the file changed while it
+#   was copied or the copy doesn't match
+###############################################################################
+def copyFile(src, dest, throttle, verify):
+    before = os.stat(src)
+    part = dest + PART_SUFFIX
+    try:
+        with open(src, "rb", buffering=0) as fin, open(part, "wb", buffering=0) as fout:
+            def write(block):
+                while len(block):
+                    block = block[fout.write(block):]
+            size, srcDigest = transfer(fin, throttle, write)
+            os.fsync(fout.fileno())
+            os.posix_fadvise(fout.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        after = os.stat(src)
+        if size != after.st_size or (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime):
+            print ("offload:", os.path.basename(src), "changed while it was copied")
+            os.remove(part)
+            return None
+        if verify:
+            with open(part, "rb", buffering=0) as fin:
+                destSize, destDigest = transfer(fin, throttle, None)
+            if (destSize, destDigest) != (size, srcDigest):
+                print ("offload:", os.path.basename(src), "copy does not match, discarded")
+                os.remove(part)
+                return None
+        os.utime(part, (after.st_atime, after.st_mtime))
+        os.replace(part, dest)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    piRecordIO.syncDir(os.path.dirname(dest))
+    return srcDigest
+
+###############################################################################
+# Function Name:
+#   loadState
+# Description:
+#   reads the state file of the files already copied
+# Parameters:
+#   destDir - the destination directory
+# Return value:
+#   dict of entries by file name (empty if there is no state file)
+###############################################################################
+def loadState(destDir):
+    try:
+        with open(os.path.join(destDir, STATE_FILE)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+###############################################################################
+# Function Name:
+#   saveState
+# Description:
+#   replaces the state file atomically
+# Parameters:
+#   destDir - the destination directory
+#   state - dict of entries by file name
+# Return value:
+#   0
+###############################################################################
+def saveState(destDir, state):
+    fn = os.path.join(destDir, STATE_FILE)
+    with open(fn + ".tmp", "w") as fd:
+        json.dump(state, fd, indent=1)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(fn + ".tmp", fn)
+    return 0
+
+###############################################################################
+# Function Name:
+#   getFinishedTakes
+# Description:
+#   lists the takes that may be copied: not the one being recorded (in any
+#   of its formats), none whose silence trim is pending or running and none
+#   changed in the last SETTLE_SECS
+# Parameters:
+#   srcDir - the recordings directory
+# Return value:
+#   sorted list of file names
+###############################################################################
+def getFinishedTakes(srcDir):
+    current = None
+    if piRecordUtils.isRecording():
+        try:
+            current = os.path.splitext(os.path.abspath(piRecordUtils.getCurrentFilename()))[0]
+        except OSError:
+            return []
+    now = time.time()
+    files = []
+    for name in sorted(os.listdir(srcDir)):
+        fn = os.path.join(srcDir, name)
+        if not name.endswith(TAKE_EXTS) or not os.path.isfile(fn):
+            continue
+        if current != None and os.path.splitext(os.path.abspath(fn))[0] == current:
+            continue
+        if piRecordUtils.isTrimPending(fn):
+            continue
+        if now - os.stat(fn).st_mtime < SETTLE_SECS:
+            continue
+        files.append(fn)
+    return files
+
+###############################################################################
+# Function Name:
+#   runOffload
+# Description:
+#   copies every finished take not already copied
+# Parameters:
+#   srcDir - the recordings directory
+#   destDir - the destination directory (which must exist, so nothing is
+#             written to the card when the drive isn't mounted)
+#   throttle - the Throttle
+#   verify - True to verify each copy
+#   deleteAfter - True to delete each take once its copy is verified
+# Return value:
+#   number of files that failed
+###############################################################################
+def runOffload(srcDir, destDir, throttle, verify, deleteAfter):
+    if not os.path.isdir(destDir):
+        print ("offload:", destDir, "is not mounted")
+        return 0
+    state = loadState(destDir)
+    failures = 0
+    for fn in getFinishedTakes(srcDir):
+        name = os.path.basename(fn)
+        dest = os.path.join(destDir, name)
+        st = os.stat(fn)
+        entry = state.get(name)
+        if entry != None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime and os.path.exists(dest):
+            if deleteAfter and entry.get("verified"):
+                removeTake(fn)
+                print ("offload: deleted", name, "(already copied)")
+            continue
+        if shutil.disk_usage(destDir).free < st.st_size + FREE_MARGIN:
+            print ("offload:", destDir, "is full")
+            failures += 1
+            break
+        start = time.monotonic()
+        try:
+            digest = copyFile(fn, dest, throttle, verify)
+            sidecar = piRecordCheck.getSidecarName(fn)
+            if digest != None and os.path.exists(sidecar):
+                if copyFile(sidecar, piRecordCheck.getSidecarName(dest), throttle, verify) == None:
+                    digest = None
+        except OSError as err:
+            print ("offload error:", name, err)
+            failures += 1
+            continue
+        if digest == None:
+            failures += 1
+            continue
+        state[name] = {"size": st.st_size, "mtime": st.st_mtime, "sha256": digest, "verified": verify}
+        saveState(destDir, state)
+        elapsed = time.monotonic() - start
+        print ("offloaded %s (%.1f MB in %.1f s, %.1f MB/s%s)" % (name, st.st_size / 1048576.0, elapsed,
+               st.st_size / 1048576.0 / max(elapsed, 0.001), ", verified" if verify else ""))
+        if deleteAfter and verify:
+            removeTake(fn)
+            print ("offload: deleted", name)
+    return failures
+
+###############################################################################
+# Function Name:
+#   removeTake
+# Description:
+#   deletes a take copied, with its checksum sidecar
+# Parameters:
+#   fn - the take
+# Return value:
+#   0
+###############################################################################
+def removeTake(fn):
+    os.remove(fn)
+    sidecar = piRecordCheck.getSidecarName(fn)
+    if os.path.exists(sidecar):
+        os.remove(sidecar)
+    return 0
+
+###############################################################################
+# Function Name:
+#   start
+# Description:
+#   starts the offloader in its own process, watching for new takes
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def start():
+    global offloadProc
+    if offloadProc == None:
+        offloadProc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--watch"])
+    return 0
+
+###############################################################################
+# Function Name:
+#   stop
+# Description:
+#   stops the offloader process; a file being copied is discarded, and
+#   copied again on the next run
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def stop():
+    global offloadProc
+    if offloadProc != None:
+        offloadProc.terminate()
+        try:
+            offloadProc.wait(timeout=10.0)
+        except subprocess.TimeoutExpired:
+            offloadProc.kill()
+        offloadProc = None
+    return 0
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   runs the offload from the command line (see piRecord.sh offload)
+###############################################################################
+if __name__ == "__main__":
+    piRecordConf.getRecDevConfig()
+
+    parser = argparse.ArgumentParser(description="copy the finished takes in " + piRecordConf.outputDir)
+    parser.add_argument("--dest", default=piRecordConf.offloadDir, help="destination directory")
+    parser.add_argument("--watch", action="store_true", help="keep copying new takes as they are finished")
+    parser.add_argument("--delete", action="store_true", default=piRecordConf.offloadDeleteAfter,
+                        help="delete each take once its copy is verified")
+    args = parser.parse_args()
+
+    # a terminated offloader removes the file it was copying
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    setIdlePriority()
+    throttle = Throttle(int(piRecordConf.offloadRateMB * 1048576), int(piRecordConf.offloadRecordingRateMB * 1048576),
+                        piRecordConf.offloadBlockMB * 1048576)
+    if args.delete and not piRecordConf.offloadVerify:
+        print ("offload: takes are only deleted once their copies are verified")
+    if not args.watch:
+        exit(1 if runOffload(piRecordConf.outputDir, args.dest, throttle, piRecordConf.offloadVerify, args.delete) else 0)
+    while True:
+        runOffload(piRecordConf.outputDir, args.dest, throttle, piRecordConf.offloadVerify, args.delete)
+        time.sleep(piRecordConf.offloadPollSecs)
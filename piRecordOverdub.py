@@ -0,0 +1,529 @@
+###############################################################################
+# piRecordOverdub.py - Raspberry Pi audio recorder overdub module
+# Description:
+#   plays a backing take while a new take is recorded, for recording along
+#   with it.  Both run from the engine's recording loop: each time it reads
+#   a period from the capture device, the same number of frames of the
+#   backing take is written to the playback device, which is opened non-
+#   blocking and kept primePeriods ahead.  The two devices therefore run off
+#   one clock (the capture device's), and the loop never waits on playback.
+#
+#   What the performer hears of backing frame n reaches the capture device
+#   a round trip later, so the first frames of the new take are dropped to
+#   line it up with the backing.  The round trip is measured with a click
+#   test over a loopback cable (output to input): the clicks are played and
+#   captured exactly as an overdub would be, so the priming and the
+#   converters all count.  Playback is started just after a capture period
+#   ends (see syncStart), and how long after is timed and allowed for, so
+#   the latency is from that point on and the start doesn't have to be
+#   equally quick each time.  The measurement is kept per device and
+#   setting in LATENCY_FILE.
+###############################################################################
+
+import argparse
+import json
+import time
+import numpy
+from piRecordHardware import alsaaudio
+import piRecordConf
+import piRecordFormat
+import piRecordPlayback
+
+# the click test: CLICK_COUNT clicks of CLICK_SECS, CLICK_SPACING seconds
+# apart, the first after CLICK_LEAD seconds of silence
+CLICK_COUNT = 4
+CLICK_SECS = 0.001
+CLICK_SPACING = 0.5
+CLICK_LEAD = 0.5
+CLICK_LEVEL = 0.5
+
+# level (dBFS) the captured clicks must reach to be heard
+CLICK_THRESHOLD_DB = -30.0
+
+# most seconds the captured clicks may disagree on the latency
+LATENCY_TOLERANCE = 0.0005
+
+# most seconds to wait for the capture device to deliver a period
+SYNC_TIMEOUT = 1.0
+
+# cache of measured latencies, by device and setting
+LATENCY_FILE = "./.latency"
+
+###############################################################################
+# Function Name:
+#   encodeSamples
+# Description:
+#   converts samples to an ALSA capture format
+# Parameters:
+#   x - the samples as floats in [-1.0, 1.0), shape (frames, channels)
+#   fmt - the ALSA format constant
+# Return value:
+#   the samples in the given format
+###############################################################################
+def encodeSamples(x, fmt):
+    width, bits, signed, bigEndian, isFloat = piRecordFormat.getCaptureFormat(fmt)
+    order = '>' if bigEndian else '<'
+    if isFloat:
+        return x.astype(order + 'f%d' % width).tobytes()
+    bits = min(bits, 32)
+    value = numpy.clip(numpy.round(x * (1 << (bits - 1))), -(1 << (bits - 1)), (1 << (bits - 1)) - 1).astype(numpy.int64)
+    if not signed:
+        value += 1 << (bits - 1)
+    if width == 3:
+        packed = value.astype(order + ('i4' if signed else 'u4')).view(numpy.uint8).reshape(-1, 4)
+        return (packed[:, 1:] if bigEndian else packed[:, :3]).tobytes()
+    return value.astype(order + ('i' if signed else 'u') + str(width)).tobytes()
+
+###############################################################################
+# Class Name:
+#   ClickSource
+# Description:
+#   the click test's audio, in the capture format
+###############################################################################
+class ClickSource:
+
+    def __init__(self, fmt, nchannels, rate):
+        self.format = fmt
+        self.nchannels = nchannels
+        self.rate = rate
+        self.frameSize = piRecordFormat.getCaptureFormat(fmt)[0] * nchannels
+        self.clicks = numpy.array([int((CLICK_LEAD + k * CLICK_SPACING) * rate) for k in range(CLICK_COUNT)])
+        self.nframes = int(self.clicks[-1] + CLICK_SPACING * rate)
+        x = numpy.zeros((self.nframes, nchannels))
+        for click in self.clicks:
+            x[click:click + max(1, int(CLICK_SECS * rate))] = CLICK_LEVEL
+        self.data = encodeSamples(x, fmt)
+        self.silence = encodeSamples(numpy.zeros((1, nchannels)), fmt)
+
+    def read(self, pos, n):
+        data = self.data[pos * self.frameSize:(pos + n) * self.frameSize]
+        return data + self.silence * (n - len(data) // self.frameSize)
+
+    def close(self):
+        pass
+
+###############################################################################
+# Class Name:
+#   TakeSource
+# Description:
+#   a take's parts (see piRecordUtils.getTakes) played as one, memory mapped.
+#   Parts in another format than the first are left out.
+###############################################################################
+class TakeSource:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   maps the take's parts
+    # Parameters:
+    #   files - the take's part files, in order
+    ###########################################################################
+    def __init__(self, files):
+        self.waves = []
+        for fn in files:
+            try:
+                wave = piRecordPlayback.MappedWave(fn)
+            except (OSError, ValueError):
+                self.close()
+                raise
+            if self.waves and wave.getFormat() != self.waves[0].getFormat():
+                wave.close()
+                break
+            self.waves.append(wave)
+        first = self.waves[0]
+        self.format = piRecordFormat.getPlaybackFormat(first.sampwidth, first.formatTag)
+        if self.format == None:
+            self.close()
+            raise ValueError("unsupported format: %s" % files[0])
+        self.nchannels = first.nchannels
+        self.rate = first.rate
+        self.frameSize = first.frameSize
+        self.nframes = sum(wave.nframes for wave in self.waves)
+        self.silence = (b'\x80' if first.sampwidth == 1 else b'\x00') * self.frameSize
+        first.prefetch(0, self.rate * 10)
+
+    ###########################################################################
+    # Method Name:
+    #   read
+    # Description:
+    #   returns frames from the take, across its parts, with silence past the
+    #   end.  The audio after them is prefetched.
+    # Parameters:
+    #   pos - first frame
+    #   n - number of frames
+    # Return value:
+    #   the samples
+    ###########################################################################
+    def read(self, pos, n):
+        data = b''
+        for wave in self.waves:
+            if pos < wave.nframes and n > 0:
+                count = min(n, wave.nframes - pos)
+                data += bytes(wave.read(pos, count))
+                start, end = wave.prefetched
+                if pos + count + self.rate > end and end < wave.nframes:
+                    wave.prefetch(pos + count, self.rate * 10)
+                n -= count
+                pos = 0
+            else:
+                pos -= wave.nframes
+        return data + self.silence * n
+
+    def close(self):
+        for wave in self.waves:
+            wave.close()
+        self.waves = []
+
+###############################################################################
+# Class Name:
+#   DuplexOutput
+# Description:
+#   plays a source on a non-blocking playback device, paced by the capture
+#   device: feed() is called with the frames just captured and writes as
+#   many.  Frames the device has no room for are kept for the next feed.
+###############################################################################
+class DuplexOutput:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   opens the playback device in the source's format, and reads the
+    #   frames it is primed with, so starting it takes no more than a write
+    # Parameters:
+    #   device - the ALSA device
+    #   source - the audio to play (ClickSource or TakeSource)
+    #   periodFrames - the capture device's period
+    #   primePeriods - periods written ahead before playback starts
+    ###########################################################################
+    def __init__(self, device, source, periodFrames, primePeriods):
+        self.source = source
+        self.periodFrames = periodFrames
+        self.primePeriods = primePeriods
+        self.pos = primePeriods * periodFrames
+        self.pending = source.read(0, self.pos)
+        self.underruns = 0
+        self.writeMax = 0.0
+        self.startTime = None
+        self.pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NONBLOCK, device=device)
+        self.pcm.setchannels(source.nchannels)
+        self.pcm.setrate(source.rate)
+        self.pcm.setformat(source.format)
+        self.pcm.setperiodsize(periodFrames)
+
+    def start(self):
+        self.startTime = time.time()
+        self.feed(0)
+
+    ###########################################################################
+    # Method Name:
+    #   feed
+    # Description:
+    #   writes the next frames of the source to the device.  After an
+    #   underrun the device restarts with the next write.
+    # Parameters:
+    #   nframes - number of frames
+    # Return value:
+    #   none
+    ###########################################################################
+    def feed(self, nframes):
+        self.pending += self.source.read(self.pos, nframes)
+        self.pos += nframes
+        start = time.perf_counter()
+        written = self.pcm.write(self.pending)
+        if written < 0:
+            self.underruns += 1
+            written = self.pcm.write(self.pending)
+        self.writeMax = max(self.writeMax, time.perf_counter() - start)
+        if written > 0:
+            self.pending = self.pending[written * self.source.frameSize:]
+
+    def getStats(self):
+        return {"playedSecs": round(self.pos / float(self.source.rate), 3), "underruns": self.underruns,
+                "pendingFrames": len(self.pending) // self.source.frameSize, "writeMaxMs": round(1000.0 * self.writeMax, 3)}
+
+    def close(self):
+        self.pcm.close()
+        self.source.close()
+
+###############################################################################
+# Function Name:
+#   syncStart
+# Description:
+#   empties the capture device, then polls it for the next period, so
+#   playback can be started just after it.  The period is dropped; the
+#   first frame read after it was captured as the period was delivered.
+# Parameters:
+#   inp - the capture device (non-blocking)
+# Return value:
+#   the time the period was delivered (of the poll before), or None if it
+#   wasn't in time
+###############################################################################
+def syncStart(inp):
+    while inp.read()[0] != 0:
+        pass
+    last = time.time()
+    endTime = last + SYNC_TIMEOUT
+    while last < endTime:
+        if inp.read()[0] > 0:
+            return last
+        last = time.time()
+    return None
+
+###############################################################################
+# Function Name:
+#   findLatency
+# Description:
+#   works out the latency from the captured click test: the frames from
+#   each click being played to it being captured, which must agree to
+#   within LATENCY_TOLERANCE
+# Parameters:
+#   level - the captured peak level of each frame (all channels)
+#   clicks - the frames the clicks were played at
+#   rate - the sample rate
+# Return value:
+#   the latency in frames, or None if the clicks weren't heard
+###############################################################################
+def findLatency(level, clicks, rate):
+    above = numpy.nonzero(level >= 10.0 ** (CLICK_THRESHOLD_DB / 20.0))[0]
+    if len(above) == 0:
+        return None
+    onsets = above[numpy.concatenate(([True], numpy.diff(above) > int(CLICK_SPACING * rate) // 2))]
+    if len(onsets) != len(clicks):
+        return None
+    offsets = onsets - clicks
+    if offsets.min() < 0 or offsets.max() - offsets.min() > LATENCY_TOLERANCE * rate:
+        return None
+    return int(numpy.median(offsets))
+
+###############################################################################
+# Function Name:
+#   measureLatency
+# Description:
+#   runs the click test: plays the clicks and captures them as an overdub
+#   would, a period at a time.  The time playback took to start after the
+#   sync (see syncStart) isn't counted.
+# Parameters:
+#   inp - the capture device (non-blocking, set up for recording)
+#   device - the playback device
+#   fmt - the capture format
+#   nchannels - the capture channels
+#   rate - the sample rate
+#   periodFrames - the capture period
+#   primePeriods - periods written ahead before playback starts
+#   beat - called every loop while waiting (e.g. to beat a heartbeat)
+# Return value:
+#   the latency in frames, or None if the clicks weren't heard
+###############################################################################
+def measureLatency(inp, device, fmt, nchannels, rate, periodFrames, primePeriods, beat=None):
+    convert, sampWidth, fmtTag = piRecordFormat.getConverter(fmt)
+    source = ClickSource(fmt, nchannels, rate)
+    output = DuplexOutput(device, source, periodFrames, primePeriods)
+    captured = []
+    try:
+        synced = syncStart(inp)
+        if synced == None:
+            return None
+        output.start()
+        frames = 0
+        endTime = time.time() + 2.0 * source.nframes / rate + SYNC_TIMEOUT
+        while frames < source.nframes and time.time() < endTime:
+            lngth, data = inp.read()
+            if lngth < 0:
+                return None
+            if lngth > 0:
+                output.feed(lngth)
+                captured.append(convert(data))
+                frames += lngth
+            else:
+                time.sleep(periodFrames / (4.0 * rate))
+            if beat != None:
+                beat()
+    finally:
+        output.close()
+    if frames < source.nframes:
+        return None
+    x = piRecordFormat.samplesToFloat(b''.join(captured), sampWidth, fmtTag, nchannels)
+    latency = findLatency(numpy.abs(x).max(axis=1), source.clicks, rate)
+    if latency == None:
+        return None
+    return max(0, int(round(latency - (output.startTime - synced) * rate)))
+
+###############################################################################
+# Function Name:
+#   getLatencyKey
+# Description:
+#   returns the key a latency is cached under
+# Parameters:
+#   device - the ALSA device
+#   rate - the sample rate
+#   periodFrames - the capture period
+#   primePeriods - periods written ahead before playback starts
+# Return value:
+#   the key
+###############################################################################
+def getLatencyKey(device, rate, periodFrames, primePeriods):
+    return "%s/%d/%d/%d" % (device, rate, periodFrames, primePeriods)
+
+###############################################################################
+# Function Name:
+#   loadLatency
+# Description:
+#   reads a cached latency
+# Parameters:
+#   key - the key (see getLatencyKey)
+# Return value:
+#   the latency in frames, or None if it hasn't been measured
+###############################################################################
+def loadLatency(key):
+    try:
+        with open(LATENCY_FILE) as fd:
+            return json.load(fd).get(key)
+    except (OSError, ValueError):
+        return None
+
+###############################################################################
+# Function Name:
+#   storeLatency
+# Description:
+#   caches a latency
+# Parameters:
+#   key - the key (see getLatencyKey)
+#   frames - the latency in frames
+# Return value:
+#   none
+###############################################################################
+def storeLatency(key, frames):
+    try:
+        with open(LATENCY_FILE) as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = frames
+    with open(LATENCY_FILE, "w") as fd:
+        json.dump(cache, fd)
+
+###############################################################################
+# Class Name:
+#   Overdub
+# Description:
+#   a backing take played while a take is recorded, and the new take's
+#   alignment with it
+###############################################################################
+class Overdub:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   maps the backing take and opens the playback device
+    # Parameters:
+    #   files - the backing take's part files
+    #   device - the playback device
+    #   rate - the capture rate, which the backing take must be at
+    #   periodFrames - the capture period
+    #   primePeriods - periods written ahead before playback starts
+    #   latency - the round trip in frames (see measureLatency)
+    ###########################################################################
+    def __init__(self, files, device, rate, periodFrames, primePeriods, latency):
+        source = TakeSource(files)
+        if source.rate != rate:
+            source.close()
+            raise ValueError("backing take is at %d, not %d: %s" % (source.rate, rate, files[0]))
+        self.files = files
+        self.rate = rate
+        self.latency = latency
+        self.offset = latency
+        self.drop = latency
+        self.output = DuplexOutput(device, source, periodFrames, primePeriods)
+
+    ###########################################################################
+    # Method Name:
+    #   start
+    # Description:
+    #   starts playback in step with the capture device (see syncStart).
+    #   The frames dropped are the latency and the time playback took to
+    #   start after the sync.
+    # Parameters:
+    #   inp - the capture device
+    # Return value:
+    #   none
+    ###########################################################################
+    def start(self, inp):
+        synced = syncStart(inp)
+        if synced == None:
+            raise alsaaudio.ALSAAudioError("no audio from the capture device")
+        self.output.start()
+        self.offset = self.latency + int(round((self.output.startTime - synced) * self.rate))
+        self.drop = self.offset
+
+    def feed(self, nframes):
+        self.output.feed(nframes)
+
+    ###########################################################################
+    # Method Name:
+    #   align
+    # Description:
+    #   drops the frames captured before the backing take was heard
+    # Parameters:
+    #   data - a block of the new take
+    #   frameSize - its frame size
+    # Return value:
+    #   the block, less the frames dropped
+    ###########################################################################
+    def align(self, data, frameSize):
+        if self.drop <= 0:
+            return data
+        n = min(self.drop, len(data) // frameSize)
+        self.drop -= n
+        return data[n * frameSize:]
+
+    ###########################################################################
+    # Method Name:
+    #   getPosition
+    # Description:
+    #   returns where the backing take is
+    # Parameters:
+    #   none
+    # Return value:
+    #   (0, seconds into the take, the take's length in seconds)
+    ###########################################################################
+    def getPosition(self):
+        source = self.output.source
+        return 0, min(self.output.pos, source.nframes) / float(source.rate), source.nframes / float(source.rate)
+
+    def getStats(self):
+        return dict(self.output.getStats(), backing=self.files[0], latencyFrames=self.latency, offsetFrames=self.offset)
+
+    def close(self):
+        self.output.close()
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   measures and caches the latency (see piRecord.sh latency).  A cable must
+#   connect the output to the input.
+###############################################################################
+if __name__ == "__main__":
+    piRecordConf.getRecDevConfig()
+
+    parser = argparse.ArgumentParser(description="measure the round trip latency with a loopback cable")
+    parser.parse_args()
+
+    device = piRecordConf.getRecDevice()
+    inp = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device=device)
+    inp.setchannels(piRecordConf.recChannels)
+    inp.setrate(piRecordConf.recRate)
+    inp.setformat(piRecordConf.recFormat)
+    inp.setperiodsize(piRecordConf.recPeriodSize)
+    latency = measureLatency(inp, device, piRecordConf.recFormat, piRecordConf.recChannels, piRecordConf.recRate,
+                             piRecordConf.recPeriodSize, piRecordConf.overdubPrimePeriods)
+    inp.close()
+    if latency == None:
+        print ("no click heard - is the output connected to the input?")
+        exit(1)
+    storeLatency(getLatencyKey(device, piRecordConf.recRate, piRecordConf.recPeriodSize,
+                               piRecordConf.overdubPrimePeriods), latency)
+    print ("latency: %d frames (%.2f ms)" % (latency, 1000.0 * latency / piRecordConf.recRate))
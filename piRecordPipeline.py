@@ -0,0 +1,604 @@
+###############################################################################
+# piRecordPipeline.py - Raspberry Pi audio recorder stage pipeline module
+# Description:
+#   runs processing stages (metering, analysis and the like) on the blocks
+#   the engine writes, each in its own thread or worker process, optionally
+#   on its own core.  The engine publishes each block once, into a ring in
+#   shared memory; the stages read their slices of the ring where they are,
+#   so no audio is copied between processes.  The shared memory also holds
+#   a header with the ring's format and write position, and a slot for each
+#   stage with its read position and counters.  Each counter is written by
+#   one side only, so there are no locks; the writer wakes the stages with a
+#   semaphore each.
+#
+#   Each stage has a backpressure policy for when it falls behind:
+#     block - the engine waits for the stage, so the stage sees every
+#             frame; but only for BLOCK_FRACTION of the block's duration (the
+#             capture buffer's headroom), after which the stage is treated
+#             as drop until it catches up, so a slow stage can't cause xruns
+#     drop - the engine never waits; a stage that falls a whole ring behind
+#            loses the oldest audio
+#     decimate - a stage that is behind skips to the newest chunkFrames, for
+#                stages that only need recent audio (displays, tuners)
+#   Per stage telemetry: CPU use (as a share of one core in real time), lag,
+#   most lag, the audio dropped, skipped and overwritten while read, and for
+#   blocking stages the time the engine waited, its longest wait as a share
+#   of the headroom (near 100 is a risk of xruns) and the times it gave up.
+#
+#   A stage is a class taking (rate, nchannels, sampWidth, fmtTag) with
+#   process(data), which gets memoryviews of whole frames of stored samples,
+#   and finish(), which returns a result dict (or None) logged when the take
+#   stops.  Stages are named in piRecord.cfg, by their name in STAGE_TYPES
+#   or as module.Class.
+###############################################################################
+
+import importlib
+import math
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import queue
+import threading
+import time
+import numpy
+import piRecordFormat
+
+# header fields (int64)
+H_GEN = 0        # take generation, changed last when a take begins (-1 while
+                 # the header is set up for it)
+H_STOP = 1       # generation of the take that has ended
+H_WRITTEN = 2    # bytes published this take
+H_SIZE = 3       # ring size in use this take (whole frames)
+H_NCHANNELS = 4
+H_WIDTH = 5
+H_TAG = 6
+H_RATE = 7
+H_QUIT = 8
+HEADER_FIELDS = 16
+
+# stage slot fields (int64), written by the stage
+S_POS = 0        # bytes read this take
+S_PROCESSED = 1  # bytes processed this take
+S_DROPPED = 2    # bytes lost by falling a ring behind
+S_DECIMATED = 3  # bytes skipped by the decimate policy
+S_TORN = 4       # bytes overwritten while they were read
+S_CPU_NS = 5     # CPU time this take
+S_MAX_LAG = 6    # most bytes behind this take
+S_DONE = 7       # generation of the last take finished
+S_FAILED = 8     # generation of a take the stage failed in
+S_READY = 9      # set once the stage's thread or process is running
+SLOT_FIELDS = 16
+
+# backpressure policies and stage modes
+POLICIES = ("block", "drop", "decimate")
+MODES = ("thread", "process")
+
+# share of a block's duration the engine may wait for the blocking stages
+# before giving up on them: the capture buffer holds a few periods, so the
+# engine must be back before the next period is due
+BLOCK_FRACTION = 0.5
+
+# seconds a stage sleeps when not woken (to notice the engine quitting)
+WAKE_TIMEOUT = 0.5
+
+# seconds a new take's blocks are held back for the stages to finish the
+# take before (see Pipeline.begin); a stage still behind then abandons it
+FINISH_TIMEOUT = 2.0
+
+###############################################################################
+# Class Name:
+#   PeakStage
+# Description:
+#   measures each channel's peak and RMS level over the take, and counts
+#   the samples at full scale
+###############################################################################
+class PeakStage:
+
+    def __init__(self, rate, nchannels, sampWidth, fmtTag):
+        self.format = (sampWidth, fmtTag, nchannels)
+        self.peak = numpy.zeros(nchannels)
+        self.sumSquares = numpy.zeros(nchannels)
+        self.frames = 0
+        self.clipped = 0
+
+    def process(self, data):
+        x = piRecordFormat.samplesToFloat(data, *self.format)
+        a = numpy.abs(x)
+        self.peak = numpy.maximum(self.peak, a.max(axis=0))
+        self.sumSquares += numpy.square(x, dtype=numpy.float64).sum(axis=0)
+        self.frames += len(x)
+        self.clipped += int(numpy.count_nonzero(a >= 1.0))
+
+    def finish(self):
+        toDb = lambda v: round(20.0 * math.log10(v), 2) if v > 0 else None
+        rms = numpy.sqrt(self.sumSquares / max(1, self.frames))
+        return {"peakDb": [toDb(v) for v in self.peak], "rmsDb": [toDb(v) for v in rms], "clipped": self.clipped}
+
+###############################################################################
+# Class Name:
+#   LoudnessStage
+# Description:
+#   measures the take's loudness, loudness range and true peak (see
+#   piRecordLoudness.LoudnessMeter)
+###############################################################################
+class LoudnessStage:
+
+    def __init__(self, rate, nchannels, sampWidth, fmtTag):
+        import piRecordLoudness
+        self.format = (sampWidth, fmtTag, nchannels)
+        self.meter = piRecordLoudness.LoudnessMeter(rate, nchannels)
+
+    def process(self, data):
+        self.meter.process(piRecordFormat.samplesToFloat(data, *self.format))
+
+    def finish(self):
+        return self.meter.result()
+
+# the stages available by name
+STAGE_TYPES = {"peak": PeakStage, "loudness": LoudnessStage}
+
+###############################################################################
+# Function Name:
+#   getStageClass
+# Description:
+#   finds a stage's class by its name in STAGE_TYPES, or as module.Class
+# Parameters:
+#   name - the stage's name
+# Return value:
+#   the class
+###############################################################################
+def getStageClass(name):
+    if name in STAGE_TYPES:
+        return STAGE_TYPES[name]
+    moduleName, sep, className = name.rpartition(".")
+    if not sep:
+        raise ValueError("unknown stage: %s" % name)
+    try:
+        return getattr(importlib.import_module(moduleName), className)
+    except (ImportError, AttributeError) as err:
+        raise ValueError("unknown stage: %s (%s)" % (name, err))
+
+###############################################################################
+# Function Name:
+#   load
+# Description:
+#   reads a counter written by another thread or process.  An int64 may be
+#   written in two halves on a 32 bit CPU, so it is read until two reads
+#   agree.
+# Parameters:
+#   fields - the int64 array
+#   index - the field
+# Return value:
+#   the value
+###############################################################################
+def load(fields, index):
+    value = int(fields[index])
+    while True:
+        again = int(fields[index])
+        if again == value:
+            return value
+        value = again
+
+###############################################################################
+# Function Name:
+#   runStage
+# Description:
+#   a stage's loop, in its thread or worker process: waits to be woken,
+#   starts the stage when a take begins, processes the audio published
+#   since it last ran (as the stage's policy allows) and finishes the stage
+#   once the take has ended and all of it is read
+# Parameters:
+#   buf - the shared memory buffer
+#   index - the stage's slot
+#   name - the stage's name
+#   policy - the stage's backpressure policy
+#   chunkFrames - most frames passed to the stage at a time
+#   cpu - the core to run on (-1 = any)
+#   wake - the semaphore the engine wakes the stage with
+#   results - queue the results are put in, as (index, generation, result)
+#   process - True in a worker process (for the CPU clock used)
+# Return value:
+#   none
+###############################################################################
+def runStage(buf, index, name, policy, chunkFrames, cpu, wake, results, process):
+    if cpu >= 0:
+        try:
+            os.sched_setaffinity(0 if process else threading.get_native_id(), {cpu})
+        except (AttributeError, OSError):
+            pass
+    header = numpy.ndarray((HEADER_FIELDS,), dtype=numpy.int64, buffer=buf)
+    slot = numpy.ndarray((SLOT_FIELDS,), dtype=numpy.int64, buffer=buf,
+                         offset=(HEADER_FIELDS + index * SLOT_FIELDS) * 8)
+    ringOffset = (HEADER_FIELDS + getSlotCount(buf) * SLOT_FIELDS) * 8
+    clock = time.process_time if process else time.thread_time
+    stageClass = getStageClass(name)
+    gen = 0
+    stage = None
+    slot[S_READY] = 1
+    try:
+        while not header[H_QUIT]:
+            wake.acquire(timeout=WAKE_TIMEOUT)
+            g = load(header, H_GEN)
+            if g != gen and g >= 0:
+                # a new take: any take still unfinished was abandoned
+                if stage != None:
+                    results.put((index, gen, {"error": "abandoned: the next take began before it was processed"}))
+                gen = g
+                slot[:S_DONE] = 0
+                frameSize = int(header[H_NCHANNELS] * header[H_WIDTH])
+                size = int(header[H_SIZE])
+                ring = buf[ringOffset:ringOffset + size]
+                chunkBytes = chunkFrames * frameSize
+                pos = 0
+                try:
+                    stage = stageClass(int(header[H_RATE]), int(header[H_NCHANNELS]), int(header[H_WIDTH]),
+                                       int(header[H_TAG]))
+                except Exception as err:
+                    slot[S_FAILED] = gen
+                    results.put((index, gen, {"error": "%s: %s" % (type(err).__name__, err)}))
+                    stage = None
+            if stage == None:
+                continue
+
+            # process what has been published, a chunk at a time
+            stopped = load(header, H_STOP) == gen
+            written = load(header, H_WRITTEN)
+            while pos < written and load(header, H_GEN) == gen:
+                lag = written - pos
+                slot[S_MAX_LAG] = max(int(slot[S_MAX_LAG]), lag)
+                if lag > size:
+                    slot[S_DROPPED] += lag - size
+                    pos = written - size
+                elif policy == "decimate" and lag > chunkBytes:
+                    slot[S_DECIMATED] += lag - chunkBytes
+                    pos = written - chunkBytes
+                first = pos
+                end = min(written, pos + chunkBytes)
+                start = clock()
+                try:
+                    while pos < end:
+                        offset = pos % size
+                        n = min(end - pos, size - offset)
+                        stage.process(ring[offset:offset + n])
+                        pos += n
+                except Exception as err:
+                    slot[S_FAILED] = gen
+                    results.put((index, gen, {"error": "%s: %s" % (type(err).__name__, err)}))
+                    stage = None
+                    break
+                slot[S_CPU_NS] += int(1e9 * (clock() - start))
+                slot[S_PROCESSED] += end - first
+                slot[S_POS] = pos
+                written = load(header, H_WRITTEN)
+                if written - size > first:
+                    # the engine wrapped onto what was being read
+                    slot[S_TORN] += min(end, written - size) - first
+            if stage != None and stopped and pos >= load(header, H_WRITTEN) and load(header, H_GEN) == gen:
+                try:
+                    result = stage.finish()
+                except Exception as err:
+                    result = {"error": "%s: %s" % (type(err).__name__, err)}
+                    slot[S_FAILED] = gen
+                results.put((index, gen, result))
+                slot[S_DONE] = gen
+                stage = None
+    finally:
+        del header, slot
+
+###############################################################################
+# Function Name:
+#   getSlotCount
+# Description:
+#   reads the number of stage slots from the end of the header
+# Parameters:
+#   buf - the shared memory buffer
+# Return value:
+#   the number of slots
+###############################################################################
+def getSlotCount(buf):
+    return int(numpy.ndarray((1,), dtype=numpy.int64, buffer=buf, offset=(HEADER_FIELDS - 1) * 8)[0])
+
+###############################################################################
+# Function Name:
+#   runStageProcess
+# Description:
+#   a worker process: attaches to the shared memory and runs the stage
+# Parameters:
+#   shmName - the shared memory's name
+#   args - the rest of runStage's parameters
+# Return value:
+#   none
+###############################################################################
+def runStageProcess(shmName, *args):
+    # the worker shares the engine's resource tracker, so the shared memory
+    # is removed when the engine removes it (or dies)
+    shm = multiprocessing.shared_memory.SharedMemory(name=shmName)
+    try:
+        runStage(shm.buf, *args, True)
+    finally:
+        shm.close()
+
+###############################################################################
+# Class Name:
+#   Pipeline
+# Description:
+#   the engine's side: the shared memory, the stages' threads and worker
+#   processes, and the publishing of blocks
+###############################################################################
+class Pipeline:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   creates the shared memory and starts the stages
+    # Parameters:
+    #   stages - list of (name, mode, policy, cpu) (see
+    #            piRecordConf.getPipelineStages)
+    #   capacity - ring size in bytes
+    #   chunkFrames - most frames passed to a stage at a time
+    ###########################################################################
+    def __init__(self, stages, capacity, chunkFrames):
+        for name, mode, policy, cpu in stages:
+            getStageClass(name)
+            if mode not in MODES or policy not in POLICIES:
+                raise ValueError("stage %s: bad mode %s or policy %s" % (name, mode, policy))
+        self.stages = stages
+        self.capacity = capacity
+        self.ringOffset = (HEADER_FIELDS + len(stages) * SLOT_FIELDS) * 8
+        self.shm = multiprocessing.shared_memory.SharedMemory(create=True, size=self.ringOffset + capacity)
+        self.header = numpy.ndarray((HEADER_FIELDS,), dtype=numpy.int64, buffer=self.shm.buf)
+        self.header[:] = 0
+        self.header[HEADER_FIELDS - 1] = len(stages)
+        self.slots = numpy.ndarray((len(stages), SLOT_FIELDS), dtype=numpy.int64, buffer=self.shm.buf,
+                                   offset=HEADER_FIELDS * 8)
+        self.slots[:] = 0
+        self.ring = self.shm.buf[self.ringOffset:self.ringOffset + capacity]
+        self.size = 0
+        self.written = 0
+        self.frameSize = 1
+        self.bytesPerSec = 1.0
+        self.gen = 0
+        self.blockedSecs = [0.0] * len(stages)
+        self.maxBlockShare = [0.0] * len(stages)
+        self.stalls = [0] * len(stages)
+        self.stalled = [False] * len(stages)
+        self.tags = {}
+        self.nextTake = None
+        self.nextDeadline = 0.0
+        self.held = []
+
+        ctx = multiprocessing.get_context("spawn")
+        self.resultQueue = ctx.Queue()
+        self.wakes = []
+        self.workers = []
+        for i, (name, mode, policy, cpu) in enumerate(stages):
+            if mode == "process":
+                wake = ctx.Semaphore(0)
+                worker = ctx.Process(target=runStageProcess, daemon=True, name="stage-" + name,
+                                     args=(self.shm.name, i, name, policy, chunkFrames, cpu, wake, self.resultQueue))
+            else:
+                wake = threading.Semaphore(0)
+                worker = threading.Thread(target=runStage, daemon=True, name="stage-" + name,
+                                          args=(self.shm.buf, i, name, policy, chunkFrames, cpu, wake,
+                                                self.resultQueue, False))
+            worker.start()
+            self.wakes.append(wake)
+            self.workers.append(worker)
+
+    ###########################################################################
+    # Method Name:
+    #   begin
+    # Description:
+    #   starts a take without waiting.  Until the stages are running and have
+    #   finished the take before (for FINISH_TIMEOUT at most), its blocks are
+    #   held back by publish (see startTake).
+    # Parameters:
+    #   nchannels - number of channels
+    #   sampWidth - stored sample width in bytes
+    #   fmtTag - wave format tag of the stored samples
+    #   rate - sample rate
+    #   tag - returned with the stages' results for the take (e.g. its name)
+    # Return value:
+    #   none
+    ###########################################################################
+    def begin(self, nchannels, sampWidth, fmtTag, rate, tag=None):
+        if self.nextTake != None:
+            self.startTake(True)
+        self.nextTake = (nchannels, sampWidth, fmtTag, rate, tag)
+        self.nextDeadline = time.monotonic() + FINISH_TIMEOUT
+        self.startTake(False)
+
+    ###########################################################################
+    # Method Name:
+    #   startTake
+    # Description:
+    #   starts the take begun in the ring, once the stages are ready for it:
+    #   sets the format, wakes the stages and publishes the blocks held back
+    #   until then (without waiting for blocking stages, as those blocks are
+    #   late already)
+    # Parameters:
+    #   force - True to start it even if the stages aren't ready
+    # Return value:
+    #   True if the take was started
+    ###########################################################################
+    def startTake(self, force):
+        if not force and time.monotonic() < self.nextDeadline and not all(load(slot, S_READY) and (
+                load(slot, S_DONE) == self.gen or load(slot, S_FAILED) == self.gen) for slot in self.slots):
+            return False
+        nchannels, sampWidth, fmtTag, rate, tag = self.nextTake
+        self.nextTake = None
+        self.header[H_GEN] = -1
+        self.frameSize = nchannels * sampWidth
+        self.bytesPerSec = float(self.frameSize * rate)
+        self.size = self.capacity - self.capacity % self.frameSize
+        self.written = 0
+        self.blockedSecs = [0.0] * len(self.stages)
+        self.maxBlockShare = [0.0] * len(self.stages)
+        self.stalls = [0] * len(self.stages)
+        self.stalled = [False] * len(self.stages)
+        self.header[H_WRITTEN] = 0
+        self.header[H_SIZE] = self.size
+        self.header[H_NCHANNELS] = nchannels
+        self.header[H_WIDTH] = sampWidth
+        self.header[H_TAG] = fmtTag
+        self.header[H_RATE] = rate
+        self.gen += 1
+        self.tags[self.gen] = tag
+        self.header[H_GEN] = self.gen
+        for wake in self.wakes:
+            wake.release()
+        held, self.held = self.held, []
+        for data in held:
+            self.publish(data, False)
+        return True
+
+    ###########################################################################
+    # Method Name:
+    #   publish
+    # Description:
+    #   copies a block into the ring and wakes the stages.  For each blocking
+    #   stage, first waits until the ring has room for the block, for at most
+    #   BLOCK_FRACTION of the block's duration in all.  A block of a take that
+    #   hasn't started in the ring yet (see begin) is held back.
+    # Parameters:
+    #   data - block of stored samples
+    #   wait - False not to wait for blocking stages
+    # Return value:
+    #   none
+    ###########################################################################
+    def publish(self, data, wait=True):
+        if self.nextTake != None and not self.startTake(False):
+            self.held.append(bytes(data))
+            return
+        if not self.size:
+            return
+        data = memoryview(data)[-self.size:]
+        n = len(data)
+        headroom = BLOCK_FRACTION * n / self.bytesPerSec
+        deadline = time.monotonic() + headroom
+        for i, (name, mode, policy, cpu) in enumerate(self.stages):
+            if policy != "block" or not wait:
+                continue
+            slot = self.slots[i]
+            if self.stalled[i]:
+                self.stalled[i] = self.written - load(slot, S_POS) > self.size // 2
+                continue
+            start = time.monotonic()
+            while self.written + n - load(slot, S_POS) > self.size and load(slot, S_FAILED) != self.gen:
+                now = time.monotonic()
+                if now >= deadline:
+                    self.stalled[i] = True
+                    self.stalls[i] += 1
+                    break
+                time.sleep(min(0.0005, deadline - now))
+            waited = time.monotonic() - start
+            self.blockedSecs[i] += waited
+            self.maxBlockShare[i] = max(self.maxBlockShare[i], waited / headroom)
+        pos = self.written % self.size
+        first = min(n, self.size - pos)
+        self.ring[pos:pos + first] = data[:first]
+        if n > first:
+            self.ring[:n - first] = data[first:]
+        self.written += n
+        self.header[H_WRITTEN] = self.written
+        for wake in self.wakes:
+            wake.release()
+
+    ###########################################################################
+    # Method Name:
+    #   end
+    # Description:
+    #   ends the take; the stages finish in their own time, and their results
+    #   are picked up by collect
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def end(self):
+        if self.nextTake != None:
+            self.startTake(True)
+        self.header[H_STOP] = self.gen
+        for wake in self.wakes:
+            wake.release()
+
+    ###########################################################################
+    # Method Name:
+    #   collect
+    # Description:
+    #   returns the results the stages have finished with since the last call
+    # Parameters:
+    #   none
+    # Return value:
+    #   list of (stage name, the take's tag, result)
+    ###########################################################################
+    def collect(self):
+        found = []
+        while True:
+            try:
+                index, gen, result = self.resultQueue.get_nowait()
+            except queue.Empty:
+                return found
+            found.append((self.stages[index][0], self.tags.get(gen), result))
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns each stage's counters for the take in progress (or the last).
+    #   cpuPct is the stage's CPU time as a share of the audio's duration,
+    #   maxBlockPct the engine's longest wait for it as a share of the most
+    #   it may wait.
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters by stage name (name#2 and so on for a stage used
+    #   more than once)
+    ###########################################################################
+    def getStats(self):
+        stats = {}
+        ms = lambda n: round(1000.0 * n / self.bytesPerSec, 1)
+        for i, (name, mode, policy, cpu) in enumerate(self.stages):
+            slot = self.slots[i]
+            processed = load(slot, S_PROCESSED)
+            used = [stage[0] for stage in self.stages[:i]].count(name)
+            stats[name + ("#%d" % (used + 1) if used else "")] = {"mode": mode, "policy": policy, "cpu": cpu,
+                           "cpuPct": round(100.0 * load(slot, S_CPU_NS) / 1e9 / max(processed / self.bytesPerSec, 1e-6), 2)
+                           if processed else 0.0,
+                           "lagMs": ms(max(0, self.written - load(slot, S_POS))), "maxLagMs": ms(load(slot, S_MAX_LAG)),
+                           "droppedMs": ms(load(slot, S_DROPPED)), "decimatedMs": ms(load(slot, S_DECIMATED)),
+                           "tornMs": ms(load(slot, S_TORN)), "blockedMs": round(1000.0 * self.blockedSecs[i], 1),
+                           "maxBlockPct": round(100.0 * self.maxBlockShare[i], 1), "stalls": self.stalls[i],
+                           "failed": load(slot, S_FAILED) == self.gen and self.gen > 0}
+        return stats
+
+    ###########################################################################
+    # Method Name:
+    #   close
+    # Description:
+    #   stops the stages and removes the shared memory
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def close(self):
+        if self.shm == None:
+            return
+        self.header[H_QUIT] = 1
+        for wake in self.wakes:
+            wake.release()
+        for worker in self.workers:
+            worker.join(2 * WAKE_TIMEOUT)
+            if isinstance(worker, multiprocessing.process.BaseProcess) and worker.is_alive():
+                worker.terminate()
+        del self.header, self.slots
+        self.ring.release()
+        try:
+            self.shm.close()
+        except BufferError:
+            # a thread stage that didn't stop still has a view
+            pass
+        self.shm.unlink()
+        self.shm = None
@@ -0,0 +1,425 @@
+###############################################################################
+# piRecordPlayback.py - Raspberry Pi audio recorder playback module
+# Description:
+#   plays a list of wave files (e.g. a take, its parts continued after a
+#   restart and the takes after it) without gaps, in the engine process.
+#   Each file is memory mapped, so a period is handed to the device straight
+#   from the page cache and a seek is only a change of position.  The audio
+#   ahead of the position, and the start of the next file as the end of one
+#   nears, is prefetched (madvise WILLNEED), so the card is read well before
+#   the audio is played.  Files of the same format follow each other in the
+#   same period; a change of format reopens the device.
+#
+#   Cue points are the markers in a file's cue chunk (see
+#   piRecordWave.readCuePoints) and the start of each file.
+###############################################################################
+
+import argparse
+import bisect
+import fcntl
+import mmap
+import os
+import time
+from piRecordHardware import alsaaudio
+import piRecordConf
+import piRecordFormat
+import piRecordUtils
+import piRecordWave
+
+# seconds into a cue before a cue back goes to its start, not the one before
+CUE_BACK_SECS = 2.0
+
+###############################################################################
+# Class Name:
+#   MappedWave
+# Description:
+#   a wave file's data, memory mapped
+###############################################################################
+class MappedWave:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   parses the header and cue points and maps the file.  A take whose
+    #   silence trim is pending or running isn't mapped, as the trim may
+    #   shorten it, and the file is share locked while mapped so that a trim
+    #   (see piRecordWave.completeTrim) waits to truncate it until it's closed.
+    # Parameters:
+    #   filename - the wave file
+    ###########################################################################
+    def __init__(self, filename):
+        self.fd = open(filename, 'rb')
+        try:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ValueError("being trimmed: %s" % filename)
+            if piRecordUtils.isTrimPending(filename):
+                raise ValueError("being trimmed: %s" % filename)
+            reader = piRecordWave.WaveReader(filename)
+            reader.close()
+            self.nchannels = reader.getnchannels()
+            self.sampwidth = reader.getsampwidth()
+            self.rate = reader.getframerate()
+            self.formatTag = reader.getformattag()
+            self.nframes = reader.getnframes()
+            self.frameSize = reader.frameSize
+            self.dataOffset = reader.getdataoffset()
+            if self.nframes == 0:
+                raise ValueError("no audio: %s" % filename)
+            self.cues = sorted(set([0] + [c for c in piRecordWave.readCuePoints(filename) if c < self.nframes]))
+            self.map = mmap.mmap(self.fd.fileno(), self.dataOffset + self.nframes * self.frameSize, access=mmap.ACCESS_READ)
+            self.data = memoryview(self.map)[self.dataOffset:]
+        except BaseException:
+            self.fd.close()
+            raise
+        self.prefetched = (0, 0)
+
+    def getFormat(self):
+        return (self.nchannels, self.sampwidth, self.rate, self.formatTag)
+
+    ###########################################################################
+    # Method Name:
+    #   prefetch
+    # Description:
+    #   asks the kernel to read frames into the page cache in the background
+    # Parameters:
+    #   pos - first frame
+    #   n - number of frames
+    # Return value:
+    #   none
+    ###########################################################################
+    def prefetch(self, pos, n):
+        end = min(self.nframes, pos + n)
+        self.prefetched = (pos, end)
+        start = (self.dataOffset + pos * self.frameSize) & ~(mmap.PAGESIZE - 1)
+        length = self.dataOffset + end * self.frameSize - start
+        if length > 0 and hasattr(mmap, "MADV_WILLNEED"):
+            self.map.madvise(mmap.MADV_WILLNEED, start, length)
+
+    def read(self, pos, n):
+        return self.data[pos * self.frameSize:(pos + n) * self.frameSize]
+
+    def close(self):
+        self.data.release()
+        self.map.close()
+        self.fd.close()
+
+###############################################################################
+# Class Name:
+#   Player
+# Description:
+#   plays a list of wave files, a period at a time (see play), and moves the
+#   position by time or cue point.  Files that can't be played are skipped.
+###############################################################################
+class Player:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   checks the files and maps the first that can be played
+    # Parameters:
+    #   files - the wave files, in order
+    #   device - the ALSA device to play on
+    #   periodFrames - frames written to the device at a time
+    #   prefetchSecs - seconds of audio prefetched ahead of the position
+    ###########################################################################
+    def __init__(self, files, device, periodFrames, prefetchSecs):
+        self.files = files
+        self.device = device
+        self.periodFrames = periodFrames
+        self.prefetchSecs = prefetchSecs
+        self.waves = {}
+        self.bad = set()
+        self.pcm = None
+        self.pcmFormat = None
+        self.index = -1
+        self.pos = 0
+        self.periods = 0
+        self.underruns = 0
+        self.seeks = 0
+        self.reopens = 0
+        self.writeMax = 0.0
+        self.errors = []
+        index = self.step(-1, 1)
+        if index == None:
+            raise ValueError("nothing to play")
+        self.moveTo(index, 0)
+
+    ###########################################################################
+    # Method Name:
+    #   getWave
+    # Description:
+    #   returns a file's mapping, mapping it first if it isn't yet
+    # Parameters:
+    #   index - the file's index
+    # Return value:
+    #   the MappedWave, or None if the file can't be played
+    ###########################################################################
+    def getWave(self, index):
+        if index < 0 or index >= len(self.files) or index in self.bad:
+            return None
+        if index not in self.waves:
+            try:
+                wave = MappedWave(self.files[index])
+                if piRecordFormat.getPlaybackFormat(wave.sampwidth, wave.formatTag) == None:
+                    wave.close()
+                    raise ValueError("unsupported format: %s" % self.files[index])
+            except (OSError, ValueError) as err:
+                self.bad.add(index)
+                self.errors.append(str(err))
+                return None
+            self.waves[index] = wave
+        return self.waves[index]
+
+    ###########################################################################
+    # Method Name:
+    #   step
+    # Description:
+    #   finds the next (or previous) file that can be played
+    # Parameters:
+    #   index - the file to start from
+    #   direction - 1 for the next, -1 for the previous
+    # Return value:
+    #   the file's index, None if there is none
+    ###########################################################################
+    def step(self, index, direction):
+        index += direction
+        while 0 <= index < len(self.files):
+            if self.getWave(index) != None:
+                return index
+            index += direction
+        return None
+
+    ###########################################################################
+    # Method Name:
+    #   moveTo
+    # Description:
+    #   moves the position, prefetching from there, and unmaps the files
+    #   that aren't next to it
+    # Parameters:
+    #   index - the file
+    #   pos - the frame in the file
+    # Return value:
+    #   none
+    ###########################################################################
+    def moveTo(self, index, pos):
+        self.index = index
+        self.wave = self.getWave(index)
+        self.pos = max(0, min(pos, self.wave.nframes))
+        self.wave.prefetch(self.pos, int(self.prefetchSecs * self.wave.rate))
+        for i in list(self.waves):
+            if abs(i - index) > 1:
+                self.waves.pop(i).close()
+
+    ###########################################################################
+    # Method Name:
+    #   prefetch
+    # Description:
+    #   keeps the prefetch ahead of the position, and prefetches the start of
+    #   the next file once the end of this one is within reach
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def prefetch(self):
+        ahead = int(self.prefetchSecs * self.wave.rate)
+        start, end = self.wave.prefetched
+        if self.pos < start or (self.pos + ahead // 2 > end and end < self.wave.nframes):
+            self.wave.prefetch(self.pos, ahead)
+        left = self.wave.nframes - self.pos
+        if left < ahead:
+            index = self.step(self.index, 1)
+            if index != None and self.waves[index].prefetched == (0, 0):
+                self.waves[index].prefetch(0, int((ahead - left) / self.wave.rate * self.waves[index].rate))
+
+    ###########################################################################
+    # Method Name:
+    #   openDevice
+    # Description:
+    #   opens the device for the current file's format, if it isn't already
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def openDevice(self):
+        fmt = self.wave.getFormat()
+        if self.pcm != None and fmt == self.pcmFormat:
+            return
+        if self.pcm != None:
+            self.pcm.close()
+            self.reopens += 1
+        self.pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, device=self.device)
+        self.pcm.setchannels(self.wave.nchannels)
+        self.pcm.setrate(self.wave.rate)
+        self.pcm.setformat(piRecordFormat.getPlaybackFormat(self.wave.sampwidth, self.wave.formatTag))
+        self.pcm.setperiodsize(self.periodFrames)
+        self.pcmFormat = fmt
+
+    ###########################################################################
+    # Method Name:
+    #   play
+    # Description:
+    #   writes the next period to the device, which waits while the device's
+    #   buffer is full.  A period that ends a file is filled from the next if
+    #   it is in the same format; the last period is filled with silence.
+    # Parameters:
+    #   none
+    # Return value:
+    #   False once everything has been played
+    ###########################################################################
+    def play(self):
+        if self.pos >= self.wave.nframes:
+            index = self.step(self.index, 1)
+            if index == None:
+                return False
+            self.moveTo(index, 0)
+        self.openDevice()
+        n = min(self.periodFrames, self.wave.nframes - self.pos)
+        data = self.wave.read(self.pos, n)
+        self.pos += n
+        if n < self.periodFrames:
+            index = self.step(self.index, 1)
+            nextWave = self.getWave(index) if index != None else None
+            if nextWave != None and nextWave.getFormat() == self.pcmFormat:
+                rest = min(self.periodFrames - n, nextWave.nframes)
+                data = bytes(data) + bytes(nextWave.read(0, rest))
+                self.moveTo(index, rest)
+            else:
+                silence = b'\x80' if self.wave.sampwidth == 1 else b'\x00'
+                data = bytes(data) + silence * ((self.periodFrames - n) * self.wave.frameSize)
+        start = time.perf_counter()
+        if self.pcm.write(data) < 0:
+            self.underruns += 1
+        self.writeMax = max(self.writeMax, time.perf_counter() - start)
+        self.periods += 1
+        self.prefetch()
+        return True
+
+    ###########################################################################
+    # Method Name:
+    #   seek
+    # Description:
+    #   moves the position by a number of seconds, into the files before or
+    #   after if it runs off the current one
+    # Parameters:
+    #   secs - seconds to move (negative to go back)
+    # Return value:
+    #   none
+    ###########################################################################
+    def seek(self, secs):
+        index, wave = self.index, self.wave
+        pos = self.pos + int(round(secs * wave.rate))
+        while pos < 0:
+            prev = self.step(index, -1)
+            if prev == None:
+                break
+            pos = self.waves[prev].nframes + int(round(pos / float(wave.rate) * self.waves[prev].rate))
+            index, wave = prev, self.waves[prev]
+        while pos >= wave.nframes:
+            nxt = self.step(index, 1)
+            if nxt == None:
+                break
+            pos = int(round((pos - wave.nframes) / float(wave.rate) * self.waves[nxt].rate))
+            index, wave = nxt, self.waves[nxt]
+        self.seeks += 1
+        self.moveTo(index, pos)
+
+    ###########################################################################
+    # Method Name:
+    #   cue
+    # Description:
+    #   moves to the next cue point, or back to the start of this one (or to
+    #   the one before, within CUE_BACK_SECS of its start)
+    # Parameters:
+    #   direction - 1 for the next, -1 to go back
+    # Return value:
+    #   none
+    ###########################################################################
+    def cue(self, direction):
+        cues = self.wave.cues
+        self.seeks += 1
+        if direction > 0:
+            i = bisect.bisect_right(cues, self.pos)
+            if i < len(cues):
+                self.moveTo(self.index, cues[i])
+            elif self.step(self.index, 1) != None:
+                self.moveTo(self.step(self.index, 1), 0)
+            else:
+                self.moveTo(self.index, self.wave.nframes)
+            return
+        i = bisect.bisect_right(cues, self.pos) - 1
+        if self.pos - cues[i] < CUE_BACK_SECS * self.wave.rate:
+            i -= 1
+        if i >= 0:
+            self.moveTo(self.index, cues[i])
+        elif self.step(self.index, -1) != None:
+            prev = self.step(self.index, -1)
+            self.moveTo(prev, self.waves[prev].cues[-1])
+        else:
+            self.moveTo(self.index, 0)
+
+    ###########################################################################
+    # Method Name:
+    #   getPosition
+    # Description:
+    #   returns where playback is
+    # Parameters:
+    #   none
+    # Return value:
+    #   (file index, seconds into the file, the file's length in seconds)
+    ###########################################################################
+    def getPosition(self):
+        return self.index, self.pos / float(self.wave.rate), self.wave.nframes / float(self.wave.rate)
+
+    def getStats(self):
+        return {"file": self.files[self.index], "index": self.index, "posSecs": round(self.pos / float(self.wave.rate), 3),
+                "periods": self.periods, "underruns": self.underruns, "seeks": self.seeks, "reopens": self.reopens,
+                "skipped": len(self.bad), "writeMaxMs": round(1000.0 * self.writeMax, 3)}
+
+    def close(self):
+        if self.pcm != None:
+            self.pcm.close()
+            self.pcm = None
+        for wave in self.waves.values():
+            wave.close()
+        self.waves = {}
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   plays files from the command line (see piRecord.sh playback)
+###############################################################################
+if __name__ == "__main__":
+    piRecordConf.getRecDevConfig()
+
+    parser = argparse.ArgumentParser(description="play wave files without gaps between them")
+    parser.add_argument("files", nargs="+", help="wave files to play, in order")
+    parser.add_argument("--start", type=float, default=0.0, help="seconds into the first file to start at")
+    args = parser.parse_args()
+
+    try:
+        player = Player([fn if os.path.exists(fn) else os.path.join(piRecordConf.outputDir, fn) for fn in args.files],
+                        piRecordConf.getRecDevice(), piRecordConf.playbackPeriodFrames, piRecordConf.playbackPrefetchSecs)
+    except ValueError as err:
+        print ("playback error:", err)
+        exit(1)
+    for err in player.errors:
+        print ("skipped:", err)
+    player.seek(args.start)
+    playing = -1
+    try:
+        while player.play():
+            if player.index != playing:
+                playing = player.index
+                print ("playing", player.files[playing])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        player.close()
+    print (player.getStats())
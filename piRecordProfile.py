@@ -0,0 +1,241 @@
+###############################################################################
+# piRecordProfile.py - Raspberry Pi audio recorder sampling profiler module
+# Description:
+#   a low overhead sampling profiler for profiling a unit in the field
+#   without restarting it.  While running, a thread wakes at the configured
+#   rate, takes the stack of every other thread in the process and counts
+#   each distinct stack.  Nothing is added to the profiled code itself.
+#
+#   Dumps are written in the collapsed stack format ("frame;frame;frame
+#   count" per line) read by flamegraph.pl and speedscope, with a JSON file
+#   of the telemetry at the time of the dump alongside.
+###############################################################################
+
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import piRecordConf
+import piRecordLog
+
+# the process's profiler, created on first use
+profiler = None
+
+###############################################################################
+# Class Name:
+#   Profiler
+# Description:
+#   the sampling profiler for one process
+###############################################################################
+class Profiler:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   creates a stopped profiler
+    # Parameters:
+    #   name - process name used in the dump file names (e.g. "ui")
+    #   rate - samples per second
+    #   outDir - directory the dumps are written to
+    #   telemetry - function returning the telemetry dict for a dump
+    ###########################################################################
+    def __init__(self, name, rate, outDir, telemetry):
+        self.name = name
+        self.period = 1.0 / rate
+        self.outDir = outDir
+        self.telemetry = telemetry
+        self.stacks = {}
+        self.samples = 0
+        self.sampleTime = 0.0
+        self.startTime = None
+        self.thread = None
+        self.running = False
+
+    def isRunning(self):
+        return self.running
+
+    ###########################################################################
+    # Method Name:
+    #   start
+    # Description:
+    #   clears the counts and starts sampling
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def start(self):
+        if self.running:
+            return
+        if self.thread != None:
+            self.thread.join()
+        self.stacks = {}
+        self.samples = 0
+        self.sampleTime = 0.0
+        self.startTime = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   stop
+    # Description:
+    #   stops sampling, keeping the counts for a dump
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def stop(self):
+        self.running = False
+
+    ###########################################################################
+    # Method Name:
+    #   toggle
+    # Description:
+    #   starts the profiler if it is stopped, or stops it if it is running
+    # Parameters:
+    #   none
+    # Return value:
+    #   True if the profiler is now running
+    ###########################################################################
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   the sampling thread
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self):
+        ownId = threading.get_ident()
+        nextTime = time.time()
+        while self.running:
+            start = time.perf_counter()
+            self.sample(ownId)
+            self.sampleTime += time.perf_counter() - start
+            nextTime = max(nextTime + self.period, time.time())
+            time.sleep(nextTime - time.time())
+
+    ###########################################################################
+    # Method Name:
+    #   sample
+    # Description:
+    #   counts the current stack of every thread except the profiler's own
+    #   threads.  Each stack is keyed by thread name then frames, outermost
+    #   first.
+    # Parameters:
+    #   ownId - thread id of the sampling thread
+    # Return value:
+    #   none
+    ###########################################################################
+    def sample(self, ownId):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for threadId, frame in sys._current_frames().items():
+            if threadId == ownId or names.get(threadId, "").startswith("profiler"):
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            frames.append(names.get(threadId, "thread-%d" % threadId))
+            key = ";".join(reversed(frames))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    ###########################################################################
+    # Method Name:
+    #   dump
+    # Description:
+    #   writes the stack counts so far and the current telemetry.  The files
+    #   are named after the process, its pid and the time of the dump.
+    # Parameters:
+    #   none
+    # Return value:
+    #   the collapsed stack file name (None if it couldn't be written)
+    ###########################################################################
+    def dump(self):
+        base = os.path.join(self.outDir, "profile-%s-%d-%s" % (self.name, os.getpid(), time.strftime("%Y%m%d_%H%M%S")))
+        stacks = dict(self.stacks)
+        elapsed = time.time() - self.startTime if self.startTime != None else 0.0
+        info = {"process": self.name, "pid": os.getpid(), "running": self.running, "samples": self.samples,
+                "seconds": elapsed, "overheadSecs": self.sampleTime, "telemetry": self.telemetry()}
+        try:
+            os.makedirs(self.outDir, exist_ok=True)
+            with open(base + ".folded", "w") as fd:
+                for key, count in sorted(stacks.items()):
+                    fd.write("%s %d\n" % (key, count))
+            with open(base + ".json", "w") as fd:
+                json.dump(info, fd, indent=1)
+        except OSError as err:
+            piRecordLog.event("profile_dump_failed", logging.ERROR, interval=0, error=err)
+            return None
+        return base + ".folded"
+
+    ###########################################################################
+    # Method Name:
+    #   dumpAsync
+    # Description:
+    #   writes a dump from a separate thread, so it can be called from a
+    #   signal handler without holding up the code that was interrupted
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def dumpAsync(self):
+        threading.Thread(target=self.dump, name="profiler-dump", daemon=True).start()
+
+###############################################################################
+# Function Name:
+#   getProfiler
+# Description:
+#   returns the process's profiler, creating it with the configured rate
+#   and dump directory (the log directory unless one is configured)
+# Parameters:
+#   name - process name used in the dump file names
+#   telemetry - function returning the telemetry dict for a dump
+# Return value:
+#   the profiler
+###############################################################################
+def getProfiler(name, telemetry):
+    global profiler
+    if profiler == None:
+        outDir = piRecordConf.profileDir or os.path.dirname(piRecordConf.logFile) or "."
+        profiler = Profiler(name, piRecordConf.profileRate, outDir, telemetry)
+    return profiler
+
+###############################################################################
+# Function Name:
+#   handleSignal
+# Description:
+#   the SIGUSR1/SIGUSR2 action: SIGUSR1 starts or stops the profiler and
+#   SIGUSR2 dumps it
+# Parameters:
+#   signum - the signal number
+#   name - process name used in the dump file names
+#   telemetry - function returning the telemetry dict for a dump
+# Return value:
+#   a description of what was done
+###############################################################################
+def handleSignal(signum, name, telemetry):
+    prof = getProfiler(name, telemetry)
+    if signum == signal.SIGUSR1:
+        return "%s profiler %s" % (name, "started" if prof.toggle() else "stopped")
+    prof.dumpAsync()
+    return "%s profile dump requested" % name
@@ -0,0 +1,225 @@
+###############################################################################
+# piRecordRealtime.py - Raspberry Pi audio recorder real-time module
+# Description:
+#   puts the engine process in real-time mode: SCHED_FIFO scheduling, a
+#   dedicated CPU, memory locked with mlockall and the heap pre-faulted so
+#   the capture loop doesn't take page faults.  Each step that isn't allowed
+#   (e.g. when not running as root) is skipped and reported, and the engine
+#   carries on at normal priority.
+#
+#   The engine's loop wakeups and xruns are counted in both modes, so the
+#   telemetry shows the difference real-time mode makes.  Running this
+#   module measures wakeup jitter on its own (see __main__).
+###############################################################################
+
+import argparse
+import logging
+import os
+import threading
+import time
+import piRecordLog
+
+# mlockall flags
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# mallopt parameters
+M_TRIM_THRESHOLD = -1
+M_MMAP_MAX = -4
+
+# stack size of threads started once memory is locked (the default 8MB
+# stacks would all be locked in)
+THREAD_STACK_SIZE = 512 * 1024
+
+# wakeup lateness histogram: JITTER_BIN seconds per bin, the last bin holds
+# everything later
+JITTER_BIN = 0.0001
+JITTER_BINS = 1000
+
+# the real-time settings in effect, reported in telemetry
+rtStatus = {"policy": "other", "priority": 0, "cpus": [], "memoryLocked": False,
+            "prefaultBytes": 0, "errors": []}
+
+###############################################################################
+# Function Name:
+#   enterRealtime
+# Description:
+#   applies the real-time settings to the calling process.  Failures are
+#   recorded in rtStatus["errors"] rather than raised.
+# Parameters:
+#   priority - SCHED_FIFO priority (1-99)
+#   cpu - CPU to run on (-1 = leave the affinity alone)
+#   lockMemory - True to lock and pre-fault memory
+#   prefaultBytes - heap pre-faulted (and kept) after locking
+# Return value:
+#   True if every setting was applied
+###############################################################################
+def enterRealtime(priority, cpu, lockMemory, prefaultBytes):
+    errors = rtStatus["errors"]
+
+    if cpu >= 0:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as err:
+            errors.append("affinity: %s" % err)
+    try:
+        rtStatus["cpus"] = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+
+    if lockMemory:
+        # imported here, as ctypes.util is slow to import and most starts
+        # don't use real-time mode
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+            rtStatus["memoryLocked"] = True
+            threading.stack_size(THREAD_STACK_SIZE)
+            rtStatus["prefaultBytes"] = prefault(libc, prefaultBytes)
+        else:
+            errors.append("mlockall: %s" % os.strerror(ctypes.get_errno()))
+
+    # with SCHED_RESET_ON_FORK, the engine's helper threads and the processes
+    # it starts (e.g. the flac encoder) run at normal priority
+    try:
+        policy = os.SCHED_FIFO | getattr(os, "SCHED_RESET_ON_FORK", 0)
+        os.sched_setscheduler(0, policy, os.sched_param(priority))
+        rtStatus["policy"] = "fifo"
+        rtStatus["priority"] = priority
+    except (AttributeError, OSError) as err:
+        errors.append("SCHED_FIFO: %s" % err)
+
+    for err in errors:
+        piRecordLog.event("realtime_unavailable", logging.WARNING, interval=0, error=err)
+    return not errors
+
+###############################################################################
+# Function Name:
+#   prefault
+# Description:
+#   grows the heap by the given amount and touches every page, then frees
+#   it.  malloc is first told never to trim the heap or to use separate
+#   mappings, so the freed (and locked) pages are kept for later buffers.
+# Parameters:
+#   libc - the C library
+#   nbytes - bytes to pre-fault
+# Return value:
+#   the bytes pre-faulted
+###############################################################################
+def prefault(libc, nbytes):
+    if nbytes <= 0:
+        return 0
+    libc.mallopt(M_TRIM_THRESHOLD, -1)
+    libc.mallopt(M_MMAP_MAX, 0)
+    buf = bytearray(nbytes)
+    pageSize = os.sysconf("SC_PAGE_SIZE")
+    for pos in range(0, nbytes, pageSize):
+        buf[pos] = 1
+    del buf
+    return nbytes
+
+###############################################################################
+# Class Name:
+#   LoopStats
+# Description:
+#   measures how late the engine loop wakes up from its sleeps, and counts
+#   the xruns reported by the capture device
+###############################################################################
+class LoopStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.histogram = [0] * JITTER_BINS
+        self.wakeups = 0
+        self.totalLate = 0.0
+        self.maxLate = 0.0
+        self.xruns = 0
+
+    ###########################################################################
+    # Method Name:
+    #   sleep
+    # Description:
+    #   sleeps and records how much longer than asked the sleep took
+    # Parameters:
+    #   duration - seconds to sleep
+    # Return value:
+    #   none
+    ###########################################################################
+    def sleep(self, duration):
+        start = time.perf_counter()
+        time.sleep(duration)
+        late = max(0.0, time.perf_counter() - start - duration)
+        self.histogram[min(int(late / JITTER_BIN), JITTER_BINS - 1)] += 1
+        self.wakeups += 1
+        self.totalLate += late
+        self.maxLate = max(self.maxLate, late)
+
+    def addXrun(self):
+        self.xruns += 1
+
+    ###########################################################################
+    # Method Name:
+    #   percentile
+    # Description:
+    #   returns a percentile of the wakeup lateness from the histogram
+    # Parameters:
+    #   pct - the percentile (0-100)
+    # Return value:
+    #   the lateness in seconds (to the upper edge of its bin)
+    ###########################################################################
+    def percentile(self, pct):
+        target = self.wakeups * pct / 100.0
+        count = 0
+        for i, n in enumerate(self.histogram):
+            count += n
+            if count >= target and n:
+                return (i + 1) * JITTER_BIN
+        return 0.0
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns the real-time settings and loop statistics for telemetry
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters
+    ###########################################################################
+    def getStats(self):
+        stats = dict(rtStatus)
+        stats.update({"wakeups": self.wakeups, "xruns": self.xruns,
+                      "meanLateMs": round(1000.0 * self.totalLate / max(1, self.wakeups), 3),
+                      "p99LateMs": round(1000.0 * self.percentile(99.0), 3),
+                      "maxLateMs": round(1000.0 * self.maxLate, 3)})
+        return stats
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   measures wakeup jitter at the engine's loop period, optionally in
+#   real-time mode, so the two can be compared on a unit, e.g.
+#     python3 piRecordRealtime.py --seconds 60
+#     sudo python3 piRecordRealtime.py --seconds 60 --realtime --cpu 3
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measure wakeup jitter")
+    parser.add_argument("--seconds", type=float, default=10.0, help="how long to measure")
+    parser.add_argument("--period", type=float, default=0.001, help="sleep period in seconds")
+    parser.add_argument("--realtime", action="store_true", help="enter real-time mode first")
+    parser.add_argument("--priority", type=int, default=70, help="SCHED_FIFO priority")
+    parser.add_argument("--cpu", type=int, default=-1, help="CPU to run on")
+    args = parser.parse_args()
+
+    if args.realtime:
+        enterRealtime(args.priority, args.cpu, True, 16 * 1024 * 1024)
+    stats = LoopStats()
+    endTime = time.time() + args.seconds
+    while time.time() < endTime:
+        stats.sleep(args.period)
+    for key, value in stats.getStats().items():
+        print ("%-14s %s" % (key + ":", value))
@@ -0,0 +1,167 @@
+###############################################################################
+# piRecordResample.py - Raspberry Pi audio recorder capture resampling module
+# Description:
+#   changes the sample rate of the captured audio on its way to the file, so
+#   the device can run at one rate (e.g. an interface that only runs at
+#   96 kHz) and takes are stored at another (e.g. 48 kHz), without a pass
+#   over the file afterwards.  The streaming polyphase resampler
+#   (piRecordDSP.Resampler) keeps its filter state from block to block, so
+#   the blocks join seamlessly.  Capture periods are small, and numpy's
+#   per-call overhead is large next to the filtering of a few hundred
+#   frames, so periods are collected into blocks of blockFrames before each
+#   is filtered in one go.
+#
+#   Running this module measures the CPU the stage takes per channel (see
+#   __main__).
+###############################################################################
+
+import argparse
+import time
+import numpy
+import piRecordDSP
+import piRecordFormat
+
+###############################################################################
+# Class Name:
+#   CaptureResampler
+# Description:
+#   resamples stored samples: takes the captured blocks and returns the
+#   resampled frames ready so far, in the same sample format
+###############################################################################
+class CaptureResampler:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   designs the filter for the rate change
+    # Parameters:
+    #   inRate - the device's sample rate
+    #   outRate - the stored sample rate
+    #   nchannels - number of channels
+    #   sampWidth - stored sample width in bytes
+    #   fmtTag - stored format tag (PCM or IEEE float)
+    #   taps - filter length per phase (quality vs. CPU)
+    #   blockFrames - input frames collected before they are filtered
+    ###########################################################################
+    def __init__(self, inRate, outRate, nchannels, sampWidth, fmtTag, taps, blockFrames):
+        self.inRate = inRate
+        self.outRate = outRate
+        self.nchannels = nchannels
+        self.sampWidth = sampWidth
+        self.fmtTag = fmtTag
+        self.frameSize = nchannels * sampWidth
+        self.blockSize = blockFrames * self.frameSize
+        self.resampler = piRecordDSP.Resampler(inRate, outRate, nchannels, tapsPerPhase=taps)
+        self.pending = bytearray()
+        self.inFrames = 0
+        self.outFrames = 0
+        self.blocks = 0
+        self.cpuSecs = 0.0
+        self.maxBlockSecs = 0.0
+
+    ###########################################################################
+    # Method Name:
+    #   process
+    # Description:
+    #   adds captured samples, returning the resampled frames once a block
+    #   has been collected
+    # Parameters:
+    #   data - stored samples at the device rate
+    # Return value:
+    #   stored samples at the stored rate (empty while a block is collected)
+    ###########################################################################
+    def process(self, data):
+        self.pending += data
+        if len(self.pending) < self.blockSize:
+            return b''
+        return self.resample(False)
+
+    ###########################################################################
+    # Method Name:
+    #   flush
+    # Description:
+    #   ends the take, returning the collected frames and those still held
+    #   in the filter
+    # Parameters:
+    #   none
+    # Return value:
+    #   stored samples at the stored rate
+    ###########################################################################
+    def flush(self):
+        return self.resample(True)
+
+    ###########################################################################
+    # Method Name:
+    #   resample
+    # Description:
+    #   filters the collected frames
+    # Parameters:
+    #   last - True to also empty the filter at the end of the take
+    # Return value:
+    #   stored samples at the stored rate
+    ###########################################################################
+    def resample(self, last):
+        start = time.perf_counter()
+        size = len(self.pending) - len(self.pending) % self.frameSize
+        x = piRecordFormat.samplesToFloat(bytes(self.pending[:size]), self.sampWidth, self.fmtTag, self.nchannels)
+        del self.pending[:size]
+        y = self.resampler.process(x)
+        if last:
+            y = numpy.concatenate((y, self.resampler.flush()))
+        data = piRecordFormat.floatToSamples(y, self.sampWidth, self.fmtTag)
+        elapsed = time.perf_counter() - start
+        self.cpuSecs += elapsed
+        self.maxBlockSecs = max(self.maxBlockSecs, elapsed)
+        self.inFrames += len(x)
+        self.outFrames += len(y)
+        self.blocks += 1
+        return data
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns the stage's counters.  cpuPct is its time as a share of the
+    #   audio's, and cpuPctPerChannel that divided by the channels.
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters
+    ###########################################################################
+    def getStats(self):
+        audioSecs = self.inFrames / float(self.inRate)
+        cpuPct = 100.0 * self.cpuSecs / audioSecs if audioSecs else 0.0
+        return {"inRate": self.inRate, "outRate": self.outRate, "inFrames": self.inFrames, "outFrames": self.outFrames,
+                "blocks": self.blocks, "cpuPct": round(cpuPct, 3), "cpuPctPerChannel": round(cpuPct / self.nchannels, 3),
+                "maxBlockMs": round(1000.0 * self.maxBlockSecs, 3)}
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   measures the CPU the stage takes per channel, feeding it capture periods
+#   of 16 bit noise, e.g.
+#     python3 piRecordResample.py --in-rate 96000 --out-rate 48000 --channels 1,2,8
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the capture resampler")
+    parser.add_argument("--in-rate", type=int, default=96000, help="device rate")
+    parser.add_argument("--out-rate", type=int, default=48000, help="stored rate")
+    parser.add_argument("--channels", default="1,2,8", help="comma separated channel counts to measure")
+    parser.add_argument("--period", type=int, default=160, help="frames per capture period")
+    parser.add_argument("--block", type=int, default=1024, help="frames collected before filtering")
+    parser.add_argument("--taps", type=int, default=32, help="filter length per phase")
+    parser.add_argument("--seconds", type=float, default=10.0, help="seconds of audio per measurement")
+    args = parser.parse_args()
+
+    for nchannels in [int(c) for c in args.channels.split(",")]:
+        stage = CaptureResampler(args.in_rate, args.out_rate, nchannels, 2, piRecordFormat.WAVE_FORMAT_PCM,
+                                 args.taps, args.block)
+        period = numpy.random.randint(-8192, 8192, (args.period, nchannels)).astype('<i2').tobytes()
+        for i in range(int(args.seconds * args.in_rate / args.period)):
+            stage.process(period)
+        stage.flush()
+        stats = stage.getStats()
+        print ("%2d channels  %6.2f%% of a core  %6.2f%% per channel  slowest block %.2f ms" % (nchannels,
+               stats["cpuPct"], stats["cpuPctPerChannel"], stats["maxBlockMs"]))
@@ -0,0 +1,329 @@
+###############################################################################
+# piRecordScenario.py - Raspberry Pi audio recorder scenario runner module
+# Description:
+#   runs the recorder on simulated hardware (see piRecordSim) and drives it
+#   from a scenario script, measuring the end to end latencies a user sees.
+#   It runs on any Linux machine, so it can be used as a regression
+#   benchmark.  The recorder runs in a scratch directory with a copy of
+#   piRecord.cfg, and its recordings go to Recordings next to it.
+#
+#   A scenario has one step per line ('#' starts a comment):
+#     press BUTTON [HOLD]        press SEL/SELECT, UP, DOWN, LEFT or RIGHT and
+#                                release it HOLD seconds (0.1) later; the
+#                                next step starts straight away
+#     wait DURATION              wait, e.g. 30m, 10s, 1h or 0.5
+#     expect "TEXT" [TIMEOUT]    wait for the LCD to show TEXT; measures the
+#                                display update delay since the last press
+#                                (or since the recorder started)
+#     await recording [TIMEOUT]  wait for the take's first samples on disk;
+#                                measures press-to-record-start
+#     await finalized [TIMEOUT]  wait for the take to be closed; measures
+#                                press-to-stop-finalized
+###############################################################################
+
+import os
+
+# the simulated hardware must be selected before the first piRecord import
+os.environ["PIRECORD_SIM"] = "1"
+
+import argparse
+import configparser
+import json
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import piRecordSim
+
+DEFAULT_HOLD = 0.1
+DEFAULT_TIMEOUT = 10.0
+
+# records for 5 seconds, the default scenario
+DEFAULT_SCENARIO = """
+expect "Rt Btn to start" 10
+press RIGHT
+expect "Any Btn to stop" 2
+await recording 5
+wait 5s
+press SEL
+expect "Stopped." 2
+await finalized 10
+"""
+
+###############################################################################
+# Function Name:
+#   parseDuration
+# Description:
+#   converts a duration such as 30m, 10s, 1h or 0.5 to seconds
+# Parameters:
+#   text - the duration
+# Return value:
+#   seconds
+###############################################################################
+def parseDuration(text):
+    units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    for unit in ("ms", "s", "m", "h"):
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * units[unit]
+    return float(text)
+
+###############################################################################
+# Function Name:
+#   parseScenario
+# Description:
+#   splits a scenario into steps
+# Parameters:
+#   text - the scenario
+# Return value:
+#   list of (line number, list of words)
+###############################################################################
+def parseScenario(text):
+    steps = []
+    for num, line in enumerate(text.splitlines(), 1):
+        words = shlex.split(line, comments=True)
+        if words:
+            steps.append((num, words))
+    return steps
+
+###############################################################################
+# Class Name:
+#   ScenarioRunner
+# Description:
+#   starts the recorder on simulated hardware and runs scenarios against it
+###############################################################################
+class ScenarioRunner:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   sets up the scratch directory and starts the recorder's main loop in
+    #   a thread
+    # Parameters:
+    #   workDir - scratch directory
+    #   settings - dict of {(section, option): value} to change in the
+    #              scratch piRecord.cfg
+    ###########################################################################
+    def __init__(self, workDir, settings=None):
+        progDir = os.path.dirname(os.path.abspath(__file__))
+        runDir = os.path.join(workDir, "run")
+        self.recDir = os.path.join(workDir, "Recordings")
+        os.makedirs(runDir, exist_ok=True)
+        os.makedirs(self.recDir, exist_ok=True)
+        shutil.copy(os.path.join(progDir, "piRecord.cfg"), runDir)
+        os.chdir(runDir)
+        if settings:
+            config = configparser.RawConfigParser()
+            config.optionxform = str
+            config.read("piRecord.cfg")
+            for (section, option), value in settings.items():
+                config.set(section, option, str(value))
+            with open("piRecord.cfg", "w") as fd:
+                config.write(fd)
+
+        # imported here, once the working directory is set up
+        global piRecord, piRecordEngine, piRecordUtils, piRecordWave
+        import piRecord
+        import piRecordEngine
+        import piRecordUtils
+        import piRecordWave
+
+        self.lcd = piRecord.init_display()
+        self.lastPress = time.time()
+        self.measurements = {}
+        self.failures = 0
+        self.thread = threading.Thread(target=piRecord.main, daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   record
+    # Description:
+    #   stores a latency measurement
+    # Parameters:
+    #   name - the measurement name
+    #   value - the latency in seconds (None if the step timed out)
+    # Return value:
+    #   none
+    ###########################################################################
+    def record(self, name, value):
+        if value == None:
+            self.failures += 1
+            print ("  %-32s TIMEOUT" % name)
+        else:
+            self.measurements.setdefault(name, []).append(value)
+            print ("  %-32s %8.1f ms" % (name, value * 1000.0))
+
+    ###########################################################################
+    # Method Name:
+    #   waitFor
+    # Description:
+    #   polls a condition until it is true
+    # Parameters:
+    #   check - function returning True when the condition is met
+    #   timeout - most seconds to wait
+    # Return value:
+    #   the time the condition was seen, or None on a timeout
+    ###########################################################################
+    def waitFor(self, check, timeout):
+        endTime = time.time() + timeout
+        while time.time() < endTime:
+            if check():
+                return time.time()
+            time.sleep(0.001)
+        return None
+
+    ###########################################################################
+    # Method Name:
+    #   takeStarted
+    # Description:
+    #   checks whether the current take has samples on disk
+    # Parameters:
+    #   none
+    # Return value:
+    #   True if it has
+    ###########################################################################
+    def takeStarted(self):
+        if not piRecordUtils.isRecording():
+            return False
+        try:
+            fn = piRecordUtils.getCurrentFilename()
+            if not fn.endswith(".wav"):
+                return os.path.getsize(fn) > 0
+            reader = piRecordWave.WaveReader(fn)
+            nframes = reader.getnframes()
+            reader.close()
+            return nframes > 0
+        except (OSError, ValueError):
+            return False
+
+    ###########################################################################
+    # Method Name:
+    #   runStep
+    # Description:
+    #   runs one scenario step
+    # Parameters:
+    #   words - the step's words
+    # Return value:
+    #   none
+    ###########################################################################
+    def runStep(self, words):
+        cmd, args = words[0], words[1:]
+        if cmd == "press":
+            button = piRecordSim.BUTTON_NAMES[args[0].upper()]
+            hold = float(args[1]) if len(args) > 1 else DEFAULT_HOLD
+            self.lastPress = time.time()
+            self.lcd.press(button)
+            threading.Timer(hold, self.lcd.release, (button,)).start()
+        elif cmd == "wait":
+            time.sleep(parseDuration(args[0]))
+        elif cmd == "expect":
+            timeout = parseDuration(args[1]) if len(args) > 1 else DEFAULT_TIMEOUT
+            seen = self.lcd.waitForText(args[0], timeout, self.lastPress)
+            self.record("display \"%s\"" % args[0], None if seen == None else seen - self.lastPress)
+        elif cmd == "await" and args[0] in ("recording", "finalized"):
+            timeout = parseDuration(args[1]) if len(args) > 1 else DEFAULT_TIMEOUT
+            if args[0] == "recording":
+                seen = self.waitFor(self.takeStarted, timeout)
+                name = "press-to-record-start"
+            else:
+                seen = self.waitFor(lambda: not piRecordUtils.isRecording(), timeout)
+                name = "press-to-stop-finalized"
+            self.record(name, None if seen == None else seen - self.lastPress)
+        else:
+            raise ValueError("unknown step: %s" % " ".join(words))
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   runs a scenario
+    # Parameters:
+    #   steps - the parsed scenario
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self, steps):
+        for num, words in steps:
+            print ("%4d: %s" % (num, " ".join(words)))
+            self.runStep(words)
+
+    ###########################################################################
+    # Method Name:
+    #   summary
+    # Description:
+    #   returns the measurements with their minimum, mean and maximum
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of statistics by measurement name, in ms
+    ###########################################################################
+    def summary(self):
+        stats = {}
+        for name, values in self.measurements.items():
+            stats[name] = {"count": len(values), "minMs": 1000.0 * min(values),
+                           "meanMs": 1000.0 * sum(values) / len(values), "maxMs": 1000.0 * max(values)}
+        return stats
+
+    ###########################################################################
+    # Method Name:
+    #   stop
+    # Description:
+    #   stops the recorder's main loop and the engine
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def stop(self):
+        piRecord.running = False
+        self.thread.join(5.0)
+        piRecord.piRecordWatchdog.stop()
+        piRecordEngine.stop_process()
+        piRecord.piRecordLog.stop()
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   runs a scenario file (or the default scenario) and prints the latencies,
+#   e.g.
+#     python3 piRecordScenario.py --repeat 10 --json latency.json
+#   The exit status is 1 if any step timed out.
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run a scenario on simulated hardware")
+    parser.add_argument("scenario", nargs="?", help="scenario file (default: a 5 second take)")
+    parser.add_argument("--repeat", type=int, default=1, help="times to run the scenario")
+    parser.add_argument("--json", help="file to write the measurements to")
+    parser.add_argument("--workdir", help="scratch directory (default: a temporary one, removed afterwards)")
+    args = parser.parse_args()
+
+    text = DEFAULT_SCENARIO
+    if args.scenario:
+        with open(args.scenario) as fd:
+            text = fd.read()
+    steps = parseScenario(text)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    workDir = args.workdir or tempfile.mkdtemp(prefix="piRecordSim")
+    runner = ScenarioRunner(workDir)
+    try:
+        for i in range(args.repeat):
+            runner.run(steps)
+    finally:
+        runner.stop()
+        if not args.workdir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    print ("\n%-32s %6s %10s %10s %10s" % ("measurement", "count", "min ms", "mean ms", "max ms"))
+    stats = runner.summary()
+    for name, s in stats.items():
+        print ("%-32s %6d %10.1f %10.1f %10.1f" % (name, s["count"], s["minMs"], s["meanMs"], s["maxMs"]))
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump({"measurements": stats, "failures": runner.failures}, fd, indent=1)
+    sys.exit(1 if runner.failures else 0)
@@ -0,0 +1,459 @@
+###############################################################################
+# piRecordSim.py - Raspberry Pi audio recorder simulated hardware module
+# Description:
+#   simulated replacements for the ALSA library and the LCD/keypad plate,
+#   with the same interface as the parts of alsaaudio and Adafruit_CharLCD
+#   the recorder uses (see piRecordHardware).
+#
+#   The simulated capture device delivers a period of samples whenever the
+#   wall clock says one is due, at PIRECORD_SIM_SPEED times real time.  The
+#   samples follow a fixed pattern of the frame number that encodes the
+#   frame number itself, so a recording can be checked sample for sample
+#   against generateBlock() (see piRecordSoak).  If the reader falls more
+#   than a buffer behind, the device overruns like a real one.  A second
+#   card, Sim2, has a clock PIRECORD_SIM_DRIFT_PPM fast (see piRecordMulti).
+#   Like a real card, a device only runs at SIM_RATES and with up to
+#   SIM_MAX_CHANNELS channels, and is set to the nearest it can do.
+#
+#   A playback device opened non-blocking plays from a buffer of
+#   BUFFER_PERIODS periods, and underruns if it isn't kept fed.  If
+#   PIRECORD_SIM_LOOPBACK is set, its output is wired back to the capture
+#   device, which then hears what it played that many frames later instead
+#   of the pattern (see piRecordOverdub).
+#
+#   The simulated LCD keeps the screen contents and the time of each
+#   update, and its keypad is pressed and released by a scenario script.
+###############################################################################
+
+import collections
+import errno
+import os
+import threading
+import time
+
+# speed of the simulated clock relative to real time
+speed = float(os.environ.get("PIRECORD_SIM_SPEED", "1"))
+
+# clock error of the second simulated card (Sim2) in parts per million, to
+# test capture from two devices with independent clocks
+drift = float(os.environ.get("PIRECORD_SIM_DRIFT_PPM", "50"))
+
+# frames between a sample being played and it being captured by the
+# simulated loopback cable (None = no cable)
+loopbackLatency = os.environ.get("PIRECORD_SIM_LOOPBACK")
+loopbackLatency = int(loopbackLatency) if loopbackLatency else None
+
+# what the last non-blocking playback device played: the time it started,
+# its frame size and the samples written to it
+loopback = None
+
+# generator frame offset between channels
+CHANNEL_OFFSET = 1 << 30
+
+# periods held by the simulated capture (or playback) buffer before it
+# overruns (or underruns)
+BUFFER_PERIODS = 32
+
+# rates and most channels the simulated devices can run at
+SIM_RATES = (8000, 11025, 16000, 22050, 32000, 44100, 48000, 96000)
+SIM_MAX_CHANNELS = 8
+
+# screen updates kept by the simulated LCD for waitForText
+LCD_HISTORY = 256
+
+###############################################################################
+# alsaaudio interface
+###############################################################################
+PCM_PLAYBACK = 0
+PCM_CAPTURE = 1
+PCM_NORMAL = 0
+PCM_NONBLOCK = 1
+
+PCM_FORMAT_S8 = 0
+PCM_FORMAT_U8 = 1
+PCM_FORMAT_S16_LE = 2
+PCM_FORMAT_S16_BE = 3
+PCM_FORMAT_U16_LE = 4
+PCM_FORMAT_U16_BE = 5
+PCM_FORMAT_S24_LE = 6
+PCM_FORMAT_S24_BE = 7
+PCM_FORMAT_U24_LE = 8
+PCM_FORMAT_U24_BE = 9
+PCM_FORMAT_S32_LE = 10
+PCM_FORMAT_S32_BE = 11
+PCM_FORMAT_U32_LE = 12
+PCM_FORMAT_U32_BE = 13
+PCM_FORMAT_FLOAT_LE = 14
+PCM_FORMAT_FLOAT_BE = 15
+PCM_FORMAT_FLOAT64_LE = 16
+PCM_FORMAT_FLOAT64_BE = 17
+PCM_FORMAT_S24_3LE = 32
+PCM_FORMAT_S24_3BE = 33
+
+class ALSAAudioError(Exception):
+    pass
+
+def pcms(pcmtype=PCM_PLAYBACK):
+    return ["null", "default", "sysdefault:CARD=Sim", "sysdefault:CARD=Sim2"]
+
+def cards():
+    return ["Sim", "Sim2"]
+
+###############################################################################
+# Function Name:
+#   generateBlock
+# Description:
+#   generates the simulated capture samples for a range of frames.  Each
+#   sample is a fixed function of its frame and channel number.  The top 8
+#   bits of a channel 0 sample hold the frame number modulo 16 and one 4 bit
+#   digit of the rest of the frame number, so findStartFrame() can tell
+#   where a recording starts; the bit below them is always 0 so they
+#   survive conversion to float, and the remaining bits are pseudo random.
+# Parameters:
+#   fmt - the ALSA format constant
+#   start - number of the first frame
+#   nframes - number of frames
+#   nchannels - number of channels
+# Return value:
+#   the samples in the given format
+###############################################################################
+def generateBlock(fmt, start, nframes, nchannels):
+    # imported here, as piRecordFormat imports this module (as alsaaudio), and
+    # so the UI doesn't load numpy (as with the real hardware)
+    import numpy
+    import piRecordFormat
+    width, bits, signed, bigEndian, isFloat = piRecordFormat.getCaptureFormat(fmt)
+    valid = 24 if isFloat else min(bits, 32)
+    frames = numpy.arange(start, start + nframes, dtype=numpy.uint64)[:, numpy.newaxis]
+    f = frames + numpy.arange(nchannels, dtype=numpy.uint64)[numpy.newaxis, :] * numpy.uint64(CHANNEL_OFFSET)
+
+    top = ((f & numpy.uint64(15)) << numpy.uint64(4)) | ((f >> (numpy.uint64(4) + numpy.uint64(4) * (f & numpy.uint64(7)))) & numpy.uint64(15))
+    u = top << numpy.uint64(valid - 8)
+    if valid > 9:
+        u |= ((f * numpy.uint64(0x9E3779B1)) & numpy.uint64(0xFFFFFFFF)) >> numpy.uint64(32 - (valid - 9))
+
+    order = '>' if bigEndian else '<'
+    value = u.astype(numpy.int64) - (1 << (valid - 1))
+    if isFloat:
+        return (value / float(1 << (valid - 1))).astype(order + 'f%d' % width).tobytes()
+    if not signed:
+        value = u.astype(numpy.int64)
+    if width == 3:
+        packed = value.astype(order + ('i4' if signed else 'u4')).view(numpy.uint8).reshape(-1, 4)
+        return (packed[:, 1:] if bigEndian else packed[:, :3]).tobytes()
+    return value.astype(order + ('i' if signed else 'u') + str(width)).tobytes()
+
+###############################################################################
+# Function Name:
+#   findStartFrame
+# Description:
+#   recovers the generator frame number of the first sample of a recording
+#   from channel 0 of its first frames (see generateBlock)
+# Parameters:
+#   x - channel 0 samples as floats in [-1.0, 1.0), at least 24 of them
+# Return value:
+#   the frame number, or None if the samples don't follow the pattern
+###############################################################################
+def findStartFrame(x):
+    import numpy
+    top = numpy.clip(numpy.floor((numpy.asarray(x, dtype=numpy.float64) + 1.0) * 128.0), 0, 255).astype(numpy.int64)
+    starts = numpy.nonzero((top[:len(top) - 7] >> 4) == 0)[0]
+    if len(starts) == 0:
+        return None
+    i = int(starts[0])
+    digits = sum(int(top[i + j] & 15) << (4 * j) for j in range(8))
+    start = digits * 16 - i
+    if start < 0 or numpy.any((top >> 4) != (start + numpy.arange(len(top))) % 16):
+        return None
+    return start
+
+###############################################################################
+# Class Name:
+#   PCM
+# Description:
+#   a simulated ALSA capture or playback device
+###############################################################################
+class PCM:
+
+    def __init__(self, type=PCM_PLAYBACK, mode=PCM_NORMAL, device='default', **kwargs):
+        self.type = type
+        self.mode = mode
+        self.device = device
+        self.channels = 2
+        self.rate = 44100
+        self.format = PCM_FORMAT_S16_LE
+        self.periodsize = 32
+        self.framesRead = 0
+        self.framesWritten = 0
+        self.xruns = 0
+        self.startTime = None
+        self.clock = speed * (1.0 + drift * 1e-6) if device.endswith("CARD=Sim2") else speed
+
+    def setchannels(self, channels):
+        self.channels = max(1, min(channels, SIM_MAX_CHANNELS))
+        return self.channels
+
+    def setrate(self, rate):
+        self.rate = min(SIM_RATES, key=lambda r: abs(r - rate))
+        return self.rate
+
+    def setformat(self, format):
+        self.format = format
+        return format
+
+    def setperiodsize(self, periodsize):
+        self.periodsize = periodsize
+        return periodsize
+
+    def pcmtype(self):
+        return self.type
+
+    def cardname(self):
+        return self.device
+
+    ###########################################################################
+    # Method Name:
+    #   available
+    # Description:
+    #   returns the number of captured frames waiting to be read.  The
+    #   simulated clock starts with the first read.
+    # Parameters:
+    #   none
+    # Return value:
+    #   the number of frames
+    ###########################################################################
+    def available(self):
+        if self.startTime == None:
+            self.startTime = time.time()
+        return int((time.time() - self.startTime) * self.rate * self.clock) - self.framesRead
+
+    ###########################################################################
+    # Method Name:
+    #   read
+    # Description:
+    #   reads a period of samples.  In non-blocking mode, returns no data if a
+    #   period isn't ready yet.  If the reader has fallen more than the
+    #   buffer behind, the frames missed are skipped and -EPIPE is returned
+    #   as ALSA does after an overrun.
+    # Parameters:
+    #   none
+    # Return value:
+    #   tuple of (frames read, data)
+    ###########################################################################
+    def read(self):
+        avail = self.available()
+        if avail > BUFFER_PERIODS * self.periodsize:
+            self.framesRead += avail
+            self.xruns += 1
+            return -errno.EPIPE, b''
+        if avail < self.periodsize:
+            if self.mode == PCM_NONBLOCK:
+                return 0, b''
+            time.sleep((self.periodsize - avail) / float(self.rate * self.clock))
+        if loopback != None and loopbackLatency != None:
+            data = self.hearLoopback(self.framesRead, self.periodsize)
+        else:
+            data = generateBlock(self.format, self.framesRead, self.periodsize, self.channels)
+        self.framesRead += self.periodsize
+        return self.periodsize, data
+
+    ###########################################################################
+    # Method Name:
+    #   hearLoopback
+    # Description:
+    #   returns the captured frames the loopback cable carries: what the
+    #   playback device played loopbackLatency frames before each was
+    #   captured, and silence before it started and after it ran out.  The
+    #   samples are copied as they are, so only a device in the same format
+    #   is heard.
+    # Parameters:
+    #   start - number of the first frame
+    #   nframes - number of frames
+    # Return value:
+    #   the samples
+    ###########################################################################
+    def hearLoopback(self, start, nframes):
+        import piRecordFormat
+        frameSize = piRecordFormat.getCaptureFormat(self.format)[0] * self.channels
+        out = bytearray(nframes * frameSize)
+        if loopback["frameSize"] != frameSize:
+            return bytes(out)
+        first = start - loopbackLatency - int(round((loopback["start"] - self.startTime) * self.rate * self.clock))
+        data = loopback["data"]
+        lo = max(0, -first)
+        hi = min(nframes, len(data) // frameSize - first)
+        if hi > lo:
+            out[lo * frameSize:hi * frameSize] = data[(first + lo) * frameSize:(first + hi) * frameSize]
+        return bytes(out)
+
+    ###########################################################################
+    # Method Name:
+    #   write
+    # Description:
+    #   "plays" samples.  In blocking mode, takes as long as they would take
+    #   to play.  In non-blocking mode, adds as many as there is room for to
+    #   the buffer, which starts playing with the first write; if it has run
+    #   dry, the device is restarted and -EPIPE returned as ALSA does after
+    #   an underrun.
+    # Parameters:
+    #   data - the samples
+    # Return value:
+    #   the number of frames written
+    ###########################################################################
+    def write(self, data):
+        global loopback
+        import piRecordFormat
+        frameSize = piRecordFormat.getCaptureFormat(self.format)[0] * self.channels
+        nframes = len(data) // frameSize
+        if self.mode != PCM_NONBLOCK:
+            time.sleep(nframes / float(self.rate * speed))
+            return nframes
+        now = time.time()
+        if self.startTime != None:
+            played = int((now - self.startTime) * self.rate * speed)
+            if played > self.framesWritten:
+                self.startTime = None
+                self.xruns += 1
+                return -errno.EPIPE
+        if self.startTime == None:
+            self.startTime = now
+            self.framesWritten = 0
+            loopback = {"start": now, "frameSize": frameSize, "data": bytearray()}
+            played = 0
+        nframes = min(nframes, BUFFER_PERIODS * self.periodsize - (self.framesWritten - played))
+        if nframes <= 0:
+            return 0
+        self.framesWritten += nframes
+        loopback["data"] += data[:nframes * frameSize]
+        return nframes
+
+    def close(self):
+        pass
+
+###############################################################################
+# Adafruit_CharLCD interface
+###############################################################################
+SELECT = 0
+RIGHT = 1
+DOWN = 2
+UP = 3
+LEFT = 4
+
+BUTTON_NAMES = {"SELECT": SELECT, "SEL": SELECT, "RIGHT": RIGHT, "DOWN": DOWN, "UP": UP, "LEFT": LEFT}
+
+LCD_COLUMNS = 16
+LCD_ROWS = 2
+
+###############################################################################
+# Class Name:
+#   Adafruit_CharLCDPlate
+# Description:
+#   a simulated 16x2 LCD and keypad plate.  Text written past the end of a
+#   line is lost, as on the real display.  Every change to the screen is
+#   time stamped and kept, so waitForText() sees text that was only shown
+#   briefly.
+###############################################################################
+class Adafruit_CharLCDPlate:
+
+    def __init__(self, *args, **kwargs):
+        self.rows = [[" "] * LCD_COLUMNS for row in range(LCD_ROWS)]
+        self.col = 0
+        self.row = 0
+        self.color = (0, 0, 0)
+        self.chars = {}
+        self.pressed = set()
+        self.history = collections.deque(maxlen=LCD_HISTORY)
+        self.changed = threading.Condition()
+
+    ###########################################################################
+    # Method Name:
+    #   updated
+    # Description:
+    #   records a change to the screen
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def updated(self):
+        with self.changed:
+            self.history.append((time.time(), self.getText()))
+            self.changed.notify_all()
+
+    def clear(self):
+        self.rows = [[" "] * LCD_COLUMNS for row in range(LCD_ROWS)]
+        self.col = 0
+        self.row = 0
+        self.updated()
+
+    def set_cursor(self, col, row):
+        self.col = col
+        self.row = min(row, LCD_ROWS - 1)
+
+    def message(self, text):
+        for char in text:
+            if char == '\n':
+                self.col = 0
+                self.row = min(self.row + 1, LCD_ROWS - 1)
+            else:
+                if self.col < LCD_COLUMNS:
+                    self.rows[self.row][self.col] = char
+                self.col += 1
+        self.updated()
+
+    def set_color(self, red, green, blue):
+        self.color = (red, green, blue)
+        self.updated()
+
+    def set_backlight(self, backlight):
+        self.set_color(backlight, backlight, backlight)
+
+    def create_char(self, location, pattern):
+        self.chars[location] = list(pattern)
+
+    def is_pressed(self, button):
+        return button in self.pressed
+
+    def press(self, button):
+        self.pressed.add(button)
+
+    def release(self, button):
+        self.pressed.discard(button)
+
+    ###########################################################################
+    # Method Name:
+    #   getText
+    # Description:
+    #   returns the screen contents, custom characters shown as their number
+    # Parameters:
+    #   none
+    # Return value:
+    #   the lines of the screen joined with newlines
+    ###########################################################################
+    def getText(self):
+        return "\n".join("".join(c if ord(c) >= 32 else str(ord(c)) for c in row) for row in self.rows)
+
+    ###########################################################################
+    # Method Name:
+    #   waitForText
+    # Description:
+    #   waits for the screen to show some text
+    # Parameters:
+    #   text - the text to wait for (within one line)
+    #   timeout - most seconds to wait
+    #   since - only accept the text if the screen was updated after this
+    # Return value:
+    #   the time of the first update that showed the text, or None on a
+    #   timeout
+    ###########################################################################
+    def waitForText(self, text, timeout, since=0.0):
+        endTime = time.time() + timeout
+        with self.changed:
+            while True:
+                for updateTime, screen in self.history:
+                    if updateTime >= since and text in screen:
+                        return updateTime
+                remaining = endTime - time.time()
+                if remaining <= 0.0:
+                    return None
+                self.changed.wait(remaining)
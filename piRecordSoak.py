@@ -0,0 +1,313 @@
+###############################################################################
+# piRecordSoak.py - Raspberry Pi audio recorder soak test module
+# Description:
+#   runs the full record path on simulated hardware (see piRecordScenario)
+#   for many simulated hours, faster than real time, to find the leaks and
+#   slowdowns that only show up a few hours into a gig.
+#
+#   While each take records, the memory use (RSS) and open file count of the
+#   UI and engine processes, the depths of the engine's queues (safety copy,
+#   live loudness meter and pipeline, from its telemetry), the log records
+#   dropped and its file write time are sampled.  Each finished take is then
+#   checked sample for sample against the simulated capture pattern, and
+#   deleted unless it is kept.
+#   The test fails if any take doesn't match, the capture device overran,
+#   or any of the sampled values grew between the first and last third of
+#   the run by more than its allowance.
+###############################################################################
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+import piRecordScenario
+import piRecordSim
+
+# capture period used for the soak, large enough for the engine loop to keep
+# up at the accelerated clock
+SOAK_PERIOD_SIZE = 4096
+
+# real seconds between samples
+SAMPLE_PERIOD = 1.0
+
+# fraction of the samples ignored at the start while buffers fill
+WARMUP_FRACTION = 0.1
+
+# growth allowed between the first and last third of the run
+GROWTH_LIMITS = {"uiRssMB": 4.0, "engineRssMB": 4.0, "uiFds": 0, "engineFds": 0,
+                 "safetyQueue": 8, "loudnessQueue": 8, "pipelineLagMs": 100.0, "logDropped": 0,
+                 "writeMs": 1.0}
+
+# frames compared at a time when verifying a take
+VERIFY_FRAMES = 65536
+
+###############################################################################
+# Function Name:
+#   getProcessUsage
+# Description:
+#   reads the resident memory and open file count of a process from /proc
+# Parameters:
+#   pid - the process id
+# Return value:
+#   tuple of (RSS in MB, open files), None for anything not readable
+###############################################################################
+def getProcessUsage(pid):
+    try:
+        fds = len(os.listdir("/proc/%d/fd" % pid))
+    except OSError:
+        fds = None
+    return piRecordUtils.getProcessRss(pid), fds
+
+###############################################################################
+# Function Name:
+#   verifyTake
+# Description:
+#   checks a recorded wave file sample for sample against the simulated
+#   capture pattern.  The pattern's frame number at the start of the take is
+#   read from the take itself (see piRecordSim.findStartFrame).
+# Parameters:
+#   filename - the wave file
+#   fmt - the ALSA capture format it was recorded with
+#   floatStorage - whether 24/32 bit samples were stored as float
+# Return value:
+#   tuple of (frames checked, first mismatching frame or None)
+###############################################################################
+def verifyTake(filename, fmt, floatStorage):
+    import piRecordFormat
+    import piRecordWave
+    convert = piRecordFormat.getConverter(fmt, floatStorage)[0]
+    reader = piRecordWave.WaveReader(filename)
+    try:
+        nframes = reader.getnframes()
+        nchannels = reader.getnchannels()
+        frameSize = nchannels * reader.getsampwidth()
+        head = reader.readframes(min(nframes, 64))
+        x = piRecordFormat.samplesToFloat(head, reader.getsampwidth(), reader.getformattag(), nchannels)
+        start = piRecordSim.findStartFrame(x[:, 0]) if len(x) >= 24 else None
+        if start == None:
+            return 0, 0
+        reader.setpos(0)
+        pos = 0
+        while pos < nframes:
+            n = min(VERIFY_FRAMES, nframes - pos)
+            data = reader.readframes(n)
+            expected = convert(piRecordSim.generateBlock(fmt, start + pos, n, nchannels))
+            if data != expected:
+                diff = numpy.nonzero(numpy.frombuffer(data, numpy.uint8) != numpy.frombuffer(expected, numpy.uint8)[:len(data)])[0]
+                return pos, pos + (int(diff[0]) if len(diff) else len(data)) // frameSize
+            pos += n
+        return nframes, None
+    finally:
+        reader.close()
+
+###############################################################################
+# Function Name:
+#   checkTrend
+# Description:
+#   measures how much a sampled value grew over the run, ignoring the warm
+#   up: the median of the last third of the samples less the median of the
+#   first third.  Growth only counts if a straight line fitted to the samples
+#   slopes upward by at least as much, so a single step (e.g. a buffer
+#   allocated late) isn't mistaken for a leak.
+# Parameters:
+#   values - the samples in time order (None entries are skipped)
+# Return value:
+#   the growth (0.0 if there are too few samples)
+###############################################################################
+def checkTrend(values):
+    values = [v for v in values[int(len(values) * WARMUP_FRACTION):] if v != None]
+    third = len(values) // 3
+    if third < 2:
+        return 0.0
+    growth = float(numpy.median(values[-third:]) - numpy.median(values[:third]))
+    slope = numpy.polyfit(numpy.arange(len(values)), values, 1)[0]
+    return min(growth, float(slope) * len(values))
+
+###############################################################################
+# Class Name:
+#   SoakRunner
+# Description:
+#   runs takes on the simulated recorder and samples its resource use
+###############################################################################
+class SoakRunner(piRecordScenario.ScenarioRunner):
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   starts the recorder with the soak settings: wave files, a safety copy
+    #   in the scratch directory and a capture period large enough for the
+    #   accelerated clock
+    # Parameters:
+    #   workDir - scratch directory
+    #   speed - simulated clock speed relative to real time
+    #   keep - True to keep the takes after they are verified
+    ###########################################################################
+    def __init__(self, workDir, speed, keep):
+        # set before the engine process is started, so it runs at this speed
+        os.environ["PIRECORD_SIM_SPEED"] = str(speed)
+        piRecordSim.speed = speed
+        piRecordScenario.ScenarioRunner.__init__(self, workDir, {
+            ("recDevice", "periodSize"): SOAK_PERIOD_SIZE,
+            ("compression", "enabled"): False,
+            ("safety", "enabled"): True,
+            ("safety", "dir"): os.path.join(os.path.abspath(workDir), "Safety")})
+        global piRecordConf, piRecordEngine, piRecordLog, piRecordTelemetry, piRecordUtils
+        import piRecordConf
+        import piRecordEngine
+        import piRecordLog
+        import piRecordTelemetry
+        import piRecordUtils
+        self.keep = keep
+        self.samples = []
+        self.takes = []
+        self.lastWrite = None
+
+    ###########################################################################
+    # Method Name:
+    #   sample
+    # Description:
+    #   samples the resource use of both processes, the engine's queue depths
+    #   and dropped log records (None if a queue isn't in use) and its mean
+    #   write time since the last sample
+    # Parameters:
+    #   filename - the take being recorded
+    # Return value:
+    #   none
+    ###########################################################################
+    def sample(self, filename):
+        telemetry = piRecordTelemetry.read()
+        engine = telemetry.get("engine", {})
+        writeMs = None
+        blocks, secs = engine.get("dataBlocks", 0), engine.get("writeSecs", 0.0)
+        if self.lastWrite != None and self.lastWrite[0] == filename and blocks > self.lastWrite[1]:
+            writeMs = 1000.0 * (secs - self.lastWrite[2]) / (blocks - self.lastWrite[1])
+        self.lastWrite = (filename, blocks, secs)
+
+        uiRss, uiFds = getProcessUsage(os.getpid())
+        engineRss, engineFds = getProcessUsage(piRecordEngine.pEngine.pid)
+        safety = telemetry.get("safety")
+        loudness = telemetry.get("loudness")
+        pipeline = telemetry.get("pipeline")
+        self.samples.append({"time": time.time(), "uiRssMB": uiRss, "engineRssMB": engineRss,
+                             "uiFds": uiFds, "engineFds": engineFds,
+                             "safetyQueue": sum(t["queuedBlocks"] for t in safety) if safety else None,
+                             "loudnessQueue": loudness["queuedBlocks"] if loudness else None,
+                             "pipelineLagMs": max(s["lagMs"] for s in pipeline.values()) if pipeline else None,
+                             "logDropped": telemetry.get("log", {}).get("dropped", 0) + piRecordLog.stats["dropped"],
+                             "writeMs": writeMs})
+
+    ###########################################################################
+    # Method Name:
+    #   runTake
+    # Description:
+    #   records a take of the given (simulated) length while sampling, then
+    #   verifies it
+    # Parameters:
+    #   seconds - simulated length of the take
+    # Return value:
+    #   dict describing the take
+    ###########################################################################
+    def runTake(self, seconds):
+        self.runStep(["expect", "Rt Btn to start", "10"])
+        self.runStep(["press", "RIGHT"])
+        self.runStep(["await", "recording", "10"])
+        filename = piRecordUtils.getCurrentFilename()
+        xruns = piRecordTelemetry.read().get("realtime", {}).get("xruns", 0)
+
+        endTime = time.time() + seconds / piRecordSim.speed
+        while time.time() < endTime:
+            time.sleep(min(SAMPLE_PERIOD, max(0.0, endTime - time.time())))
+            self.sample(filename)
+            xruns = piRecordTelemetry.read().get("realtime", {}).get("xruns", xruns)
+
+        self.runStep(["press", "SEL"])
+        self.runStep(["await", "finalized", "30"])
+        checked, mismatch = verifyTake(filename, piRecordConf.recFormat, piRecordConf.floatStorage)
+        take = {"file": os.path.basename(filename), "frames": checked, "mismatchFrame": mismatch, "xruns": xruns}
+        self.takes.append(take)
+        if mismatch == None and xruns == 0:
+            print ("  take %s: %d frames verified" % (take["file"], checked))
+            if not self.keep:
+                os.remove(filename)
+                safety = os.path.join(piRecordConf.safetyDir, os.path.basename(filename))
+                if os.path.exists(safety):
+                    os.remove(safety)
+        else:
+            print ("  take %s: MISMATCH at frame %s, %d xruns" % (take["file"], mismatch, xruns))
+        return take
+
+    ###########################################################################
+    # Method Name:
+    #   report
+    # Description:
+    #   checks the takes and the sampled values for failures
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict with the growth of each sampled value and a list of failures
+    ###########################################################################
+    def report(self):
+        failures = []
+        for take in self.takes:
+            if take["mismatchFrame"] != None:
+                failures.append("%s differs from the capture pattern at frame %d" % (take["file"], take["mismatchFrame"]))
+            if take["xruns"]:
+                failures.append("%s had %d capture overruns" % (take["file"], take["xruns"]))
+        growth = {}
+        for name, limit in GROWTH_LIMITS.items():
+            growth[name] = checkTrend([s[name] for s in self.samples])
+            if growth[name] > limit:
+                failures.append("%s grew by %.3f (limit %s)" % (name, growth[name], limit))
+        if self.failures:
+            failures.append("%d scenario steps timed out" % self.failures)
+        return {"growth": growth, "failures": failures}
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   runs the soak test and prints the result, e.g.
+#     python3 piRecordSoak.py --hours 8 --take-minutes 60 --speed 40
+#   The exit status is 1 if it failed.
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="soak test the record path on simulated hardware")
+    parser.add_argument("--hours", type=float, default=4.0, help="simulated hours to record")
+    parser.add_argument("--take-minutes", type=float, default=30.0, help="simulated length of each take")
+    parser.add_argument("--speed", type=float, default=20.0, help="simulated clock speed relative to real time")
+    parser.add_argument("--keep", action="store_true", help="keep the takes")
+    parser.add_argument("--json", help="file to write the samples and result to")
+    parser.add_argument("--workdir", help="scratch directory (default: a temporary one, removed afterwards)")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    workDir = args.workdir or tempfile.mkdtemp(prefix="piRecordSoak")
+    runner = SoakRunner(workDir, args.speed, args.keep)
+    remaining = args.hours * 3600.0
+    try:
+        while remaining > 0.0:
+            take = min(remaining, args.take_minutes * 60.0)
+            runner.runTake(take)
+            remaining -= take
+    finally:
+        runner.stop()
+        if not args.workdir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    result = runner.report()
+    print ("\n%-14s %10s %10s" % ("value", "growth", "limit"))
+    for name, value in result["growth"].items():
+        print ("%-14s %10.3f %10s" % (name, value, GROWTH_LIMITS[name]))
+    for failure in result["failures"]:
+        print ("FAIL:", failure)
+    print ("PASS" if not result["failures"] else "FAIL")
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump({"takes": runner.takes, "samples": runner.samples, "result": result}, fd, indent=1)
+    sys.exit(1 if result["failures"] else 0)
@@ -0,0 +1,389 @@
+###############################################################################
+# piRecordSpectrum.py - Raspberry Pi audio recorder spectrum/tuner module
+# Description:
+#   analyzes the captured audio for the spectrum and tuner displays.  The
+#   engine hands each captured block to the Analyzer, which queues it without
+#   any processing; the analyzer thread mixes the blocks to mono, decimates
+#   them and runs a windowed FFT at no more than the configured rate.  The
+#   time the thread spends is measured, and the analysis rate is lowered so
+#   it never uses more than the configured share of the CPU.  Blocks that
+#   arrive while the queue is full are dropped, so the capture loop never
+#   waits for the analysis.
+#
+#   The results are kept in a shared array the UI process reads, and are
+#   rendered here as two 16 character LCD lines: a 16 band bar graph using
+#   custom characters, or a note name and cents readout.
+###############################################################################
+
+import math
+import os
+import queue
+import threading
+import time
+
+# numpy and the modules using it are imported by the Analyzer, so the UI can
+# use the result layout and the renderers without loading them
+numpy = None
+piRecordDSP = None
+piRecordFormat = None
+
+# number of spectrum bands (one per LCD column)
+NUM_BANDS = 16
+
+# frequency range of the spectrum bands
+BAND_LOW = 40.0
+BAND_HIGH = 12000.0
+
+# levels shown by the bar graph, in dBFS
+BAR_FLOOR = -60.0
+BAR_CEILING = 0.0
+
+# the decimated analysis rate is at least this
+MIN_ANALYSIS_RATE = 16000
+
+# tuner range and the quietest signal it tries to name
+TUNER_LOW = 30.0
+TUNER_HIGH = 2000.0
+TUNER_MIN_LEVEL = -50.0
+
+# harmonics used by the harmonic product spectrum, and the floor (relative
+# to the peak) under the magnitudes multiplied, so a harmonic that is missing
+# (as with a pure tone) doesn't outweigh the ones that are there
+TUNER_HARMONICS = 3
+TUNER_FLOOR = 1e-3
+
+# blocks queued before blocks are dropped
+MAX_QUEUED_BLOCKS = 64
+
+# layout of the shared result array
+RESULT_SEQ = 0
+RESULT_FREQ = 1
+RESULT_LEVEL = 2
+RESULT_BANDS = 3
+RESULT_SIZE = RESULT_BANDS + NUM_BANDS
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+###############################################################################
+# Class Name:
+#   Analyzer
+# Description:
+#   the analysis thread (see the module description)
+###############################################################################
+class Analyzer:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   sets up the decimator and FFT and starts the thread
+    # Parameters:
+    #   rate - sample rate
+    #   nchannels - number of channels
+    #   sampWidth - stored sample width in bytes
+    #   fmtTag - wave format tag of the stored samples
+    #   result - shared array of RESULT_SIZE doubles the results are put in
+    #   maxRate - most analyses per second
+    #   cpuCap - largest share of one CPU the thread may use (0.05 = 5%)
+    #   fftSize - FFT length at the decimated rate
+    ###########################################################################
+    def __init__(self, rate, nchannels, sampWidth, fmtTag, result, maxRate, cpuCap, fftSize):
+        global numpy, piRecordDSP, piRecordFormat
+        import numpy
+        import piRecordDSP
+        import piRecordFormat
+        self.format = (sampWidth, fmtTag, nchannels)
+        self.result = result
+        self.minPeriod = 1.0 / maxRate
+        self.cpuCap = cpuCap
+        self.factor = max(1, rate // MIN_ANALYSIS_RATE)
+        self.rate = rate // self.factor
+        self.decimator = None
+        if self.factor > 1:
+            self.decimator = piRecordDSP.Resampler(rate, self.rate, 1, tapsPerPhase=16)
+        self.fftSize = fftSize
+        self.window = numpy.hanning(fftSize).astype(numpy.float32)
+        self.history = numpy.zeros(fftSize, dtype=numpy.float32)
+        self.freqs = numpy.fft.rfftfreq(fftSize, 1.0 / self.rate)
+
+        # band edges, log spaced up to the decimated Nyquist frequency
+        high = min(BAND_HIGH, self.rate / 2.0)
+        edges = BAND_LOW * (high / BAND_LOW) ** (numpy.arange(NUM_BANDS + 1) / float(NUM_BANDS))
+        self.bandBins = [(int(numpy.searchsorted(self.freqs, lo)), max(int(numpy.searchsorted(self.freqs, hi)),
+                          int(numpy.searchsorted(self.freqs, lo)) + 1)) for lo, hi in zip(edges[:-1], edges[1:])]
+
+        self.blocks = queue.Queue(maxsize=MAX_QUEUED_BLOCKS)
+        self.droppedBlocks = 0
+        self.analyses = 0
+        self.busyTime = 0.0
+        self.startTime = time.time()
+        self.lastCost = 0.0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   feed
+    # Description:
+    #   queues a captured block without ever waiting; the block is dropped if
+    #   the thread is behind
+    # Parameters:
+    #   data - block of stored samples
+    # Return value:
+    #   none
+    ###########################################################################
+    def feed(self, data):
+        try:
+            self.blocks.put_nowait(data)
+        except queue.Full:
+            self.droppedBlocks += 1
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   the analysis thread: takes in the queued blocks, then analyzes the
+    #   latest audio and sleeps until the next analysis is due.  The period
+    #   is stretched so the time spent stays under the CPU cap.
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        nextTime = time.time()
+        while True:
+            cpuStart = time.thread_time()
+            while True:
+                try:
+                    data = self.blocks.get_nowait()
+                except queue.Empty:
+                    break
+                if data is None:
+                    return
+                self.addBlock(data)
+            self.analyze()
+            cost = time.thread_time() - cpuStart
+            self.busyTime += cost
+            self.lastCost = cost
+
+            nextTime = max(nextTime + max(self.minPeriod, cost / self.cpuCap), time.time())
+            time.sleep(nextTime - time.time())
+
+    ###########################################################################
+    # Method Name:
+    #   addBlock
+    # Description:
+    #   mixes a block to mono, decimates it and appends it to the history
+    # Parameters:
+    #   data - block of stored samples
+    # Return value:
+    #   none
+    ###########################################################################
+    def addBlock(self, data):
+        x = piRecordFormat.samplesToFloat(data, *self.format)
+        x = x.mean(axis=1, keepdims=True)
+        if self.decimator != None:
+            x = self.decimator.run(x)
+        x = x[-self.fftSize:, 0]
+        n = len(x)
+        if n:
+            self.history[:-n] = self.history[n:]
+            self.history[-n:] = x
+
+    ###########################################################################
+    # Method Name:
+    #   analyze
+    # Description:
+    #   runs the FFT over the history and stores the band levels, overall
+    #   level and tuner frequency in the shared result array
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def analyze(self):
+        # amplitude spectrum, scaled so a full scale sine reads 1.0
+        mag = numpy.abs(numpy.fft.rfft(self.history * self.window)) * (4.0 / self.fftSize)
+        bands = [toDb(mag[lo:hi].max()) for lo, hi in self.bandBins]
+        level = toDb(mag.max())
+        freq = findPitch(mag, self.freqs) if level > TUNER_MIN_LEVEL else 0.0
+
+        with self.result.get_lock():
+            self.result[RESULT_FREQ] = freq
+            self.result[RESULT_LEVEL] = level
+            self.result[RESULT_BANDS:RESULT_SIZE] = bands
+            self.result[RESULT_SEQ] += 1
+        self.analyses += 1
+
+    ###########################################################################
+    # Method Name:
+    #   stop
+    # Description:
+    #   stops the thread
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def stop(self):
+        try:
+            self.blocks.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+        self.thread.join(1.0)
+
+    ###########################################################################
+    # Method Name:
+    #   getStats
+    # Description:
+    #   returns the analysis rate and CPU use for telemetry
+    # Parameters:
+    #   none
+    # Return value:
+    #   dict of counters
+    ###########################################################################
+    def getStats(self):
+        elapsed = max(time.time() - self.startTime, 1e-6)
+        return {"analyses": self.analyses, "ratePerSec": round(self.analyses / elapsed, 2),
+                "cpuPercent": round(100.0 * self.busyTime / elapsed, 2),
+                "lastCostMs": round(1000.0 * self.lastCost, 3), "droppedBlocks": self.droppedBlocks}
+
+###############################################################################
+# Function Name:
+#   toDb
+# Description:
+#   converts an amplitude to dBFS
+# Parameters:
+#   level - the amplitude (1.0 = full scale)
+# Return value:
+#   the level in dBFS (-200 for silence)
+###############################################################################
+def toDb(level):
+    return 20.0 * math.log10(level) if level > 1e-10 else -200.0
+
+###############################################################################
+# Function Name:
+#   findPitch
+# Description:
+#   estimates the fundamental frequency with a harmonic product spectrum,
+#   which keeps a strong harmonic from being taken for the note, then
+#   refines it by parabolic interpolation around the peak.  Where the product
+#   picks a sub-harmonic that isn't in the signal, the lowest of its
+#   multiples that is (else the strongest bin) is taken instead.
+# Parameters:
+#   mag - amplitude spectrum
+#   freqs - frequency of each bin
+# Return value:
+#   the frequency in Hz (0.0 if none was found in the tuner range)
+###############################################################################
+def findPitch(mag, freqs):
+    import numpy
+    binWidth = freqs[1]
+    lo = max(1, int(TUNER_LOW / binWidth))
+    hi = min(int(TUNER_HIGH / binWidth), (len(mag) - 1) // TUNER_HARMONICS)
+    if hi <= lo:
+        return 0.0
+    logMag = numpy.log(numpy.maximum(mag, mag[lo:hi * TUNER_HARMONICS].max() * TUNER_FLOOR) + 1e-12)
+    hps = logMag[lo:hi].copy()
+    for h in range(2, TUNER_HARMONICS + 1):
+        hps += logMag[lo * h:hi * h:h][:hi - lo]
+    k = lo + int(numpy.argmax(hps))
+
+    # the product can favour a sub-harmonic that isn't in the signal (with a
+    # pure tone, the note and the sub-harmonics below it score the same)
+    peak = mag[lo:hi].max()
+    if mag[k] < peak * 0.1:
+        for h in range(2, TUNER_HARMONICS + 1):
+            j = k * h - 1 + int(numpy.argmax(mag[k * h - 1:k * h + 2]))
+            if mag[j] >= peak * 0.1:
+                k = j
+                break
+        else:
+            k = lo + int(numpy.argmax(mag[lo:hi]))
+    if 0 < k < len(mag) - 1:
+        a, b, c = numpy.log(mag[k - 1:k + 2] + 1e-12)
+        denom = a - 2.0 * b + c
+        if denom != 0.0:
+            return (k + 0.5 * (a - c) / denom) * binWidth
+    return k * binWidth
+
+###############################################################################
+# Function Name:
+#   freqToNote
+# Description:
+#   names the nearest equal tempered note (A4 = 440 Hz)
+# Parameters:
+#   freq - frequency in Hz
+# Return value:
+#   the note name with octave (e.g. "A4") and the offset in cents
+###############################################################################
+def freqToNote(freq):
+    midi = 69.0 + 12.0 * math.log2(freq / 440.0)
+    note = int(round(midi))
+    return NOTE_NAMES[note % 12] + str(note // 12 - 1), (midi - note) * 100.0
+
+###############################################################################
+# Function Name:
+#   getBarChars
+# Description:
+#   returns the custom LCD characters for the bar graph: character i is a
+#   bar i+1 rows high
+# Parameters:
+#   none
+# Return value:
+#   list of 8 character patterns (8 rows of 5 bits each)
+###############################################################################
+def getBarChars():
+    return [[0x1F if row >= 7 - i else 0x00 for row in range(8)] for i in range(8)]
+
+###############################################################################
+# Function Name:
+#   renderBars
+# Description:
+#   renders the band levels as a two line bar graph, 16 steps high, using
+#   the characters from getBarChars
+# Parameters:
+#   bands - band levels in dBFS
+# Return value:
+#   the top and bottom lines
+###############################################################################
+def renderBars(bands):
+    top = ""
+    bottom = ""
+    for level in bands:
+        steps = int(round(16.0 * (level - BAR_FLOOR) / (BAR_CEILING - BAR_FLOOR)))
+        steps = max(0, min(16, steps))
+        bottom += chr(min(steps, 8) - 1) if steps > 0 else " "
+        top += chr(steps - 9) if steps > 8 else " "
+    return top, bottom
+
+###############################################################################
+# Function Name:
+#   renderTuner
+# Description:
+#   renders the note, offset and frequency on the top line and a needle
+#   showing the offset (-50 to +50 cents) on the bottom line; the centre
+#   mark changes to # when the note is within 5 cents
+# Parameters:
+#   freq - frequency in Hz (0.0 if there is no pitch)
+# Return value:
+#   the top and bottom lines
+###############################################################################
+def renderTuner(freq):
+    if freq <= 0.0:
+        return "--              ", "       |        "
+    name, cents = freqToNote(freq)
+    top = "%-4s%+4.0fc %6.1f" % (name, cents, freq)
+    pos = int(round(7.5 + cents * 15.0 / 100.0))
+    needle = [" "] * 16
+    needle[7] = "|"
+    if abs(cents) < 5.0:
+        needle[7] = "#"
+    else:
+        needle[max(0, min(15, pos))] = "*"
+    return top[:16], "".join(needle)
@@ -0,0 +1,198 @@
+###############################################################################
+# piRecordTelemetry.py - Raspberry Pi audio recorder telemetry module
+# Description:
+#   collects status counters from the engine and publishes them to the
+#   .telemetry file, where the UI, piRecord.sh and other tools can read them.
+#   Each part of the engine registers a provider function returning a dict
+#   of its counters; providers are only called when the file is published,
+#   at most once per PUBLISH_PERIOD, so nothing is done per capture block.
+#   The file is written by a background thread, so a slow SD card never holds
+#   up the capture loop that publishes.
+###############################################################################
+
+import json
+import os
+import threading
+import time
+
+TELEMETRY_FILE = "./.telemetry"
+PUBLISH_PERIOD = 1.0
+
+# provider functions by section name
+providers = {}
+lastPublish = 0.0
+
+# the snapshot waiting for the writer thread, the time of the last one
+# written, and the writer thread (started by the first publish)
+pending = None
+lastWritten = 0.0
+writerThread = None
+writeReady = threading.Condition()
+writeLock = threading.Lock()
+
+###############################################################################
+# Function Name:
+#   register
+# Description:
+#   adds (or replaces) the provider for a telemetry section
+# Parameters:
+#   section - the section name
+#   provider - function returning a dict (or list) of counters
+# Return value:
+#   0
+###############################################################################
+def register(section, provider):
+    providers[section] = provider
+    return 0
+
+###############################################################################
+# Function Name:
+#   unregister
+# Description:
+#   removes the provider for a telemetry section
+# Parameters:
+#   section - the section name
+# Return value:
+#   0
+###############################################################################
+def unregister(section):
+    providers.pop(section, None)
+    return 0
+
+###############################################################################
+# Function Name:
+#   snapshot
+# Description:
+#   collects the counters from every provider
+# Parameters:
+#   none
+# Return value:
+#   dict of counters by section, plus the time they were collected
+###############################################################################
+def snapshot():
+    data = {"time": time.time()}
+    for section, provider in list(providers.items()):
+        try:
+            data[section] = provider()
+        except Exception as err:
+            data[section] = {"error": str(err)}
+    return data
+
+###############################################################################
+# Function Name:
+#   publish
+# Description:
+#   collects a snapshot if PUBLISH_PERIOD has passed since the last one, and
+#   hands it to the writer thread.  Only the latest snapshot is kept if the
+#   thread is still writing an earlier one.
+# Parameters:
+#   force - True to publish now regardless of the period
+# Return value:
+#   True if a snapshot was published
+###############################################################################
+def publish(force=False):
+    global lastPublish, pending, writerThread
+    now = time.time()
+    if not force and now - lastPublish < PUBLISH_PERIOD:
+        return False
+    lastPublish = now
+    data = snapshot()
+    with writeReady:
+        pending = data
+        if writerThread == None:
+            writerThread = threading.Thread(target=writeLoop, daemon=True)
+            writerThread.start()
+        writeReady.notify()
+    return True
+
+###############################################################################
+# Function Name:
+#   writeLoop
+# Description:
+#   the writer thread: writes each snapshot published
+# Parameters:
+#   none
+# Return value:
+#   none
+###############################################################################
+def writeLoop():
+    global pending
+    while True:
+        with writeReady:
+            while pending == None:
+                writeReady.wait()
+            data = pending
+            pending = None
+        write(data)
+
+###############################################################################
+# Function Name:
+#   write
+# Description:
+#   writes a snapshot to the telemetry file, unless a later one has been
+#   written already.  The file is replaced atomically so readers never see
+#   it half written.
+# Parameters:
+#   data - the snapshot
+# Return value:
+#   True if the file was written
+###############################################################################
+def write(data):
+    global lastWritten
+    with writeLock:
+        if data["time"] < lastWritten:
+            return False
+        try:
+            with open(TELEMETRY_FILE + ".tmp", "w") as fd:
+                json.dump(data, fd, indent=1)
+            os.replace(TELEMETRY_FILE + ".tmp", TELEMETRY_FILE)
+        except OSError:
+            return False
+        lastWritten = data["time"]
+    return True
+
+###############################################################################
+# Function Name:
+#   flush
+# Description:
+#   writes the snapshot waiting for the writer thread, if any, before the
+#   engine exits
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def flush():
+    global pending
+    with writeReady:
+        data = pending
+        pending = None
+    if data != None:
+        write(data)
+    return 0
+
+###############################################################################
+# Function Name:
+#   read
+# Description:
+#   reads the last published telemetry
+# Parameters:
+#   none
+# Return value:
+#   dict of counters by section (empty if nothing was published)
+###############################################################################
+def read():
+    try:
+        with open(TELEMETRY_FILE) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   prints the last published telemetry (see piRecord.sh telemetry)
+###############################################################################
+if __name__ == "__main__":
+    print (json.dumps(read(), indent=1))
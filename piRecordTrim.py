@@ -0,0 +1,264 @@
+###############################################################################
+# piRecordTrim.py - Raspberry Pi audio recorder silence trim module
+# Description:
+#   trims the setup before and the teardown after the music in a take.  The
+#   take's level is measured in short windows (the RMS of the loudest
+#   channel), reading blocks forward from the start and backward from the
+#   end, only until the music is found, so a long take is mostly never read.
+#   The music starts where the level stays above a threshold for most of
+#   holdSecs (so a tap on a mic or a word between songs doesn't count), and
+#   padSecs is kept on either side.  The file is then trimmed in place
+#   (piRecordWave.trimWave): the tail is truncated and the head skipped by a
+#   header rewrite, so the audio kept is never copied.
+#
+#   The engine runs this as its own process at idle priority when a take
+#   stops, so the trim never holds up the next take; piRecord.sh trim trims
+#   takes already recorded.  While the engine's trim is pending or running,
+#   the take is marked (see piRecordUtils.isTrimPending), and offload,
+#   playback, verify and batch leave it alone.  Interrupted trims are
+#   finished from their journals (see piRecordWave.recoverTrims) when the
+#   engine starts and by piRecord.sh trim, never by a trim the engine
+#   started, which could otherwise replay the journal of one still running.
+###############################################################################
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import numpy
+import piRecordConf
+import piRecordFormat
+import piRecordUtils
+import piRecordWave
+
+# seconds per level measurement
+WINDOW_SECS = 0.05
+
+# seconds read at a time
+SCAN_BLOCK_SECS = 10.0
+
+# share of the windows in holdSecs that must be above the threshold
+HOLD_FRACTION = 0.5
+
+# trim processes started by the engine
+trimProcs = []
+
+###############################################################################
+# Function Name:
+#   getLevels
+# Description:
+#   measures which windows of a block of samples are above the threshold
+# Parameters:
+#   x - float samples, shape (frames, channels)
+#   window - frames per window
+#   threshold - mean square level (of full scale) of the threshold
+# Return value:
+#   bool array, one entry per whole window
+###############################################################################
+def getLevels(x, window, threshold):
+    n = len(x) // window
+    meanSquare = numpy.square(x[:n * window].reshape(n, window, -1)).mean(axis=1).max(axis=1)
+    return meanSquare > threshold
+
+###############################################################################
+# Function Name:
+#   findHold
+# Description:
+#   finds the first hold where the level stays above the threshold for
+#   most of the hold, and the first window above it there
+# Parameters:
+#   active - bool array of windows above the threshold, in scan order
+#   hold - windows in the hold
+# Return value:
+#   the window's index, or None if there is none yet
+###############################################################################
+def findHold(active, hold):
+    if len(active) < hold:
+        return None
+    counts = numpy.cumsum(numpy.concatenate(([0], active)))
+    found = numpy.nonzero(counts[hold:] - counts[:-hold] >= HOLD_FRACTION * hold)[0]
+    if not len(found):
+        return None
+    return int(found[0] + numpy.argmax(active[found[0]:]))
+
+###############################################################################
+# Function Name:
+#   scanLevels
+# Description:
+#   reads a take in blocks, forward from the start or backward from the end,
+#   until the music is found
+# Parameters:
+#   reader - the WaveReader for the take
+#   window - frames per window
+#   hold - windows in the hold
+#   threshold - mean square level of the threshold
+#   backward - True to scan from the end
+# Return value:
+#   windows from the start (or end) to where the music begins (or ends),
+#   or None if the take is all below the threshold
+###############################################################################
+def scanLevels(reader, window, hold, threshold, backward):
+    nframes = reader.getnframes()
+    blockFrames = max(1, int(SCAN_BLOCK_SECS * reader.getframerate()) // window) * window
+    active = numpy.zeros(0, dtype=bool)
+    done = 0
+    while done < nframes:
+        n = min(blockFrames, nframes - done)
+        reader.setpos(nframes - done - n if backward else done)
+        x = piRecordFormat.samplesToFloat(reader.readframes(n), reader.getsampwidth(), reader.getformattag(),
+                                          reader.getnchannels())
+        if backward:
+            x = x[::-1]
+        active = numpy.concatenate((active, getLevels(x, window, threshold)))
+        done += n
+        found = findHold(active, min(hold, len(active)) if done >= nframes else hold)
+        if found != None:
+            return found
+    return None
+
+###############################################################################
+# Function Name:
+#   findContent
+# Description:
+#   finds the music in a take
+# Parameters:
+#   reader - the WaveReader for the take
+#   thresholdDb - level (dBFS RMS) above which a window counts as music
+#   holdSecs - seconds the level must mostly stay above the threshold
+#   padSecs - seconds kept before and after the music
+#   head - False to keep the head (e.g. for a later part of a take)
+#   tail - False to keep the tail
+# Return value:
+#   (first frame kept, frame after the last kept), or None if the take is
+#   all below the threshold
+###############################################################################
+def findContent(reader, thresholdDb, holdSecs, padSecs, head=True, tail=True):
+    rate = reader.getframerate()
+    nframes = reader.getnframes()
+    window = max(1, int(WINDOW_SECS * rate))
+    hold = max(1, int(round(holdSecs / WINDOW_SECS)))
+    threshold = 10.0 ** (thresholdDb / 10.0)
+    pad = int(padSecs * rate)
+    start, end = 0, nframes
+    if head:
+        found = scanLevels(reader, window, hold, threshold, False)
+        if found == None:
+            return None
+        start = max(0, found * window - pad)
+    if tail:
+        found = scanLevels(reader, window, hold, threshold, True)
+        if found == None:
+            return None
+        end = min(nframes, nframes - found * window + pad)
+    return start, max(start, end)
+
+###############################################################################
+# Function Name:
+#   trimTake
+# Description:
+#   trims the silence before and after the music in a wave file
+# Parameters:
+#   filename - the wave file
+#   thresholdDb, holdSecs, padSecs, head, tail - see findContent
+# Return value:
+#   (frames trimmed from the head, frames trimmed from the tail), or None if
+#   the take was left as it is
+###############################################################################
+def trimTake(filename, thresholdDb, holdSecs, padSecs, head=True, tail=True):
+    reader = piRecordWave.WaveReader(filename)
+    try:
+        nframes = reader.getnframes()
+        content = findContent(reader, thresholdDb, holdSecs, padSecs, head, tail)
+    finally:
+        reader.close()
+    if content == None or content == (0, nframes):
+        return None
+    start, kept = piRecordWave.trimWave(filename, content[0], content[1])
+    return start, nframes - start - kept
+
+###############################################################################
+# Function Name:
+#   start
+# Description:
+#   trims a take in a process of its own, at idle CPU and I/O priority.  The
+#   take is marked as pending first, and the process inherits the marker's
+#   lock.  The process isn't waited for; those finished are reaped on the
+#   next call.
+# Parameters:
+#   filename - the wave file
+#   head - False to keep the head
+#   tail - False to keep the tail
+# Return value:
+#   the process (a subprocess.Popen)
+###############################################################################
+def start(filename, head=True, tail=True):
+    global trimProcs
+    trimProcs = [proc for proc in trimProcs if proc.poll() == None]
+    cmd = [sys.executable, os.path.abspath(__file__), "--threshold", str(piRecordConf.trimThresholdDb),
+           "--hold", str(piRecordConf.trimHoldSecs), "--pad", str(piRecordConf.trimPadSecs)]
+    if not head:
+        cmd.append("--keep-head")
+    if not tail:
+        cmd.append("--keep-tail")
+    cmd += ["--pending", filename]
+    if shutil.which("ionice") != None:
+        cmd = ["ionice", "-c", "3"] + cmd
+    marker = piRecordUtils.markTrimPending(filename)
+    try:
+        trimProcs.append(subprocess.Popen(["nice", "-n", "19"] + cmd, pass_fds=(marker.fileno(),)))
+    except OSError:
+        piRecordUtils.clearTrimPending(filename)
+        raise
+    finally:
+        marker.close()
+    return trimProcs[-1]
+
+###############################################################################
+# Function Name:
+#   __main__
+# Description:
+#   trims takes from the command line (see piRecord.sh trim)
+###############################################################################
+if __name__ == "__main__":
+    piRecordConf.getRecDevConfig()
+
+    parser = argparse.ArgumentParser(description="trim the silence before and after the music in takes")
+    parser.add_argument("files", nargs="+", help="wave files to trim")
+    parser.add_argument("--threshold", type=float, default=piRecordConf.trimThresholdDb, help="music level in dBFS")
+    parser.add_argument("--hold", type=float, default=piRecordConf.trimHoldSecs,
+                        help="seconds the level must mostly stay above the threshold")
+    parser.add_argument("--pad", type=float, default=piRecordConf.trimPadSecs, help="seconds kept either side")
+    parser.add_argument("--keep-head", action="store_true", help="don't trim the start")
+    parser.add_argument("--keep-tail", action="store_true", help="don't trim the end")
+    parser.add_argument("--pending", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # the engine's trims leave interrupted trims to the engine
+    if not args.pending:
+        dirs = set(os.path.dirname(fn if os.path.exists(fn) else os.path.join(piRecordConf.outputDir, fn)) or "."
+                   for fn in args.files)
+        for dirName in sorted(dirs):
+            for fn in piRecordWave.recoverTrims(dirName, piRecordUtils.isTrimPending):
+                print ("trim: finished the interrupted trim of", fn)
+
+    failures = 0
+    for fn in args.files:
+        fn = fn if os.path.exists(fn) else os.path.join(piRecordConf.outputDir, fn)
+        try:
+            reader = piRecordWave.WaveReader(fn)
+            rate = float(reader.getframerate())
+            reader.close()
+            result = trimTake(fn, args.threshold, args.hold, args.pad, not args.keep_head, not args.keep_tail)
+        except (OSError, ValueError) as err:
+            print ("trim error:", fn, err)
+            failures += 1
+            continue
+        finally:
+            if args.pending:
+                piRecordUtils.clearTrimPending(fn)
+        if result == None:
+            print ("trim:", fn, "left as it is")
+        else:
+            print ("trimmed %s: %.1f s from the start, %.1f s from the end" % (fn, result[0] / rate, result[1] / rate))
+    exit(1 if failures else 0)
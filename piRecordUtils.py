@@ -8,8 +8,17 @@
 ###############################################################################
 
 import datetime
+import fcntl
+import os
 import piRecordConf
 
+# lock file held by the engine while a recording is in progress
+REC_LOCK_FILE = "./.reclock"
+recLockFd = None
+
+# suffix of the marker next to a take whose silence trim is pending or running
+TRIM_PENDING_SUFFIX = ".trimming"
+
 ###############################################################################
 # Function Name:
 #   getNextFilename  
@@ -24,6 +33,67 @@ def getNextFilename():
     nextFilename = piRecordConf.outputDir + "/" + datetime.datetime.now().strftime(piRecordConf.fileFormatStr) + piRecordConf.fileTypeExt 
     return(nextFilename)
 
+###############################################################################
+# Function Name:
+#   getPartFilename
+# Description:
+#   generates the filename for a later part of a take, used when a take is
+#   continued in a new file (e.g. 20191124_201530.wav -> 20191124_201530_2.wav)
+# Parameters:
+#   filename - the filename of the take's first part
+#   part - the part number (1 = the first part)
+# Return value:
+#   the filename
+###############################################################################
+def getPartFilename(filename, part):
+    if part <= 1:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return "%s_%d%s" % (base, part, ext)
+
+###############################################################################
+# Function Name:
+#   getPartNumber
+# Description:
+#   tells which part of a take a file is, the reverse of getPartFilename.  A
+#   file is only taken for a later part if the take's first part exists (in
+#   either format), so a name that happens to end in _2 isn't.
+# Parameters:
+#   filename - the file name
+# Return value:
+#   the part number (1 = the first part)
+###############################################################################
+def getPartNumber(filename):
+    base, ext = os.path.splitext(filename)
+    first, sep, part = base.rpartition("_")
+    if not sep or not part.isdigit() or int(part) < 2:
+        return 1
+    if not any(os.path.exists(first + e) for e in (ext, ".wav", ".flac")):
+        return 1
+    return int(part)
+
+###############################################################################
+# Function Name:
+#   getTakes
+# Description:
+#   lists the wave takes in a directory, oldest first, with the parts of a
+#   take continued after a restart (see getPartFilename) in order
+# Parameters:
+#   dirName - the directory
+# Return value:
+#   list of takes, each a list of the take's part files
+###############################################################################
+def getTakes(dirName):
+    takes = {}
+    for name in os.listdir(dirName):
+        if not name.endswith(".wav"):
+            continue
+        fn = os.path.join(dirName, name)
+        part = getPartNumber(fn)
+        first = fn if part == 1 else fn[:-len("_%d.wav" % part)] + ".wav"
+        takes.setdefault(first, []).append((part, fn))
+    return [[fn for part, fn in sorted(takes[first])] for first in sorted(takes)]
+
 ###############################################################################
 # Function Name:
 #   getCurrentFilename 
@@ -56,3 +126,169 @@ def setCurrentFilename(newFilename):
     fd.write(newFilename)
     fd.close()
     return 0
+
+
+###############################################################################
+# Function Name:
+#   setRecording
+# Description:
+#   called by the engine to take or release the recording lock.  The lock is
+#   released by the kernel if the engine dies, so it is never left stale.
+# Parameters:
+#   active - True when a recording starts, False when it stops
+# Return value:
+#   0
+###############################################################################
+def setRecording(active):
+    global recLockFd
+    if active and recLockFd == None:
+        recLockFd = open(REC_LOCK_FILE, "a")
+        fcntl.flock(recLockFd, fcntl.LOCK_EX)
+    elif not active and recLockFd != None:
+        fcntl.flock(recLockFd, fcntl.LOCK_UN)
+        recLockFd.close()
+        recLockFd = None
+    return 0
+
+###############################################################################
+# Function Name:
+#   isRecording
+# Description:
+#   checks whether the engine (in any process) is currently recording
+# Parameters:
+#   none
+# Return value:
+#   True if a recording is in progress
+###############################################################################
+def isRecording():
+    if recLockFd != None:
+        return True
+    try:
+        fd = open(REC_LOCK_FILE, "a")
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    except OSError:
+        return True
+    finally:
+        fd.close()
+
+###############################################################################
+# Function Name:
+#   markTrimPending
+# Description:
+#   called by the engine before it starts a take's trim process, to mark the
+#   take so other tools leave it alone.  The marker is locked; the trim
+#   process inherits the lock (see piRecordTrim.start) and removes the marker
+#   when it is done, and the kernel releases the lock if it dies instead.
+# Parameters:
+#   filename - the take
+# Return value:
+#   the locked marker, to be passed to the trim process and then closed
+###############################################################################
+def markTrimPending(filename):
+    fd = open(filename + TRIM_PENDING_SUFFIX, "w")
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+###############################################################################
+# Function Name:
+#   isTrimPending
+# Description:
+#   checks whether a take's trim is pending or running.  A marker left by a
+#   trim process that died isn't locked, and doesn't count.
+# Parameters:
+#   filename - the take
+# Return value:
+#   True if it is
+###############################################################################
+def isTrimPending(filename):
+    try:
+        fd = open(filename + TRIM_PENDING_SUFFIX, "r")
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    except OSError:
+        return True
+    finally:
+        fd.close()
+
+###############################################################################
+# Function Name:
+#   clearTrimPending
+# Description:
+#   removes a take's trim marker, if it has one
+# Parameters:
+#   filename - the take
+# Return value:
+#   0
+###############################################################################
+def clearTrimPending(filename):
+    try:
+        os.remove(filename + TRIM_PENDING_SUFFIX)
+    except FileNotFoundError:
+        pass
+    return 0
+
+###############################################################################
+# Function Name:
+#   getProcessRss
+# Description:
+#   reads the resident memory of a process from /proc
+# Parameters:
+#   pid - the process id (default: this process)
+# Return value:
+#   the resident memory in MB, or None if it can't be read
+###############################################################################
+def getProcessRss(pid=None):
+    try:
+        with open("/proc/%d/status" % (os.getpid() if pid == None else pid)) as fd:
+            for line in fd:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+###############################################################################
+# Function Name:
+#   getUptime
+# Description:
+#   reads the time since the system booted
+# Parameters:
+#   none
+# Return value:
+#   the uptime in seconds, or None if it can't be read
+###############################################################################
+def getUptime():
+    try:
+        with open("/proc/uptime") as fd:
+            return float(fd.read().split()[0])
+    except (OSError, ValueError):
+        return None
+
+###############################################################################
+# Function Name:
+#   getProcessAge
+# Description:
+#   works out how long ago this process was started, from its start time in
+#   /proc/self/stat (in clock ticks since boot)
+# Parameters:
+#   none
+# Return value:
+#   the age in seconds, or None if it can't be read
+###############################################################################
+def getProcessAge():
+    uptime = getUptime()
+    try:
+        with open("/proc/self/stat") as fd:
+            fields = fd.read().rsplit(")", 1)[1].split()
+        return uptime - int(fields[19]) / float(os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, TypeError):
+        return None
@@ -0,0 +1,194 @@
+###############################################################################
+# piRecordWatchdog.py - Raspberry Pi audio recorder engine watchdog module
+# Description:
+#   supervises the engine process from the UI process.  The engine beats a
+#   heartbeat in shared memory on every pass of its loop (at least every
+#   HEARTBEAT_PERIOD when idle); a thread here checks it every CHECK_PERIOD,
+#   so an engine that has died (e.g. after an ALSA error when a USB
+#   interface drops out) or stalled is noticed within the configured timeout
+#   plus a check period.
+#
+#   The engine is then restarted, which opens the capture device again.  A
+#   take that was in progress is finalized and continued in the take's next
+#   numbered file, and the gap between the two parts is logged in frames,
+#   measured from the capture times of the last frame saved before the
+#   failure and the first frame written after it.  If the engine has to be
+#   restarted more than maxRestarts times in RESTART_WINDOW, the watchdog
+#   gives up and the take is reported as failed.
+###############################################################################
+
+import logging
+import threading
+import time
+import piRecordEngine
+import piRecordLog
+
+# seconds between checks of the engine
+CHECK_PERIOD = 0.5
+
+# seconds over which restarts are counted against maxRestarts
+RESTART_WINDOW = 3600.0
+
+# most seconds to wait for the continued take's first frame to measure the
+# gap
+GAP_TIMEOUT = 10.0
+
+# the running watchdog
+watchdog = None
+
+###############################################################################
+# Class Name:
+#   Watchdog
+# Description:
+#   the watchdog thread
+###############################################################################
+class Watchdog:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   starts the watchdog thread
+    # Parameters:
+    #   timeout - most seconds allowed between engine heartbeats
+    #   maxRestarts - most restarts in RESTART_WINDOW
+    ###########################################################################
+    def __init__(self, timeout, maxRestarts):
+        self.timeout = timeout
+        self.maxRestarts = maxRestarts
+        self.restartTimes = []
+        self.restarts = 0
+        self.failedRestarts = 0
+        self.lastReason = ""
+        self.lastGapFrames = None
+        self.gaveUp = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="engine-watchdog", daemon=True)
+        self.thread.start()
+
+    ###########################################################################
+    # Method Name:
+    #   run
+    # Description:
+    #   the watchdog thread: checks the engine until stopped or it gives up
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def run(self):
+        while not self.stopped.wait(CHECK_PERIOD):
+            reason = piRecordEngine.check_engine(self.timeout)
+            if reason == None:
+                continue
+            now = time.time()
+            self.restartTimes = [t for t in self.restartTimes if now - t < RESTART_WINDOW] + [now]
+            if len(self.restartTimes) > self.maxRestarts:
+                self.giveUp(reason)
+                break
+            self.restart(reason)
+
+    ###########################################################################
+    # Method Name:
+    #   restart
+    # Description:
+    #   restarts the engine and, if a take was continued, logs the gap
+    # Parameters:
+    #   reason - why the engine is restarted
+    # Return value:
+    #   none
+    ###########################################################################
+    def restart(self, reason):
+        self.lastReason = reason
+        result = piRecordEngine.restart_process(reason)
+        if result == None:
+            self.failedRestarts += 1
+            return
+        self.restarts += 1
+        if result["next"] == None:
+            return
+
+        firstSample = piRecordEngine.wait_first_sample(GAP_TIMEOUT)
+        if firstSample == None or not result["lastSample"]:
+            piRecordLog.event("take_continued", logging.WARNING, interval=0, file=result["file"],
+                              frames=result["frames"], next=result["next"], gapFrames="unknown")
+            return
+        gap = firstSample - result["lastSample"]
+        self.lastGapFrames = int(round(gap * result["rate"]))
+        piRecordLog.event("take_continued", logging.WARNING, interval=0, file=result["file"],
+                          frames=result["frames"], next=result["next"], gapFrames=self.lastGapFrames,
+                          gapSecs=round(gap, 3), unsavedFrames=result["unsaved"])
+
+    ###########################################################################
+    # Method Name:
+    #   giveUp
+    # Description:
+    #   stops any take and leaves the engine down once it has failed too
+    #   often, so the UI reports the error rather than a take that isn't
+    #   recording
+    # Parameters:
+    #   reason - why the engine last failed
+    # Return value:
+    #   none
+    ###########################################################################
+    def giveUp(self, reason):
+        self.gaveUp = True
+        piRecordLog.event("watchdog_gave_up", logging.CRITICAL, interval=0, reason=reason,
+                          restarts=len(self.restartTimes) - 1, window=RESTART_WINDOW)
+        piRecordEngine.kill_process(reason)
+        piRecordEngine.stop_record()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def getStats(self):
+        return {"restarts": self.restarts, "failedRestarts": self.failedRestarts, "lastReason": self.lastReason,
+                "lastGapFrames": self.lastGapFrames, "gaveUp": self.gaveUp}
+
+###############################################################################
+# Function Name:
+#   start
+# Description:
+#   starts watching the engine (once it has been started)
+# Parameters:
+#   timeout - most seconds allowed between engine heartbeats
+#   maxRestarts - most restarts in RESTART_WINDOW
+# Return value:
+#   0
+###############################################################################
+def start(timeout, maxRestarts):
+    global watchdog
+    stop()
+    watchdog = Watchdog(timeout, maxRestarts)
+    return 0
+
+###############################################################################
+# Function Name:
+#   stop
+# Description:
+#   stops watching the engine (before it is stopped)
+# Parameters:
+#   none
+# Return value:
+#   0
+###############################################################################
+def stop():
+    global watchdog
+    if watchdog != None:
+        watchdog.stop()
+        watchdog = None
+    return 0
+
+###############################################################################
+# Function Name:
+#   getStats
+# Description:
+#   returns the watchdog's counters
+# Parameters:
+#   none
+# Return value:
+#   dict of counters (empty if the watchdog isn't running)
+###############################################################################
+def getStats():
+    return watchdog.getStats() if watchdog != None else {}
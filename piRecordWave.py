@@ -0,0 +1,524 @@
+###############################################################################
+# piRecordWave.py - Raspberry Pi audio recorder wave file module
+# Description:
+#   reads and writes RIFF wave files.  Unlike the standard wave module, this
+#   supports packed 24 bit PCM and IEEE float samples, writing a
+#   WAVE_FORMAT_EXTENSIBLE header where the wave format requires it.
+###############################################################################
+
+import fcntl
+import json
+import os
+import struct
+import piRecordCheck
+import piRecordFormat
+import piRecordIO
+
+# sub format GUID tail shared by the KSDATAFORMAT_SUBTYPE_xxx GUIDs
+GUID_TAIL = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+# default speaker positions for WAVE_FORMAT_EXTENSIBLE, indexed by channels
+CHANNEL_MASKS = {1: 0x4, 2: 0x3, 4: 0x33, 6: 0x3F, 8: 0x63F}
+
+# largest chunk size a RIFF header can hold
+MAX_SIZE = 0xFFFFFFFF
+
+# suffix of the journal of a trim in progress
+TRIM_JOURNAL_SUFFIX = ".trim"
+
+# chunks that may come before the data chunk of a file that can be trimmed
+TRIM_CHUNKS = (b'fmt ', b'fact', b'JUNK')
+
+###############################################################################
+# Function Name:
+#   makeWaveHeader
+# Description:
+#   builds a RIFF wave header.  The extensible format is used for more than 2
+#   channels or more than 16 bits, and float files carry the fact chunk that
+#   non-PCM formats require.  Sizes too large for the header (e.g. for a
+#   stream of unknown length) are written as the maximum size.
+# Parameters:
+#   nchannels - number of channels
+#   sampwidth - stored sample width in bytes
+#   framerate - sample rate
+#   formatTag - WAVE_FORMAT_PCM or WAVE_FORMAT_IEEE_FLOAT
+#   dataBytes - size of the sample data
+# Return value:
+#   the header bytes
+###############################################################################
+def makeWaveHeader(nchannels, sampwidth, framerate, formatTag, dataBytes):
+    bits = sampwidth * 8
+    frameSize = nchannels * sampwidth
+    isFloat = formatTag == piRecordFormat.WAVE_FORMAT_IEEE_FLOAT
+    common = struct.pack('<HIIH', nchannels, framerate, framerate * frameSize, frameSize)
+
+    if nchannels > 2 or (bits > 16 and not isFloat):
+        subFormat = struct.pack('<H', formatTag) + GUID_TAIL
+        fmt = struct.pack('<H', piRecordFormat.WAVE_FORMAT_EXTENSIBLE) + common
+        fmt += struct.pack('<HHHI', bits, 22, bits, CHANNEL_MASKS.get(nchannels, 0)) + subFormat
+    elif isFloat:
+        fmt = struct.pack('<H', formatTag) + common + struct.pack('<HH', bits, 0)
+    else:
+        fmt = struct.pack('<H', formatTag) + common + struct.pack('<H', bits)
+
+    chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    if isFloat:
+        chunks += b'fact' + struct.pack('<II', 4, min(dataBytes // frameSize, MAX_SIZE))
+    chunks += b'data' + struct.pack('<I', min(dataBytes, MAX_SIZE))
+
+    riffSize = 4 + len(chunks) + dataBytes + (dataBytes & 1)
+    return b'RIFF' + struct.pack('<I', min(riffSize, MAX_SIZE)) + b'WAVE' + chunks
+
+###############################################################################
+# Class Name:
+#   WaveWriter
+# Description:
+#   writes a wave file.  The header is written when the file is opened and the
+#   chunk sizes are filled in when it is closed.  The write methods match the
+#   standard wave module so the engine can use either.
+###############################################################################
+class WaveWriter:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   opens the file and writes the header
+    # Parameters:
+    #   filename - name of the file to create
+    #   nchannels - number of channels
+    #   sampwidth - stored sample width in bytes
+    #   framerate - sample rate
+    #   formatTag - WAVE_FORMAT_PCM or WAVE_FORMAT_IEEE_FLOAT
+    #   preallocBytes, writebackBytes, directIO - how the file is written
+    #       to spare the page cache (see piRecordIO.StreamFile); by default
+    #       it is written as an ordinary file
+    #   checksumBytes - block size of the CRCs written to the checksum
+    #       sidecar (see piRecordCheck; 0 = no sidecar)
+    ###########################################################################
+    def __init__(self, filename, nchannels, sampwidth, framerate, formatTag=piRecordFormat.WAVE_FORMAT_PCM,
+                 preallocBytes=0, writebackBytes=0, directIO=False, checksumBytes=0):
+        self.nchannels = nchannels
+        self.sampwidth = sampwidth
+        self.framerate = framerate
+        self.formatTag = formatTag
+        self.frameSize = nchannels * sampwidth
+        self.dataBytes = 0
+        if preallocBytes or writebackBytes or directIO:
+            self.file = piRecordIO.StreamFile(filename, preallocBytes, writebackBytes, directIO)
+        else:
+            self.file = open(filename, 'wb')
+        self.file.write(self.makeHeader())
+        self.dataOffset = self.file.tell()
+        self.checksum = None
+        if checksumBytes:
+            self.checksum = piRecordCheck.BlockChecksum(filename, checksumBytes, self.dataOffset, self.frameSize, framerate)
+
+    ###########################################################################
+    # Method Name:
+    #   makeHeader
+    # Description:
+    #   builds the RIFF header for the current data size
+    # Parameters:
+    #   none
+    # Return value:
+    #   the header bytes
+    ###########################################################################
+    def makeHeader(self):
+        return makeWaveHeader(self.nchannels, self.sampwidth, self.framerate, self.formatTag, self.dataBytes)
+
+    ###########################################################################
+    # Method Name:
+    #   writeframesraw
+    # Description:
+    #   appends sample data without updating the header
+    # Parameters:
+    #   data - the sample data
+    # Return value:
+    #   none
+    ###########################################################################
+    def writeframesraw(self, data):
+        self.file.write(data)
+        self.dataBytes += len(data)
+        if self.checksum != None:
+            self.checksum.update(data)
+
+    ###########################################################################
+    # Method Name:
+    #   writeframes
+    # Description:
+    #   appends sample data and updates the header
+    # Parameters:
+    #   data - the sample data
+    # Return value:
+    #   none
+    ###########################################################################
+    def writeframes(self, data):
+        self.writeframesraw(data)
+        self.updateHeader()
+
+    ###########################################################################
+    # Method Name:
+    #   updateHeader
+    # Description:
+    #   rewrites the header with the current chunk sizes
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def updateHeader(self):
+        pos = self.file.tell()
+        self.file.seek(0)
+        self.file.write(self.makeHeader())
+        self.file.seek(pos)
+
+    ###########################################################################
+    # Method Name:
+    #   getnframes
+    # Description:
+    #   returns the number of frames written so far
+    # Parameters:
+    #   none
+    # Return value:
+    #   the number of frames
+    ###########################################################################
+    def getnframes(self):
+        return self.dataBytes // self.frameSize
+
+    ###########################################################################
+    # Method Name:
+    #   close
+    # Description:
+    #   pads the data chunk to an even size, updates the header and closes
+    #   the file (and its checksum sidecar)
+    # Parameters:
+    #   none
+    # Return value:
+    #   none
+    ###########################################################################
+    def close(self):
+        if self.file == None:
+            return
+        if self.dataBytes & 1:
+            self.file.write(b'\x00')
+        self.updateHeader()
+        self.file.close()
+        self.file = None
+        if self.checksum != None:
+            self.checksum.close()
+
+###############################################################################
+# Class Name:
+#   WaveReader
+# Description:
+#   reads a wave file written by WaveWriter, the standard wave module or other
+#   programs.  If the data chunk size was never filled in (e.g. the recording
+#   was cut off by a power loss), the data is assumed to run to the end of
+#   the file.
+###############################################################################
+class WaveReader:
+
+    ###########################################################################
+    # Method Name:
+    #   __init__
+    # Description:
+    #   opens the file and parses its header
+    # Parameters:
+    #   filename - name of the file to read
+    ###########################################################################
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        fileSize = os.fstat(self.file.fileno()).st_size
+        riff = self.file.read(12)
+        if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            self.file.close()
+            raise ValueError("not a wave file: %s" % filename)
+
+        self.formatTag = None
+        self.dataOffset = None
+        while self.dataOffset == None:
+            hdr = self.file.read(8)
+            if len(hdr) < 8:
+                break
+            chunkId, chunkSize = struct.unpack('<4sI', hdr)
+            if chunkId == b'fmt ':
+                fmt = self.file.read(chunkSize + (chunkSize & 1))
+                self.formatTag, self.nchannels, self.framerate = struct.unpack('<HHI', fmt[0:8])
+                self.frameSize, bits = struct.unpack('<HH', fmt[12:16])
+                if self.formatTag == piRecordFormat.WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    self.formatTag = struct.unpack('<H', fmt[24:26])[0]
+                self.sampwidth = self.frameSize // self.nchannels
+            elif chunkId == b'data':
+                self.dataOffset = self.file.tell()
+                if chunkSize == 0 or self.dataOffset + chunkSize > fileSize:
+                    chunkSize = fileSize - self.dataOffset
+                self.dataBytes = chunkSize
+            else:
+                self.file.seek(chunkSize + (chunkSize & 1), os.SEEK_CUR)
+
+        if self.formatTag == None or self.dataOffset == None:
+            self.file.close()
+            raise ValueError("missing fmt or data chunk: %s" % filename)
+
+        self.nframes = self.dataBytes // self.frameSize
+        self.pos = 0
+
+    def getnchannels(self):
+        return self.nchannels
+
+    def getsampwidth(self):
+        return self.sampwidth
+
+    def getframerate(self):
+        return self.framerate
+
+    def getformattag(self):
+        return self.formatTag
+
+    def getnframes(self):
+        return self.nframes
+
+    def getdataoffset(self):
+        return self.dataOffset
+
+    def tell(self):
+        return self.pos
+
+    ###########################################################################
+    # Method Name:
+    #   setpos
+    # Description:
+    #   moves the read position to the given frame
+    # Parameters:
+    #   pos - the frame number
+    # Return value:
+    #   none
+    ###########################################################################
+    def setpos(self, pos):
+        self.pos = max(0, min(pos, self.nframes))
+        self.file.seek(self.dataOffset + self.pos * self.frameSize)
+
+    ###########################################################################
+    # Method Name:
+    #   readframes
+    # Description:
+    #   reads up to n frames from the current position
+    # Parameters:
+    #   n - number of frames to read
+    # Return value:
+    #   the sample data (empty at the end of the data)
+    ###########################################################################
+    def readframes(self, n):
+        n = max(0, min(n, self.nframes - self.pos))
+        data = self.file.read(n * self.frameSize)
+        self.pos += len(data) // self.frameSize
+        return data
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+###############################################################################
+# Function Name:
+#   readCuePoints
+# Description:
+#   reads the cue points (markers) of a wave file's cue chunk, which other
+#   recorders and editors write before or after the data chunk
+# Parameters:
+#   filename - the wave file
+# Return value:
+#   sorted list of the cue points' frame numbers (empty if there are none)
+###############################################################################
+def readCuePoints(filename):
+    cues = set()
+    with open(filename, 'rb') as fd:
+        fileSize = os.fstat(fd.fileno()).st_size
+        pos = 12
+        while pos + 8 <= fileSize:
+            fd.seek(pos)
+            chunkId, chunkSize = struct.unpack('<4sI', fd.read(8))
+            if chunkId == b'data' and (chunkSize == 0 or pos + 8 + chunkSize > fileSize):
+                # the data runs to the end of the file
+                break
+            if chunkId == b'cue ' and chunkSize >= 4:
+                body = fd.read(chunkSize)
+                count = min(struct.unpack('<I', body[0:4])[0], (len(body) - 4) // 24)
+                for i in range(count):
+                    cues.add(struct.unpack('<6I', body[4 + 24 * i:28 + 24 * i])[5])
+            pos += 8 + chunkSize + (chunkSize & 1)
+    return sorted(cues)
+
+###############################################################################
+# Function Name:
+#   finalizeWave
+# Description:
+#   finishes a wave file whose writer never closed it (e.g. the engine died
+#   mid-take): drops any partly written frame, pads the data chunk and fills
+#   in the chunk sizes from the data actually on disk.  Only files with the
+#   header WaveWriter writes can be finalized.
+# Parameters:
+#   filename - the wave file
+# Return value:
+#   the number of frames in the file
+###############################################################################
+def finalizeWave(filename):
+    reader = WaveReader(filename)
+    reader.close()
+    dataBytes = reader.getnframes() * reader.frameSize
+    header = makeWaveHeader(reader.nchannels, reader.sampwidth, reader.framerate, reader.formatTag, dataBytes)
+    if len(header) != reader.getdataoffset():
+        raise ValueError("unexpected header layout: %s" % filename)
+    with open(filename, 'r+b') as fd:
+        fd.truncate(reader.getdataoffset() + dataBytes)
+        if dataBytes & 1:
+            fd.seek(0, os.SEEK_END)
+            fd.write(b'\x00')
+        fd.seek(0)
+        fd.write(header)
+    return reader.getnframes()
+
+###############################################################################
+# Function Name:
+#   trimWave
+# Description:
+#   trims a wave file to a range of its frames without rewriting the audio
+#   kept.  The tail is cut off by truncating the file.  The head is skipped
+#   by rewriting the header: a JUNK chunk, which readers ignore, covers the
+#   frames trimmed, and the data chunk starts just after it (the frames
+#   trimmed stay on disk, but their whole blocks are freed where the file
+#   system can).  The start may move forward a frame or two, so the chunks
+#   line up.
+#   The header and the data chunk header can't be written together, so the
+#   writes are first saved in a journal next to the file, then made, and the
+#   journal deleted.  If that is interrupted, completeTrim finishes the trim
+#   from the journal.  A checksum sidecar is updated along with the file.
+#   Only files with the header WaveWriter writes (or one trimmed before) can
+#   be trimmed.
+# Parameters:
+#   filename - the wave file
+#   startFrame - first frame kept
+#   endFrame - frame after the last frame kept
+# Return value:
+#   (first frame kept, frames kept)
+###############################################################################
+def trimWave(filename, startFrame, endFrame):
+    reader = WaveReader(filename)
+    reader.close()
+    frameSize = reader.frameSize
+    dataOffset = reader.getdataoffset()
+    endFrame = min(endFrame, reader.getnframes())
+    with open(filename, 'rb') as fd:
+        head = fd.read(dataOffset)
+    pos = 12
+    while pos < dataOffset - 8:
+        chunkId, chunkSize = struct.unpack('<4sI', head[pos:pos + 8])
+        if chunkId not in TRIM_CHUNKS:
+            raise ValueError("unexpected header layout: %s" % filename)
+        pos += 8 + chunkSize + (chunkSize & 1)
+
+    # move the start forward until the data chunk can begin there: right
+    # after the header, or after a JUNK chunk of an even size
+    while True:
+        keptBytes = max(0, endFrame - startFrame) * frameSize
+        header = makeWaveHeader(reader.nchannels, reader.sampwidth, reader.framerate, reader.formatTag, keptBytes)
+        prefixLen = len(header) - 8
+        start = dataOffset + startFrame * frameSize
+        junkSize = start - prefixLen - 16
+        if start == prefixLen + 8 or (junkSize >= 0 and junkSize % 2 == 0):
+            break
+        startFrame += 1
+    fmtEnd = 20 + struct.unpack('<I', header[16:20])[0]
+    if head[12:fmtEnd] != header[12:fmtEnd]:
+        raise ValueError("unexpected header layout: %s" % filename)
+
+    size = start + keptBytes + (keptBytes & 1)
+    writes = [(0, b'RIFF' + struct.pack('<I', min(size - 8, MAX_SIZE)) + header[8:prefixLen])]
+    if start != prefixLen + 8:
+        writes.append((prefixLen, b'JUNK' + struct.pack('<I', junkSize)))
+    writes.append((start - 8, header[prefixLen:]))
+    if keptBytes & 1:
+        writes.append((start + keptBytes, b'\x00'))
+    journal = {"writes": [[offset, data.hex()] for offset, data in writes], "size": size,
+               "hole": [prefixLen + 8, max(0, junkSize)]}
+    journalName = filename + TRIM_JOURNAL_SUFFIX
+    dataEnd = dataOffset + reader.getnframes() * frameSize
+    journal["sidecar"] = piRecordCheck.trimSidecar(filename, dataOffset, dataEnd, start, start + keptBytes)
+    with open(journalName + ".tmp", "w") as fd:
+        json.dump(journal, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(journalName + ".tmp", journalName)
+    piRecordIO.syncDir(os.path.dirname(filename))
+    completeTrim(filename)
+    return startFrame, keptBytes // frameSize
+
+###############################################################################
+# Function Name:
+#   completeTrim
+# Description:
+#   makes the writes saved in a trim's journal (again, if the trim was
+#   interrupted), then deletes the journal.  The file is locked first, so
+#   it isn't truncated while mapped for playback (see
+#   piRecordPlayback.MappedWave).
+# Parameters:
+#   filename - the wave file
+#   wait - False to leave the journal for later if the file is mapped
+# Return value:
+#   True if there was a journal and the trim was finished
+###############################################################################
+def completeTrim(filename, wait=True):
+    journalName = filename + TRIM_JOURNAL_SUFFIX
+    try:
+        with open(journalName) as fd:
+            journal = json.load(fd)
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # the journal is only renamed into place once written, so a broken
+        # one was never acted on
+        os.remove(journalName)
+        return False
+    if os.path.exists(filename):
+        with open(filename, 'r+b') as fd:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            for offset, data in journal["writes"]:
+                fd.seek(offset)
+                fd.write(bytes.fromhex(data))
+            fd.truncate(journal["size"])
+            fd.flush()
+            os.fsync(fd.fileno())
+            piRecordIO.punchHole(fd.fileno(), journal["hole"][0], journal["hole"][1])
+    if journal.get("sidecar") and os.path.exists(journal["sidecar"]):
+        os.replace(journal["sidecar"], piRecordCheck.getSidecarName(filename))
+    os.remove(journalName)
+    piRecordIO.syncDir(os.path.dirname(filename))
+    return True
+
+###############################################################################
+# Function Name:
+#   recoverTrims
+# Description:
+#   finishes the trims interrupted in a directory, except for files mapped
+#   for playback, which are left for the next time
+# Parameters:
+#   dirName - the directory
+#   skip - function returning True for a file whose trim is still running
+#          (see piRecordUtils.isTrimPending), else None
+# Return value:
+#   list of the files whose trims were finished
+###############################################################################
+def recoverTrims(dirName, skip=None):
+    files = []
+    for name in sorted(os.listdir(dirName)):
+        if name.endswith(TRIM_JOURNAL_SUFFIX):
+            fn = os.path.join(dirName, name[:-len(TRIM_JOURNAL_SUFFIX)])
+            if skip != None and skip(fn):
+                continue
+            if completeTrim(fn, wait=False):
+                files.append(fn)
+    return files